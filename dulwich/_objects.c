@@ -31,7 +31,7 @@ size_t rep_strnlen(char *text, size_t maxlen)
 #define strnlen rep_strnlen
 #endif
 
-static PyObject *tree_entry_cls, *sha1sum_cls;
+static PyObject *tree_entry_cls, *sha1sum_cls, *sha1sum_from_raw;
 static PyObject *object_format_exception_cls;
 
 
@@ -41,7 +41,7 @@ static PyObject *bytes_to_pysha(const unsigned char *sha) {
 		return NULL;
 	}
 
-	PyObject* pysha = PyObject_CallFunctionObjArgs(sha1sum_cls, bytes, NULL);
+	PyObject* pysha = PyObject_CallFunctionObjArgs(sha1sum_from_raw, bytes, NULL);
 	Py_DECREF(bytes);
 	if(pysha == NULL) {
 		return NULL;
@@ -304,5 +304,9 @@ PyObject *PyInit__objects(void) {
 	if (tree_entry_cls == NULL || sha1sum_cls == NULL)
 		return NULL;
 
+	sha1sum_from_raw = PyObject_GetAttrString(sha1sum_cls, "from_raw");
+	if (sha1sum_from_raw == NULL)
+		return NULL;
+
 	return m;
 }
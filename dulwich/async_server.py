@@ -0,0 +1,518 @@
+# async_server.py -- git:// server on top of asyncio
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""git:// server that serves all connections from a single asyncio loop.
+
+The event loop reads the requests of the clients and sends them the output
+of the handlers, so idle and slow clients only cost a little memory. The
+handlers of server.py run in a pool of threads, one request at a time:
+
+* In protocol version 2, the loop reads every command request before a thread
+  handles it, so sessions only hold a thread while a command is handled.
+* Fetches in protocol version 0 and pushes read their input while they are
+  handled, so they hold a thread for the whole session. Only max_sessions of
+  them are handled at once, so that they leave threads for the commands of
+  protocol version 2, and clients that send nothing for idle_timeout seconds
+  are disconnected.
+
+Handlers do not wait for the client to receive their output: output that
+the client has not read yet is kept in memory up to a limit and then in a
+temporary file.
+
+This module needs Python 3.7 or later.
+"""
+
+import asyncio
+import collections
+from concurrent import futures
+import signal
+import socket
+import tempfile
+import threading
+
+from dulwich.errors import (
+    GitProtocolError,
+    HangupException,
+    )
+from dulwich import log_utils
+from dulwich.protocol import (
+    ReceivableProtocol,
+    SIDEBAND_64K_MAX_DATA,
+    TCP_GIT_PORT,
+    _SPECIAL_PKTS,
+    pkt_line,
+    )
+from dulwich.server import (
+    DEFAULT_HANDLERS,
+    DEFAULT_MAX_CONNECTIONS,
+    negotiate_protocol_version,
+    )
+
+logger = log_utils.getLogger(__name__)
+
+# Output of a session that is kept in memory before it is spooled to disk.
+DEFAULT_SPOOL_SIZE = 256 * 1024
+
+# Seconds to wait for a client to send something. Pushes compute the pack
+# before they send it, which can take a while for large ones.
+DEFAULT_IDLE_TIMEOUT = 120
+
+
+class AsyncProtocol(object):
+    """Protocol for reading and writing pkt-lines on asyncio streams.
+
+    This is the counterpart of Protocol for code that runs in an event loop:
+    the read methods are coroutines, and writes are buffered by the stream
+    writer until drain() is awaited.
+    """
+
+    def __init__(self, reader, writer, report_activity=None):
+        self.reader = reader
+        self.writer = writer
+        self.report_activity = report_activity
+
+    async def _read(self, size):
+        try:
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise HangupException()
+        except ConnectionError as e:
+            raise GitProtocolError(e)
+
+    async def read_pkt_line(self):
+        """Read a pkt-line from the remote git process.
+
+        :return: The next string from the stream, without the length prefix,
+            None for a flush-pkt ('0000'), or DELIM_PKT or RESPONSE_END_PKT
+            for the special packets of protocol version 2.
+        """
+        sizestr = await self._read(4)
+        try:
+            size = int(sizestr, 16)
+        except ValueError:
+            raise GitProtocolError('Invalid pkt-line length %r' % sizestr)
+        if self.report_activity:
+            self.report_activity(max(size, 4), 'read')
+        if size < 4:
+            if size == 0:
+                return None
+            try:
+                return _SPECIAL_PKTS[size]
+            except KeyError:
+                raise GitProtocolError('Invalid pkt-line length %d' % size)
+        return await self._read(size - 4)
+
+    async def read_pkt_seq(self):
+        """Read pkt-lines up to but not including the next flush-pkt.
+
+        :return: List with the data of the pkt-lines
+        """
+        pkts = []
+        pkt = await self.read_pkt_line()
+        while pkt:
+            pkts.append(pkt)
+            pkt = await self.read_pkt_line()
+        return pkts
+
+    async def read_cmd(self):
+        """Read a command and some arguments from the git client.
+
+        :return: A tuple of (command, [list of arguments]).
+        """
+        line = await self.read_pkt_line()
+        if not isinstance(line, bytes) or not line.endswith(b'\0'):
+            raise GitProtocolError('Invalid command line %r' % (line,))
+        cmd, _, args = line.partition(b' ')
+        return cmd, args[:-1].split(b'\0')
+
+    def write_pkt_line(self, line):
+        """Queue a pkt-line for sending; see drain().
+
+        :param line: A string containing the data to send, without the length
+            prefix.
+        """
+        line = pkt_line(line)
+        self.writer.write(line)
+        if self.report_activity:
+            self.report_activity(len(line), 'write')
+
+    def write_sideband(self, channel, blob):
+        """Queue multiplexed data for sending; see drain().
+
+        :param channel: An int specifying the channel to write to.
+        :param blob: A blob of data (as a string) to send on this channel.
+        """
+        channel = bytes((channel,))
+        while blob:
+            self.write_pkt_line(channel + blob[:SIDEBAND_64K_MAX_DATA])
+            blob = blob[SIDEBAND_64K_MAX_DATA:]
+
+    async def drain(self):
+        """Wait until the stream writer is ready for more data."""
+        try:
+            await self.writer.drain()
+        except ConnectionError as e:
+            raise GitProtocolError(e)
+
+    def close(self):
+        self.writer.close()
+
+
+class _OutputSpool(object):
+    """Output of a session, written by handler threads and sent by the loop.
+
+    Up to max_memory bytes are kept in memory, and the rest is written to a
+    temporary file, so that writes never wait for the client.
+    """
+
+    def __init__(self, loop, max_memory=DEFAULT_SPOOL_SIZE):
+        self._loop = loop
+        self._max_memory = max_memory
+        self._lock = threading.Lock()
+        self._chunks = collections.deque()
+        self._memory = 0
+        self._file = None
+        self._file_read = 0
+        self._file_written = 0
+        self._closed = False
+        self._error = None
+        self._wakeup_pending = False
+        self._ready = asyncio.Event()
+
+    def _wakeup(self):
+        # Called with the lock held; the sender is woken up at most once
+        # for every time it takes the data.
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+    def write(self, data):
+        """Add data to the output; this may be called from any thread.
+
+        :raise socket.error: if the client went away
+        """
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            if (self._file is None and
+                self._memory + len(data) <= self._max_memory):
+                self._chunks.append(bytes(data))
+                self._memory += len(data)
+            else:
+                if self._file is None:
+                    self._file = tempfile.TemporaryFile()
+                self._file.seek(self._file_written)
+                self._file.write(data)
+                self._file_written += len(data)
+            self._wakeup()
+
+    def close(self):
+        """Mark the end of the output."""
+        with self._lock:
+            self._closed = True
+            self._wakeup()
+
+    def _take(self):
+        """Take the oldest output that was not sent yet.
+
+        :return: The data, b'' if there is none, or None if there is none
+            and the output was closed
+        """
+        with self._lock:
+            self._wakeup_pending = False
+            if self._chunks:
+                data = b''.join(self._chunks)
+                self._chunks.clear()
+                self._memory = 0
+                return data
+            if self._file is not None:
+                self._file.seek(self._file_read)
+                data = self._file.read(self._max_memory)
+                self._file_read += len(data)
+                if self._file_read == self._file_written:
+                    self._file.close()
+                    self._file = None
+                    self._file_read = self._file_written = 0
+                return data
+            if self._closed:
+                return None
+            return b''
+
+    def _discard(self, error):
+        with self._lock:
+            self._error = error
+            self._chunks.clear()
+            self._memory = 0
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    async def send(self, writer):
+        """Send the output to a stream writer until it is closed."""
+        while True:
+            data = self._take()
+            if data is None:
+                return
+            if not data:
+                await self._ready.wait()
+                self._ready.clear()
+                continue
+            writer.write(data)
+            try:
+                await writer.drain()
+            except ConnectionError as e:
+                self._discard(e)
+                return
+
+
+class _SessionInput(object):
+    """Input of a handler thread.
+
+    The thread first reads the data that the loop read ahead for it, and
+    then waits for the loop to read more from the client.
+    """
+
+    def __init__(self, loop, reader, timeout=None):
+        self._loop = loop
+        self._reader = reader
+        self._timeout = timeout
+        self._buf = bytearray()
+
+    def feed(self, data):
+        """Add data read ahead by the loop."""
+        self._buf.extend(data)
+
+    def recv(self, size):
+        """Read up to size bytes, like socket.recv."""
+        if self._buf:
+            data = bytes(self._buf[:size])
+            del self._buf[:size]
+            return data
+        future = asyncio.run_coroutine_threadsafe(self._reader.read(size),
+                                                  self._loop)
+        try:
+            return future.result(self._timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            raise socket.timeout('timed out')
+
+
+async def _read_raw_request_v2(aproto):
+    """Read the pkt-lines of a command request of protocol version 2.
+
+    :return: The request as it was sent, up to and including the flush-pkt
+        that ends it, or None if the client closed the connection
+    """
+    pkts = []
+    try:
+        while True:
+            pkt = await aproto.read_pkt_line()
+            pkts.append(pkt_line(pkt))
+            if pkt is None:
+                return b''.join(pkts)
+    except HangupException:
+        if pkts:
+            raise
+        return None
+
+
+class AsyncTCPGitServer(object):
+    """git:// server that handles all connections from a single event loop.
+
+    At most max_workers requests are handled at once, by a pool of threads
+    that is created when the server starts.
+    """
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT,
+                 handlers=None, max_workers=DEFAULT_MAX_CONNECTIONS,
+                 max_sessions=None, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 spool_size=DEFAULT_SPOOL_SIZE):
+        """Create a new AsyncTCPGitServer.
+
+        :param backend: Backend to serve repositories from
+        :param listen_addr: Address to listen on
+        :param port: Port to listen on; 0 to pick a free port
+        :param handlers: Dictionary with handler classes for git services,
+            in addition to DEFAULT_HANDLERS
+        :param max_workers: Maximum number of requests to handle at once
+        :param max_sessions: Maximum number of fetches in protocol version 0
+            and pushes to handle at once. These hold a thread while they wait
+            for the client, so this defaults to three quarters of
+            max_workers, leaving the other threads to protocol version 2.
+        :param idle_timeout: Seconds to wait for a client to send something
+            before closing its connection, or None to wait forever
+        :param spool_size: Bytes of output per connection to keep in memory
+            while the client is not reading it
+        """
+        self.handlers = dict(DEFAULT_HANDLERS)
+        if handlers is not None:
+            self.handlers.update(handlers)
+        self.backend = backend
+        self.listen_addr = listen_addr
+        self.port = port
+        self.max_workers = max_workers
+        if max_sessions is None:
+            max_sessions = max(1, max_workers * 3 // 4)
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.spool_size = spool_size
+        self._server = None
+        self._executor = None
+        self._session_slots = None
+        self._closing = False
+        self._sessions = set()
+        self._idle = set()
+
+    @property
+    def server_address(self):
+        """Address and port the server listens on, once it is started."""
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def start(self):
+        """Start listening for connections."""
+        self._executor = futures.ThreadPoolExecutor(self.max_workers)
+        self._session_slots = asyncio.Semaphore(self.max_sessions)
+        self._server = await asyncio.start_server(
+          self._handle_connection, self.listen_addr, self.port)
+        logger.info('Listening for TCP connections on %s:%d',
+                    *self.server_address)
+
+    async def serve_forever(self):
+        """Handle connections until the task is cancelled."""
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    async def close(self):
+        """Stop the server.
+
+        Connections that wait for a request are closed, and requests that
+        are being handled are finished first.
+        """
+        self._closing = True
+        self._server.close()
+        for task in self._idle:
+            task.cancel()
+        if self._sessions:
+            await asyncio.wait(self._sessions)
+        await self._server.wait_closed()
+        self._executor.shutdown()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _wait_idle(self, aw):
+        # While a session waits for the client, the server may close it.
+        if self._closing:
+            raise HangupException()
+        task = asyncio.current_task()
+        self._idle.add(task)
+        try:
+            return await asyncio.wait_for(aw, self.idle_timeout)
+        finally:
+            self._idle.discard(task)
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._sessions.add(task)
+        peer = writer.get_extra_info('peername')
+        logger.info('Handling request from %s', peer)
+        loop = asyncio.get_running_loop()
+        spool = _OutputSpool(loop, self.spool_size)
+        sender = loop.create_task(spool.send(writer))
+        try:
+            await self._handle_session(AsyncProtocol(reader, writer), spool)
+        except (HangupException, asyncio.TimeoutError,
+                asyncio.CancelledError):
+            logger.info('Closing connection from %s', peer)
+        except Exception:
+            logger.exception('Exception happened during processing of '
+                             'request from %s', peer)
+        finally:
+            spool.close()
+            try:
+                await sender
+            finally:
+                writer.close()
+                self._sessions.discard(task)
+
+    async def _handle_session(self, aproto, spool):
+        command, args = await self._wait_idle(aproto.read_cmd())
+        logger.info('Handling %s request, args="%s"',
+                    command.decode('utf-8', 'replace'),
+                    ', '.join(arg.decode('utf-8', 'replace') for arg in args))
+        cls = self.handlers.get(command, None)
+        if not callable(cls):
+            raise GitProtocolError('Invalid service %s' %
+                                   command.decode('utf-8', 'replace'))
+        # Extra parameters follow the host after an empty argument.
+        params = []
+        if b'' in args:
+            params = args[args.index(b'') + 1:]
+        kwargs = negotiate_protocol_version(cls, params)
+
+        session_input = _SessionInput(asyncio.get_running_loop(),
+                                      aproto.reader, self.idle_timeout)
+        proto = ReceivableProtocol(session_input.recv, spool.write, None)
+        handler = await self._run(
+          lambda: cls(self.backend, args, proto, **kwargs))
+        try:
+            if (getattr(handler, 'protocol_version', 0) == 2 and
+                hasattr(handler, 'handle_request_v2')):
+                handler.advertise_capabilities_v2()
+                while True:
+                    request = await self._wait_idle(
+                      _read_raw_request_v2(aproto))
+                    if request is None:
+                        break
+                    session_input.feed(request)
+                    if not await self._run(handler.handle_request_v2):
+                        break
+            else:
+                # The client waits for a slot on the loop rather than in a
+                # thread, and for at most idle_timeout seconds.
+                await self._wait_idle(self._session_slots.acquire())
+                try:
+                    await self._run(handler.handle)
+                finally:
+                    self._session_slots.release()
+        finally:
+            await self._run(handler.close)
+        logger.info('Finished handling request')
+
+
+def serve_async(backend, listen_addr, port=TCP_GIT_PORT, **kwargs):
+    """Run an AsyncTCPGitServer until SIGINT or SIGTERM.
+
+    The requests that are being handled are finished before this returns.
+
+    :param backend: Backend to serve repositories from
+    :param listen_addr: Address to listen on
+    :param port: Port to listen on
+    :param kwargs: Further arguments for AsyncTCPGitServer
+    """
+    async def run():
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        server = AsyncTCPGitServer(backend, listen_addr, port, **kwargs)
+        await server.start()
+        await stop.wait()
+        await server.close()
+    asyncio.run(run())
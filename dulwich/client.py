@@ -22,6 +22,7 @@
 __docformat__ = 'restructuredText'
 
 from io import BytesIO
+import os
 import select
 import socket
 import subprocess
@@ -36,8 +37,10 @@ from dulwich.errors import (
     )
 from dulwich.protocol import (
     _RBUFSIZE,
+    DELIM_PKT,
     PktLineParser,
     Protocol,
+    ReceivableProtocol,
     TCP_GIT_PORT,
     ZERO_SHA,
     extract_capabilities,
@@ -63,6 +66,23 @@ COMMON_CAPABILITIES = [b'ofs-delta', b'side-band-64k']
 FETCH_CAPABILITIES = [b'multi_ack', b'multi_ack_detailed'] + COMMON_CAPABILITIES
 SEND_CAPABILITIES = [b'report-status'] + COMMON_CAPABILITIES
 
+# Number of haves sent in the first round of a protocol version 2 fetch; it
+# doubles with every round in which the server is not ready yet.
+_INITIAL_HAVES_V2 = 16
+
+
+def _filter_refs(refs, ref_prefix):
+    """Keep the refs whose names start with one of a list of prefixes.
+
+    :param refs: Dictionary mapping ref names to SHAs
+    :param ref_prefix: List of prefixes, or None to keep all refs
+    :return: Dictionary with the matching refs
+    """
+    if ref_prefix is None:
+        return refs
+    return dict((name, sha) for (name, sha) in refs.items()
+                if any(name.startswith(prefix) for prefix in ref_prefix))
+
 
 class ReportStatusParser(object):
     """Handle status as reported by servers with the 'report-status' capability.
@@ -130,14 +150,19 @@ class GitClient(object):
 
     """
 
-    def __init__(self, thin_packs=True, report_activity=None):
+    def __init__(self, thin_packs=True, report_activity=None,
+                 protocol_version=0):
         """Create a new GitClient instance.
 
         :param thin_packs: Whether or not thin packs should be retrieved
         :param report_activity: Optional callback for reporting transport
             activity.
+        :param protocol_version: Version of the git protocol to ask servers
+            for when fetching, 0 or 2. Servers that do not support the
+            version asked for answer in version 0.
         """
         self._report_activity = report_activity
+        self.protocol_version = protocol_version
         self._fetch_capabilities = list(FETCH_CAPABILITIES)
         self._send_capabilities = list(SEND_CAPABILITIES)
         if thin_packs:
@@ -156,6 +181,31 @@ class GitClient(object):
             refs[ref] = Sha1Sum(sha)
         return refs, server_capabilities
 
+    def _get_protocol_version(self, service):
+        """Return the protocol version to ask for when connecting.
+
+        :param service: Name of the service, with or without git- prefix
+        :return: The protocol version; only upload-pack has a version 2
+        """
+        if service in ('upload-pack', 'git-upload-pack'):
+            return self.protocol_version
+        return 0
+
+    def _read_advertisement(self, proto):
+        """Read what an upload-pack server sends when a client connects.
+
+        :param proto: Protocol object to read from
+        :return: Tuple with the protocol version of the server, the refs it
+            advertised (None for version 2, where refs are listed with the
+            ls-refs command) and the server capabilities
+        """
+        pkt = proto.read_pkt_line()
+        if pkt == b'version 2\n':
+            return 2, None, [c.rstrip(b'\n') for c in proto.read_pkt_seq()]
+        proto.unread_pkt_line(pkt)
+        refs, server_capabilities = self._read_refs(proto)
+        return 0, refs, server_capabilities
+
     def send_pack(self, path, determine_wants, generate_pack_contents,
                   progress=None):
         """Upload a pack to a remote repository.
@@ -171,7 +221,8 @@ class GitClient(object):
         """
         raise NotImplementedError(self.send_pack)
 
-    def fetch(self, path, target, determine_wants=None, progress=None):
+    def fetch(self, path, target, determine_wants=None, progress=None,
+              depth=None, filter_spec=None, ref_prefix=None):
         """Fetch into a target repository.
 
         :param path: Path to fetch from
@@ -179,27 +230,52 @@ class GitClient(object):
         :param determine_wants: Optional function to determine what refs
             to fetch
         :param progress: Optional progress function
+        :param depth: Optional number of commits to fetch along each path
+            from the wanted refs; the commits at that depth are recorded as
+            shallow in the target
+        :param filter_spec: Optional filter spec, such as b'blob:none', for
+            the objects the server should leave out of the pack
+        :param ref_prefix: Optional list of prefixes, such as
+            [b'refs/heads/'], of the names of the refs to fetch
         :return: remote refs
         """
         if determine_wants is None:
             determine_wants = target.object_store.determine_wants_all
+        graph_walker = target.get_graph_walker()
         f, commit = target.object_store.add_pack()
         try:
-            return self.fetch_pack(path, determine_wants,
-                target.get_graph_walker(), f.write, progress)
+            refs = self.fetch_pack(path, determine_wants, graph_walker,
+                f.write, progress, depth=depth, filter_spec=filter_spec,
+                ref_prefix=ref_prefix)
         finally:
             pack = commit()
             if pack and hasattr(pack, 'close'):
                 pack.close()
+        if (getattr(graph_walker, 'new_shallow', None) or
+            getattr(graph_walker, 'new_unshallow', None)):
+            target.update_shallow(graph_walker.new_shallow,
+                                  graph_walker.new_unshallow)
+        if refs and hasattr(target, 'update_commit_graph'):
+            target.update_commit_graph(refs.values())
+        return refs
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress):
+                   progress, depth=None, filter_spec=None, ref_prefix=None):
         """Retrieve a pack from a git smart server.
 
         :param determine_wants: Callback that returns list of commits to fetch
-        :param graph_walker: Object with next() and ack().
+        :param graph_walker: Object with next() and ack(). If it has a
+            shallow attribute, the commits in it are reported as shallow to
+            the server, and changes to them are passed to its
+            update_shallow() method.
         :param pack_data: Callback called for each bit of data in the pack
         :param progress: Callback for progress reports (strings)
+        :param depth: Optional depth to limit the fetched history to
+        :param filter_spec: Optional filter spec for the objects to leave out
+        :param ref_prefix: Optional list of prefixes of the names of the refs
+            to pass to determine_wants and return. Protocol version 2 servers
+            only list the matching refs; with older servers, the refs are
+            filtered by the client.
         """
         raise NotImplementedError(self.fetch_pack)
 
@@ -319,8 +395,62 @@ class GitClient(object):
         if data:
             raise SendPackError('Unexpected response %r' % data)
 
+    def _check_shallow_capability(self, server_capabilities, graph_walker,
+                                  depth):
+        """Check that the server can send what a shallow fetch needs.
+
+        :return: Whether the shallow capability should be requested
+        :raise GitProtocolError: if the server does not support shallow
+            fetches, but one is needed
+        """
+        if depth is None and not getattr(graph_walker, 'shallow', None):
+            return False
+        if b'shallow' not in server_capabilities:
+            if depth is not None:
+                raise GitProtocolError(
+                  'server does not support shallow capability required for '
+                  'depth')
+            return False
+        return True
+
+    def _check_filter_capability(self, server_capabilities, filter_spec):
+        """Check that the server can filter the objects it sends.
+
+        :return: Whether the filter capability should be requested
+        :raise GitProtocolError: if the server does not support filters, but
+            one is needed
+        """
+        if filter_spec is None:
+            return False
+        if b'filter' not in server_capabilities:
+            raise GitProtocolError(
+              'server does not support filter capability required for '
+              'filter_spec')
+        return True
+
+    def _handle_shallow_updates(self, pkts, graph_walker):
+        """Handle the commits that the server made shallow or unshallow.
+
+        :param pkts: Iterable of the shallow and unshallow pkt-lines sent by
+            the server
+        :param graph_walker: GraphWalker instance to call .update_shallow() on
+        """
+        new_shallow = set()
+        new_unshallow = set()
+        for pkt in pkts:
+            cmd, sha = pkt.rstrip(b'\n').split(b' ', 1)
+            if cmd == b'shallow':
+                new_shallow.add(Sha1Sum(sha))
+            elif cmd == b'unshallow':
+                new_unshallow.add(Sha1Sum(sha))
+            else:
+                raise GitProtocolError('unknown command %r' % pkt)
+        if hasattr(graph_walker, 'update_shallow'):
+            graph_walker.update_shallow(new_shallow, new_unshallow)
+
     def _handle_upload_pack_head(self, proto, capabilities, graph_walker,
-                                 wants, can_read):
+                                 wants, can_read, depth=None,
+                                 filter_spec=None):
         """Handle the head of a 'git-upload-pack' request.
 
         :param proto: Protocol object to read from
@@ -328,18 +458,31 @@ class GitClient(object):
         :param graph_walker: GraphWalker instance to call .ack() on
         :param wants: List of commits to fetch
         :param can_read: function that returns a boolean that indicates
-            whether there is extra graph data to read on proto
+            whether there is extra graph data to read on proto, or None if
+            the response is only read once the request is complete
+        :param depth: Optional depth to limit the fetched history to
+        :param filter_spec: Optional filter spec for the objects to leave out
         """
 
         proto.write_pkt_line(b'want ' + wants[0].hex_bytes + b' ' +
                              b' '.join(capabilities) + b'\n')
         for want in wants[1:]:
             proto.write_pkt_line(b'want ' + want.hex_bytes + b'\n')
+        if b'shallow' in capabilities:
+            for sha in sorted(getattr(graph_walker, 'shallow', None) or []):
+                proto.write_pkt_line(b'shallow ' + sha.hex_bytes + b'\n')
+            if depth is not None:
+                proto.write_pkt_line(b'deepen ' + str(depth).encode('ascii')
+                                     + b'\n')
+        if filter_spec is not None:
+            proto.write_pkt_line(b'filter ' + filter_spec + b'\n')
         proto.write_pkt_line(None)
+        if depth is not None and can_read is not None:
+            self._handle_shallow_updates(proto.read_pkt_seq(), graph_walker)
         have = next(graph_walker)
         while have:
             proto.write_pkt_line(b'have ' + have.hex_bytes + b'\n')
-            if can_read():
+            if can_read is not None and can_read():
                 pkt = proto.read_pkt_line()
                 parts = pkt.rstrip(b'\n').split(b' ')
                 if parts[0] == b'ACK':
@@ -388,6 +531,145 @@ class GitClient(object):
                     break
                 pack_data(data)
 
+    def _get_v2_features(self, server_capabilities, command):
+        """Find the features a protocol version 2 server has for a command.
+
+        :param server_capabilities: Capabilities advertised by the server
+        :param command: Name of the command
+        :return: List of features, such as b'shallow' for fetch
+        :raise GitProtocolError: if the server does not support the command
+        """
+        for capability in server_capabilities:
+            name, _, features = capability.partition(b'=')
+            if name == command:
+                return features.split()
+        raise GitProtocolError('server does not support the %s command' %
+                               command.decode('ascii'))
+
+    def _read_section_v2(self, proto):
+        """Read the lines of a section of a protocol version 2 response.
+
+        :param proto: Protocol object to read from
+        :return: Tuple with the list of lines, and whether another section
+            follows
+        """
+        lines = []
+        pkt = proto.read_pkt_line()
+        while pkt is not None and pkt is not DELIM_PKT:
+            lines.append(pkt)
+            pkt = proto.read_pkt_line()
+        return lines, pkt is DELIM_PKT
+
+    def _ls_refs_v2(self, request, server_capabilities, ref_prefix=None):
+        """List refs with the ls-refs command of protocol version 2.
+
+        :param request: Function that sends a list of pkt-lines to the server
+            and returns a Protocol object to read the response from
+        :param server_capabilities: Capabilities advertised by the server
+        :param ref_prefix: Optional list of prefixes of the refs to list
+        :return: Dictionary mapping ref names to SHAs. Like in version 0,
+            peeled tags have an extra entry with ^{} appended to the name.
+        """
+        self._get_v2_features(server_capabilities, b'ls-refs')
+        pkts = [b'command=ls-refs\n', DELIM_PKT, b'peel\n']
+        for prefix in ref_prefix or []:
+            pkts.append(b'ref-prefix ' + prefix + b'\n')
+        proto = request(pkts + [None])
+        refs = {}
+        for pkt in proto.read_pkt_seq():
+            fields = pkt.rstrip(b'\n').split(b' ')
+            if fields[0] == b'ERR':
+                raise GitProtocolError(b' '.join(fields[1:]))
+            (sha, name) = fields[:2]
+            refs[name] = Sha1Sum(sha)
+            for attribute in fields[2:]:
+                if attribute.startswith(b'peeled:'):
+                    refs[name + b'^{}'] = Sha1Sum(attribute[len(b'peeled:'):])
+        return refs
+
+    def _fetch_v2(self, request, server_capabilities, graph_walker, wants,
+                  pack_data, progress, depth=None, filter_spec=None):
+        """Retrieve a pack with the fetch command of protocol version 2.
+
+        The server does not remember anything between fetch requests, so
+        each round of negotiation repeats the wants and the haves the server
+        found in common, followed by more haves than the previous round,
+        until the server is ready or the graph walker runs out of commits.
+
+        :param request: Function that sends a list of pkt-lines to the server
+            and returns a Protocol object to read the response from
+        :param server_capabilities: Capabilities advertised by the server
+        :param graph_walker: GraphWalker instance to call .ack() on
+        :param wants: List of commits to fetch
+        :param pack_data: Function to call with pack data
+        :param progress: Optional progress reporting function
+        :param depth: Optional depth to limit the fetched history to
+        :param filter_spec: Optional filter spec for the objects to leave out
+        """
+        features = self._get_v2_features(server_capabilities, b'fetch')
+        args = [b'ofs-delta\n']
+        if b'thin-pack' in self._fetch_capabilities:
+            args.append(b'thin-pack\n')
+        if progress is None:
+            args.append(b'no-progress\n')
+        for want in wants:
+            args.append(b'want ' + want.hex_bytes + b'\n')
+        if self._check_shallow_capability(features, graph_walker, depth):
+            for sha in sorted(getattr(graph_walker, 'shallow', None) or []):
+                args.append(b'shallow ' + sha.hex_bytes + b'\n')
+            if depth is not None:
+                args.append(b'deepen ' + str(depth).encode('ascii') + b'\n')
+        if self._check_filter_capability(features, filter_spec):
+            args.append(b'filter ' + filter_spec + b'\n')
+
+        common = []
+        count = _INITIAL_HAVES_V2
+        while True:
+            haves = []
+            while len(haves) < count:
+                have = next(graph_walker)
+                if not have:
+                    break
+                haves.append(have)
+            done = len(haves) < count
+            pkts = [b'command=fetch\n', DELIM_PKT] + args
+            for have in common + haves:
+                pkts.append(b'have ' + have.hex_bytes + b'\n')
+            if done:
+                pkts.append(b'done\n')
+            proto = request(pkts + [None])
+            if done:
+                break
+            pkt = proto.read_pkt_line()
+            if pkt != b'acknowledgments\n':
+                raise GitProtocolError('unexpected section %r' % pkt)
+            lines, more = self._read_section_v2(proto)
+            for line in lines:
+                parts = line.rstrip(b'\n').split(b' ')
+                if parts[0] == b'ACK':
+                    sha = Sha1Sum(parts[1])
+                    graph_walker.ack(sha)
+                    common.append(sha)
+            if more:
+                # The server is ready, and the pack follows.
+                break
+            count *= 2
+
+        pkt = proto.read_pkt_line()
+        while pkt is not None:
+            section = pkt.rstrip(b'\n')
+            if section == b'packfile':
+                self._read_side_band64k_data(proto,
+                                             {1: pack_data, 2: progress})
+                return
+            lines, more = self._read_section_v2(proto)
+            if section == b'shallow-info':
+                self._handle_shallow_updates(lines, graph_walker)
+            if not more:
+                break
+            pkt = proto.read_pkt_line()
+        raise GitProtocolError('server did not send a pack')
+
     def __enter__(self):
         return self
 
@@ -450,24 +732,51 @@ class TraditionalGitClient(GitClient):
         return new_refs
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress=None):
+                   progress=None, depth=None, filter_spec=None,
+                   ref_prefix=None):
         """Retrieve a pack from a git smart server.
 
         :param determine_wants: Callback that returns list of commits to fetch
         :param graph_walker: Object with next() and ack().
         :param pack_data: Callback called for each bit of data in the pack
         :param progress: Callback for progress reports (strings)
+        :param depth: Optional depth to limit the fetched history to
+        :param filter_spec: Optional filter spec for the objects to leave out
+        :param ref_prefix: Optional list of prefixes of the refs to fetch
         """
         proto, can_read = self._connect('upload-pack', path)
         with proto:
-            (refs, server_capabilities) = self._read_refs(proto)
+            (version, refs, server_capabilities) = self._read_advertisement(
+                proto)
+            if version == 2:
+                def request(pkts):
+                    for pkt in pkts:
+                        proto.write_pkt_line(pkt)
+                    return proto
+                refs = self._ls_refs_v2(request, server_capabilities,
+                                        ref_prefix)
+                wants = determine_wants(refs)
+                if wants:
+                    self._fetch_v2(request, server_capabilities,
+                        graph_walker, wants, pack_data, progress,
+                        depth=depth, filter_spec=filter_spec)
+                proto.write_pkt_line(None)
+                return refs
+            refs = _filter_refs(refs, ref_prefix)
             negotiated_capabilities = list(self._fetch_capabilities)
             wants = determine_wants(refs)
             if not wants:
                 proto.write_pkt_line(None)
                 return refs
+            if self._check_shallow_capability(server_capabilities,
+                                              graph_walker, depth):
+                negotiated_capabilities.append(b'shallow')
+            if self._check_filter_capability(server_capabilities,
+                                             filter_spec):
+                negotiated_capabilities.append(b'filter')
             self._handle_upload_pack_head(proto, negotiated_capabilities,
-                graph_walker, wants, can_read)
+                graph_walker, wants, can_read, depth=depth,
+                filter_spec=filter_spec)
             self._handle_upload_pack_tail(proto, negotiated_capabilities,
                 graph_walker, pack_data, progress)
         return refs
@@ -509,12 +818,21 @@ class TCPGitClient(TraditionalGitClient):
             wfile.close()
             s.close()
 
-        proto = Protocol(rfile.read, wfile.write, _closeit,
-                         report_activity=self._report_activity)
+        # read1 returns the data that is available, like recv, so that
+        # pkt-lines are parsed several at a time.
+        proto = ReceivableProtocol(rfile.read1, wfile.write, _closeit,
+                                   report_activity=self._report_activity)
         if path.startswith("/~"):
             path = path[1:]
-        proto.send_cmd(b'git-' + cmd.encode('utf-8'), path.encode('utf-8'), b'host=' + self._host.encode('utf-8'))
-        return proto, lambda: _fileno_can_read(s)
+        params = [b'host=' + self._host.encode('utf-8')]
+        version = self._get_protocol_version(cmd)
+        if version:
+            # Extra parameters follow the host after an empty parameter.
+            params.extend([b'', ('version=%d' % version).encode('ascii')])
+        proto.send_cmd(b'git-' + cmd.encode('utf-8'), path.encode('utf-8'),
+                       *params)
+        return proto, lambda: (proto.has_buffered_data() or
+                               _fileno_can_read(s))
 
     def close(self):
         pass
@@ -559,29 +877,42 @@ class SubprocessGitClient(TraditionalGitClient):
     def _connect(self, service, path):
         import subprocess
         argv = ['git', service, path]
+        env = None
+        version = self._get_protocol_version(service)
+        if version:
+            env = dict(os.environ, GIT_PROTOCOL='version=%d' % version)
         p = SubprocessWrapper(
             subprocess.Popen(argv, bufsize=0, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE))
-        return Protocol(p.read, p.write, p.close,
-                        report_activity=self._report_activity), p.can_read
+                             stdout=subprocess.PIPE, env=env))
+        # The pipe is unbuffered, so reads return the data that is available.
+        proto = ReceivableProtocol(p.read, p.write, p.close,
+                                   report_activity=self._report_activity)
+        return proto, lambda: proto.has_buffered_data() or p.can_read()
 
     def close(self):
         pass
 
 class SSHVendor(object):
 
-    def connect_ssh(self, host, command, username=None, port=None):
+    def connect_ssh(self, host, command, username=None, port=None,
+                    protocol_version=None):
         import subprocess
         #FIXME: This has no way to deal with passwords..
         args = ['ssh', '-x']
+        env = None
         if port is not None:
             args.extend(['-p', str(port)])
+        if protocol_version:
+            # The server only sees the variable if its sshd accepts it.
+            args.extend(['-o', 'SendEnv=GIT_PROTOCOL'])
+            env = dict(os.environ,
+                       GIT_PROTOCOL='version=%d' % protocol_version)
         if username is not None:
             host = '%s@%s' % (username, host)
         args.append(host)
         proc = subprocess.Popen(args + command,
                                 stdin=subprocess.PIPE,
-                                stdout=subprocess.PIPE)
+                                stdout=subprocess.PIPE, env=env)
         return SubprocessWrapper(proc)
 
 # Can be overridden by users
@@ -600,9 +931,14 @@ class SSHGitClient(TraditionalGitClient):
         return self.alternative_paths.get(cmd, 'git-%s' % cmd)
 
     def _connect(self, cmd, path):
+        kwargs = {}
+        version = self._get_protocol_version(cmd)
+        if version:
+            # Only passed when needed, so older vendors keep working.
+            kwargs['protocol_version'] = version
         con = get_ssh_vendor().connect_ssh(
             self.host, ["%s '%s'" % (self._get_cmd_path(cmd), path)],
-            port=self.port, username=self.username)
+            port=self.port, username=self.username, **kwargs)
         return (Protocol(con.read, con.write, con.close,
                 report_activity=self._report_activity),
                 con.can_read)
@@ -630,13 +966,26 @@ class HttpGitClient(GitClient):
         """
         return urllib.request.urlopen(req)
 
+    def _get_headers(self, service):
+        """Return the headers to send with a request for a service."""
+        headers = {"Content-Type": "application/x-%s-request" % service}
+        version = self._get_protocol_version(service)
+        if version:
+            headers["Git-Protocol"] = "version=%d" % version
+        return headers
+
     def _discover_references(self, service, url):
+        """Retrieve the refs and capabilities of a service.
+
+        :return: Tuple with the protocol version of the server, the refs it
+            advertised (None for version 2) and its capabilities
+        """
         assert url[-1] == "/"
         url = urllib.parse.urljoin(url, "info/refs")
         headers = {}
-        if self.dumb != False:
+        if self.dumb is not True:
             url += "?service=%s" % service
-            headers["Content-Type"] = "application/x-%s-request" % service
+            headers = self._get_headers(service)
         req = urllib.request.Request(url, headers=headers)
         resp = self._perform(req)
         if resp.getcode() == 404:
@@ -647,18 +996,23 @@ class HttpGitClient(GitClient):
         self.dumb = (not resp.info().get_content_type().startswith("application/x-git-"))
         proto = Protocol(resp.read, None, resp.close)
         if not self.dumb:
+            pkt = proto.read_pkt_line()
+            if pkt == b'version 2\n':
+                # Version 2 servers do not mention the service.
+                proto.unread_pkt_line(pkt)
+                return self._read_advertisement(proto)
             # The first line should mention the service
-            pkts = list(proto.read_pkt_seq())
+            pkts = [pkt] + list(proto.read_pkt_seq())
             if pkts != [(('# service=%s\n' % service).encode('utf-8'))]:
                 raise GitProtocolError(
                     "unexpected first line %r from smart server" % pkts)
-        return self._read_refs(proto)
+        refs, server_capabilities = self._read_refs(proto)
+        return 0, refs, server_capabilities
 
     def _smart_request(self, service, url, data):
         assert url[-1] == "/"
         url = urllib.parse.urljoin(url, service)
-        req = urllib.request.Request(url,
-            headers={"Content-Type": "application/x-%s-request" % service},
+        req = urllib.request.Request(url, headers=self._get_headers(service),
             data=data)
         resp = self._perform(req)
         if resp.getcode() == 404:
@@ -685,8 +1039,8 @@ class HttpGitClient(GitClient):
                                  and rejects ref updates
         """
         url = self._get_url(path)
-        old_refs, server_capabilities = self._discover_references(
-            "git-receive-pack", url)
+        unused_version, old_refs, server_capabilities = (
+            self._discover_references("git-receive-pack", url))
         negotiated_capabilities = list(self._send_capabilities)
         new_refs = determine_wants(old_refs)
         if new_refs is None:
@@ -710,31 +1064,61 @@ class HttpGitClient(GitClient):
         return new_refs
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress):
+                   progress, depth=None, filter_spec=None, ref_prefix=None):
         """Retrieve a pack from a git smart server.
 
         :param determine_wants: Callback that returns list of commits to fetch
         :param graph_walker: Object with next() and ack().
         :param pack_data: Callback called for each bit of data in the pack
         :param progress: Callback for progress reports (strings)
+        :param depth: Optional depth to limit the fetched history to
+        :param filter_spec: Optional filter spec for the objects to leave out
+        :param ref_prefix: Optional list of prefixes of the refs to fetch
         """
         url = self._get_url(path)
-        refs, server_capabilities = self._discover_references(
+        version, refs, server_capabilities = self._discover_references(
             "git-upload-pack", url)
-        negotiated_capabilities = list(server_capabilities)
+        if version == 2:
+            def request(pkts):
+                req_data = BytesIO()
+                req_proto = Protocol(None, req_data.write, None)
+                for pkt in pkts:
+                    req_proto.write_pkt_line(pkt)
+                resp = self._smart_request("git-upload-pack", url,
+                    data=req_data.getvalue())
+                return Protocol(resp.read, None, resp.close)
+            refs = self._ls_refs_v2(request, server_capabilities, ref_prefix)
+            wants = determine_wants(refs)
+            if wants:
+                self._fetch_v2(request, server_capabilities, graph_walker,
+                    wants, pack_data, progress, depth=depth,
+                    filter_spec=filter_spec)
+            return refs
+        refs = _filter_refs(refs, ref_prefix)
+        negotiated_capabilities = [
+            c for c in self._fetch_capabilities if c in server_capabilities]
         wants = determine_wants(refs)
         if not wants:
             return refs
         if self.dumb:
             raise NotImplementedError(self.send_pack)
+        if self._check_shallow_capability(server_capabilities,
+                                          graph_walker, depth):
+            negotiated_capabilities.append(b'shallow')
+        if self._check_filter_capability(server_capabilities,
+                                         filter_spec):
+            negotiated_capabilities.append(b'filter')
         req_data = BytesIO()
         with Protocol(None, req_data.write, req_data.close) as req_proto:
             self._handle_upload_pack_head(req_proto,
-                negotiated_capabilities, graph_walker, wants,
-                lambda: False)
+                negotiated_capabilities, graph_walker, wants, None,
+                depth=depth, filter_spec=filter_spec)
             resp = self._smart_request("git-upload-pack", url,
                 data=req_data.getvalue())
             with Protocol(resp.read, None, resp.close) as resp_proto:
+                if depth is not None:
+                    self._handle_shallow_updates(resp_proto.read_pkt_seq(),
+                                                 graph_walker)
                 self._handle_upload_pack_tail(resp_proto, negotiated_capabilities,
                     graph_walker, pack_data, progress)
         return refs
@@ -0,0 +1,865 @@
+# commit_graph.py -- Reading and writing commit-graph files.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# or (at your option) a later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Reading and writing commit-graph files.
+
+A commit-graph file lists commits sorted by SHA, with for each commit its root
+tree, the positions of its parents in the file, its commit time and its
+generation number. Traversals that only need the shape of the history can use
+it instead of inflating and parsing commit objects.
+
+A commit-graph can also store a Bloom filter for each commit, with the paths
+changed relative to its first parent. Path-limited walks use these to skip
+commits that certainly do not touch the paths they are interested in.
+
+A commit graph can be split into a chain of layers, each in its own file and
+holding only the commits that were added after the layers below it were
+written. New commits can then be added by writing a small layer, rather than
+rewriting the whole graph.
+
+The format is the one used by C git for objects/info/commit-graph and for the
+layers in objects/info/commit-graphs.
+"""
+
+import errno
+import hashlib
+import os
+import struct
+from struct import unpack_from
+
+from dulwich.diff_tree import (
+    tree_changes,
+    )
+from dulwich.errors import (
+    ChecksumMismatch,
+    FileFormatException,
+    )
+from dulwich.file import GitFile
+from dulwich.objects import (
+    Commit,
+    Tag,
+    Sha1Sum,
+    _as_sha,
+    )
+from dulwich.pack import (
+    SHA1Writer,
+    _load_file_contents,
+    bisect_find_sha,
+    )
+
+COMMIT_GRAPH_SIGNATURE = b'CGPH'
+COMMIT_GRAPH_VERSION = 1
+COMMIT_GRAPH_HASH_VERSION = 1
+
+CHUNK_OID_FANOUT = b'OIDF'
+CHUNK_OID_LOOKUP = b'OIDL'
+CHUNK_COMMIT_DATA = b'CDAT'
+CHUNK_EXTRA_EDGES = b'EDGE'
+CHUNK_BLOOM_INDEXES = b'BIDX'
+CHUNK_BLOOM_DATA = b'BDAT'
+CHUNK_BASE_GRAPHS = b'BASE'
+
+COMMIT_GRAPH_CHAIN_FILE = 'commit-graph-chain'
+
+# Parent position that means there is no such parent.
+GRAPH_PARENT_NONE = 0x70000000
+# Set on the second parent if it is an index into the extra edges chunk, and on
+# the last entry in the extra edges of a commit.
+GRAPH_EXTRA_EDGES = 0x80000000
+
+GENERATION_NUMBER_MAX = 0x3FFFFFFF
+
+# Settings of the changed-path Bloom filters that are written. Version 1 of
+# the hash is the one that all versions of C git that support Bloom filters
+# can read.
+BLOOM_HASH_VERSION = 1
+BLOOM_NUM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+# Commits that change more paths get a filter that matches every path.
+BLOOM_MAX_CHANGED_PATHS = 512
+
+_HEADER_SIZE = 8
+_CHUNK_ENTRY_SIZE = 12
+_COMMIT_DATA_SIZE = 36
+_BLOOM_HEADER_SIZE = 12
+
+_BLOOM_SEED0 = 0x293ae76f
+_BLOOM_SEED1 = 0x7e646e2c
+
+
+def _rotl32(value, count):
+    return ((value << count) | (value >> (32 - count))) & 0xffffffff
+
+
+def murmur3_32(data, seed, signed_chars=False):
+    """Compute the 32-bit murmur3 hash of a string.
+
+    :param data: The string to hash
+    :param seed: The seed of the hash
+    :param signed_chars: If True, sign-extend bytes with the high bit set
+        before mixing them in, like version 1 of the Bloom filter hash of C
+        git does.
+    :return: The hash, as an integer
+    """
+    length = len(data)
+    if signed_chars and any(c & 0x80 for c in data):
+        chars = [c & 0x80 and c | 0xffffff00 or c for c in data]
+    else:
+        chars = data
+    h = seed
+    nblocks = length // 4
+    for i in range(0, nblocks * 4, 4):
+        k = (chars[i] | (chars[i+1] << 8) | (chars[i+2] << 16) |
+             (chars[i+3] << 24)) & 0xffffffff
+        k = (k * 0xcc9e2d51) & 0xffffffff
+        k = _rotl32(k, 15)
+        k = (k * 0x1b873593) & 0xffffffff
+        h ^= k
+        h = (_rotl32(h, 13) * 5 + 0xe6546b64) & 0xffffffff
+    tail = length & 3
+    if tail:
+        k = 0
+        for i in reversed(range(tail)):
+            k ^= chars[nblocks * 4 + i] << (8 * i)
+        k &= 0xffffffff
+        k = (k * 0xcc9e2d51) & 0xffffffff
+        k = _rotl32(k, 15)
+        k = (k * 0x1b873593) & 0xffffffff
+        h ^= k
+    h ^= length
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+
+def bloom_key(path, num_hashes=BLOOM_NUM_HASHES,
+              hash_version=BLOOM_HASH_VERSION):
+    """Compute the Bloom filter key of a path.
+
+    :param path: The path, as a string
+    :param num_hashes: Number of hashes per key
+    :param hash_version: Version of the hash; 1 or 2
+    :return: Tuple of num_hashes hash values
+    """
+    signed_chars = (hash_version == 1)
+    hash0 = murmur3_32(path, _BLOOM_SEED0, signed_chars)
+    hash1 = murmur3_32(path, _BLOOM_SEED1, signed_chars)
+    return tuple((hash0 + i * hash1) & 0xffffffff for i in range(num_hashes))
+
+
+def bloom_filter_contains(data, key):
+    """Check whether a Bloom filter may contain a key.
+
+    :param data: The filter, as a string
+    :param key: The key, as returned by bloom_key
+    :return: False if the key is certainly not in the filter, True otherwise
+    """
+    num_bits = len(data) * 8
+    if not num_bits:
+        return True
+    for h in key:
+        bit = h % num_bits
+        if not data[bit >> 3] & (1 << (bit & 7)):
+            return False
+    return True
+
+
+def make_bloom_filter(paths, num_hashes=BLOOM_NUM_HASHES,
+                      bits_per_entry=BLOOM_BITS_PER_ENTRY,
+                      hash_version=BLOOM_HASH_VERSION):
+    """Create a Bloom filter for a set of paths.
+
+    :param paths: Set of paths, or None if there are too many to store
+    :return: The filter, as a string
+    """
+    if paths is None:
+        return b'\xff'
+    # Commits that change nothing still get a (zero) byte, as an empty filter
+    # would mean that nothing is known.
+    data = bytearray(max(1, (len(paths) * bits_per_entry + 7) // 8))
+    num_bits = len(data) * 8
+    for path in paths:
+        for h in bloom_key(path, num_hashes, hash_version):
+            bit = h % num_bits
+            data[bit >> 3] |= 1 << (bit & 7)
+    return bytes(data)
+
+
+def path_prefixes(path):
+    """Return a path and the paths of all directories leading up to it."""
+    ret = [path]
+    while True:
+        path = path.rpartition(b'/')[0]
+        if not path:
+            return ret
+        ret.append(path)
+
+
+def changed_paths(object_store, parent_tree, tree,
+                  max_paths=BLOOM_MAX_CHANGED_PATHS):
+    """Find the paths changed between two trees, as stored in Bloom filters.
+
+    :param object_store: Object store to read trees from
+    :param parent_tree: SHA of the tree of the first parent, or None
+    :param tree: SHA of the tree
+    :param max_paths: Maximum number of paths to return
+    :return: Set with the changed paths and their leading directories, or None
+        if there are more than max_paths of them
+    """
+    paths = set()
+    for change in tree_changes(object_store, parent_tree, tree):
+        for path in (change.old.path, change.new.path):
+            if path is not None:
+                paths.update(path_prefixes(path))
+        if len(paths) > max_paths:
+            return None
+    return paths
+
+
+class CommitGraph(object):
+    """A commit-graph file.
+
+    Commits are addressed by their position in the file, which is their index
+    in SHA order. All lookups are reads from the (memory-mapped) file.
+
+    A layer of a split commit graph has the graph below it as its base. The
+    commits of the base come first, so the positions in the layer start at
+    the number of commits in the base, and lookups of lower positions go to
+    the base.
+    """
+
+    def __init__(self, contents, file=None, base=None):
+        """Create a CommitGraph.
+
+        :param contents: The contents of the file, as a string or mmap.
+        :param file: Optional file object to close along with this object.
+        :param base: The CommitGraph of the layers below this one, if this is
+            a layer of a split commit graph.
+        :raise FileFormatException: if the contents are not a valid
+            commit-graph, or were not written on top of base.
+        """
+        self._contents = contents
+        self._file = file
+        self.base = base
+        if len(contents) < _HEADER_SIZE + 20:
+            raise FileFormatException('commit-graph file is truncated')
+        if contents[:4] != COMMIT_GRAPH_SIGNATURE:
+            raise FileFormatException('not a commit-graph file')
+        version, hash_version, num_chunks, num_base_graphs = unpack_from(
+          '>BBBB', contents, 4)
+        if version != COMMIT_GRAPH_VERSION:
+            raise FileFormatException(
+              'unsupported commit-graph version %d' % version)
+        if hash_version != COMMIT_GRAPH_HASH_VERSION:
+            raise FileFormatException(
+              'unsupported commit-graph hash version %d' % hash_version)
+        self._chunks = {}
+        offset = _HEADER_SIZE
+        chunk_id, chunk_offset = unpack_from('>4sQ', contents, offset)
+        for i in range(num_chunks):
+            offset += _CHUNK_ENTRY_SIZE
+            next_id, next_offset = unpack_from('>4sQ', contents, offset)
+            if next_offset < chunk_offset or next_offset > len(contents) - 20:
+                raise FileFormatException('invalid commit-graph chunk offset')
+            self._chunks[chunk_id] = (chunk_offset, next_offset - chunk_offset)
+            chunk_id, chunk_offset = next_id, next_offset
+        for chunk_id in (CHUNK_OID_FANOUT, CHUNK_OID_LOOKUP, CHUNK_COMMIT_DATA):
+            if chunk_id not in self._chunks:
+                raise FileFormatException(
+                  'commit-graph is missing the %s chunk' %
+                  chunk_id.decode('ascii'))
+        self._read_base_graphs(num_base_graphs)
+        self._fan_out_table = struct.unpack_from(
+          '>256L', contents, self._chunks[CHUNK_OID_FANOUT][0])
+        self._num_commits = self._fan_out_table[-1]
+        self._oid_offset = self._chunks[CHUNK_OID_LOOKUP][0]
+        self._data_offset = self._chunks[CHUNK_COMMIT_DATA][0]
+        if (self._chunks[CHUNK_OID_LOOKUP][1] != 20 * self._num_commits or
+            self._chunks[CHUNK_COMMIT_DATA][1] !=
+            _COMMIT_DATA_SIZE * self._num_commits):
+            raise FileFormatException('commit-graph chunks have wrong sizes')
+        self._edge_offset = self._chunks.get(CHUNK_EXTRA_EDGES, (None, 0))[0]
+        self._bloom_index_offset = None
+        if (CHUNK_BLOOM_INDEXES in self._chunks and
+            CHUNK_BLOOM_DATA in self._chunks):
+            self._read_bloom_settings()
+        self._has_bloom_filters = self._bloom_index_offset is not None and (
+          base is None or (base.has_bloom_filters and
+                           self.bloom_settings == base.bloom_settings))
+
+    def _read_base_graphs(self, num_base_graphs):
+        if self.base is None:
+            self._num_base_commits = 0
+            base_checksums = []
+        else:
+            self._num_base_commits = len(self.base)
+            base_checksums = [layer.get_stored_checksum()
+                              for layer in self.base.layers()]
+        if num_base_graphs != len(base_checksums):
+            raise FileFormatException(
+              'commit-graph has %d base graphs, expected %d' %
+              (num_base_graphs, len(base_checksums)))
+        if base_checksums:
+            offset, size = self._chunks.get(CHUNK_BASE_GRAPHS, (0, 0))
+            if (bytes(self._contents[offset:offset+size]) !=
+                b''.join(base_checksums)):
+                raise FileFormatException(
+                  'commit-graph was not written on top of its base')
+
+    def _read_bloom_settings(self):
+        offset, size = self._chunks[CHUNK_BLOOM_DATA]
+        if size < _BLOOM_HEADER_SIZE:
+            raise FileFormatException('commit-graph BDAT chunk is truncated')
+        (self.bloom_hash_version, self.bloom_num_hashes,
+         self.bloom_bits_per_entry) = unpack_from('>LLL', self._contents,
+                                                  offset)
+        if self.bloom_hash_version not in (1, 2):
+            # Unknown hash; ignore the filters.
+            return
+        if self._chunks[CHUNK_BLOOM_INDEXES][1] != 4 * self._num_commits:
+            raise FileFormatException('commit-graph BIDX chunk has wrong size')
+        self._bloom_index_offset = self._chunks[CHUNK_BLOOM_INDEXES][0]
+        self._bloom_data_offset = offset + _BLOOM_HEADER_SIZE
+        self._bloom_data_size = size - _BLOOM_HEADER_SIZE
+
+    @classmethod
+    def from_path(cls, path, base=None):
+        """Open the commit-graph file at path.
+
+        The file itself is closed right away; the graph only keeps its
+        contents, which are unmapped when the graph is closed or no longer
+        referenced.
+
+        :param base: The CommitGraph of the layers below the one in path, if
+            it is a layer of a split commit graph.
+        """
+        with GitFile(path, 'rb') as f:
+            contents, size = _load_file_contents(f)
+        try:
+            return cls(contents, base=base)
+        except:
+            if getattr(contents, 'close', None) is not None:
+                contents.close()
+            raise
+
+    def close(self):
+        if getattr(self._contents, 'close', None) is not None:
+            self._contents.close()
+        if self._file is not None:
+            self._file.close()
+        if self.base is not None:
+            self.base.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def __len__(self):
+        """Return the number of commits in the graph, including its base."""
+        return self._num_base_commits + self._num_commits
+
+    def __iter__(self):
+        """Iterate over the SHAs of the commits, in position order."""
+        for i in range(len(self)):
+            yield self.sha_at(i)
+
+    def layers(self):
+        """Return the layers of this graph, from the bottom one to this one."""
+        ret = [self]
+        while ret[-1].base is not None:
+            ret.append(ret[-1].base)
+        ret.reverse()
+        return ret
+
+    @property
+    def num_base_commits(self):
+        """The number of commits in the layers below this one."""
+        return self._num_base_commits
+
+    def __contains__(self, sha):
+        return self.position(sha) is not None
+
+    def _unpack_name(self, i):
+        offset = self._oid_offset + i * 20
+        return self._contents[offset:offset+20]
+
+    def position(self, sha):
+        """Return the position of a commit in the graph.
+
+        :param sha: SHA of the commit
+        :return: The position of the commit, or None if it is not in the graph
+        """
+        sha = _as_sha(sha)
+        if self.base is not None:
+            i = self.base.position(sha)
+            if i is not None:
+                return i
+        sha = sha.bytes
+        idx = sha[0]
+        if idx == 0:
+            start = 0
+        else:
+            start = self._fan_out_table[idx-1]
+        end = self._fan_out_table[idx] - 1
+        if start > end:
+            return None
+        i = bisect_find_sha(start, end, sha, self._unpack_name)
+        if i is None:
+            return None
+        return self._num_base_commits + i
+
+    def sha_at(self, i):
+        """Return the SHA of the commit at position i."""
+        if i < self._num_base_commits:
+            return self.base.sha_at(i)
+        return Sha1Sum.from_raw(self._unpack_name(i - self._num_base_commits))
+
+    def tree_at(self, i):
+        """Return the SHA of the root tree of the commit at position i."""
+        if i < self._num_base_commits:
+            return self.base.tree_at(i)
+        i -= self._num_base_commits
+        offset = self._data_offset + i * _COMMIT_DATA_SIZE
+        return Sha1Sum.from_raw(self._contents[offset:offset+20])
+
+    def parent_positions_at(self, i):
+        """Return the positions of the parents of the commit at position i.
+
+        :return: List of positions, in parent order
+        """
+        if i < self._num_base_commits:
+            return self.base.parent_positions_at(i)
+        i -= self._num_base_commits
+        parent1, parent2 = unpack_from(
+          '>LL', self._contents, self._data_offset + i * _COMMIT_DATA_SIZE + 20)
+        if parent1 == GRAPH_PARENT_NONE:
+            return []
+        if parent2 == GRAPH_PARENT_NONE:
+            return [parent1]
+        if not parent2 & GRAPH_EXTRA_EDGES:
+            return [parent1, parent2]
+        ret = [parent1]
+        offset = self._edge_offset + (parent2 & ~GRAPH_EXTRA_EDGES) * 4
+        while True:
+            (edge, ) = unpack_from('>L', self._contents, offset)
+            ret.append(edge & ~GRAPH_EXTRA_EDGES)
+            if edge & GRAPH_EXTRA_EDGES:
+                return ret
+            offset += 4
+
+    def parents_at(self, i):
+        """Return the SHAs of the parents of the commit at position i."""
+        return [self.sha_at(p) for p in self.parent_positions_at(i)]
+
+    def generation_at(self, i):
+        """Return the generation number of the commit at position i.
+
+        Commits without parents have generation 1; other commits have a
+        generation one larger than the largest generation of their parents.
+        """
+        if i < self._num_base_commits:
+            return self.base.generation_at(i)
+        i -= self._num_base_commits
+        (value, ) = unpack_from(
+          '>L', self._contents, self._data_offset + i * _COMMIT_DATA_SIZE + 28)
+        return value >> 2
+
+    def commit_time_at(self, i):
+        """Return the commit time of the commit at position i."""
+        if i < self._num_base_commits:
+            return self.base.commit_time_at(i)
+        i -= self._num_base_commits
+        high, low = unpack_from(
+          '>LL', self._contents, self._data_offset + i * _COMMIT_DATA_SIZE + 28)
+        return ((high & 0x3) << 32) | low
+
+    def _get_position(self, sha):
+        i = self.position(sha)
+        if i is None:
+            raise KeyError(sha)
+        return i
+
+    def get_parents(self, sha):
+        """Return the SHAs of the parents of a commit.
+
+        :raise KeyError: if the commit is not in the graph
+        """
+        return self.parents_at(self._get_position(sha))
+
+    def get_commit_time(self, sha):
+        """Return the commit time of a commit.
+
+        :raise KeyError: if the commit is not in the graph
+        """
+        return self.commit_time_at(self._get_position(sha))
+
+    def get_generation(self, sha):
+        """Return the generation number of a commit.
+
+        :raise KeyError: if the commit is not in the graph
+        """
+        return self.generation_at(self._get_position(sha))
+
+    @property
+    def has_bloom_filters(self):
+        """Whether this graph has changed-path Bloom filters.
+
+        A split graph only has them if all its layers have them, with the
+        same settings.
+        """
+        return self._has_bloom_filters
+
+    @property
+    def bloom_settings(self):
+        """The (hash version, number of hashes, bits per entry) of the
+        changed-path Bloom filters in this layer, or None."""
+        if self._bloom_index_offset is None:
+            return None
+        return (self.bloom_hash_version, self.bloom_num_hashes,
+                self.bloom_bits_per_entry)
+
+    def bloom_filter_at(self, i):
+        """Return the changed-path Bloom filter of the commit at position i.
+
+        :return: The filter as a string, or None if the graph has no filters
+        """
+        if not self.has_bloom_filters:
+            return None
+        if i < self._num_base_commits:
+            return self.base.bloom_filter_at(i)
+        i -= self._num_base_commits
+        offset = self._bloom_index_offset + i * 4
+        if i == 0:
+            start = 0
+            (end, ) = unpack_from('>L', self._contents, offset)
+        else:
+            start, end = unpack_from('>LL', self._contents, offset - 4)
+        if start > end or end > self._bloom_data_size:
+            raise FileFormatException('invalid commit-graph BIDX entry')
+        return self._contents[self._bloom_data_offset + start:
+                              self._bloom_data_offset + end]
+
+    def bloom_key(self, path):
+        """Compute the Bloom filter key of a path for this graph."""
+        return bloom_key(path, self.bloom_num_hashes, self.bloom_hash_version)
+
+    def iterentries(self, start=0):
+        """Iterate over the commits in the graph.
+
+        :param start: Position of the first commit to return
+        :return: Iterator over (sha, tree, parents, commit_time) tuples
+        """
+        for i in range(start, len(self)):
+            yield (self.sha_at(i), self.tree_at(i), self.parents_at(i),
+                   self.commit_time_at(i))
+
+    def calculate_checksum(self):
+        """Calculate the SHA1 checksum over the file of this layer.
+
+        :return: 20-byte binary digest
+        """
+        return hashlib.sha1(self._contents[:-20]).digest()
+
+    def get_stored_checksum(self):
+        """Return the SHA1 checksum stored in the file of this layer.
+
+        :return: 20-byte binary digest
+        """
+        return bytes(self._contents[-20:])
+
+    def check(self):
+        """Check that the stored checksums match the actual checksums."""
+        for layer in self.layers():
+            actual = layer.calculate_checksum()
+            stored = layer.get_stored_checksum()
+            if actual != stored:
+                raise ChecksumMismatch(stored, actual)
+
+
+def commit_graph_layer_name(checksum):
+    """Return the name of the file of a layer of a split commit graph.
+
+    :param checksum: The SHA1 checksum of the layer, as a 20-byte string
+    """
+    return 'graph-%s.graph' % Sha1Sum.from_raw(checksum).hex_bytes.decode(
+      'ascii')
+
+
+def read_commit_graph_chain(path):
+    """Open the layers of a split commit graph.
+
+    Like C git, only the layers up to the first one that is missing or
+    damaged are used.
+
+    :param path: Path of the directory with the layers and the chain file
+        that lists them
+    :return: The CommitGraph of the top layer, or None if the chain is empty
+    :raise IOError: if there is no chain file
+    """
+    with open(os.path.join(path, COMMIT_GRAPH_CHAIN_FILE), 'rb') as f:
+        checksums = [Sha1Sum(l.strip()).bytes for l in f if l.strip()]
+    graph = None
+    for checksum in checksums:
+        try:
+            layer = CommitGraph.from_path(
+              os.path.join(path, commit_graph_layer_name(checksum)),
+              base=graph)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            break
+        except FileFormatException:
+            break
+        if layer.get_stored_checksum() != checksum:
+            layer.close()
+            break
+        graph = layer
+    return graph
+
+
+def _compute_generations(entries, base=None):
+    """Compute the generation numbers of a set of commits.
+
+    :param entries: Dictionary mapping SHAs to (tree, parents, commit_time)
+    :param base: Optional CommitGraph with the generations of parents that
+        are not in entries
+    :return: Dictionary mapping SHAs to generation numbers. Commits with
+        parents that are not in entries or base, directly or through their
+        ancestors, get a generation of 0.
+    """
+    generations = {}
+    for sha in entries:
+        if sha in generations:
+            continue
+        todo = [sha]
+        while todo:
+            current = todo[-1]
+            if current in generations:
+                todo.pop()
+                continue
+            parents = entries[current][1]
+            pending = [p for p in parents
+                       if p in entries and p not in generations]
+            if pending:
+                todo.extend(pending)
+                continue
+            todo.pop()
+            generation = 1
+            for p in parents:
+                parent_generation = generations.get(p, 0)
+                if not parent_generation and base is not None:
+                    i = base.position(p)
+                    if i is not None:
+                        parent_generation = base.generation_at(i)
+                if not parent_generation:
+                    generation = 0
+                    break
+                generation = max(generation, parent_generation + 1)
+            generations[current] = min(generation, GENERATION_NUMBER_MAX)
+    return generations
+
+
+def write_commit_graph(f, entries, bloom_filters=None, base=None):
+    """Write a commit-graph file.
+
+    Commits whose parents are not all in the graph, for example because they
+    are missing from a shallow repository, are left out, together with their
+    descendants.
+
+    :param f: File-like object to write to
+    :param entries: Iterable over (sha, tree, parents, commit_time) tuples
+    :param bloom_filters: Optional dictionary mapping the SHAs of all commits
+        to their changed-path Bloom filters; see compute_bloom_filters.
+    :param base: Optional CommitGraph to write a layer on top of. The file
+        then only has the commits in entries that are not in base.
+    :return: The SHA1 checksum of the written file, as a 20-byte string
+    """
+    entries = dict((_as_sha(sha), (tree, parents, commit_time))
+                   for sha, tree, parents, commit_time in entries)
+    num_base_commits = 0
+    if base is not None:
+        num_base_commits = len(base)
+        entries = dict((sha, entry) for sha, entry in entries.items()
+                       if base.position(sha) is None)
+    generations = _compute_generations(entries, base)
+    shas = sorted(sha for sha, generation in generations.items()
+                  if generation)
+    positions = dict((sha, num_base_commits + i) for i, sha in enumerate(shas))
+
+    fan_out_table = [0] * 256
+    for sha in shas:
+        fan_out_table[sha.bytes[0]] += 1
+    total = 0
+    for i in range(256):
+        total += fan_out_table[i]
+        fan_out_table[i] = total
+
+    commit_data = []
+    extra_edges = []
+    for sha in shas:
+        tree, parents, commit_time = entries[sha]
+        parent_positions = [
+          positions[p] if p in positions else base.position(p)
+          for p in parents]
+        if not parent_positions:
+            parent1 = parent2 = GRAPH_PARENT_NONE
+        elif len(parent_positions) == 1:
+            parent1, parent2 = parent_positions[0], GRAPH_PARENT_NONE
+        elif len(parent_positions) == 2:
+            parent1, parent2 = parent_positions
+        else:
+            parent1 = parent_positions[0]
+            parent2 = GRAPH_EXTRA_EDGES | len(extra_edges)
+            extra_edges.extend(parent_positions[1:])
+            extra_edges[-1] |= GRAPH_EXTRA_EDGES
+        commit_time = max(commit_time, 0)
+        commit_data.append(struct.pack('>20sLLLL', _as_sha(tree).bytes,
+          parent1, parent2,
+          (generations[sha] << 2) | ((commit_time >> 32) & 0x3),
+          commit_time & 0xffffffff))
+
+    chunks = [
+      (CHUNK_OID_FANOUT, struct.pack('>256L', *fan_out_table)),
+      (CHUNK_OID_LOOKUP, b''.join(sha.bytes for sha in shas)),
+      (CHUNK_COMMIT_DATA, b''.join(commit_data)),
+      ]
+    if extra_edges:
+        chunks.append((CHUNK_EXTRA_EDGES,
+                       struct.pack('>%dL' % len(extra_edges), *extra_edges)))
+    if bloom_filters is not None:
+        filters = [bloom_filters[sha] for sha in shas]
+        indexes = []
+        end = 0
+        for data in filters:
+            end += len(data)
+            indexes.append(end)
+        chunks.append((CHUNK_BLOOM_INDEXES,
+                       struct.pack('>%dL' % len(indexes), *indexes)))
+        chunks.append((CHUNK_BLOOM_DATA, struct.pack('>LLL',
+          BLOOM_HASH_VERSION, BLOOM_NUM_HASHES, BLOOM_BITS_PER_ENTRY) +
+          b''.join(filters)))
+    base_checksums = []
+    if base is not None:
+        base_checksums = [layer.get_stored_checksum()
+                          for layer in base.layers()]
+        chunks.append((CHUNK_BASE_GRAPHS, b''.join(base_checksums)))
+
+    f = SHA1Writer(f)
+    f.write(COMMIT_GRAPH_SIGNATURE)
+    f.write(struct.pack('>BBBB', COMMIT_GRAPH_VERSION,
+                        COMMIT_GRAPH_HASH_VERSION, len(chunks),
+                        len(base_checksums)))
+    offset = _HEADER_SIZE + (len(chunks) + 1) * _CHUNK_ENTRY_SIZE
+    for chunk_id, data in chunks:
+        f.write(struct.pack('>4sQ', chunk_id, offset))
+        offset += len(data)
+    f.write(struct.pack('>4sQ', b'\0\0\0\0', offset))
+    for chunk_id, data in chunks:
+        f.write(data)
+    return f.write_sha()
+
+
+def find_commit_graph_entries(object_store, heads, graph=None,
+                              new_only=False):
+    """Find the commits to write to a commit-graph.
+
+    :param object_store: Object store to read commits from
+    :param heads: SHAs of the commits (or tags) to start from
+    :param graph: Optional existing CommitGraph. Its commits are included
+        without reading them from the object store.
+    :param new_only: Whether to leave out the commits in graph, to write a
+        layer on top of it
+    :return: Iterator over (sha, tree, parents, commit_time) tuples for the
+        commits in graph and all commits reachable from heads
+    """
+    done = set()
+    if graph is not None and not new_only:
+        for entry in graph.iterentries():
+            done.add(entry[0])
+            yield entry
+    todo = []
+    for sha in heads:
+        try:
+            obj = object_store[sha]
+            while isinstance(obj, Tag):
+                obj = object_store[obj.object[1]]
+        except KeyError:
+            continue
+        if isinstance(obj, Commit):
+            todo.append(obj.id)
+    while todo:
+        sha = todo.pop()
+        if sha in done:
+            continue
+        done.add(sha)
+        if new_only and graph.position(sha) is not None:
+            continue
+        try:
+            commit = object_store[sha]
+        except KeyError:
+            # Left out by write_commit_graph, along with its descendants.
+            continue
+        todo.extend(commit.parents)
+        yield (sha, commit.tree, commit.parents, commit.commit_time)
+
+
+def has_current_bloom_filters(graph):
+    """Check whether a graph has Bloom filters with the settings written now.
+    """
+    return graph.has_bloom_filters and graph.bloom_settings == (
+      BLOOM_HASH_VERSION, BLOOM_NUM_HASHES, BLOOM_BITS_PER_ENTRY)
+
+
+def compute_bloom_filters(object_store, entries, graph=None):
+    """Compute the changed-path Bloom filters for a set of commits.
+
+    :param object_store: Object store to read trees from
+    :param entries: List of (sha, tree, parents, commit_time) tuples
+    :param graph: Optional existing CommitGraph. Filters of commits in it are
+        reused if they have the same settings, and the trees of the first
+        parents of commits in entries are looked up in it.
+    :return: Dictionary mapping SHAs to Bloom filters
+    """
+    filter_graph = graph
+    if graph is not None and not has_current_bloom_filters(graph):
+        filter_graph = None
+    trees = dict((entry[0], entry[1]) for entry in entries)
+    ret = {}
+    for sha, tree, parents, commit_time in entries:
+        if filter_graph is not None:
+            i = filter_graph.position(sha)
+            if i is not None:
+                ret[sha] = bytes(filter_graph.bloom_filter_at(i))
+                continue
+        parent_tree = None
+        if parents:
+            parent_tree = trees.get(parents[0])
+            if parent_tree is None and graph is not None:
+                i = graph.position(parents[0])
+                if i is not None:
+                    parent_tree = graph.tree_at(i)
+            if parent_tree is None:
+                # Not in the graph, so neither is this commit.
+                continue
+        ret[sha] = make_bloom_filter(
+          changed_paths(object_store, parent_tree, tree))
+    return ret
@@ -138,6 +138,13 @@ class HangupException(GitProtocolError):
             "The remote server unexpectedly closed the connection.")
 
 
+class QueueTimeoutError(GitProtocolError):
+    """A request waited too long for the server to handle it."""
+
+    def __init__(self, *args, **kwargs):
+        GitProtocolError.__init__(self, *args, **kwargs)
+
+
 class UnexpectedCommandError(GitProtocolError):
     """Unexpected command received in a proto line."""
 
@@ -0,0 +1,387 @@
+# graph.py -- Merge bases and reachability of commits.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# or (at your option) a later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Merge bases and reachability of commits.
+
+The functions in this module paint the history down from a set of commits,
+marking each commit with a bit for every starting point it can be reached
+from. The walk goes from children to parents and stops as soon as the
+remaining commits can no longer change the answer.
+
+Parents, commit times and generation numbers are read from the commit graph
+of the object store if it has one; other commits are read from the store,
+which benefits from its parsed object cache if that is enabled.
+"""
+
+import heapq
+
+from dulwich.errors import (
+    MissingCommitError,
+    NotCommitError,
+    )
+
+# Generation number of commits that are not in the commit graph. These are
+# newer than all commits that are, so they are walked first.
+GENERATION_NUMBER_INFINITY = 0xFFFFFFFF
+
+# Without generation numbers, commits are walked in commit time order, which
+# may be wrong when clocks were skewed. Keep walking this many commits past
+# the point where the walk would otherwise stop, like the Walker does.
+_MAX_EXTRA_COMMITS = 5
+
+_PARENT1 = 1
+_PARENT2 = 2
+_STALE = 4
+
+
+class _PaintQueue(object):
+    """Priority queue of commits, children before their parents.
+
+    Commits are ordered by generation number, then by commit time.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._graph = store.commit_graph
+        # Commits with a lower generation number are not queued.
+        self.min_generation = 0
+        self._info = {}
+        self._heap = []
+        self._queued = set()
+
+    def _get_info(self, sha):
+        info = self._info.get(sha)
+        if info is not None:
+            return info
+        i = None
+        if self._graph is not None:
+            i = self._graph.position(sha)
+        if i is not None:
+            info = (self._graph.parents_at(i), self._graph.generation_at(i),
+                    self._graph.commit_time_at(i))
+        else:
+            try:
+                commit = self._store[sha]
+            except KeyError:
+                raise MissingCommitError(sha)
+            info = (commit.parents, GENERATION_NUMBER_INFINITY,
+                    commit.commit_time)
+        self._info[sha] = info
+        return info
+
+    def get_parents(self, sha):
+        return self._get_info(sha)[0]
+
+    def get_generation(self, sha):
+        """Return the generation number of a commit.
+
+        :return: The generation number, or GENERATION_NUMBER_INFINITY if the
+            commit is not in the commit graph.
+        """
+        return self._get_info(sha)[1]
+
+    def push(self, sha):
+        """Add a commit to the queue.
+
+        :return: Whether the commit is queued; commits with a generation
+            number below min_generation are not.
+        """
+        if sha in self._queued:
+            return True
+        _, generation, commit_time = self._get_info(sha)
+        if generation < self.min_generation:
+            return False
+        heapq.heappush(self._heap, (-generation, -commit_time, sha))
+        self._queued.add(sha)
+        return True
+
+    def pop(self):
+        """Remove and return the SHA of the next commit."""
+        _, _, sha = heapq.heappop(self._heap)
+        self._queued.remove(sha)
+        return sha
+
+    def next_by_time(self):
+        """Whether the next commit is only ordered by its commit time."""
+        return -self._heap[0][0] == GENERATION_NUMBER_INFINITY
+
+    def __len__(self):
+        return len(self._heap)
+
+
+def _paint_down(queue, flags, visit, is_done):
+    """Propagate flags from commits to their ancestors.
+
+    :param queue: A _PaintQueue
+    :param flags: Dictionary mapping the SHAs of the starting commits to their
+        flags; updated in place with the flags of all commits walked
+    :param visit: Callable that is called with the SHA and flags of each
+        commit walked, and returns the flags to pass to its parents
+    :param is_done: Callable that returns whether the given flags of a queued
+        commit mean its ancestors can no longer change the result
+    """
+    active = set()
+    for sha, commit_flags in flags.items():
+        if queue.push(sha) and not is_done(commit_flags):
+            active.add(sha)
+    extra_commits_left = _MAX_EXTRA_COMMITS
+    while queue:
+        if active:
+            extra_commits_left = _MAX_EXTRA_COMMITS
+        elif not queue.next_by_time():
+            break
+        else:
+            extra_commits_left -= 1
+            if not extra_commits_left:
+                break
+        sha = queue.pop()
+        active.discard(sha)
+        parent_flags = visit(sha, flags[sha])
+        for parent in queue.get_parents(sha):
+            old_flags = flags.get(parent, 0)
+            new_flags = old_flags | parent_flags
+            if new_flags == old_flags:
+                continue
+            flags[parent] = new_flags
+            if not queue.push(parent):
+                continue
+            if is_done(new_flags):
+                active.discard(parent)
+            else:
+                active.add(parent)
+
+
+def _paint_down_to_common(queue, one, twos):
+    """Find the common ancestors of one and twos closest to them.
+
+    :return: List of SHAs of common ancestors; some may be ancestors of
+        others
+    """
+    flags = dict((two, _PARENT2) for two in twos)
+    flags[one] = flags.get(one, 0) | _PARENT1
+    results = []
+
+    def visit(sha, commit_flags):
+        both = _PARENT1 | _PARENT2
+        if commit_flags & both == both and not commit_flags & _STALE:
+            if sha not in results:
+                results.append(sha)
+            return commit_flags | _STALE
+        return commit_flags
+
+    _paint_down(queue, flags, visit, lambda f: f & _STALE)
+    # Common ancestors that were reached from another one are not the best.
+    return [sha for sha in results if not flags[sha] & _STALE]
+
+
+def is_ancestor(store, ancestor, descendant):
+    """Check whether a commit is an ancestor of another.
+
+    :param store: Object store with the commits
+    :param ancestor: SHA of the possible ancestor
+    :param descendant: SHA of the possible descendant
+    :return: True if ancestor is reachable from descendant, or they are the
+        same commit
+    :raise MissingCommitError: if a commit that is needed is missing
+    """
+    if ancestor == descendant:
+        return True
+    queue = _PaintQueue(store)
+    # Commits with a lower generation number can not reach the ancestor.
+    queue.min_generation = queue.get_generation(ancestor)
+    return ancestor in _paint_down_to_common(queue, ancestor, [descendant])
+
+
+def _remove_redundant(store, shas):
+    return [sha for sha in shas
+            if not any(is_ancestor(store, sha, other)
+                       for other in shas if other != sha)]
+
+
+def merge_base(store, a, b):
+    """Find the best common ancestors of two commits.
+
+    :param store: Object store with the commits
+    :param a: SHA of a commit
+    :param b: SHA of a commit
+    :return: List of SHAs of the common ancestors of a and b that are not
+        ancestors of other common ancestors. This is empty if the commits have
+        no history in common, and has more than one entry for criss-cross
+        merges.
+    :raise MissingCommitError: if a commit that is needed is missing
+    """
+    if a == b:
+        return [a]
+    results = _paint_down_to_common(_PaintQueue(store), a, [b])
+    if len(results) > 1:
+        results = _remove_redundant(store, results)
+    return results
+
+
+def ahead_behind(store, base, tips):
+    """Count the commits by which tips are ahead of and behind a base.
+
+    All tips are counted in a single walk over the history, which stops once
+    the remaining commits are reachable from the base and every tip.
+
+    :param store: Object store with the commits
+    :param base: SHA of the base commit
+    :param tips: List of SHAs of commits to compare with base
+    :return: List with for each tip a tuple with the number of commits
+        reachable from the tip but not from base, and the number of commits
+        reachable from base but not from the tip
+    :raise MissingCommitError: if a commit that is needed is missing
+    """
+    # Bit 0 is for base, bit i + 1 for tips[i].
+    all_flags = (1 << (len(tips) + 1)) - 1
+    flags = {base: 1}
+    for i, tip in enumerate(tips):
+        flags[tip] = flags.get(tip, 0) | (1 << (i + 1))
+    _paint_down(_PaintQueue(store), flags, lambda sha, f: f,
+                lambda f: f == all_flags)
+
+    counts = {}
+    for commit_flags in flags.values():
+        counts[commit_flags] = counts.get(commit_flags, 0) + 1
+    ahead = [0] * len(tips)
+    behind = [0] * len(tips)
+    for commit_flags, count in counts.items():
+        for i in range(len(tips)):
+            if (commit_flags >> (i + 1)) & 1:
+                if not commit_flags & 1:
+                    ahead[i] += count
+            elif commit_flags & 1:
+                behind[i] += count
+    return list(zip(ahead, behind))
+
+
+class SatisfiedWants(object):
+    """Tracks which wants are reachable from a growing set of haves.
+
+    This answers the question an upload-pack server asks on every have that
+    the client and server have in common: whether each want has a path back
+    to one of the haves, so that no more haves are needed. Like C git, the
+    search does not go past commits older than the oldest have.
+
+    Each want has a bit, which is painted down from the want. The painted
+    commits are kept between haves, and commits older than the oldest have
+    wait in a queue until an older have arrives, so each commit is walked
+    once per want at most, however many haves there are. Bits of wants that
+    are satisfied are no longer painted.
+    """
+
+    def __init__(self, store, wants):
+        """Create a new SatisfiedWants.
+
+        :param store: Object store with the commits
+        :param wants: SHAs of the wants; wants that are not commits are
+            satisfied from the start
+        """
+        self._store = store
+        self._wants = list(wants)
+        self._unsatisfied = 0
+        # Bits of the wants each commit was reached from.
+        self._flags = {}
+        # Commits reached that are older than the oldest have, with their
+        # bits, and a heap of them, newest first.
+        self._held = {}
+        self._held_heap = []
+        self._haves = set()
+        self._earliest = None
+        for i, want in enumerate(self._wants):
+            try:
+                store.get_parents(want)
+            except NotCommitError:
+                # non-commit wants are assumed to be satisfied
+                continue
+            self._unsatisfied |= 1 << i
+            self._flags[want] = self._flags.get(want, 0) | (1 << i)
+
+    def _paint(self, pending):
+        """Paint the bits of commits on their parents.
+
+        :param pending: List of tuples with the SHA of a commit and the bits
+            it gained
+        """
+        store = self._store
+        flags = self._flags
+        earliest = self._earliest
+        while pending and self._unsatisfied:
+            sha, bits = pending.pop()
+            bits &= self._unsatisfied
+            if not bits:
+                continue
+            for parent in store.get_parents(sha):
+                # TODO: handle parents with later commit times than children
+                commit_time = store.get_commit_time(parent)
+                if commit_time < earliest:
+                    if parent not in self._held:
+                        heapq.heappush(self._held_heap, (-commit_time, parent))
+                    self._held[parent] = self._held.get(parent, 0) | bits
+                    continue
+                old_flags = flags.get(parent, 0)
+                new_flags = old_flags | bits
+                if new_flags == old_flags:
+                    continue
+                flags[parent] = new_flags
+                if parent in self._haves:
+                    self._unsatisfied &= ~new_flags
+                pending.append((parent, new_flags & ~old_flags))
+
+    def add_have(self, sha):
+        """Add a commit the client has.
+
+        :param sha: SHA of the commit
+        :raise NotCommitError: if sha does not point at a commit
+        """
+        if sha in self._haves:
+            return
+        self._haves.add(sha)
+        self._unsatisfied &= ~self._flags.get(sha, 0)
+        commit_time = self._store.get_commit_time(sha)
+        if self._earliest is None:
+            # The walk starts with the first have.
+            self._earliest = commit_time
+            self._paint(list(self._flags.items()))
+        elif commit_time < self._earliest:
+            self._earliest = commit_time
+            pending = []
+            heap = self._held_heap
+            while heap and -heap[0][0] >= commit_time:
+                _, parent = heapq.heappop(heap)
+                bits = self._held.pop(parent)
+                old_flags = self._flags.get(parent, 0)
+                new_flags = old_flags | bits
+                if new_flags != old_flags:
+                    self._flags[parent] = new_flags
+                    if parent in self._haves:
+                        self._unsatisfied &= ~new_flags
+                    pending.append((parent, new_flags & ~old_flags))
+            self._paint(pending)
+
+    def is_satisfied(self, want):
+        """Check whether a want is reachable from the haves added so far.
+
+        :param want: SHA of one of the wants
+        """
+        i = self._wants.index(want)
+        return not self._unsatisfied & (1 << i)
+
+    def all_satisfied(self):
+        """Check whether all wants are reachable from the haves added so far.
+        """
+        return not self._unsatisfied
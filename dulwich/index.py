@@ -99,7 +99,7 @@ def read_cache_entry(f):
     real_size = ((f.tell() - beginoffset + 8) & ~7)
     data = f.read((beginoffset + real_size) - f.tell())
     return (name, ctime, mtime, dev, ino, mode, uid, gid, size, 
-            Sha1Sum(sha), flags & ~0x0fff)
+            Sha1Sum.from_raw(sha), flags & ~0x0fff)
 
 
 def write_cache_entry(f, entry):
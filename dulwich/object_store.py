@@ -20,21 +20,38 @@
 """Git object store interfaces and implementation."""
 
 
+import bisect
 import errno
 import itertools
 import os
 import stat
 import tempfile
-
+import threading
+
+from dulwich.commit_graph import (
+    COMMIT_GRAPH_CHAIN_FILE,
+    CommitGraph,
+    commit_graph_layer_name,
+    compute_bloom_filters,
+    find_commit_graph_entries,
+    has_current_bloom_filters,
+    read_commit_graph_chain,
+    write_commit_graph,
+    )
 from dulwich.diff_tree import (
     tree_changes,
     walk_trees,
     )
 from dulwich.errors import (
+    NotCommitError,
     NotTreeError,
     )
 from dulwich.file import GitFile
+from dulwich.lru_cache import (
+    LRUSizeCache,
+    )
 from dulwich.objects import (
+    Blob,
     Commit,
     ShaFile,
     Tag,
@@ -43,7 +60,9 @@ from dulwich.objects import (
     ZERO_SHA,
     S_ISGITLINK,
     object_class,
+    read_loose_object_size,
     sha_to_filename,
+    _as_sha,
     )
 from dulwich.pack import (
     Pack,
@@ -57,14 +76,320 @@ from dulwich.pack import (
     PackIndexer,
     PackStreamCopier,
     )
+from dulwich.walk import (
+    Walker,
+    )
 
 INFODIR = 'info'
 PACKDIR = 'pack'
+CLONE_PACK_FILE = 'clone-pack'
+COMMIT_GRAPH_FILE = 'commit-graph'
+COMMIT_GRAPHS_DIR = 'commit-graphs'
+
+# Default budgets (in bytes of raw object text) for ParsedObjectCache.
+# Commits and trees are read over and over by history walks and tree diffs;
+# blobs are rarely read twice, so they are not cached by default.
+DEFAULT_OBJECT_CACHE_SIZES = {
+    Commit.type_name: 4 * 1024 * 1024,
+    Tree.type_name: 8 * 1024 * 1024,
+    Tag.type_name: 512 * 1024,
+    Blob.type_name: 0,
+    }
+
+# Cached trees with at least this many bytes of raw text are compacted.
+DEFAULT_COMPACT_TREE_SIZE = 4096
+
+# Stores with at least this many packed objects use ObjectIdSet for the sets
+# of SHAs kept by traversals; None to always use hash sets. Without the C
+# extensions, a hash set takes about 106 bytes per SHA, including the SHA
+# itself, and ObjectIdSet a quarter of a byte, but membership tests take about
+# 6us rather than 1us, which makes a full clone traversal up to twice as slow.
+# ObjectIdSet is therefore only used for stores that ask for it, to bound
+# memory use at the cost of speed.
+DEFAULT_OBJECT_ID_SET_MIN_OBJECTS = None
+
+
+class ParsedObjectCache(object):
+    """Size-bounded cache of parsed ShaFile objects, keyed by binary SHA.
+
+    Each object type has its own LRU budget, so that a burst of large blobs
+    can not push out the commits and trees that history walks keep coming
+    back to.
+
+    :note: Objects returned from the cache are shared between callers, so they
+        must not be modified. The cache itself may be shared between threads.
+    """
+
+    def __init__(self, max_sizes=None,
+                 compact_tree_size=DEFAULT_COMPACT_TREE_SIZE):
+        """Create a new ParsedObjectCache.
+
+        :param max_sizes: Dictionary mapping type names to the maximum number
+            of bytes of raw object text to cache for that type. Types that are
+            missing or have a budget of 0 are not cached. Defaults to
+            DEFAULT_OBJECT_CACHE_SIZES.
+        :param compact_tree_size: Trees with at least this many bytes of raw
+            text are stored compacted (see Tree.compact). None disables this.
+        """
+        if max_sizes is None:
+            max_sizes = DEFAULT_OBJECT_CACHE_SIZES
+        self._compact_tree_size = compact_tree_size
+        self._caches = {}
+        for type_name, max_size in max_sizes.items():
+            if max_size:
+                self._caches[object_class(type_name).type_num] = LRUSizeCache(
+                  max_size, compute_size=lambda obj: obj.raw_length())
+        self.hits = dict((t, 0) for t in self._caches)
+        self.misses = dict((t, 0) for t in self._caches)
+        self._lock = threading.Lock()
+
+    def get(self, sha):
+        """Look up a cached object.
+
+        :param sha: Binary SHA of the object.
+        :return: The cached ShaFile, or None if it is not cached.
+        """
+        with self._lock:
+            for type_num, cache in self._caches.items():
+                obj = cache.get(sha)
+                if obj is not None:
+                    self.hits[type_num] += 1
+                    return obj
+        return None
+
+    def add(self, sha, obj):
+        """Add a freshly parsed object to the cache.
+
+        :param sha: Binary SHA of the object.
+        :param obj: The ShaFile to cache.
+        """
+        cache = self._caches.get(obj.type_num)
+        if cache is None:
+            return
+        with self._lock:
+            self.misses[obj.type_num] += 1
+            cache.add(sha, obj)
+            # Other threads may get the tree once it is added, so compact it
+            # before they can.
+            if (self._compact_tree_size is not None and
+                obj.type_num == Tree.type_num and
+                obj.raw_length() >= self._compact_tree_size):
+                obj.compact()
+
+    def clear(self):
+        """Remove all objects from the cache."""
+        with self._lock:
+            for cache in self._caches.values():
+                cache.clear()
+
+    def size(self):
+        """Return the number of bytes of raw object text that is cached."""
+        with self._lock:
+            return sum(cache._value_size for cache in self._caches.values())
+
+    def stats(self):
+        """Return cache statistics.
+
+        :return: Dictionary mapping type names to tuples of
+            (hits, misses, number of cached objects).
+        """
+        ret = {}
+        for type_num, cache in self._caches.items():
+            ret[object_class(type_num).type_name] = (
+              self.hits[type_num], self.misses[type_num], len(cache))
+        return ret
+
+    def hit_rate(self):
+        """Return the fraction of lookups of cacheable objects that hit."""
+        hits = sum(self.hits.values())
+        total = hits + sum(self.misses.values())
+        if not total:
+            return 0.0
+        return hits / total
+
+
+class ObjectNumbering(object):
+    """Numbering of objects with small integers.
+
+    Objects in packs are numbered by their position in the pack index, after
+    the objects in the packs before it, so numbering them takes no memory.
+    Other objects are numbered in the order they are first seen, after all
+    packed objects; these are kept in an overflow table.
+
+    A SHA that is in more than one pack gets the number from the first one.
+    """
+
+    def __init__(self, indexes=()):
+        """Create a new ObjectNumbering.
+
+        :param indexes: Pack indexes whose objects to number
+        """
+        self._indexes = []
+        self._bases = []
+        base = 0
+        for index in indexes:
+            self._indexes.append(index)
+            self._bases.append(base)
+            base += len(index)
+        self._num_packed = base
+        self._overflow = {}
+        self._overflow_shas = []
+
+    def copy_packed(self):
+        """Return a new numbering of the same packed objects.
+
+        The new numbering shares the pack indexes but not the numbers given
+        to other objects.
+        """
+        numbering = ObjectNumbering()
+        numbering._indexes = self._indexes
+        numbering._bases = self._bases
+        numbering._num_packed = self._num_packed
+        return numbering
+
+    def get(self, sha):
+        """Return the number of an object.
+
+        :return: The number, or None if the object has no number yet
+        """
+        sha = _as_sha(sha).bytes
+        for index, base in zip(self._indexes, self._bases):
+            i = index.object_position(sha)
+            if i is not None:
+                return base + i
+        return self._overflow.get(sha)
+
+    def number(self, sha):
+        """Return the number of an object, numbering it if it is new."""
+        n = self.get(sha)
+        if n is None:
+            sha = _as_sha(sha).bytes
+            n = self._overflow[sha] = self._num_packed + len(self._overflow)
+            self._overflow_shas.append(sha)
+        return n
+
+    def __getitem__(self, number):
+        """Return the SHA of the object with a number."""
+        if number >= self._num_packed:
+            return Sha1Sum.from_raw(
+              self._overflow_shas[number - self._num_packed])
+        i = bisect.bisect_right(self._bases, number) - 1
+        return self._indexes[i].object_name(number - self._bases[i])
+
+    def __len__(self):
+        """Return the number of objects that have a number."""
+        return self._num_packed + len(self._overflow)
+
+
+class ObjectIdSet(object):
+    """Set of SHAs, stored as a bitmap over the numbers of an ObjectNumbering.
+
+    This takes a bit per object in the numbering rather than a hash table
+    entry per member, which matters for traversals over the full history of
+    large repositories.
+    """
+
+    def __init__(self, numbering, iterable=()):
+        self._numbering = numbering
+        self._bits = bytearray()
+        self._len = 0
+        self.update(iterable)
+
+    def add(self, sha):
+        n = self._numbering.number(sha)
+        byte = n >> 3
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(max(byte + 1 - len(self._bits),
+                                        len(self._bits) // 2)))
+        mask = 1 << (n & 7)
+        if not self._bits[byte] & mask:
+            self._bits[byte] |= mask
+            self._len += 1
+
+    def update(self, iterable):
+        for sha in iterable:
+            self.add(sha)
+
+    def discard(self, sha):
+        n = self._numbering.get(sha)
+        if n is None:
+            return
+        byte = n >> 3
+        mask = 1 << (n & 7)
+        if byte < len(self._bits) and self._bits[byte] & mask:
+            self._bits[byte] &= ~mask
+            self._len -= 1
+
+    def remove(self, sha):
+        if sha not in self:
+            raise KeyError(sha)
+        self.discard(sha)
+
+    def __contains__(self, sha):
+        n = self._numbering.get(sha)
+        if n is None:
+            return False
+        byte = n >> 3
+        return (byte < len(self._bits) and
+                bool(self._bits[byte] & (1 << (n & 7))))
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        numbering = self._numbering
+        for byte, value in enumerate(self._bits):
+            if not value:
+                continue
+            for bit in range(8):
+                if value & (1 << bit):
+                    yield numbering[(byte << 3) | bit]
 
 
 class BaseObjectStore(object):
     """Object store interface."""
 
+    _object_cache = None
+
+    # The CommitGraph of this store, or None if it does not have one.
+    commit_graph = None
+
+    def enable_object_cache(self, max_sizes=None,
+                            compact_tree_size=DEFAULT_COMPACT_TREE_SIZE):
+        """Cache parsed objects returned by __getitem__.
+
+        This helps walks and negotiations that read the same commits and trees
+        many times. Objects returned from the cache are shared, so callers
+        must not modify them while the cache is enabled.
+
+        :param max_sizes: Optional dictionary of per-type budgets; see
+            ParsedObjectCache.
+        :param compact_tree_size: Minimum raw size of trees that are cached in
+            compact form; see ParsedObjectCache.
+        :return: The ParsedObjectCache in use.
+        """
+        self._object_cache = ParsedObjectCache(max_sizes, compact_tree_size)
+        return self._object_cache
+
+    def disable_object_cache(self):
+        """Stop caching parsed objects and drop the cached ones."""
+        self._object_cache = None
+
+    @property
+    def object_cache(self):
+        """The ParsedObjectCache in use, or None if caching is disabled."""
+        return self._object_cache
+
+    def memory_size(self):
+        """Estimate the memory used by the caches of this store.
+
+        :return: Size in bytes
+        """
+        cache = self._object_cache
+        if cache is None:
+            return 0
+        return cache.size()
+
     def determine_wants_all(self, refs):
         return [sha for (ref, sha) in refs.items()
                 if not sha in self and not ref.endswith(b"^{}") and
@@ -106,10 +431,30 @@ class BaseObjectStore(object):
         """
         raise NotImplementedError(self.get_raw)
 
+    def get_object_size(self, sha):
+        """Return the size of the contents of an object.
+
+        Stores avoid reading the whole object where they can.
+
+        :param sha: SHA of the object
+        :return: Size of the object in bytes
+        :raise KeyError: if the object does not exist
+        """
+        return len(self.get_raw(sha)[1])
+
     def __getitem__(self, sha):
         """Obtain an object by SHA1."""
-        type_num, uncomp = self.get_raw(sha)
-        return ShaFile.from_raw_string(type_num, uncomp)
+        cache = self._object_cache
+        if cache is None:
+            type_num, uncomp = self.get_raw(sha)
+            return ShaFile.from_raw_string(type_num, uncomp)
+        key = _as_sha(sha).bytes
+        obj = cache.get(key)
+        if obj is None:
+            type_num, uncomp = self.get_raw(sha)
+            obj = ShaFile.from_raw_string(type_num, uncomp)
+            cache.add(key, obj)
+        return obj
 
     def __iter__(self):
         """Iterate over the SHAs that are present in this store."""
@@ -158,7 +503,9 @@ class BaseObjectStore(object):
                 yield entry
 
     def find_missing_objects(self, haves, wants, progress=None,
-                             get_tagged=None):
+                             get_tagged=None, shallow=None,
+                             target_shallow=None, object_filter=None,
+                             thin_pack=False):
         """Find the missing objects required for a set of revisions.
 
         :param haves: Iterable over SHAs already in common.
@@ -167,10 +514,21 @@ class BaseObjectStore(object):
             updated progress strings.
         :param get_tagged: Function that returns a dict of pointed-to sha -> tag
             sha for including tags.
-        :return: Iterator over (sha, path) pairs.
+        :param shallow: Optional set of SHAs of commits whose parents are not
+            to be sent
+        :param target_shallow: Optional set of SHAs of commits whose parents
+            are missing from the target
+        :param object_filter: Optional ObjectFilter for the trees and blobs
+            to leave out
+        :param thin_pack: Whether to look for delta bases for a thin pack
+        :return: Iterable over (sha, path) pairs, which is a
+            MissingObjectFinder.
         """
-        finder = MissingObjectFinder(self, haves, wants, progress, get_tagged)
-        return iter(finder.__next__, None)
+        return MissingObjectFinder(self, haves, wants, progress, get_tagged,
+                                   shallow=shallow,
+                                   target_shallow=target_shallow,
+                                   object_filter=object_filter,
+                                   thin_pack=thin_pack)
 
     def find_common_revisions(self, graphwalker):
         """Find which revisions this store has in common using graphwalker.
@@ -193,7 +551,103 @@ class BaseObjectStore(object):
         :param heads: Local heads to start search with
         :return: GraphWalker object
         """
-        return ObjectStoreGraphWalker(heads, lambda sha: self[sha].parents)
+        return ObjectStoreGraphWalker(heads, self.get_parents,
+                                      self.new_object_set)
+
+    def new_object_set(self, iterable=()):
+        """Create a set for the SHAs of objects visited by a traversal.
+
+        :param iterable: Optional SHAs to add to the set
+        :return: A set-like object supporting add, discard, update, len,
+            iteration and membership tests
+        """
+        return set(iterable)
+
+    def _get_commit(self, sha):
+        commit = self[sha]
+        if not isinstance(commit, Commit):
+            raise NotCommitError(sha)
+        return commit
+
+    def get_parents(self, sha):
+        """Return the parents of a commit.
+
+        The commit graph is used if it has the commit, so that the commit does
+        not have to be read.
+
+        :param sha: SHA of the commit
+        :return: List of parent SHAs
+        :raise KeyError: if the commit does not exist
+        :raise NotCommitError: if sha does not point at a commit
+        """
+        graph = self.commit_graph
+        if graph is not None:
+            i = graph.position(sha)
+            if i is not None:
+                return graph.parents_at(i)
+        return self._get_commit(sha).parents
+
+    def get_commit_time(self, sha):
+        """Return the commit time of a commit.
+
+        The commit graph is used if it has the commit, so that the commit does
+        not have to be read.
+
+        :param sha: SHA of the commit
+        :raise KeyError: if the commit does not exist
+        :raise NotCommitError: if sha does not point at a commit
+        """
+        graph = self.commit_graph
+        if graph is not None:
+            i = graph.position(sha)
+            if i is not None:
+                return graph.commit_time_at(i)
+        return self._get_commit(sha).commit_time
+
+    def write_commit_graph(self, heads, changed_paths=None):
+        """Write a commit graph for the commits reachable from heads.
+
+        Commits in the existing commit graph are kept.
+
+        :param heads: SHAs of the commits (or tags) to include
+        :param changed_paths: Whether to include changed-path Bloom filters.
+            Defaults to whether the existing commit graph has them.
+        :return: The new CommitGraph
+        """
+        raise NotImplementedError(self.write_commit_graph)
+
+    def extend_commit_graph(self, heads):
+        """Add the commits reachable from heads to the commit graph.
+
+        Unlike write_commit_graph, this does not rewrite the commits that are
+        already in the graph, so its cost depends on the number of new
+        commits rather than on the size of the history.
+
+        :param heads: SHAs of the commits (or tags) to include
+        :return: The new CommitGraph
+        """
+        raise NotImplementedError(self.extend_commit_graph)
+
+    def find_clone_pack(self):
+        """Find the clone pack of this store.
+
+        A clone pack contains exactly the objects reachable from a set of
+        tips, so that it can be sent as is to clients that want these tips
+        and have nothing.
+
+        :return: Tuple with the Pack and the list of SHAs of its tips, or
+            None if there is no clone pack
+        """
+        return None
+
+    def write_clone_pack(self, tips):
+        """Write a clone pack for the objects reachable from tips.
+
+        :param tips: SHAs of the objects to include, along with the objects
+            reachable from them
+        :return: The new Pack
+        """
+        raise NotImplementedError(self.write_clone_pack)
 
     def generate_pack_contents(self, have, want, progress=None):
         """Iterate over the contents of a pack file.
@@ -222,8 +676,12 @@ class BaseObjectStore(object):
 
 class PackBasedObjectStore(BaseObjectStore):
 
+    object_id_set_min_objects = DEFAULT_OBJECT_ID_SET_MIN_OBJECTS
+
     def __init__(self):
         self._pack_cache = None
+        self._pack_cache_lock = threading.Lock()
+        self._object_numbering = None
 
     def __enter__(self):
         return self
@@ -236,6 +694,7 @@ class PackBasedObjectStore(BaseObjectStore):
             for pack in self._pack_cache:
                 pack.close()
             self._pack_cache = None
+        self._object_numbering = None
 
     @property
     def alternates(self):
@@ -261,14 +720,53 @@ class PackBasedObjectStore(BaseObjectStore):
         """
         if self._pack_cache is not None:
             self._pack_cache.append(pack)
+            self._object_numbering = None
 
     @property
     def packs(self):
         """List with pack objects."""
         if self._pack_cache is None or self._pack_cache_stale():
-            self._pack_cache = self._load_packs()
+            # Threads sharing the store load the new packs only once.
+            with self._pack_cache_lock:
+                if self._pack_cache is None or self._pack_cache_stale():
+                    self._pack_cache = self._load_packs()
+                    self._object_numbering = None
         return self._pack_cache
 
+    def memory_size(self):
+        size = super(PackBasedObjectStore, self).memory_size()
+        # Count the pack indexes and object caches of the packs opened so
+        # far, but do not open any.
+        for pack in self._pack_cache or []:
+            size += getattr(pack._idx, '_size', 0) or 0
+            if pack._data is not None:
+                size += pack._data._offset_cache._value_size
+        return size
+
+    def new_object_set(self, iterable=()):
+        """Create a set for the SHAs of objects visited by a traversal.
+
+        If object_id_set_min_objects is set and the store has at least that
+        many packed objects, this returns an ObjectIdSet numbering objects by
+        their position in the pack indexes. The numbering of the packed
+        objects is kept until the packs change.
+
+        :param iterable: Optional SHAs to add to the set
+        :return: A set-like object supporting add, discard, update, len,
+            iteration and membership tests
+        """
+        if self.object_id_set_min_objects is None:
+            return set(iterable)
+        packs = self.packs
+        numbering = self._object_numbering
+        if numbering is None:
+            numbering = ObjectNumbering([p.index for p in packs])
+            self._object_numbering = numbering
+        if len(numbering) < self.object_id_set_min_objects:
+            return set(iterable)
+        # Each set numbers the objects that are not packed on its own.
+        return ObjectIdSet(numbering.copy_packed(), iterable)
+
     def _iter_loose_objects(self):
         """Iterate over the SHAs of all loose objects."""
         raise NotImplementedError(self._iter_loose_objects)
@@ -276,6 +774,12 @@ class PackBasedObjectStore(BaseObjectStore):
     def _get_loose_object(self, sha):
         raise NotImplementedError(self._get_loose_object)
 
+    def _get_loose_object_size(self, sha):
+        obj = self._get_loose_object(sha)
+        if obj is None:
+            return None
+        return obj.raw_length()
+
     def _remove_loose_object(self, sha):
         raise NotImplementedError(self._remove_loose_object)
 
@@ -322,6 +826,30 @@ class PackBasedObjectStore(BaseObjectStore):
                 pass
         raise KeyError(sha)
 
+    def get_object_size(self, sha):
+        """Return the size of the contents of an object.
+
+        Only the header of the object is read.
+
+        :param sha: SHA of the object
+        :return: Size of the object in bytes
+        :raise KeyError: if the object does not exist
+        """
+        for pack in self.packs:
+            try:
+                return pack.get_object_size(sha)
+            except KeyError:
+                pass
+        size = self._get_loose_object_size(sha)
+        if size is not None:
+            return size
+        for alternate in self.alternates:
+            try:
+                return alternate.get_object_size(sha)
+            except KeyError:
+                pass
+        raise KeyError(sha)
+
 
     def add_objects(self, objects):
         """Add a set of objects to this object store.
@@ -350,7 +878,10 @@ class DiskObjectStore(PackBasedObjectStore):
         self.path = path
         self.pack_dir = os.path.join(self.path, PACKDIR)
         self._pack_cache_time = 0
+        self._pack_mtimes = {}
         self._alternates = None
+        self._commit_graph = None
+        self._commit_graph_loaded = False
 
     @property
     def alternates(self):
@@ -399,6 +930,197 @@ class DiskObjectStore(PackBasedObjectStore):
             f.write(("%s\n" % path).encode('utf-8'))
         self.alternates.append(DiskObjectStore(path))
 
+    def close(self):
+        super(DiskObjectStore, self).close()
+        if self._commit_graph is not None:
+            self._commit_graph.close()
+        self._commit_graph = None
+        self._commit_graph_loaded = False
+
+    @property
+    def commit_graph(self):
+        """The CommitGraph in objects/info, or None if there is none.
+
+        Like C git, a commit-graph file takes precedence over a split commit
+        graph in objects/info/commit-graphs.
+        """
+        if not self._commit_graph_loaded:
+            try:
+                self._commit_graph = CommitGraph.from_path(
+                  os.path.join(self.path, INFODIR, COMMIT_GRAPH_FILE))
+            except (OSError, IOError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._commit_graph = self._read_commit_graph_chain()
+            self._commit_graph_loaded = True
+        return self._commit_graph
+
+    def _read_commit_graph_chain(self):
+        try:
+            return read_commit_graph_chain(
+              os.path.join(self.path, INFODIR, COMMIT_GRAPHS_DIR))
+        except (OSError, IOError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def _remove_commit_graph_layers(self, keep=()):
+        """Remove the layers of the split commit graph that are not in keep.
+
+        :param keep: Names of the layer files to keep. If empty, the chain
+            file is removed as well.
+        """
+        path = os.path.join(self.path, INFODIR, COMMIT_GRAPHS_DIR)
+        try:
+            names = os.listdir(path)
+        except (OSError, IOError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            if name.endswith('.graph'):
+                if name in keep:
+                    continue
+            elif keep or name != COMMIT_GRAPH_CHAIN_FILE:
+                continue
+            try:
+                os.remove(os.path.join(path, name))
+            except (OSError, IOError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def write_commit_graph(self, heads, changed_paths=None):
+        graph = self.commit_graph
+        try:
+            os.mkdir(os.path.join(self.path, INFODIR))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        entries = list(find_commit_graph_entries(self, heads, graph))
+        if changed_paths is None:
+            changed_paths = graph is not None and graph.has_bloom_filters
+        if (graph is not None and len(entries) == len(graph) and
+            changed_paths == graph.has_bloom_filters):
+            # No new commits.
+            return graph
+        bloom_filters = None
+        if changed_paths:
+            bloom_filters = compute_bloom_filters(self, entries, graph)
+        path = os.path.join(self.path, INFODIR, COMMIT_GRAPH_FILE)
+        with GitFile(path, 'wb') as f:
+            write_commit_graph(f, entries, bloom_filters)
+        # The new file takes precedence over a split graph, which is now
+        # only in the way.
+        self._remove_commit_graph_layers()
+        # Walks in other threads may still be reading the old graph, so it is
+        # not closed; its contents are unmapped once it is no longer used.
+        self._commit_graph = CommitGraph.from_path(path)
+        self._commit_graph_loaded = True
+        return self._commit_graph
+
+    def extend_commit_graph(self, heads):
+        graph = self.commit_graph
+        if graph is None:
+            return self.write_commit_graph(heads)
+        entries = list(find_commit_graph_entries(self, heads, graph,
+                                                 new_only=True))
+        if not entries:
+            return graph
+        changed_paths = graph.has_bloom_filters
+        base = graph
+        if changed_paths and not has_current_bloom_filters(graph):
+            # All filters have to be recomputed with the current settings.
+            return self.write_commit_graph(heads, changed_paths)
+        # Like C git, merge the new commits with the top layers that have
+        # fewer than twice as many commits, so that there are only a few
+        # layers and each commit is rewritten only a few times.
+        while (base is not None and
+               2 * len(entries) >= len(base) - base.num_base_commits):
+            entries = (list(base.iterentries(base.num_base_commits)) +
+                       entries)
+            base = base.base
+        bloom_filters = None
+        if changed_paths:
+            bloom_filters = compute_bloom_filters(self, entries, graph)
+        info_path = os.path.join(self.path, INFODIR)
+        path = os.path.join(info_path, COMMIT_GRAPHS_DIR)
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        layers = []
+        if base is not None:
+            layers = base.layers()
+        # The lock on the chain file keeps other writers out until the chain
+        # is complete.
+        with GitFile(os.path.join(path, COMMIT_GRAPH_CHAIN_FILE), 'wb') as f:
+            fd, tmp_path = tempfile.mkstemp(dir=path, prefix='tmp_graph_')
+            try:
+                with os.fdopen(fd, 'wb') as layer_file:
+                    checksum = write_commit_graph(layer_file, entries,
+                                                  bloom_filters, base)
+                os.rename(tmp_path,
+                          os.path.join(path, commit_graph_layer_name(checksum)))
+            except:
+                os.remove(tmp_path)
+                raise
+            checksums = [layer.get_stored_checksum() for layer in layers]
+            checksums.append(checksum)
+            for c in checksums:
+                f.write(Sha1Sum.from_raw(c).hex_bytes + b'\n')
+        names = [commit_graph_layer_name(c) for c in checksums]
+        graph_path = os.path.join(info_path, COMMIT_GRAPH_FILE)
+        if os.path.exists(graph_path):
+            # The commit-graph file takes precedence over the chain, so it
+            # is only moved out of the way now that the chain is complete.
+            # If it is kept, it is the bottom layer.
+            if layers and not os.path.exists(os.path.join(path, names[0])):
+                os.rename(graph_path, os.path.join(path, names[0]))
+            else:
+                os.remove(graph_path)
+        self._remove_commit_graph_layers(names)
+        self._commit_graph = self._read_commit_graph_chain()
+        self._commit_graph_loaded = True
+        return self._commit_graph
+
+    def find_clone_pack(self):
+        # The file names the clone pack, followed by its tips.
+        path = os.path.join(self.path, INFODIR, CLONE_PACK_FILE)
+        try:
+            with open(path, 'rb') as f:
+                lines = [l.strip() for l in f if l.strip()]
+        except (OSError, IOError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        if not lines:
+            return None
+        name = lines[0].decode('ascii')
+        for pack in self.packs:
+            if os.path.basename(pack._basename) == name:
+                return pack, [Sha1Sum(l) for l in lines[1:]]
+        # The pack was removed, e.g. by git gc.
+        return None
+
+    def write_clone_pack(self, tips):
+        tips = list(tips)
+        try:
+            os.mkdir(os.path.join(self.path, INFODIR))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        objects = self.iter_shas(self.find_missing_objects([], tips))
+        f, commit = self.add_pack()
+        write_pack_objects(f, objects)
+        pack = commit()
+        path = os.path.join(self.path, INFODIR, CLONE_PACK_FILE)
+        with GitFile(path, 'wb') as f:
+            f.write(os.path.basename(pack._basename).encode('ascii') + b'\n')
+            for tip in tips:
+                f.write(Sha1Sum(tip).hex_bytes + b'\n')
+        return pack
+
     def _load_packs(self):
         pack_files = []
         try:
@@ -415,7 +1137,22 @@ class DiskObjectStore(PackBasedObjectStore):
             raise
         pack_files.sort(reverse=True)
         suffix_len = len(".pack")
-        return [Pack(f[:-suffix_len]) for _, f in pack_files]
+        # Packs that are already open and have not been rewritten are kept,
+        # so that their indexes and caches stay loaded.
+        old_packs = {}
+        for pack in self._pack_cache or []:
+            old_packs[pack._basename] = pack
+        packs = []
+        pack_mtimes = {}
+        for mtime, f in pack_files:
+            basename = f[:-suffix_len]
+            pack = old_packs.get(basename)
+            if pack is None or self._pack_mtimes.get(basename) != mtime:
+                pack = Pack(basename)
+            packs.append(pack)
+            pack_mtimes[basename] = mtime
+        self._pack_mtimes = pack_mtimes
+        return packs
 
     def _pack_cache_stale(self):
         try:
@@ -445,6 +1182,17 @@ class DiskObjectStore(PackBasedObjectStore):
                 return None
             raise
 
+    def _get_loose_object_size(self, sha):
+        path = self._get_shafile_path(sha)
+        try:
+            f = GitFile(path, 'rb')
+        except (OSError, IOError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        with f:
+            return read_loose_object_size(f)
+
     def _remove_loose_object(self, sha):
         os.remove(self._get_shafile_path(sha))
 
@@ -546,17 +1294,24 @@ class DiskObjectStore(PackBasedObjectStore):
     def add_pack(self):
         """Add a new pack to this object store.
 
+        The pack may be thin; deltas against objects in this store are
+        completed when it is committed.
+
         :return: Fileobject to write to and a commit function to
             call when the pack is finished.
         """
         fd, path = tempfile.mkstemp(dir=self.pack_dir, suffix=".pack")
-        f = os.fdopen(fd, 'wb')
+        f = os.fdopen(fd, 'w+b')
         def commit():
+            f.flush()
             os.fsync(fd)
-            f.close()
             if os.path.getsize(path) > 0:
-                return self.move_in_pack(path)
+                f.seek(0)
+                indexer = PackIndexer.for_pack_data(
+                  PackData(path, file=f), resolve_ext_ref=self.get_raw)
+                return self._complete_thin_pack(f, path, None, indexer)
             else:
+                f.close()
                 os.remove(path)
                 return None
         return f, commit
@@ -731,6 +1486,23 @@ class ObjectStoreIterator(ObjectIterator):
         """Return the number of objects."""
         return len(list(self.itershas()))
 
+    def get_delta_base(self, obj, path):
+        """Find an object the receiver has, to use as delta base.
+
+        :param obj: Object to find a delta base for
+        :param path: Path of the object
+        :return: An object with the same path on the receiving side, or None.
+            These are only known if the SHA iterator is a MissingObjectFinder
+            created with thin_pack=True.
+        """
+        get_delta_base = getattr(self.sha_iter, 'get_delta_base', None)
+        if get_delta_base is None:
+            return None
+        sha = get_delta_base(path)
+        if sha is None:
+            return None
+        return self.store[sha]
+
 
 def tree_lookup_path(lookup_obj, root_sha, path):
     """Look up an object in a Git tree.
@@ -746,9 +1518,145 @@ def tree_lookup_path(lookup_obj, root_sha, path):
     return tree.lookup_path(lookup_obj, path)
 
 
+def _split_commits_and_tags(object_store, shas, ignore_unknown=False):
+    """Split SHAs into commits and the tags and other objects among them.
+
+    Tags are peeled; the commits they point at are included in the commits.
+
+    :param object_store: Object store to look up the SHAs in
+    :param shas: Iterable of SHAs
+    :param ignore_unknown: Whether to skip SHAs that are not in the store,
+        rather than raising KeyError
+    :return: Tuple with a set of commit SHAs and a set of other SHAs
+    """
+    commits = set()
+    others = set()
+    for sha in shas:
+        try:
+            obj = object_store[sha]
+        except KeyError:
+            if not ignore_unknown:
+                raise
+            continue
+        while isinstance(obj, Tag):
+            others.add(obj.id)
+            try:
+                obj = object_store[obj.object[1]]
+            except KeyError:
+                if not ignore_unknown:
+                    raise
+                obj = None
+        if isinstance(obj, Commit):
+            commits.add(obj.id)
+        elif obj is not None:
+            others.add(obj.id)
+    return commits, others
+
+
+_SIZE_SUFFIXES = {b'k': 1 << 10, b'm': 1 << 20, b'g': 1 << 30}
+
+
+class ObjectFilter(object):
+    """Filter for the trees and blobs to leave out of a fetch.
+
+    Partial clones ask for these with the filter capability.
+
+    :ivar blob_limit: Blobs of this size in bytes or larger are left out, or
+        None to not filter on blob size
+    :ivar tree_depth: Trees and blobs at this depth below the root tree or
+        deeper are left out, or None to not filter on depth
+    """
+
+    def __init__(self, blob_limit=None, tree_depth=None):
+        self.blob_limit = blob_limit
+        self.tree_depth = tree_depth
+
+    def __eq__(self, other):
+        return (isinstance(other, ObjectFilter) and
+                self.blob_limit == other.blob_limit and
+                self.tree_depth == other.tree_depth)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(blob_limit=%r, tree_depth=%r)' % (
+          type(self).__name__, self.blob_limit, self.tree_depth)
+
+
+def _parse_filter_number(text):
+    multiplier = _SIZE_SUFFIXES.get(text[-1:].lower(), 1)
+    if multiplier != 1:
+        text = text[:-1]
+    if not text.isdigit():
+        raise ValueError('invalid number in filter: %r' % text)
+    return int(text) * multiplier
+
+
+def parse_filter_spec(spec):
+    """Parse a filter spec, as given to git clone --filter.
+
+    The supported specs are blob:none, blob:limit=<n> (with an optional k, m
+    or g suffix) and tree:<depth>.
+
+    :param spec: The filter spec, as bytes
+    :return: An ObjectFilter
+    :raise ValueError: if the spec is not supported
+    """
+    if spec == b'blob:none':
+        return ObjectFilter(blob_limit=0)
+    elif spec.startswith(b'blob:limit='):
+        return ObjectFilter(
+          blob_limit=_parse_filter_number(spec[len(b'blob:limit='):]))
+    elif spec.startswith(b'tree:'):
+        return ObjectFilter(
+          tree_depth=_parse_filter_number(spec[len(b'tree:'):]))
+    raise ValueError('unsupported filter spec: %r' % spec)
+
+
+def _collect_ancestors(object_store, heads, shallow=frozenset(),
+                       common=frozenset(), unshallow=frozenset()):
+    """Collect the commits reachable from a set of heads.
+
+    :param object_store: Object store with the commits
+    :param heads: SHAs of the commits to start from
+    :param shallow: SHAs of commits whose parents are not walked
+    :param common: SHAs of commits at which the walk stops
+    :param unshallow: SHAs of commits in common whose parents are walked
+        nonetheless
+    :return: Set of the SHAs of the commits walked, apart from those in common
+    """
+    result = object_store.new_object_set()
+    unshallowed = set()
+    todo = list(heads)
+    while todo:
+        sha = todo.pop()
+        if sha in common:
+            if sha not in unshallow or sha in unshallowed:
+                continue
+            unshallowed.add(sha)
+        elif sha in result:
+            continue
+        else:
+            result.add(sha)
+        if sha not in shallow:
+            todo.extend(object_store.get_parents(sha))
+    return result
+
+
+# Number of objects between progress reports of the MissingObjectFinder.
+_PROGRESS_INTERVAL = 1000
+
+
 class MissingObjectFinder(object):
     """Find the objects missing from another object store.
 
+    The commits reachable from the wants but not from the haves are found
+    first. The trees and blobs of the haves, and of the commits on the edge
+    of the missing history, are then marked as present on the target, like C
+    git does for the negative refs given to rev-list --objects. Only the
+    trees and blobs of missing commits that are not marked this way are sent.
+
     :param object_store: Object store containing at least all objects to be
         sent
     :param haves: SHA1s of commits not to send (already present in target)
@@ -756,38 +1664,180 @@ class MissingObjectFinder(object):
     :param progress: Optional function to report progress to.
     :param get_tagged: Function that returns a dict of pointed-to sha -> tag
         sha for including tags.
-    :param tagged: dict of pointed-to sha -> tag sha for including tags
+    :param shallow: Optional set of SHAs of commits whose parents are not to
+        be sent
+    :param target_shallow: Optional set of SHAs of commits whose parents are
+        missing from the target, so that the haves only stand for the history
+        down to them. The history of the haves is then walked in full, rather
+        than only as far as the history of the wants. The history of those
+        that are not in shallow is sent.
+    :param object_filter: Optional ObjectFilter for the trees and blobs of
+        the missing commits to leave out. Blob sizes are read from the object
+        headers. Trees and blobs that are wanted explicitly are always sent.
+    :param thin_pack: Whether to remember the trees and blobs marked as
+        present by name, so that get_delta_base can suggest them as delta
+        bases for the objects sent with the same name.
     """
 
     def __init__(self, object_store, haves, wants, progress=None,
-                 get_tagged=None):
-        haves = set(haves)
-
-        self.sha_done = haves
-        self.objects_to_send = set([(w, None, False) for w in wants
-                                    if w not in haves])
+                 get_tagged=None, shallow=None, target_shallow=None,
+                 object_filter=None, thin_pack=False):
         self.object_store = object_store
+        self._filter = object_filter
+        if thin_pack:
+            self._delta_bases = {}
+        else:
+            self._delta_bases = None
+        # Smallest depth below a root tree at which each tree and blob was
+        # reached, and the trees parsed so far, if filtering on depth.
+        self._depths = {}
+        self._parsed_trees = set()
         if progress is None:
             self.progress = lambda x: None
         else:
             self.progress = progress
         if get_tagged is None:
-            self._tagged = lambda: {}
+            self._tagged = {}
         else:
-            self._tagged = get_tagged
+            self._tagged = get_tagged()
+
+        have_commits, have_others = _split_commits_and_tags(
+          object_store, haves, ignore_unknown=True)
+        want_commits, want_others = _split_commits_and_tags(
+          object_store, wants)
+        self.sha_done = object_store.new_object_set(have_others)
+        self._num_found = 0
+
+        if shallow is None:
+            shallow = frozenset()
+        # (sha, parents) tuples rather than commits, which can be large.
+        children = []
+        unshallow = frozenset()
+        if shallow or target_shallow:
+            if target_shallow is None:
+                target_shallow = frozenset()
+            # The target gets the parents of its shallow commits that are
+            # no longer shallow.
+            unshallow = set(target_shallow) - set(shallow)
+            common = _collect_ancestors(object_store, have_commits,
+                                        target_shallow)
+            missing = _collect_ancestors(
+              object_store, list(want_commits) + list(unshallow), shallow,
+              common, unshallow)
+            children = [(sha, object_store.get_parents(sha))
+                        for sha in missing]
+        else:
+            missing = object_store.new_object_set()
+            if want_commits:
+                walker = Walker(object_store, list(want_commits),
+                                exclude=list(have_commits))
+                for entry in walker:
+                    commit = entry.commit
+                    children.append((commit.id, commit.parents))
+                    missing.add(commit.id)
+        edge_commits = set(have_commits)
+        self.objects_to_send = set([(sha, None, False)
+                                    for sha, parents in children])
+        children.extend((sha, object_store.get_parents(sha))
+                        for sha in unshallow if sha in object_store)
+        for sha, parents in children:
+            if sha in shallow:
+                continue
+            edge_commits.update(p for p in parents
+                                if p not in missing and p in object_store)
+        for sha in edge_commits:
+            self.sha_done.add(sha)
+            self._mark_tree_done(object_store[sha].tree)
+
+        self.add_todo([(sha, None, False) for sha in want_others])
+
+    def _mark_tree_done(self, tree_sha):
+        """Mark a tree and everything it contains as present on the target."""
+        delta_bases = self._delta_bases
+        # Root trees have the same name as in parse_commit.
+        todo = [(tree_sha, "")]
+        while todo:
+            sha, name = todo.pop()
+            if sha in self.sha_done:
+                continue
+            self.sha_done.add(sha)
+            if delta_bases is not None:
+                delta_bases.setdefault(name, sha)
+            for name, mode, entry_sha in self.object_store[sha].iteritems():
+                if stat.S_ISDIR(mode):
+                    todo.append((entry_sha, name))
+                elif not S_ISGITLINK(mode):
+                    self.sha_done.add(entry_sha)
+                    if delta_bases is not None:
+                        delta_bases.setdefault(name, entry_sha)
+
+    def get_delta_base(self, name):
+        """Find an object the target has with the same name as another.
+
+        :param name: Name of an object to send
+        :return: SHA of a tree or blob with that name in the trees of the
+            haves or the edge commits, or None if there is none or thin_pack
+            was not set
+        """
+        if not self._delta_bases:
+            return None
+        return self._delta_bases.get(name)
 
     def add_todo(self, entries):
         self.objects_to_send.update([e for e in entries
                                      if not e[0] in self.sha_done])
 
-    def parse_tree(self, tree):
-        self.add_todo([(sha, name, not stat.S_ISDIR(mode))
-                       for name, mode, sha in tree.items()
-                       if not S_ISGITLINK(mode)])
+    def _filter_entries(self, entries, depth):
+        """Leave out the trees and blobs the filter asks for.
+
+        :param entries: List of (sha, name, leaf) tuples
+        :param depth: Depth of the entries below the root tree
+        :return: List of the entries to send
+        """
+        tree_depth = self._filter.tree_depth
+        blob_limit = self._filter.blob_limit
+        result = []
+        for entry in entries:
+            sha, name, leaf = entry
+            if tree_depth is not None:
+                if self._depths.get(sha, depth + 1) <= depth:
+                    continue
+                self._depths[sha] = depth
+                if depth >= tree_depth:
+                    # Not marked as done, as it may yet be reached at a
+                    # smaller depth.
+                    continue
+                if sha in self._parsed_trees:
+                    # Sent at a greater depth before, which may have left out
+                    # entries that are in range now.
+                    self.parse_tree(self.object_store[sha], sha)
+                    continue
+            if (leaf and blob_limit is not None and sha not in self.sha_done
+                and self.object_store.get_object_size(sha) >= blob_limit):
+                self.sha_done.add(sha)
+                continue
+            result.append(entry)
+        return result
+
+    def parse_tree(self, tree, tree_sha=None):
+        entries = [(sha, name, not stat.S_ISDIR(mode))
+                   for name, mode, sha in tree.iteritems()
+                   if not S_ISGITLINK(mode)]
+        if self._filter is not None:
+            # The SHA is usually known already; computing tree.id would
+            # serialize a compacted tree again.
+            if tree_sha is None:
+                tree_sha = tree.id
+            self._parsed_trees.add(tree_sha)
+            entries = self._filter_entries(
+              entries, self._depths.get(tree_sha, 0) + 1)
+        self.add_todo(entries)
 
     def parse_commit(self, commit):
-        self.add_todo([(commit.tree, "", False)])
-        self.add_todo([(p, None, False) for p in commit.parents])
+        entries = [(commit.tree, "", False)]
+        if self._filter is not None:
+            entries = self._filter_entries(entries, 0)
+        self.add_todo(entries)
 
     def parse_tag(self, tag):
         self.add_todo([(tag.object[1], None, False)])
@@ -804,16 +1854,20 @@ class MissingObjectFinder(object):
             if isinstance(o, Commit):
                 self.parse_commit(o)
             elif isinstance(o, Tree):
-                self.parse_tree(o)
+                self.parse_tree(o, sha)
             elif isinstance(o, Tag):
                 self.parse_tag(o)
-        tagged = self._tagged()
-        if sha in tagged:
-            self.add_todo([(tagged[sha], None, True)])
+        if sha in self._tagged:
+            self.add_todo([(self._tagged[sha], None, True)])
         self.sha_done.add(sha)
-        self.progress("counting objects: %d\r" % len(self.sha_done))
+        self._num_found += 1
+        if not self._num_found % _PROGRESS_INTERVAL:
+            self.progress("counting objects: %d\r" % self._num_found)
         return (sha, name)
 
+    def __iter__(self):
+        return iter(self.__next__, None)
+
 
 class ObjectStoreGraphWalker(object):
     """Graph walker that finds what commits are missing from an object store.
@@ -822,15 +1876,38 @@ class ObjectStoreGraphWalker(object):
     :ivar get_parents: Function to retrieve parents in the local repo
     """
 
-    def __init__(self, local_heads, get_parents):
+    def __init__(self, local_heads, get_parents, new_object_set=set,
+                 shallow=None):
         """Create a new instance.
 
         :param local_heads: Heads to start search with
         :param get_parents: Function for finding the parents of a SHA1.
+        :param new_object_set: Function that returns an empty set for the
+            SHAs of acknowledged commits.
+        :param shallow: Set of SHAs of local commits whose parents are missing
         """
         self.heads = set(local_heads)
         self.get_parents = get_parents
         self.parents = {}
+        self._acked = new_object_set()
+        if shallow is None:
+            shallow = set()
+        self.shallow = shallow
+        self.new_shallow = set()
+        self.new_unshallow = set()
+
+    def update_shallow(self, new_shallow, new_unshallow):
+        """Record the changes to the shallow commits told by the server.
+
+        The changes only apply to the repository once the fetched objects are
+        stored, so writing them out is left to the caller; until then, the
+        walk still stops at the commits in shallow.
+
+        :param new_shallow: SHAs of commits that become shallow
+        :param new_unshallow: SHAs of commits that are no longer shallow
+        """
+        self.new_shallow.update(new_shallow)
+        self.new_unshallow.update(new_unshallow)
 
     def ack(self, sha):
         """Ack that a revision and its ancestors are present in the source."""
@@ -845,10 +1922,10 @@ class ObjectStoreGraphWalker(object):
             # collect all ancestors
             new_ancestors = set()
             for a in ancestors:
-                ps = self.parents.get(a)
+                ps = self.parents.pop(a, None)
                 if ps is not None:
                     new_ancestors.update(ps)
-                self.parents[a] = None
+                self._acked.add(a)
 
             # no more ancestors; stop
             if not new_ancestors:
@@ -860,8 +1937,13 @@ class ObjectStoreGraphWalker(object):
         """Iterate over ancestors of heads in the target."""
         if self.heads:
             ret = self.heads.pop()
-            ps = self.get_parents(ret)
+            if ret in self.shallow:
+                # The parents are not available locally.
+                ps = []
+            else:
+                ps = self.get_parents(ret)
             self.parents[ret] = ps
-            self.heads.update([p for p in ps if not p in self.parents])
+            self.heads.update([p for p in ps if p not in self.parents and
+                               p not in self._acked])
             return ret
         return None
@@ -20,6 +20,7 @@
 """Access to base git objects."""
 
 
+from array import array
 import binascii
 from io import (
     BytesIO,
@@ -30,7 +31,7 @@ import stat
 import warnings
 import zlib
 import hashlib
-import re
+import operator
 
 from collections import namedtuple
 
@@ -61,10 +62,6 @@ _TYPE_HEADER = "type"
 _TAG_HEADER = "tag"
 _TAGGER_HEADER = "tagger"
 
-# What's a SHA1 sum look like?
-_SREX = re.compile("^[A-Fa-f0-9]{40}$")
-_HBREX = re.compile(b"^[A-Fa-f0-9]{40}$")
-
 
 S_IFGITLINK = 0o160000
 
@@ -97,6 +94,44 @@ def filename_to_sha(filename):
     return Sha1Sum(hex)
 
 
+def read_loose_object_size(f):
+    """Read the size of a loose object from the start of its file.
+
+    Only as much of the file is read and decompressed as the header takes.
+
+    :param f: File object positioned at the start of the object file
+    :return: Size of the object contents in bytes
+    :raise ObjectFormatException: if the header is invalid
+    """
+    magic = f.read(2)
+    if len(magic) < 2:
+        raise ObjectFormatException("invalid object header")
+    if not ShaFile._is_legacy_object(magic):
+        # New style objects start with an uncompressed pack object header.
+        header = bytearray(magic[:1])
+        rest = magic[1:]
+        while header[-1] & 0x80:
+            byte, rest = rest or f.read(1), b''
+            if not byte:
+                raise ObjectFormatException("invalid object header")
+            header.extend(byte)
+        size = header[0] & 0x0f
+        for i, byte in enumerate(header[1:]):
+            size += (byte & 0x7f) << ((i * 7) + 4)
+        return size
+    decomp = zlib.decompressobj()
+    header = decomp.decompress(magic)
+    while b'\0' not in header:
+        data = f.read(64)
+        if not data:
+            raise ObjectFormatException("Invalid object header, no \\0")
+        header += decomp.decompress(data)
+    try:
+        return int(header[:header.index(b'\0')].split(b' ', 1)[1])
+    except (IndexError, ValueError):
+        raise ObjectFormatException("invalid object header")
+
+
 def object_header(num_type, length):
     """Return an object header for the given numeric type and text length."""
     return object_class(num_type).type_name.encode('utf-8') + \
@@ -114,6 +149,21 @@ def serializable_property(name, docstring=None):
     return property(get, set, doc=docstring)
 
 
+def _lazy_serializable_property(name, docstring=None):
+    """Like serializable_property, but for fields that are parsed on demand.
+
+    The getter only parses the object completely when the field is accessed.
+    """
+    def set(obj, value):
+        obj._ensure_fully_parsed()
+        setattr(obj, "_"+name, value)
+        obj._needs_serialization = True
+    def get(obj):
+        obj._ensure_fully_parsed()
+        return getattr(obj, "_"+name)
+    return property(get, set, doc=docstring)
+
+
 def object_class(type):
     """Get the object class corresponding to the given type.
 
@@ -164,10 +214,12 @@ def _as_sha(obj):
 class Sha1Sum(object):
     """
     Represent a sha-1 sum as bytes, ascii bytes, and a unicode string
+
+    The raw digest is always stored; the hex and string forms are computed on
+    first access and cached.
     """
 
-    __slots__ = ('_string', '_hex_bytes', '_bytes',
-                 '_get_string', '_get_bytes', '_get_hex_bytes')
+    __slots__ = ('_bytes', '_hex_bytes', '_string', '_error')
 
     def __init__(self, sha, error_message=None, resolve=False,
                  lazy_errors=False):
@@ -183,125 +235,102 @@ class Sha1Sum(object):
         :param lazy_errors: If True, no errors are thrown until someone asks
             for the value. Otherwise the errors are thrown immediately.
         """
+        self._bytes = None
+        self._hex_bytes = None
+        self._string = None
+        self._error = None
 
-        def _exception(default_msg, cls=ObjectFormatException):
-            if not error_message:
-                ex = cls("{0}: {1}".format(default_msg, repr(sha)))
-            else:
-                ex = cls("{0}: {1}".format(error_message, repr(sha)))
-
-            if not lazy_errors:
-                raise ex
-            else:
-                def _throw():
-                    raise ex
-
-                self._string = None
-                self._hex_bytes = None
-                self._bytes = None
-                self._get_string = _throw
-                self._get_bytes = _throw
-                self._get_hex_bytes = _throw
-
-        if isinstance(sha, str):
-            # The only kind of actual strings accepted are len 40 hex strings
-
-            self._string = sha
-            self._hex_bytes = None
-            self._bytes = None
-
-            # Could be a bit of a performance drain
-            if not _SREX.match(sha):
-                _exception('invalid sha string')
-                return
-
-            self._get_string = None
-            self._get_bytes = lambda: binascii.unhexlify(sha.encode('utf-8'))
-            self._get_hex_bytes = lambda: sha.encode('utf-8')
-
-        elif isinstance(sha, bytes):
-            # Bytes objects could be a raw digest or an encoded hex string
-
+        if isinstance(sha, bytes):
             if len(sha) == 20:
                 # It's a raw digest
-
-                self._string = None
-                self._hex_bytes = None
                 self._bytes = sha
-
-                self._get_string = \
-                  lambda: binascii.hexlify(sha).decode('utf-8')
-                self._get_hex_bytes = lambda: binascii.hexlify(sha)
-                self._get_bytes = None
-
             elif len(sha) == 40:
                 # It's probably an encoded hex string
-
-                self._string = None
-                self._hex_bytes = sha
-                self._bytes = None
-
-                # Could be a bit of a performance drain
-                if not _HBREX.match(sha):
-                    _exception('invalid sha byte string')
+                try:
+                    self._bytes = binascii.unhexlify(sha)
+                except ValueError:
+                    self._set_error(sha, 'invalid sha byte string',
+                                    error_message, lazy_errors)
                     return
-
-                self._get_string = lambda: sha.decode('utf-8')
-                self._get_hex_bytes = None
-                self._get_bytes = lambda: binascii.unhexlify(sha)
-
+                self._hex_bytes = sha
             else:
-                # It's garbage
-                _exception('unrecognized bytes object')
+                self._set_error(sha, 'unrecognized bytes object',
+                                error_message, lazy_errors)
                 return
 
+        elif isinstance(sha, str):
+            # The only kind of actual strings accepted are len 40 hex strings
+            try:
+                if len(sha) != 40:
+                    raise ValueError(sha)
+                self._bytes = binascii.unhexlify(sha)
+            except ValueError:
+                self._set_error(sha, 'invalid sha string', error_message,
+                                lazy_errors)
+                return
+            self._string = sha
+
         elif isinstance(sha, Sha1Sum):
             # It's another Sha1Sum object, copy it
-
-            self._string = sha._string
-            self._hex_bytes = sha._hex_bytes
             self._bytes = sha._bytes
-            self._get_string = sha._get_string
-            self._get_hex_bytes = sha._get_hex_bytes
-            self._get_bytes = sha._get_bytes
+            self._hex_bytes = sha._hex_bytes
+            self._string = sha._string
+            self._error = sha._error
 
         elif hasattr(sha, 'digest') and callable(sha.digest):
             # It could be a hashlib sha1 object, let's try calling it...
-
-            self._string = None
-            self._hex_bytes = None
-            self._bytes = sha.digest()
-
-            # digest() should return a bytes object
-            if not isinstance(self._bytes, bytes):
-                _exception('unrecognized sha object')
-                return
-
-            # Damn, it looked so promising
-            if len(self._bytes) != 20:
-                _exception('unrecognized sha object')
+            digest = sha.digest()
+            if not isinstance(digest, bytes) or len(digest) != 20:
+                self._set_error(sha, 'unrecognized sha object', error_message,
+                                lazy_errors)
                 return
-
-            self._get_string = \
-              lambda: binascii.hexlify(self._bytes).decode('utf-8')
-            self._get_hex_bytes = lambda: binascii.hexlify(self._bytes)
-            self._get_bytes = None
+            self._bytes = digest
 
         else:
-            _exception('expecting a SHA-1 hash as a bytes or str object', cls=TypeError)
+            self._set_error(sha,
+                'expecting a SHA-1 hash as a bytes or str object',
+                error_message, lazy_errors, cls=TypeError)
             return
 
         if resolve:
             # Go ahead and fill in all the other representations up front
-            if self._string is None:
-                self._string = self._get_string()
-            if self._hex_bytes is None:
-                self._hex_bytes = self._get_hex_bytes()
-            if self._bytes is None:
-                self._bytes = self._get_bytes()
-            self._get_string = None
-            self._get_hex_bytes = None
-            self._get_bytes = None
+            self.hex_bytes
+            self.string
+
+    def _set_error(self, sha, default_msg, error_message, lazy_errors,
+                   cls=ObjectFormatException):
+        ex = cls("{0}: {1}".format(error_message or default_msg, repr(sha)))
+        if not lazy_errors:
+            raise ex
+        self._error = ex
+
+    @classmethod
+    def from_raw(cls, digest, intern_table=None):
+        """Create a SHA-1 sum from a trusted raw digest.
+
+        This skips the type sniffing and validation done by the constructor,
+        so it should only be used for digests read from well-formed binary
+        structures (trees, pack files and index files).
+
+        :param digest: A length-20 raw bytes object
+        :param intern_table: Optional dict mapping raw digests to Sha1Sum
+            objects. If given, an existing entry is returned instead of a new
+            object, and new objects are added to it. The caller owns the table
+            and decides how long it lives.
+        :return: A Sha1Sum object
+        """
+        if intern_table is not None:
+            ret = intern_table.get(digest)
+            if ret is not None:
+                return ret
+        ret = object.__new__(cls)
+        ret._bytes = digest
+        ret._hex_bytes = None
+        ret._string = None
+        ret._error = None
+        if intern_table is not None:
+            intern_table[digest] = ret
+        return ret
 
     @property
     def string(self):
@@ -310,8 +339,7 @@ class Sha1Sum(object):
         :return: A hex string representing a sha-1 sum
         """
         if self._string is None:
-            self._string = self._get_string()
-            self._get_string = None
+            self._string = self.hex_bytes.decode('ascii')
         return self._string
 
     @property
@@ -329,8 +357,7 @@ class Sha1Sum(object):
         :return: A hex byte-string representing a sha-1 sum
         """
         if self._hex_bytes is None:
-            self._hex_bytes = self._get_hex_bytes()
-            self._get_hex_bytes = None
+            self._hex_bytes = binascii.hexlify(self.bytes)
         return self._hex_bytes
 
     @property
@@ -348,8 +375,7 @@ class Sha1Sum(object):
         :return: A raw byte-string representing a sha-1 sum
         """
         if self._bytes is None:
-            self._bytes = self._get_bytes()
-            self._get_bytes = None
+            raise self._error
         return self._bytes
 
     def digest(self):
@@ -412,6 +438,8 @@ class Sha1Sum(object):
         :return: True if the two Sha1Sum objects are equal, False otherwise
         """
         try:
+            if isinstance(other, Sha1Sum):
+                return self.bytes == other.bytes
             return self.bytes == _as_sha(other).bytes
         except (TypeError, ObjectFormatException):
             return False
@@ -599,7 +627,9 @@ class ShaFile(object):
                 else:
                     raise AssertionError(
                         "ShaFile needs either text or filename")
-            self._deserialize(self._chunked_text)
+                # Reading the file already deserialized the object.
+            else:
+                self._deserialize(self._chunked_text)
             self._needs_parsing = False
 
     def set_raw_string(self, text):
@@ -796,7 +826,7 @@ class ShaFile(object):
 
     @property
     def id(self):
-        return Sha1Sum(self.sha().hexdigest())
+        return Sha1Sum.from_raw(self.sha().digest())
 
     def get_type(self):
         return self.type_num
@@ -1049,7 +1079,7 @@ class TreeEntry(namedtuple('TreeEntry', ['path', 'mode', 'sha'])):
 
         if not isinstance(self.path, bytes) or not isinstance(path, bytes):
             raise TypeError
-        return TreeEntry(posixpath.join(path.decode('utf-8'), self.path.decode('utf-8')).encode('utf-8'), self.mode, self.sha)
+        return TreeEntry(posixpath.join(path, self.path), self.mode, self.sha)
 
 def parse_tree(text, strict=False):
     """Parse a tree text.
@@ -1076,7 +1106,43 @@ def parse_tree(text, strict=False):
         sha = text[name_end+1:count]
         if len(sha) != 20:
             raise ObjectFormatException("Sha has invalid length")
-        yield (name, mode, Sha1Sum(sha))
+        yield (name, mode, Sha1Sum.from_raw(sha))
+
+
+def iter_tree_entries(text):
+    """Iterate over the entries of a tree text in stored order.
+
+    Unlike parse_tree, this yields TreeEntry objects and only slices the names
+    and binary SHAs out of the text. For well-formed trees the stored order is
+    tree order, as returned by sorted_tree_items.
+
+    :param text: Serialized text to parse
+    :return: iterator of TreeEntry objects
+    :raise ObjectFormatException: if the object was malformed in some way
+    """
+    make_entry = TreeEntry._make
+    from_raw = Sha1Sum.from_raw
+    find = text.find
+    offset = 0
+    end = len(text)
+    while offset < end:
+        mode_end = find(b' ', offset)
+        name_end = find(b'\0', mode_end)
+        if mode_end < 0 or name_end < 0:
+            raise ObjectFormatException("Truncated tree entry")
+        try:
+            mode = int(text[offset:mode_end], 8)
+        except ValueError:
+            raise ObjectFormatException(
+              "Invalid mode '%s'" % text[offset:mode_end])
+        offset = name_end + 21
+        if offset > end:
+            raise ObjectFormatException("Sha has invalid length")
+        yield make_entry((text[mode_end+1:name_end], mode,
+                          from_raw(text[name_end+1:offset])))
+
+
+_entry_path = operator.itemgetter(0)
 
 
 def serialize_tree(items):
@@ -1146,6 +1212,110 @@ def cmp_entry_name_order(entry1, entry2):
     return (entry1[0] > entry2[0]) - (entry1[0] < entry2[0])
 
 
+class _CompactTreeEntries(object):
+    """Read-only tree entries stored in flat arrays.
+
+    The names are kept in a single string indexed by an array of offsets, the
+    modes in an array and the binary SHAs in one string of 20 bytes per
+    entry. Entries are stored in tree order, so lookups by name can bisect.
+    """
+
+    __slots__ = ('_names', '_offsets', '_modes', '_shas')
+
+    def __init__(self, entries):
+        """Create compact entries.
+
+        :param entries: Iterable of (name, mode, sha) tuples in tree order
+        :raise ValueError: if the entries are not strictly in tree order
+        """
+        names = []
+        shas = []
+        offsets = array('I', [0])
+        modes = array('I')
+        offset = 0
+        last = None
+        for name, mode, sha in entries:
+            key = stat.S_ISDIR(mode) and name + b'/' or name
+            if last is not None and key <= last:
+                raise ValueError('entries not in tree order: %r' % name)
+            last = key
+            names.append(name)
+            offset += len(name)
+            offsets.append(offset)
+            modes.append(mode)
+            shas.append(_as_sha(sha).bytes)
+        self._names = b''.join(names)
+        self._offsets = offsets
+        self._modes = modes
+        self._shas = b''.join(shas)
+
+    def _find(self, name):
+        """Return the index of the entry called name, or -1."""
+        names = self._names
+        offsets = self._offsets
+        modes = self._modes
+        S_ISDIR = stat.S_ISDIR
+        # A subtree sorts as if its name ended in '/', so look for a file
+        # under name and for a subtree under name + '/'. A name that already
+        # ends in '/' can not be that of a subtree.
+        keys = [(name, False)]
+        if not name.endswith(b'/'):
+            keys.append((name + b'/', True))
+        for key, is_dir in keys:
+            lo, hi = 0, len(modes)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                mid_is_dir = S_ISDIR(modes[mid])
+                mid_key = names[offsets[mid]:offsets[mid+1]]
+                if mid_is_dir:
+                    mid_key += b'/'
+                if mid_key < key:
+                    lo = mid + 1
+                elif mid_key == key:
+                    if mid_is_dir == is_dir:
+                        return mid
+                    break
+                else:
+                    hi = mid
+        return -1
+
+    def _entry(self, i):
+        return TreeEntry(self._names[self._offsets[i]:self._offsets[i+1]],
+                         self._modes[i],
+                         Sha1Sum.from_raw(self._shas[20*i:20*i+20]))
+
+    def __len__(self):
+        return len(self._modes)
+
+    def __contains__(self, name):
+        return self._find(name) >= 0
+
+    def __getitem__(self, name):
+        i = self._find(name)
+        if i < 0:
+            raise KeyError(name)
+        entry = self._entry(i)
+        return entry.mode, entry.sha
+
+    def __iter__(self):
+        names = self._names
+        offsets = self._offsets
+        for i in range(len(self._modes)):
+            yield names[offsets[i]:offsets[i+1]]
+
+    def iteritems(self):
+        """Iterate over the entries in tree order.
+
+        :return: Iterator over TreeEntry objects
+        """
+        for i in range(len(self._modes)):
+            yield self._entry(i)
+
+    def to_dict(self):
+        """Return a dictionary mapping names to (mode, sha) tuples."""
+        return dict((name, (mode, sha)) for name, mode, sha in self.iteritems())
+
+
 class Tree(ShaFile):
     """A Git tree object"""
 
@@ -1154,6 +1324,13 @@ class Tree(ShaFile):
 
     __slots__ = ('_entries')
 
+    # _entries is None while the tree has only been deserialized. The
+    # dictionary of entries is built on first use; iterating in tree order
+    # reads straight from the raw text instead. After compact(), _entries
+    # holds a _CompactTreeEntries and the raw text is dropped; it is
+    # regenerated on demand and modifying the tree turns it back into a
+    # dictionary.
+
     def __init__(self):
         super(Tree, self).__init__()
         self._entries = {}
@@ -1165,13 +1342,44 @@ class Tree(ShaFile):
             raise NotTreeError(filename)
         return tree
 
-    def __contains__(self, name):
+    def _raw_text(self):
+        """Return the raw text of this tree as a single string."""
+        chunks = self._chunked_text
+        if len(chunks) != 1:
+            # Join once and keep the result, so that repeated iteration does
+            # not copy the text again.
+            chunks = self._chunked_text = [b''.join(chunks)]
+        return chunks[0]
+
+    def _ensure_entries(self, writable=True):
+        """Return the entries, building a dictionary if necessary.
+
+        :param writable: If False, compact entries are returned as they are
+            instead of being converted into a dictionary.
+        """
         self._ensure_parsed()
-        return name in self._entries
+        if isinstance(self._entries, _CompactTreeEntries):
+            if writable:
+                # The raw text is serialized again from the dictionary.
+                self._entries = self._entries.to_dict()
+                self._chunked_text = []
+                self._needs_serialization = True
+        elif self._entries is None:
+            try:
+                parsed_entries = parse_tree(self._raw_text())
+            except ValueError as e:
+                raise ObjectFormatException(e)
+            # TODO: list comprehension is for efficiency in the common (small)
+            # case; if memory efficiency in the large case is a concern, use
+            # a genexp.
+            self._entries = dict([(n, (m, s)) for n, m, s in parsed_entries])
+        return self._entries
+
+    def __contains__(self, name):
+        return name in self._ensure_entries(False)
 
     def __getitem__(self, name):
-        self._ensure_parsed()
-        return self._entries[name]
+        return self._ensure_entries(False)[name]
 
     def __setitem__(self, name, value):
         """Set a tree entry by name.
@@ -1182,22 +1390,20 @@ class Tree(ShaFile):
             a string.
         """
         mode, sha = value
-        self._ensure_parsed()
-        self._entries[name] = (mode, sha)
+        self._ensure_entries()[name] = (mode, sha)
         self._needs_serialization = True
 
     def __delitem__(self, name):
-        self._ensure_parsed()
-        del self._entries[name]
+        if name not in self:
+            raise KeyError(name)
+        del self._ensure_entries()[name]
         self._needs_serialization = True
 
     def __len__(self):
-        self._ensure_parsed()
-        return len(self._entries)
+        return len(self._ensure_entries(False))
 
     def __iter__(self):
-        self._ensure_parsed()
-        return iter(self._entries)
+        return iter(self._ensure_entries(False))
 
     def add(self, name, mode, sha):
         """Add an entry to the tree.
@@ -1207,8 +1413,7 @@ class Tree(ShaFile):
         :param name: The name of the entry, as a string.
         :param hexsha: The hex SHA of the entry as a string.
         """
-        self._ensure_parsed()
-        self._entries[name] = mode, sha
+        self._ensure_entries()[name] = mode, sha
         self._needs_serialization = True
 
     def entries(self):
@@ -1230,11 +1435,25 @@ class Tree(ShaFile):
     def iteritems(self, name_order=False):
         """Iterate over entries.
 
+        If the tree has not been modified since it was read, the entries are
+        read straight from the raw text, without building a dictionary or
+        sorting it.
+
         :param name_order: If True, iterate in name order instead of tree order.
         :return: Iterator over (name, mode, sha) tuples
         """
         self._ensure_parsed()
-        return sorted_tree_items(self._entries, name_order)
+        if isinstance(self._entries, _CompactTreeEntries):
+            entries = self._entries.iteritems()
+        elif self._entries is not None:
+            return sorted_tree_items(self._entries, name_order)
+        else:
+            entries = iter_tree_entries(self._raw_text())
+        if name_order:
+            # Tree order only differs from name order around subtrees, so
+            # the stored entries are nearly sorted already.
+            entries = sorted(entries, key=_entry_path)
+        return iter(entries)
 
     def items(self):
         """Return the sorted entries in this tree.
@@ -1243,15 +1462,42 @@ class Tree(ShaFile):
         """
         return list(self.iteritems())
 
+    def compact(self):
+        """Store the entries of this tree in a compact form.
+
+        The names, modes and SHAs are packed into flat arrays and the raw text
+        is dropped, which keeps the memory used by large trees close to their
+        raw size. Lookups by name bisect the sorted entries. Modifying the
+        tree turns it back into a dictionary of entries.
+
+        :return: True if the tree was compacted, False if its entries are not
+            in tree order and it was left as it is.
+        """
+        self._ensure_parsed()
+        if isinstance(self._entries, _CompactTreeEntries):
+            return True
+        try:
+            entries = _CompactTreeEntries(self.iteritems())
+        except (ValueError, ObjectFormatException):
+            return False
+        # Hash the raw text while it is still there, as serializing the
+        # compact entries again is slow.
+        self.sha()
+        self._needs_serialization = False
+        self._entries = entries
+        self._chunked_text = None
+        return True
+
+    def as_raw_chunks(self):
+        if self._chunked_text is None:
+            # The raw text of compacted trees is not kept around.
+            return list(serialize_tree(self._entries.iteritems()))
+        return super(Tree, self).as_raw_chunks()
+
     def _deserialize(self, chunks):
         """Grab the entries in the tree"""
-        try:
-            parsed_entries = parse_tree(b"".join(chunks))
-        except ValueError as e:
-            raise ObjectFormatException(e)
-        # TODO: list comprehension is for efficiency in the common (small) case;
-        # if memory efficiency in the large case is a concern, use a genexp.
-        self._entries = dict([(n, (m, s)) for n, m, s in parsed_entries])
+        self._chunked_text = chunks
+        self._entries = None
 
     def check(self):
         """Check this object for internal consistency.
@@ -1264,8 +1510,7 @@ class Tree(ShaFile):
                          stat.S_IFLNK, stat.S_IFDIR, S_IFGITLINK,
                          # TODO: optionally exclude as in git fsck --strict
                          stat.S_IFREG | 0o664)
-        for name, mode, sha in parse_tree(b''.join(self._chunked_text),
-                                          True):
+        for name, mode, sha in parse_tree(self.as_raw_string(), True):
             check_hexsha(sha, 'invalid sha %s' % sha)
             if b'/' in name or name in (b'', b'.', b'..'):
                 raise ObjectFormatException('invalid name %s' % name)
@@ -1364,7 +1609,7 @@ class Commit(ShaFile):
                  '_commit_timezone_neg_utc', '_commit_time',
                  '_author_time', '_author_timezone', '_commit_timezone',
                  '_author', '_committer', '_parents', '_extra',
-                 '_encoding', '_tree', '_message')
+                 '_encoding', '_tree', '_message', '_unparsed_text')
 
     def __init__(self):
         super(Commit, self).__init__()
@@ -1373,6 +1618,7 @@ class Commit(ShaFile):
         self._extra = {}
         self._author_timezone_neg_utc = False
         self._commit_timezone_neg_utc = False
+        self._unparsed_text = None
 
     @classmethod
     def from_path(cls, path):
@@ -1382,35 +1628,90 @@ class Commit(ShaFile):
         return commit
 
     def _deserialize(self, chunks):
+        """Parse the fields needed for walking history.
+
+        Only the tree, parents and commit time are parsed here; the remaining
+        header lines and the message are parsed by _ensure_fully_parsed when
+        one of them is first accessed.
+        """
+        text = b''.join(chunks)
+        self._tree = None
         self._parents = []
-        self._extra = []
-        self._author = None
+        self._commit_time = None
+        self._unparsed_text = text
+
+        offset = 0
+        end = len(text)
+        while offset < end:
+            eol = text.find(b'\n', offset)
+            if eol < 0:
+                eol = end
+            if eol == offset:
+                # Empty line indicates end of headers
+                break
+            if text.startswith(b'parent ', offset):
+                self._parents.append(Sha1Sum(text[offset+7:eol]))
+            elif text.startswith(b'tree ', offset):
+                self._tree = Sha1Sum(text[offset+5:eol])
+            elif text.startswith(b'committer ', offset):
+                self._commit_time = int(text[offset:eol].rsplit(b' ', 2)[1])
+                # Nothing needed for walking comes after the committer.
+                break
+            offset = eol + 1
+
+    def _ensure_fully_parsed(self):
+        """Parse the header fields and message skipped by _deserialize.
 
-        for field, value in parse_commit(b''.join(self._chunked_text)):
+        Cached commits are shared between threads, so the fields are parsed
+        into locals and _unparsed_text is only cleared once they are all set.
+        Threads that parse the same commit at once set the same values.
+        """
+        self._ensure_parsed()
+        text = self._unparsed_text
+        if text is None:
+            return
+        extra = []
+        author = None
+        encoding = None
+        message = None
+        committer = None
+
+        for field, value in parse_commit(text):
             if field:
                 fieldname = field.decode('utf-8')
             else:
                 fieldname = None
-            if fieldname == _TREE_HEADER:
-                self._tree = Sha1Sum(value)
-            elif fieldname == _PARENT_HEADER:
-                self._parents.append(Sha1Sum(value))
+            if fieldname in (_TREE_HEADER, _PARENT_HEADER):
+                # Already parsed by _deserialize
+                continue
             elif fieldname == _AUTHOR_HEADER:
-                self._author, timetext, timezonetext = value.decode('utf-8').rsplit(" ", 2)
-                self._author_time = int(timetext)
-                self._author_timezone, self._author_timezone_neg_utc =\
-                    parse_timezone(timezonetext)
+                author, author_time, author_timezone = \
+                    value.decode('utf-8').rsplit(" ", 2)
             elif fieldname == _COMMITTER_HEADER:
-                self._committer, timetext, timezonetext = value.decode('utf-8').rsplit(" ", 2)
-                self._commit_time = int(timetext)
-                self._commit_timezone, self._commit_timezone_neg_utc =\
-                    parse_timezone(timezonetext)
+                committer, commit_time, commit_timezone = \
+                    value.decode('utf-8').rsplit(" ", 2)
             elif fieldname == _ENCODING_HEADER:
-                self._encoding = value.decode('utf-8')
+                encoding = value.decode('utf-8')
             elif fieldname is None:
-                self._message = value.decode('utf-8')
+                message = value.decode('utf-8')
             else:
-                self._extra.append((field, value))
+                extra.append((field, value))
+
+        if author is not None:
+            self._author_time = int(author_time)
+            self._author_timezone, self._author_timezone_neg_utc = \
+                parse_timezone(author_timezone)
+        if committer is not None:
+            self._committer = committer
+            self._commit_time = int(commit_time)
+            self._commit_timezone, self._commit_timezone_neg_utc = \
+                parse_timezone(commit_timezone)
+        if message is not None:
+            self._message = message
+        self._author = author
+        self._encoding = encoding
+        self._extra = extra
+        self._unparsed_text = None
 
     def check(self):
         """Check this object for internal consistency.
@@ -1418,6 +1719,7 @@ class Commit(ShaFile):
         :raise ObjectFormatException: if the object is malformed in some way
         """
         super(Commit, self).check()
+        self._ensure_fully_parsed()
         self._check_has_member("_tree", "missing tree")
         self._check_has_member("_author", "missing author")
         self._check_has_member("_committer", "missing committer")
@@ -1451,6 +1753,7 @@ class Commit(ShaFile):
         # TODO: optionally check for duplicate parents
 
     def _serialize(self):
+        self._ensure_fully_parsed()
         chunks = []
         chunks.append(_TREE_HEADER.encode('utf-8') + b' ' + self._tree.hex_bytes + b'\n')
         for p in self._parents:
@@ -1474,7 +1777,19 @@ class Commit(ShaFile):
         chunks.append(self._message.encode('utf-8'))
         return chunks
 
-    tree = serializable_property("tree", "Tree that is the state of this commit")
+    def _get_tree(self):
+        """Return the tree that is the state of this commit."""
+        self._ensure_parsed()
+        return self._tree
+
+    def _set_tree(self, value):
+        """Set the tree that is the state of this commit."""
+        self._ensure_fully_parsed()
+        self._needs_serialization = True
+        self._tree = value
+
+    tree = property(_get_tree, _set_tree,
+                    doc="Tree that is the state of this commit")
 
     def _get_parents(self):
         """Return a list of parents of this commit."""
@@ -1483,41 +1798,53 @@ class Commit(ShaFile):
 
     def _set_parents(self, value):
         """Set a list of parents of this commit."""
-        self._ensure_parsed()
+        self._ensure_fully_parsed()
         self._needs_serialization = True
         self._parents = value
 
     parents = property(_get_parents, _set_parents)
 
+    def _get_commit_time(self):
+        """Return the timestamp of this commit."""
+        self._ensure_parsed()
+        return self._commit_time
+
+    def _set_commit_time(self, value):
+        """Set the timestamp of this commit."""
+        self._ensure_fully_parsed()
+        self._needs_serialization = True
+        self._commit_time = value
+
+    commit_time = property(_get_commit_time, _set_commit_time,
+        doc="The timestamp of the commit. As the number of seconds since the "
+            "epoch.")
+
     def _get_extra(self):
         """Return extra settings of this commit."""
-        self._ensure_parsed()
+        self._ensure_fully_parsed()
         return self._extra
 
     extra = property(_get_extra)
 
-    author = serializable_property("author",
+    author = _lazy_serializable_property("author",
         "The name of the author of the commit")
 
-    committer = serializable_property("committer",
+    committer = _lazy_serializable_property("committer",
         "The name of the committer of the commit")
 
-    message = serializable_property("message",
+    message = _lazy_serializable_property("message",
         "The commit message")
 
-    commit_time = serializable_property("commit_time",
-        "The timestamp of the commit. As the number of seconds since the epoch.")
-
-    commit_timezone = serializable_property("commit_timezone",
+    commit_timezone = _lazy_serializable_property("commit_timezone",
         "The zone the commit time is in")
 
-    author_time = serializable_property("author_time",
+    author_time = _lazy_serializable_property("author_time",
         "The timestamp the commit was written. as the number of seconds since the epoch.")
 
-    author_timezone = serializable_property("author_timezone",
+    author_timezone = _lazy_serializable_property("author_timezone",
         "Returns the zone the author time is in.")
 
-    encoding = serializable_property("encoding",
+    encoding = _lazy_serializable_property("encoding",
         "Encoding of the commit message.")
 
 
@@ -39,7 +39,7 @@ from io import (
 from collections import (
     deque,
     )
-import difflib
+from concurrent.futures import ThreadPoolExecutor
 from itertools import (
     chain,
     )
@@ -50,10 +50,12 @@ except ImportError:
 else:
     has_mmap = True
 import os
+import queue
 import struct
 from struct import unpack_from
 from os import SEEK_CUR, SEEK_END
 import sys
+import threading
 import warnings
 import zlib
 import hashlib
@@ -82,6 +84,11 @@ REF_DELTA = 7
 
 DELTA_TYPES = (OFS_DELTA, REF_DELTA)
 
+# Objects larger than this are not deltified when thin packs are generated,
+# like core.bigFileThreshold in C git. The delta search is done in Python, so
+# the default is much lower than that of C git.
+DEFAULT_BIG_FILE_THRESHOLD = 512 * 1024
+
 
 def take_msb_bytes(read, crc32=None):
     """Read bytes marked with most significant bit.
@@ -249,7 +256,7 @@ def iter_sha1(iter):
     sha1 = hashlib.sha1(b'')
     for name in iter:
         sha1.update(name)
-    return Sha1Sum(sha1.digest())
+    return Sha1Sum.from_raw(sha1.digest())
 
 
 def load_pack_index(path):
@@ -385,6 +392,28 @@ class PackIndex(object):
         """
         raise NotImplementedError(self._object_index)
 
+    def object_position(self, sha):
+        """Return the position of an object in this index.
+
+        Objects are sorted by SHA, so positions range from 0 to the number of
+        objects in the index.
+
+        :param sha: SHA of the object
+        :return: The position, or None if the index does not have the object
+        """
+        return self._object_position(bytes(sha))
+
+    def _object_position(self, sha):
+        """See object_position.
+
+        :param sha: A *binary* SHA string. (20 characters long)_
+        """
+        raise NotImplementedError(self._object_position)
+
+    def object_name(self, position):
+        """Return the SHA of the object at a position in this index."""
+        raise NotImplementedError(self.object_name)
+
     def objects_sha1(self):
         """Return the hex SHA1 over all the shas of all objects in this pack.
 
@@ -407,8 +436,10 @@ class MemoryPackIndex(PackIndex):
         :param pack_checksum: Optional pack checksum
         """
         self._by_sha = {}
-        for name, idx, crc32 in entries:
+        self._positions = {}
+        for i, (name, idx, crc32) in enumerate(entries):
             self._by_sha[bytes(name)] = idx
+            self._positions[bytes(name)] = i
         self._entries = entries
         self._pack_checksum = pack_checksum
 
@@ -421,6 +452,12 @@ class MemoryPackIndex(PackIndex):
     def _object_index(self, sha):
         return self._by_sha[bytes(sha)][0]
 
+    def _object_position(self, sha):
+        return self._positions.get(sha)
+
+    def object_name(self, position):
+        return Sha1Sum(self._entries[position][0])
+
     def _itersha(self):
         return iter(self._by_sha)
 
@@ -546,6 +583,16 @@ class FilePackIndex(PackIndex):
     def _object_index(self, sha):
         """See object_index.
 
+        :param sha: A *binary* SHA string. (20 characters long)_
+        """
+        i = self._object_position(sha)
+        if i is None:
+            raise KeyError(sha)
+        return self._unpack_offset(i)
+
+    def _object_position(self, sha):
+        """See object_position.
+
         :param sha: A *binary* SHA string. (20 characters long)_
         """
         assert len(sha) == 20
@@ -555,10 +602,10 @@ class FilePackIndex(PackIndex):
         else:
             start = self._fan_out_table[idx-1]
         end = self._fan_out_table[idx]
-        i = bisect_find_sha(start, end, sha, self._unpack_name)
-        if i is None:
-            raise KeyError(sha)
-        return self._unpack_offset(i)
+        return bisect_find_sha(start, end, sha, self._unpack_name)
+
+    def object_name(self, position):
+        return Sha1Sum(self._unpack_name(position))
 
 
 class PackIndex1(FilePackIndex):
@@ -901,7 +948,7 @@ def obj_sha(type, chunks):
         if isinstance(chunk, int):
             chunk = bytes((chunk,))
         sha.update(chunk)
-    return Sha1Sum(sha.digest())
+    return Sha1Sum.from_raw(sha.digest())
 
 
 def compute_file_sha(f, start_ofs=0, end_ofs=0, buffer_size=1<<16):
@@ -925,6 +972,10 @@ def compute_file_sha(f, start_ofs=0, end_ofs=0, buffer_size=1<<16):
     return sha
 
 
+# Size of the chunks in which the raw contents of packs are read.
+_RAW_DATA_CHUNK_SIZE = 1024 * 1024
+
+
 class PackData(object):
     """The data contained in a packfile.
 
@@ -972,6 +1023,9 @@ class PackData(object):
         (version, self._num_objects) = read_pack_header(self._file.read)
         self._offset_cache = LRUSizeCache(1024*1024*20,
             compute_size=_compute_object_size)
+        # Reading an object seeks the file, so reads at an offset hold this
+        # lock to allow threads to share the pack.
+        self._file_lock = threading.Lock()
         self.pack = None
 
     def __enter__(self):
@@ -1147,10 +1201,52 @@ class PackData(object):
         else:
             raise ValueError('unknown index format %d' % version)
 
+    def iter_raw_data(self, start_ofs=0, end_ofs=0,
+                      chunk_size=_RAW_DATA_CHUNK_SIZE):
+        """Iterate over the raw contents of a portion of the pack file.
+
+        Where the file can be mapped, the chunks are read-only views of the
+        mapping, so no data is copied; a chunk is only valid until the next
+        one is requested.
+
+        :param start_ofs: The offset in the file to start reading at.
+        :param end_ofs: The offset in the file to end reading at, relative to
+            the end of the file.
+        :param chunk_size: Maximum size of the chunks.
+        :return: Iterator over bytes-like chunks
+        """
+        with self._file_lock:
+            self._file.seek(0, SEEK_END)
+            end = self._file.tell() + end_ofs
+        try:
+            fileno = self._file.fileno()
+        except (AttributeError, IOError, ValueError):
+            fileno = None
+        if not has_mmap or fileno is None or end <= start_ofs:
+            offset = start_ofs
+            while offset < end:
+                with self._file_lock:
+                    self._file.seek(offset)
+                    data = self._file.read(min(end - offset, chunk_size))
+                if not data:
+                    raise AssertionError('%s is truncated' % self._filename)
+                offset += len(data)
+                yield data
+            return
+        contents = mmap.mmap(fileno, end, access=mmap.ACCESS_READ)
+        try:
+            with memoryview(contents) as view:
+                for offset in range(start_ofs, end, chunk_size):
+                    with view[offset:min(end, offset + chunk_size)] as chunk:
+                        yield chunk
+        finally:
+            contents.close()
+
     def get_stored_checksum(self):
         """Return the expected checksum stored in this pack."""
-        self._file.seek(-20, SEEK_END)
-        return self._file.read(20)
+        with self._file_lock:
+            self._file.seek(-20, SEEK_END)
+            return self._file.read(20)
 
     def check(self):
         """Check the consistency of this pack."""
@@ -1159,6 +1255,50 @@ class PackData(object):
         if actual != stored:
             raise ChecksumMismatch(stored, actual)
 
+    def get_object_size(self, offset):
+        """Return the size of the object at an offset, reading only its header.
+
+        The size of a delta is the size of the object it results in, which
+        is read from the start of the delta data.
+
+        :param offset: Offset of the object in the pack
+        :return: Size of the object in bytes
+        """
+        assert offset >= self._header_size
+        with self._file_lock:
+            self._file.seek(offset)
+            return self._read_object_size(offset, self._file.read)
+
+    def _read_object_size(self, offset, read):
+        bytes, _ = take_msb_bytes(read)
+        type_num = (bytes[0] >> 4) & 0x07
+        size = bytes[0] & 0x0f
+        for i, byte in enumerate(bytes[1:]):
+            size += (byte & 0x7f) << ((i * 7) + 4)
+        if type_num not in DELTA_TYPES:
+            return size
+        if type_num == OFS_DELTA:
+            take_msb_bytes(read)
+        else:
+            read(20)
+        # Each of the two sizes at the start of the delta takes at most 10
+        # bytes, so only decompress that much.
+        decomp = zlib.decompressobj()
+        header = b''
+        while True:
+            data = decomp.unconsumed_tail or read(64)
+            if not data:
+                raise zlib.error('Truncated delta for object at %d' % offset)
+            header += decomp.decompress(data, 20 - len(header))
+            try:
+                src_size, index = _get_delta_header_size(header, 0)
+                dest_size, index = _get_delta_header_size(header, index)
+                return dest_size
+            except IndexError:
+                if decomp.eof:
+                    raise
+                continue
+
     def get_object_at(self, offset):
         """Given an offset in to the packfile return the object that is there.
 
@@ -1166,12 +1306,13 @@ class PackData(object):
         and then the packfile can be asked directly for that object using this
         function.
         """
-        if offset in self._offset_cache:
-            return self._offset_cache[offset]
         assert isinstance(offset, int), 'offset was %r' % offset
         assert offset >= self._header_size
-        self._file.seek(offset)
-        unpacked, _ = unpack_object(self._file.read)
+        with self._file_lock:
+            if offset in self._offset_cache:
+                return self._offset_cache[offset]
+            self._file.seek(offset)
+            unpacked, _ = unpack_object(self._file.read)
         return (unpacked.pack_type_num, unpacked._obj())
 
 
@@ -1223,7 +1364,7 @@ class DeltaChainIterator(object):
             base_offset = offset - unpacked.delta_base
             self._pending_ofs[base_offset].append(offset)
         elif type_num == REF_DELTA:
-            sha = Sha1Sum(unpacked.delta_base)
+            sha = Sha1Sum.from_raw(unpacked.delta_base)
             self._pending_ref[sha].append(offset)
         else:
             self._full_ofs.append((offset, type_num))
@@ -1414,12 +1555,14 @@ def pack_object_header(type_num, delta_base, size):
         header += delta_base
     return header
 
-def write_pack_object(f, type, object, sha=None):
+def write_pack_object(f, type, object, sha=None, comp_data=None):
     """Write pack object to a file.
 
     :param f: File to write to
     :param type: Numeric type of the object
     :param object: Object to write
+    :param comp_data: Optional compressed object data, if it was already
+        compressed
     :return: Tuple with offset at which the object was written, and crc32
     """
 
@@ -1430,7 +1573,8 @@ def write_pack_object(f, type, object, sha=None):
     else:
         delta_base = None
     header = pack_object_header(type, delta_base, len(object))
-    comp_data = zlib.compress(object)
+    if comp_data is None:
+        comp_data = zlib.compress(object)
     crc32 = 0
     for data in (header, comp_data):
         f.write(data)
@@ -1507,32 +1651,171 @@ def deltify_pack_objects(objects, window=10):
             possible_bases.pop()
 
 
-def write_pack_objects(f, objects, window=10, num_objects=None):
+def deltify_thin_pack_objects(objects, get_delta_base,
+                              big_file_threshold=DEFAULT_BIG_FILE_THRESHOLD):
+    """Generate deltas against objects that are left out of the pack.
+
+    :param objects: Iterable of (object, path) tuples
+    :param get_delta_base: Function that takes an object and its path and
+        returns an object the receiver already has to use as delta base, or
+        None
+    :param big_file_threshold: Size above which objects and bases are not
+        deltified
+    :return: Iterator over type_num, object id, delta_base, content
+        delta_base is None for full text entries
+    """
+    for o, path in objects:
+        raw = o.as_raw_string()
+        base = None
+        if len(raw) <= big_file_threshold:
+            base = get_delta_base(o, path)
+        if (base is not None and base.type_num == o.type_num and
+            base.raw_length() <= big_file_threshold):
+            # Like C git, only use deltas that save at least half the size.
+            max_size = len(raw) // 2 - 20
+            delta = create_delta(base.as_raw_string(), raw,
+                                 max_inserted=max_size)
+            if delta is not None and len(delta) < max_size:
+                yield o.type_num, o.sha().digest(), base.sha().digest(), delta
+                continue
+        yield o.type_num, o.sha().digest(), None, raw
+
+
+def write_pack_objects(f, objects, window=10, num_objects=None,
+                       get_delta_base=None, compression_threads=None):
     """Write a new pack data file.
 
     :param f: File to write to
     :param objects: Iterable of (object, path) tuples to write.
-        Should provide __len__
+        Should provide __len__. With more than one compression thread, it is
+        iterated over in another thread; see write_pack_data.
     :param window: Sliding window size for searching for deltas; currently
                    unimplemented
     :param num_objects: Number of objects (do not use, deprecated)
+    :param get_delta_base: Optional function that takes an object and its
+        path and returns an object the receiver already has, or None. If
+        given, objects are sent as deltas against these where that is
+        smaller, which makes the pack thin. It is called from the same
+        thread as objects is iterated over.
+    :param compression_threads: Number of threads to compress objects in;
+        see write_pack_data
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
     if num_objects is None:
         num_objects = len(objects)
-    # FIXME: pack_contents = deltify_pack_objects(objects, window)
-    pack_contents = (
-        (o.type_num, o.sha().digest(), None, o.as_raw_string())
-        for (o, path) in objects)
-    return write_pack_data(f, num_objects, pack_contents)
+    if get_delta_base is not None:
+        pack_contents = deltify_thin_pack_objects(objects, get_delta_base)
+    else:
+        # FIXME: pack_contents = deltify_pack_objects(objects, window)
+        pack_contents = (
+            (o.type_num, o.sha().digest(), None, o.as_raw_string())
+            for (o, path) in objects)
+    return write_pack_data(f, num_objects, pack_contents,
+                           compression_threads=compression_threads)
+
+
+# Objects are compressed in batches of about this many bytes, so that small
+# objects do not each need a round trip to a compression thread.
+_COMPRESS_BATCH_SIZE = 256 * 1024
+
+
+def _batch_records(records):
+    batch = []
+    batch_size = 0
+    for record in records:
+        batch.append(record)
+        batch_size += len(record[3])
+        if batch_size >= _COMPRESS_BATCH_SIZE:
+            yield batch
+            batch = []
+            batch_size = 0
+    if batch:
+        yield batch
+
+
+def _compress_batch(batch):
+    return [record + (zlib.compress(record[3]),) for record in batch]
+
+
+def compress_pack_records(records, threads=None):
+    """Compress the contents of pack records.
+
+    Records are compressed in batches. With more than one thread, this is a
+    pipeline: a thread reads the records and queues their batches, a pool
+    of threads compresses them, and the compressed records are yielded in
+    order as they become ready. zlib releases the GIL while it compresses.
+    At most two batches per compression thread are queued.
+
+    :param records: Iterator over type_num, object_id, delta_base, raw. With
+        more than one thread, it is iterated over in the reader thread.
+    :param threads: Number of threads to compress in, or None for one per
+        CPU
+    :return: Iterator over type_num, object_id, delta_base, raw, comp_data
+    """
+    if threads is None:
+        threads = os.cpu_count() or 1
+    batches = _batch_records(records)
+    first = next(batches, None)
+    second = next(batches, None)
+    if threads <= 1 or second is None:
+        # Not worth starting threads for.
+        for batch in chain([first, second], batches):
+            if batch is not None:
+                for record in _compress_batch(batch):
+                    yield record
+        return
+
+    pending = queue.Queue(threads * 2)
+    stop = threading.Event()
+
+    def read_batches():
+        try:
+            for batch in chain([first, second], batches):
+                if stop.is_set():
+                    return
+                pending.put(executor.submit(_compress_batch, batch))
+        except BaseException as e:
+            pending.put(e)
+        else:
+            pending.put(None)
+
+    with ThreadPoolExecutor(threads) as executor:
+        reader = threading.Thread(target=read_batches)
+        reader.start()
+        try:
+            while True:
+                future = pending.get()
+                if future is None:
+                    break
+                if isinstance(future, BaseException):
+                    raise future
+                for record in future.result():
+                    yield record
+        finally:
+            # Unblock the reader if the records are not all consumed.
+            stop.set()
+            while reader.is_alive():
+                try:
+                    pending.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            reader.join()
 
 
-def write_pack_data(f, num_records, records):
+def write_pack_data(f, num_records, records, compression_threads=None):
     """Write a new pack data file.
 
+    Objects are compressed ahead of writing by compress_pack_records, and
+    written in the calling thread. With more than one compression thread,
+    records is consumed by a separate reader thread, so it must be safe to
+    iterate over from another thread: everything it does to generate the
+    records, such as reading objects and computing deltas, runs there.
+
     :param f: File to write to
     :param num_records: Number of records
     :param records: Iterator over type_num, object_id, delta_base, raw
+    :param compression_threads: Number of threads to compress objects in, or
+        None for one per CPU
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
 
@@ -1540,7 +1823,8 @@ def write_pack_data(f, num_records, records):
     entries = {}
     f = SHA1Writer(f)
     write_pack_header(f, num_records)
-    for type_num, object_id, delta_base, raw in records:
+    for type_num, object_id, delta_base, raw, comp_data in (
+            compress_pack_records(records, compression_threads)):
         if delta_base is not None:
             try:
                 base_offset, base_crc32 = entries[delta_base]
@@ -1551,11 +1835,44 @@ def write_pack_data(f, num_records, records):
                 type_num = OFS_DELTA
                 raw = (base_offset, raw)
         offset = f.offset()
-        crc32 = write_pack_object(f, type_num, raw)
+        crc32 = write_pack_object(f, type_num, raw, comp_data=comp_data)
         entries[object_id] = (offset, crc32)
     return entries, f.write_sha()
 
 
+def write_reused_pack_data(f, pack_data, num_records=0, records=(),
+                           compression_threads=None):
+    """Write the contents of an existing pack, optionally with more objects.
+
+    The objects of the existing pack are copied verbatim, without being
+    decompressed. As the pack header has a fixed size, the offsets of
+    deltas in the pack stay valid. Without extra objects, the whole pack
+    file including its checksum is copied.
+
+    :param f: File to write to
+    :param pack_data: PackData of the existing pack
+    :param num_records: Number of extra records
+    :param records: Iterator over type_num, object_id, delta_base, raw of
+        the extra objects; delta_base must be None
+    :param compression_threads: Number of threads to compress the extra
+        objects in; see write_pack_data
+    :return: The pack checksum
+    """
+    if not num_records:
+        for chunk in pack_data.iter_raw_data():
+            f.write(chunk)
+        return pack_data.get_stored_checksum()
+    f = SHA1Writer(f)
+    write_pack_header(f, len(pack_data) + num_records)
+    for chunk in pack_data.iter_raw_data(pack_data._header_size, -20):
+        f.write(chunk)
+    for type_num, object_id, delta_base, raw, comp_data in (
+            compress_pack_records(records, compression_threads)):
+        assert delta_base is None
+        write_pack_object(f, type_num, raw, comp_data=comp_data)
+    return f.write_sha()
+
+
 def write_pack_index_v1(f, entries, pack_checksum):
     """Write a new pack index file.
 
@@ -1580,63 +1897,145 @@ def write_pack_index_v1(f, entries, pack_checksum):
     f.write(bytes(pack_checksum))
     return f.write_sha()
 
-def create_delta(base_buf, target_buf):
-    """Use python difflib to work out how to transform base_buf to target_buf.
+
+# Deltas are found by indexing the base in blocks of this many bytes and
+# looking for them in the target, like the Rabin window of C git.
+_DELTA_BLOCK_SIZE = 16
+
+# Largest number of bytes copied or inserted by a single delta instruction.
+_MAX_COPY_SIZE = 0xffff
+_MAX_INSERT_SIZE = 0x7f
+
+
+def _encode_delta_size(size):
+    ret = b''
+    c = size & 0x7f
+    size >>= 7
+    while size:
+        ret += bytes((c | 0x80,))
+        c = size & 0x7f
+        size >>= 7
+    ret += bytes((c,))
+    return ret
+
+
+def _encode_copy_operation(start, length):
+    scratch = []
+    op = 0x80
+    for i in range(4):
+        if start & 0xff << i*8:
+            scratch.append((start >> i*8) & 0xff)
+            op |= 1 << i
+    for i in range(2):
+        if length & 0xff << i*8:
+            scratch.append((length >> i*8) & 0xff)
+            op |= 1 << (4+i)
+    return bytes([op] + scratch)
+
+
+def _match_length(a, a_start, b, b_start):
+    """Count the bytes that are equal in two buffers from given offsets.
+
+    The buffers are compared in chunks that double in size while they match,
+    and are halved again at a mismatch.
+    """
+    limit = min(len(a) - a_start, len(b) - b_start)
+    length = 0
+    chunk_size = 64
+    while length < limit:
+        size = min(chunk_size, limit - length)
+        if (a[a_start+length:a_start+length+size] ==
+            b[b_start+length:b_start+length+size]):
+            length += size
+            chunk_size *= 2
+        elif size == 1:
+            break
+        else:
+            chunk_size = size // 2
+    return length
+
+
+def create_delta(base_buf, target_buf, max_inserted=None):
+    """Work out how to transform base_buf to target_buf.
+
+    The base is indexed in blocks of _DELTA_BLOCK_SIZE bytes. The target is
+    scanned for those blocks; every block found is extended as far as the
+    buffers match in both directions and copied from the base, and the rest
+    of the target is inserted.
 
     :param base_buf: Base buffer
     :param target_buf: Target buffer
+    :param max_inserted: Optional number of bytes of the target that may be
+        inserted. The search stops as soon as more are needed, since the
+        delta is then too large to be of use.
+    :return: The delta, as a string, or None if it would insert more than
+        max_inserted bytes
     """
+    if max_inserted is None:
+        # The delta can never insert more than the whole target.
+        max_inserted = len(target_buf)
+    out = [_encode_delta_size(len(base_buf)),
+           _encode_delta_size(len(target_buf))]
+    blocks = {}
+    for i in range(len(base_buf) - _DELTA_BLOCK_SIZE, -1, -_DELTA_BLOCK_SIZE):
+        # Going backwards, so that the first occurrence wins.
+        blocks[base_buf[i:i+_DELTA_BLOCK_SIZE]] = i
+
+    def insert(start, end):
+        while start < end:
+            size = min(end - start, _MAX_INSERT_SIZE)
+            out.append(bytes((size,)))
+            out.append(target_buf[start:start+size])
+            start += size
+
+    insert_start = 0
+    j = 0
+    last = len(target_buf) - _DELTA_BLOCK_SIZE
+    while j <= last:
+        i = blocks.get(target_buf[j:j+_DELTA_BLOCK_SIZE])
+        if i is None:
+            j += 1
+            if j - insert_start > max_inserted:
+                return None
+            continue
+        # Take back as much of the pending insert as matches.
+        while (j > insert_start and i > 0 and
+               base_buf[i-1] == target_buf[j-1]):
+            i -= 1
+            j -= 1
+        insert(insert_start, j)
+        max_inserted -= j - insert_start
+        length = _match_length(base_buf, i, target_buf, j)
+        j += length
+        insert_start = j
+        while length:
+            size = min(length, _MAX_COPY_SIZE)
+            out.append(_encode_copy_operation(i, size))
+            i += size
+            length -= size
+    if len(target_buf) - insert_start > max_inserted:
+        return None
+    insert(insert_start, len(target_buf))
+    return b''.join(out)
+
+
+def _get_delta_header_size(delta, index):
+    """Decode one of the sizes at the start of a delta.
+
+    :return: Tuple with the size and the index of the byte after it
+    :raise IndexError: if delta ends before the size does
+    """
+    size = 0
+    i = 0
+    while True:
+        cmd = delta[index]
+        index += 1
+        size |= (cmd & ~0x80) << i
+        i += 7
+        if not cmd & 0x80:
+            break
+    return size, index
 
-    out_buf = b''
-    # write delta header
-    def encode_size(size):
-        ret = b''
-        c = size & 0x7f
-        size >>= 7
-        while size:
-            ret += bytes((c | 0x80,))
-            c = size & 0x7f
-            size >>= 7
-        ret += bytes((c,))
-        return ret
-    out_buf += encode_size(len(base_buf))
-    out_buf += encode_size(len(target_buf))
-    # write out delta opcodes
-    seq = difflib.SequenceMatcher(a=base_buf, b=target_buf)
-    for opcode, i1, i2, j1, j2 in seq.get_opcodes():
-        # Git patch opcodes don't care about deletes!
-        #if opcode == 'replace' or opcode == 'delete':
-        #    pass
-        if opcode == 'equal':
-            # If they are equal, unpacker will use data from base_buf
-            # Write out an opcode that says what range to use
-            scratch = b''
-            op = 0x80
-            o = i1
-            for i in range(4):
-                if o & 0xff << i*8:
-                    scratch += bytes(((o >> i*8) & 0xff,))
-                    op |= 1 << i
-            s = i2 - i1
-            for i in range(2):
-                if s & 0xff << i*8:
-                    scratch += bytes(((s >> i*8) & 0xff,))
-                    op |= 1 << (4+i)
-            out_buf += bytes((op,))
-            out_buf += scratch
-        if opcode == 'replace' or opcode == 'insert':
-            # If we are replacing a range or adding one, then we just
-            # output it to the stream (prefixed by its size)
-            s = j2 - j1
-            o = j1
-            while s > 127:
-                out_buf += bytes((127,))
-                out_buf += target_buf[o:o+127]
-                s -= 127
-                o += 127
-            out_buf += bytes((s,))
-            out_buf += target_buf[o:o+s]
-    return out_buf
 
 def apply_delta(src_buf, delta):
     """Based on the similar function in git's patch-delta.c.
@@ -1653,19 +2052,8 @@ def apply_delta(src_buf, delta):
     out = []
     index = 0
     delta_length = len(delta)
-    def get_delta_header_size(delta, index):
-        size = 0
-        i = 0
-        while delta:
-            cmd = delta[index]
-            index += 1
-            size |= (cmd & ~0x80) << i
-            i += 7
-            if not cmd & 0x80:
-                break
-        return size, index
-    src_size, index = get_delta_header_size(delta, index)
-    dest_size, index = get_delta_header_size(delta, index)
+    src_size, index = _get_delta_header_size(delta, index)
+    dest_size, index = _get_delta_header_size(delta, index)
     assert src_size == len(src_buf), '%d vs %d' % (src_size, len(src_buf))
     while index < delta_length:
         cmd = delta[index]
@@ -1862,6 +2250,15 @@ class Pack(object):
         type, uncomp = self.get_raw(sha1)
         return ShaFile.from_raw_string(type, uncomp)
 
+    def get_object_size(self, sha1):
+        """Return the size of an object, without decompressing it.
+
+        :param sha1: SHA of the object
+        :return: Size of the object in bytes
+        :raise KeyError: if the object is not in this pack
+        """
+        return self.data.get_object_size(self.index.object_index(sha1))
+
     def iterobjects(self):
         """Iterate over the objects in this pack."""
         return iter(PackInflater.for_pack_data(self.data))
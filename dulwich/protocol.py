@@ -30,10 +30,14 @@ from dulwich.objects import (
     Sha1Sum
 )
 
-from os import SEEK_END
-
 TCP_GIT_PORT = 9418
 
+# The largest amount of data in a side-band-64k packet, after the channel.
+SIDEBAND_64K_MAX_DATA = 65515
+
+# Buffers passed to a single sendmsg call.
+_SENDMSG_MAX_BUFFERS = 512
+
 ZERO_SHA = Sha1Sum("0" * 40)
 
 SINGLE_ACK = 0
@@ -41,6 +45,29 @@ MULTI_ACK = 1
 MULTI_ACK_DETAILED = 2
 
 
+class SpecialPkt(object):
+    """A pkt-line of protocol version 2 that has a length but no data."""
+
+    def __init__(self, name, length):
+        self.name = name
+        self.length = length
+
+    def __repr__(self):
+        return '<%s>' % self.name
+
+
+# The delim-pkt separates the sections of a protocol version 2 message, and
+# the response-end-pkt ends a stateless response.
+DELIM_PKT = SpecialPkt('delim-pkt', 1)
+RESPONSE_END_PKT = SpecialPkt('response-end-pkt', 2)
+_SPECIAL_PKTS = dict((pkt.length, pkt) for pkt in (DELIM_PKT, RESPONSE_END_PKT))
+# The flush-pkt is returned as None.
+_SPECIAL_PKTS[0] = None
+
+# Returned by PktLineBuffer.read_pkt for a pkt-line it does not hold all of.
+INCOMPLETE_PKT = object()
+
+
 class ProtocolFile(object):
     """A dummy file for network ops that expect file-like objects."""
 
@@ -57,15 +84,127 @@ class ProtocolFile(object):
 def pkt_line(data):
     """Wrap data in a pkt-line.
 
-    :param data: The data to wrap, as a str or None.
+    :param data: The data to wrap, as a str or None, or a SpecialPkt.
     :return: The data prefixed with its length in pkt-line format; if data was
         None, returns the flush-pkt ('0000').
     """
     if data is None:
         return b'0000'
+    if isinstance(data, SpecialPkt):
+        return ('%04x' % data.length).encode('ascii')
 
     return ('%04x' % (len(data) + 4)).encode('utf-8') + data
 
+def sendmsg_all(sock, buffers):
+    """Send a list of buffers on a socket, with as few system calls as
+    possible.
+
+    :param sock: The socket, which must support sendmsg
+    :param buffers: List of bytes-like objects
+    """
+    buffers = [memoryview(b) for b in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers[:_SENDMSG_MAX_BUFFERS])
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+
+def _parse_pkt_size(sizestr):
+    """Parse the length prefix of a pkt-line.
+
+    :param sizestr: The four hex digits of the length prefix
+    :return: The size of the pkt-line, including the length prefix
+    :raise GitProtocolError: If the length prefix is invalid
+    """
+    try:
+        size = int(sizestr, 16)
+    except ValueError:
+        raise GitProtocolError('Invalid pkt-line length %r' % bytes(sizestr))
+    if size < 4 and size not in _SPECIAL_PKTS:
+        raise GitProtocolError('Invalid pkt-line length %d' % size)
+    return size
+
+
+class PktLineBuffer(object):
+    """Buffer of data from a pkt-line stream that has not been parsed yet.
+
+    The data is kept in a single bytearray; parsed data is dropped from its
+    start, which does not move the rest, and the space is reused for the data
+    fed next. Pkt-lines are copied out of the buffer once, through a
+    memoryview.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._buf) - self._pos
+
+    def feed(self, data):
+        """Add data from the stream to the buffer.
+
+        :param data: A bytes-like object
+        """
+        if self._pos:
+            del self._buf[:self._pos]
+            self._pos = 0
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._buf += data
+
+    def getvalue(self):
+        """Return the data in the buffer, without removing it."""
+        return bytes(self._buf[self._pos:])
+
+    def unread(self, data):
+        """Put data back at the start of the buffer."""
+        pos = self._pos
+        if pos >= len(data):
+            self._buf[pos - len(data):pos] = data
+            self._pos = pos - len(data)
+        else:
+            self._buf[pos:pos] = data
+
+    def take(self, size):
+        """Remove data from the start of the buffer.
+
+        :param size: Maximum number of bytes to remove
+        :return: The data, as a string
+        """
+        pos = self._pos
+        with memoryview(self._buf) as view:
+            data = bytes(view[pos:pos + size])
+        self._pos = pos + len(data)
+        return data
+
+    def read_pkt(self):
+        """Remove the next pkt-line from the buffer, if it holds all of it.
+
+        :return: Tuple with the data of the pkt-line, as read_pkt_line returns
+            it, and the size of the pkt-line; or INCOMPLETE_PKT and the number
+            of bytes that are missing from the pkt-line
+        :raise GitProtocolError: If the length prefix is invalid
+        """
+        buf = self._buf
+        pos = self._pos
+        avail = len(buf) - pos
+        if avail < 4:
+            return INCOMPLETE_PKT, 4 - avail
+        size = _parse_pkt_size(buf[pos:pos + 4])
+        if size < 4:
+            self._pos = pos + 4
+            return _SPECIAL_PKTS[size], 4
+        if size > avail:
+            return INCOMPLETE_PKT, size - avail
+        with memoryview(buf) as view:
+            pkt = bytes(view[pos + 4:pos + size])
+        self._pos = pos + size
+        return pkt, size
+
+
 class Protocol(object):
     """Class for interacting with a remote git process over the wire.
 
@@ -78,12 +217,18 @@ class Protocol(object):
         Documentation/technical/protocol-common.txt
     """
 
-    def __init__(self, read, write, close, report_activity=None):
+    def __init__(self, read, write, close, report_activity=None,
+                 writev=None):
         self.read = read
         self.write = write
+        # Optional function that writes a list of buffers, such as a
+        # wrapper around socket.sendmsg; see SidebandWriter.
+        self.writev = writev
         self.report_activity = report_activity
         self._close = close
-        self._readahead = None
+        # Data read from the stream that has not been returned yet.
+        self._rbuf = PktLineBuffer()
+        self._unread = False
 
     def __enter__(self):
         return self
@@ -95,69 +240,77 @@ class Protocol(object):
         if callable(self._close):
             self._close()
 
+    def _read_more(self, size):
+        """Read data for the read buffer.
+
+        :param size: Number of bytes needed to complete the next pkt-line
+        :return: Up to size bytes, or an empty string at the end of the stream
+        """
+        return self.read(size)
+
+    def _read_pkt_unbuffered(self):
+        """Read a pkt-line when no data has been read ahead.
+
+        If reads return exactly the data asked for, the pkt-line does not go
+        through the read buffer.
+
+        :return: Tuple with the data of the pkt-line and its size, or
+            INCOMPLETE_PKT and the number of bytes that are missing
+        """
+        rbuf = self._rbuf
+        sizestr = self._read_more(4)
+        if not sizestr:
+            raise HangupException()
+        if len(sizestr) != 4:
+            rbuf.feed(sizestr)
+            return rbuf.read_pkt()
+        size = _parse_pkt_size(sizestr)
+        if size < 4:
+            return _SPECIAL_PKTS[size], 4
+        data = self._read_more(size - 4)
+        if not data:
+            raise HangupException()
+        if len(data) == size - 4:
+            return data, size
+        rbuf.feed(sizestr)
+        rbuf.feed(data)
+        return rbuf.read_pkt()
+
     def read_pkt_line(self):
         """Reads a pkt-line from the remote git process.
 
         This method may read from the readahead buffer; see unread_pkt_line.
 
-        :return: The next string from the stream, without the length prefix, or
-            None for a flush-pkt ('0000').
+        :return: The next string from the stream, without the length prefix,
+            None for a flush-pkt ('0000'), or DELIM_PKT or RESPONSE_END_PKT
+            for the special packets of protocol version 2.
         """
-        #if self._readahead is None:
-        #    read = self.read
-        #else:
-        #    read = self._readahead.read
-        #    self._readahead = None
-
-        # Every now and then the readahead doesn't fill all the way up and things get
-        # split up strangely. This closure automatically switches from the readahead
-        # to the real read in this case.
-        def _do_read(size):
-            remaining = size
-            with BytesIO() as buf:
-                while remaining > 0:
-                    if self._readahead is None:
-                        part = self.read(remaining)
-                        if part is None:
-                            plen = 0
-                        else:
-                            plen = len(part)
-                        if plen == 0:
-                            if self._readahead is None:
-                                break
-                            else:
-                                continue
-                    else:
-                        part = self._readahead.read(remaining)
-                        if part is None:
-                            self._readahead = None
-                            continue
-                        plen = len(part)
-                        if plen == 0:
-                            self._readahead = None
-                            continue
-                    if isinstance(part, str):
-                        part = part.encode('utf-8')
-                    buf.write(part)
-                    remaining -= plen
-                buf.seek(0)
-                return buf.read()
-
+        self._unread = False
+        rbuf = self._rbuf
         try:
-            sizestr = _do_read(4)
-            if not sizestr:
-                raise HangupException()
-            size = int(sizestr, 16)
-            if size == 0:
-                if self.report_activity:
-                    self.report_activity(4, 'read')
-                return None
-            if self.report_activity:
-                self.report_activity(size, 'read')
-            return _do_read(size-4)
-
+            if rbuf:
+                pkt, size = rbuf.read_pkt()
+            else:
+                pkt, size = self._read_pkt_unbuffered()
+            while pkt is INCOMPLETE_PKT:
+                data = self._read_more(size)
+                if not data:
+                    raise HangupException()
+                rbuf.feed(data)
+                pkt, size = rbuf.read_pkt()
         except socket.error as e:
             raise GitProtocolError(e)
+        if self.report_activity:
+            self.report_activity(size, 'read')
+        return pkt
+
+    def has_buffered_data(self):
+        """Check whether data has been read ahead of the pkt-lines returned.
+
+        :return: True if there is data that can be returned without reading
+            from the stream
+        """
+        return bool(self._rbuf)
 
     def eof(self):
         """Test whether the protocol stream has reached EOF.
@@ -182,9 +335,10 @@ class Protocol(object):
         :param data: The data to unread, without the length prefix.
         :raise ValueError: If more than one pkt-line is unread.
         """
-        if self._readahead is not None:
+        if self._unread:
             raise ValueError('Attempted to unread multiple pkt-lines.')
-        self._readahead = BytesIO(pkt_line(data))
+        self._rbuf.unread(pkt_line(data))
+        self._unread = True
 
     def read_pkt_seq(self):
         """Read a sequence of pkt-lines from the remote git process.
@@ -242,8 +396,8 @@ class Protocol(object):
         # WTF: Why have the len in ASCII, but the channel in binary.
         channel = bytes((channel,))
         while blob:
-            self.write_pkt_line(channel + blob[:65515])
-            blob = blob[65515:]
+            self.write_pkt_line(channel + blob[:SIDEBAND_64K_MAX_DATA])
+            blob = blob[SIDEBAND_64K_MAX_DATA:]
 
     def send_cmd(self, cmd, *args):
         """Send a command and some arguments to a git server.
@@ -284,95 +438,62 @@ class ReceivableProtocol(Protocol):
     still block until at least one byte is read.
     """
 
-    def __init__(self, recv, write, close, report_activity=None, rbufsize=_RBUFSIZE):
+    def __init__(self, recv, write, close, report_activity=None, rbufsize=_RBUFSIZE,
+                 writev=None):
         super(ReceivableProtocol, self).__init__(self.read, write, close,
-                                                 report_activity)
+                                                 report_activity, writev)
         self._recv = recv
-        self._rbuf = BytesIO()
         self._rbufsize = rbufsize
 
-    def read(self, size):
-        # From _fileobj.read in socket.py in the Python 2.6.5 standard library,
-        # with the following modifications:
-        #  - omit the size <= 0 branch
-        #  - seek back to start rather than 0 in case some buffer has been
-        #    consumed.
-        #  - use SEEK_END instead of the magic number.
-        # Copyright (c) 2001-2010 Python Software Foundation; All Rights Reserved
-        # Licensed under the Python Software Foundation License.
-        # TODO: see if buffer is more efficient than cBytesIO.
-        assert size > 0
+    def _read_more(self, size):
+        # Read ahead, so that a single recv call returns many small pkt-lines.
+        return self._recv(max(size, self._rbufsize))
+
+    def read(self, size=-1):
+        """Read size bytes, or less at the end of the stream.
 
-        # Our use of BytesIO rather than lists of string objects returned by
-        # recv() minimizes memory usage and fragmentation that occurs when
-        # rbufsize is large compared to the typical return value of recv().
-        buf = self._rbuf
-        start = buf.tell()
-        buf.seek(0, SEEK_END)
-        # buffer may have been partially consumed by recv()
-        buf_len = buf.tell() - start
-        if buf_len >= size:
-            # Already have size bytes in our buffer?  Extract and return.
-            buf.seek(start)
-            rv = buf.read(size)
-            self._rbuf = BytesIO()
-            self._rbuf.write(buf.read())
-            self._rbuf.seek(0)
-            return rv
-
-        self._rbuf = BytesIO()  # reset _rbuf.  we consume it via buf.
-        while True:
-            left = size - buf_len
-            # recv() will malloc the amount of memory given as its
-            # parameter even though it often returns much less data
-            # than that.  The returned data string is short lived
-            # as we copy it into a BytesIO and free it.  This avoids
-            # fragmentation issues on many platforms.
+        :param size: Number of bytes to read, or -1 to read until the end of
+            the stream
+        """
+        rbuf = self._rbuf
+        if size < 0:
+            chunks = [rbuf.take(len(rbuf))]
+            data = self._recv(self._rbufsize)
+            while data:
+                chunks.append(data)
+                data = self._recv(self._rbufsize)
+            return b''.join(chunks)
+        if len(rbuf) >= size:
+            return rbuf.take(size)
+        if not rbuf:
+            # Return the data as is if recv returns all of it.
+            data = self._recv(size)
+            if not data or len(data) == size:
+                return data
+            rbuf.feed(data)
+        while len(rbuf) < size:
+            # Only ask for the data that is needed; the rest of the stream
+            # might not have been sent yet.
+            left = size - len(rbuf)
             data = self._recv(left)
             if not data:
                 break
-            n = len(data)
-            if n == size and not buf_len:
-                # Shortcut.  Avoid buffer data copies when:
-                # - We have no data in our buffer.
-                # AND
-                # - Our call to recv returned exactly the
-                #   number of bytes we were asked to read.
-                return data
-            if n == left:
-                buf.write(data)
-                del data  # explicit free
-                break
-            assert n <= left, "_recv(%d) returned %d bytes" % (left, n)
-            buf.write(data)
-            buf_len += n
-            del data  # explicit free
-            #assert buf_len == buf.tell()
-        buf.seek(start)
-        return buf.read()
+            assert len(data) <= left, "_recv(%d) returned %d bytes" % (
+                left, len(data))
+            rbuf.feed(data)
+        return rbuf.take(size)
 
     def recv(self, size):
         assert size > 0
-
-        buf = self._rbuf
-        start = buf.tell()
-        buf.seek(0, SEEK_END)
-        buf_len = buf.tell()
-        buf.seek(start)
-
-        left = buf_len - start
-        if not left:
+        rbuf = self._rbuf
+        if not rbuf:
             # only read from the wire if our read buffer is exhausted
             data = self._recv(self._rbufsize)
-            if len(data) == size:
-                # shortcut: skip the buffer if we read exactly size bytes
+            if len(data) <= size:
+                # shortcut: skip the buffer if we read at most size bytes
                 return data
-            buf = BytesIO()
-            buf.write(data)
-            buf.seek(0)
-            del data  # explicit free
-            self._rbuf = buf
-        return buf.read(size)
+            rbuf.feed(data)
+        return rbuf.take(size)
 
 def extract_capabilities(text):
     """Extract a capabilities list from a string, if present.
@@ -403,6 +524,29 @@ def extract_want_line_capabilities(text):
     return (b" ".join(split_text[:2]), split_text[2:])
 
 
+def extract_protocol_version(params):
+    """Find the protocol version a client asked for.
+
+    Clients pass extra parameters, such as version=2, in the GIT_PROTOCOL
+    environment variable and Git-Protocol HTTP header, separated by colons,
+    and after the host in git:// requests.
+
+    :param params: Iterable of parameters, or a string of colon-separated
+        parameters
+    :return: The highest version asked for, or 0 if none was
+    """
+    if isinstance(params, bytes):
+        params = params.split(b':')
+    version = 0
+    for param in params:
+        if param.startswith(b'version='):
+            try:
+                version = max(version, int(param[len(b'version='):]))
+            except ValueError:
+                continue
+    return version
+
+
 def ack_type(capabilities):
     """Extract the ack type from a capabilities list."""
     if b'multi_ack_detailed' in capabilities:
@@ -451,38 +595,110 @@ class BufferedPktLineWriter(object):
         data = self._wbuf.getvalue()
         if data:
             self._write(data)
-        self._len = 0
+        self._buflen = 0
         self._wbuf = BytesIO()
 
 
+class SidebandWriter(object):
+    """File-like object that sends its data on a side-band channel.
+
+    The data is buffered until it fills a packet of the maximum size, so
+    that small writes, such as the headers and data of pack objects, are
+    sent in a few large packets. Call flush where the client should get the
+    data written so far, such as before the end of the response.
+
+    If the protocol has a writev function, the packets that large writes
+    fill are passed to it as a list of buffers, without copying the data.
+    """
+
+    def __init__(self, proto, channel, bufsize=SIDEBAND_64K_MAX_DATA):
+        """Create a new SidebandWriter.
+
+        :param proto: The Protocol to write to
+        :param channel: The side-band channel, such as 1 for pack data
+        :param bufsize: Maximum amount of data in a packet
+        """
+        self._proto = proto
+        self._channel = bytes((channel,))
+        self._bufsize = bufsize
+        self._buf = bytearray()
+        self._offset = 0
+
+    def _header(self, size):
+        return ('%04x' % (size + 5)).encode('ascii') + self._channel
+
+    def _send(self, chunks):
+        # Each chunk is sent as a packet of its own.
+        try:
+            writev = self._proto.writev
+            if writev is not None and len(chunks) > 1:
+                buffers = []
+                for chunk in chunks:
+                    buffers.append(self._header(len(chunk)))
+                    buffers.append(chunk)
+                writev(buffers)
+            else:
+                for chunk in chunks:
+                    self._proto.write(self._header(len(chunk)) + chunk)
+        except socket.error as e:
+            raise GitProtocolError(e)
+        if self._proto.report_activity:
+            for chunk in chunks:
+                self._proto.report_activity(len(chunk) + 5, 'write')
+
+    def write(self, data):
+        """Write data to the channel.
+
+        :param data: A bytes-like object; it is not used after write returns
+        """
+        data = memoryview(data)
+        size = len(data)
+        self._offset += size
+        bufsize = self._bufsize
+        if self._buf or size < bufsize:
+            n = bufsize - len(self._buf)
+            self._buf += data[:n]
+            data = data[n:]
+            if len(self._buf) < bufsize:
+                return
+            self._send([bytes(self._buf)])
+            self._buf = bytearray()
+        end = len(data) - len(data) % bufsize
+        if end:
+            self._send([data[i:i + bufsize] for i in range(0, end, bufsize)])
+        self._buf += data[end:]
+
+    def flush(self):
+        """Send the buffered data."""
+        if self._buf:
+            self._send([bytes(self._buf)])
+            self._buf = bytearray()
+
+    def tell(self):
+        return self._offset
+
+    def close(self):
+        self.flush()
+
+
 class PktLineParser(object):
     """Packet line parser that hands completed packets off to a callback.
     """
 
     def __init__(self, handle_pkt):
         self.handle_pkt = handle_pkt
-        self._readahead = BytesIO()
+        self._rbuf = PktLineBuffer()
 
     def parse(self, data):
         """Parse a fragment of data and call back for any completed packets.
         """
-        self._readahead.write(data)
-        buf = self._readahead.getvalue()
-        if len(buf) < 4:
-            return
-        while len(buf) >= 4:
-            size = int(buf[:4], 16)
-            if size == 0:
-                self.handle_pkt(None)
-                buf = buf[4:]
-            elif size <= len(buf):
-                self.handle_pkt(buf[4:size])
-                buf = buf[size:]
-            else:
-                break
-        self._readahead = BytesIO()
-        self._readahead.write(buf)
+        rbuf = self._rbuf
+        rbuf.feed(data)
+        pkt, size = rbuf.read_pkt()
+        while pkt is not INCOMPLETE_PKT:
+            self.handle_pkt(pkt)
+            pkt, size = rbuf.read_pkt()
 
     def get_tail(self):
         """Read back any unused data."""
-        return self._readahead.getvalue()
+        return self._rbuf.getvalue()
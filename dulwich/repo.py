@@ -44,6 +44,7 @@ from dulwich.file import (
 from dulwich.object_store import (
     DiskObjectStore,
     MemoryObjectStore,
+    ObjectStoreGraphWalker,
     )
 from dulwich.objects import (
     Blob,
@@ -491,7 +492,7 @@ class DiskRefsContainer(RefsContainer):
             # No cache: no peeled refs were read, or this ref is loose
             return None
         if name in self._peeled_refs:
-            return self._peeled_refs[name]
+            return Sha1Sum(self._peeled_refs[name])
         else:
             # Known not peelable
             return self[name]
@@ -815,7 +816,10 @@ class BaseRepo(object):
         target.object_store.add_objects(
           self.fetch_objects(determine_wants, target.get_graph_walker(),
                              progress))
-        return self.get_refs()
+        refs = self.get_refs()
+        if hasattr(target, 'update_commit_graph'):
+            target.update_commit_graph(refs.values())
+        return refs
 
     def fetch_objects(self, determine_wants, graph_walker, progress,
                       get_tagged=None):
@@ -837,15 +841,64 @@ class BaseRepo(object):
             # TODO(dborowitz): find a way to short-circuit that doesn't change
             # this interface.
             return None
+        if not wants:
+            # Nothing to send, and a client that wants nothing may not have
+            # negotiated any capabilities.
+            return []
+        # The shallow commits of the target once the fetch is done, and those
+        # it has now; graph walkers that do not deepen only have the latter.
+        shallow = getattr(graph_walker, 'shallow', None)
+        target_shallow = getattr(graph_walker, 'client_shallow', shallow)
+        object_filter = getattr(graph_walker, 'object_filter', None)
+        thin_pack = getattr(graph_walker, 'thin_pack', False)
         haves = self.object_store.find_common_revisions(graph_walker)
         return self.object_store.iter_shas(
-          self.object_store.find_missing_objects(haves, wants, progress,
-                                                 get_tagged))
+          self.object_store.find_missing_objects(
+            haves, wants, progress, get_tagged, shallow=shallow,
+            target_shallow=target_shallow, object_filter=object_filter,
+            thin_pack=thin_pack))
 
     def get_graph_walker(self, heads=None):
+        """Obtain a graph walker for the commits in this repository.
+
+        Commits listed in the shallow file are treated as having no parents.
+
+        :param heads: Optional heads to start the search with; defaults to all
+            branches
+        :return: ObjectStoreGraphWalker instance
+        """
         if heads is None:
             heads = list(self.refs.as_dict(b'refs/heads').values())
-        return self.object_store.get_graph_walker(heads)
+        return ObjectStoreGraphWalker(
+          heads, self.object_store.get_parents,
+          self.object_store.new_object_set, shallow=self.get_shallow())
+
+    def get_shallow(self):
+        """Get the commits whose parents are missing from this repository.
+
+        :return: Set of SHAs of the commits listed in the shallow file
+        """
+        f = self.get_named_file('shallow')
+        if f is None:
+            return set()
+        try:
+            return set(Sha1Sum(line.strip()) for line in f if line.strip())
+        finally:
+            f.close()
+
+    def update_shallow(self, new_shallow, new_unshallow):
+        """Update the list of shallow commits.
+
+        :param new_shallow: SHAs of commits whose parents are missing
+        :param new_unshallow: SHAs of commits whose parents are now present
+        """
+        shallow = self.get_shallow()
+        if new_shallow:
+            shallow.update(new_shallow)
+        if new_unshallow:
+            shallow.difference_update(new_unshallow)
+        self._put_named_file('shallow', b''.join(
+          [sha.hex_bytes + b'\n' for sha in sorted(shallow)]))
 
     def ref(self, name):
         """Return the SHA1 a ref is pointing to."""
@@ -879,7 +932,64 @@ class BaseRepo(object):
         return self.object_store[sha]
 
     def get_parents(self, sha):
-        return self.commit(sha).parents
+        return self.object_store.get_parents(sha)
+
+    def write_commit_graph(self, heads=None, changed_paths=None):
+        """Write the commit graph of this repository.
+
+        Once it has been written, the commit graph is kept up to date by
+        update_commit_graph, which fetches and pushes call.
+
+        :param heads: SHAs of the commits to include, along with their
+            ancestors. Defaults to the targets of all refs.
+        :param changed_paths: Whether to include changed-path Bloom filters,
+            which speed up walks limited to paths. Defaults to whether the
+            existing commit graph has them.
+        :return: The new CommitGraph
+        """
+        if heads is None:
+            heads = self.get_refs().values()
+        return self.object_store.write_commit_graph(heads, changed_paths)
+
+    def update_commit_graph(self, heads):
+        """Add newly received commits to the commit graph, if there is one.
+
+        The commits are written as a new layer of the graph, so the cost
+        depends on the number of new commits rather than on the size of the
+        history.
+
+        :param heads: SHAs of the new commits, along with their ancestors
+        """
+        graph = self.object_store.commit_graph
+        if graph is None:
+            return
+        new_heads = []
+        for head in heads:
+            try:
+                obj = self.object_store[head]
+                while isinstance(obj, Tag):
+                    obj = self.object_store[obj.object[1]]
+            except KeyError:
+                continue
+            if isinstance(obj, Commit) and obj.id not in graph:
+                new_heads.append(obj.id)
+        if new_heads:
+            self.object_store.extend_commit_graph(new_heads)
+
+    def write_clone_pack(self, tips=None):
+        """Write a pack with all objects reachable from the refs.
+
+        The upload-pack server sends this pack as is to clients that clone
+        the repository, along with the objects that were added since. Call
+        this again from time to time to keep the added objects few.
+
+        :param tips: SHAs of the objects to include, along with the objects
+            reachable from them. Defaults to the targets of all refs.
+        :return: The new Pack
+        """
+        if tips is None:
+            tips = set(self.get_refs().values())
+        return self.object_store.write_clone_pack(tips)
 
     def get_config(self):
         import configparser
@@ -957,7 +1067,9 @@ class BaseRepo(object):
         :param exclude: Iterable of SHAs of commits to exclude along with their
             ancestors, overriding includes.
         :param order: ORDER_* constant specifying the order of results. Anything
-            other than ORDER_DATE may result in O(n) memory usage.
+            other than ORDER_DATE may result in O(n) memory usage, unless the
+            store has a commit graph and since is not given; ORDER_TOPO then
+            streams results.
         :param reverse: If True, reverse the order of output, requiring O(n)
             memory.
         :param max_entries: The maximum number of entries to yield, or None for
@@ -26,44 +26,74 @@ Documentation/technical directory in the cgit distribution, and in particular:
 """
 
 
+import array
 import collections
+import errno
+from getopt import getopt
+import hashlib
+import os
+import signal
 import socket
 import socketserver
 import sys
+import tempfile
+import threading
+import time
 import zlib
 
 from dulwich.errors import (
     ApplyDeltaError,
     ChecksumMismatch,
     GitProtocolError,
+    HangupException,
     NotGitRepository,
+    QueueTimeoutError,
     UnexpectedCommandError,
     ObjectFormatException,
     )
 from dulwich import log_utils
+from dulwich.graph import (
+    SatisfiedWants,
+    is_ancestor,
+    )
+from dulwich.object_store import (
+    parse_filter_spec,
+    )
 from dulwich.pack import (
     write_pack_objects,
+    write_reused_pack_data,
     )
 from dulwich.protocol import (
     BufferedPktLineWriter,
+    DELIM_PKT,
     MULTI_ACK,
     MULTI_ACK_DETAILED,
     Protocol,
     ProtocolFile,
     ReceivableProtocol,
     SINGLE_ACK,
+    SidebandWriter,
     TCP_GIT_PORT,
     ZERO_SHA,
     ack_type,
     extract_capabilities,
+    extract_protocol_version,
     extract_want_line_capabilities,
+    pkt_line,
+    sendmsg_all,
     )
 from dulwich.repo import (
+    OBJECTDIR,
+    SYMREF,
     Repo,
     )
 from dulwich.objects import (
+    Commit,
     Sha1Sum
 )
+from dulwich.walk import (
+    Walker,
+    )
 
 logger = log_utils.getLogger(__name__)
 
@@ -79,7 +109,15 @@ def _force_bytes(text):
 
 
 class Backend(object):
-    """A backend for the Git smart server implementation."""
+    """A backend for the Git smart server implementation.
+
+    :ivar pack_cache: Optional PackCache for the packs sent to clients
+    :ivar admission_control: Optional AdmissionControl for the requests
+        that send packs to clients
+    """
+
+    pack_cache = None
+    admission_control = None
 
     def open_repository(self, path):
         """Open the repository at a path.
@@ -90,6 +128,16 @@ class Backend(object):
         """
         raise NotImplementedError(self.open_repository)
 
+    def release_repository(self, repo):
+        """Release a repository returned by open_repository.
+
+        Handlers call this once they are done with the repository.
+
+        :param repo: The BackendRepo to release
+        """
+        if hasattr(repo, 'close'):
+            repo.close()
+
 
 class BackendRepo(object):
     """Repository abstraction used by the Git server.
@@ -154,24 +202,185 @@ class DictBackend(Backend):
     def __exit__(self, type, value, tb):
         self.close()
 
+    def release_repository(self, repo):
+        # The repositories are shared between requests, which may be handled
+        # concurrently; they are only closed with the backend.
+        pass
+
     def close(self):
         for repo in self.repos.values():
             repo.close()
 
 
+# Defaults for RepoPool.
+DEFAULT_REPO_POOL_SIZE = 32
+DEFAULT_REPO_POOL_MEMORY = 512 * 1024 * 1024
+
+
+class _PooledRepo(object):
+
+    def __init__(self, path, repo, stamp):
+        self.path = path
+        self.repo = repo
+        self.stamp = stamp
+        self.users = 0
+        self.pooled = True
+
+
+class RepoPool(object):
+    """Pool of open repositories, shared between requests.
+
+    Repositories stay open after the requests that used them are done, so
+    that the pack indexes and object caches of their object stores stay warm
+    for the next request. The least recently used repositories that are not
+    in use are closed when there are more than max_repos in the pool, or
+    when together they use more than max_memory bytes; see
+    BaseObjectStore.memory_size.
+
+    A repository is opened again when its packed-refs file or its
+    objects/info directory changes, as the Repo caches their contents; the
+    object store picks up new packs by itself. The pool can be shared by
+    threads, and so are the repositories in it.
+    """
+
+    def __init__(self, max_repos=DEFAULT_REPO_POOL_SIZE,
+                 max_memory=DEFAULT_REPO_POOL_MEMORY, object_cache=True,
+                 open_repo=Repo):
+        """Create a new RepoPool.
+
+        :param max_repos: Maximum number of repositories to keep open
+        :param max_memory: Maximum memory used by the repositories to keep
+            open, in bytes
+        :param object_cache: Whether to enable the cache of parsed objects
+            in the object stores of the repositories
+        :param open_repo: Function that opens the repository at a path
+        """
+        self.max_repos = max_repos
+        self.max_memory = max_memory
+        self.object_cache = object_cache
+        self._open_repo = open_repo
+        self._lock = threading.Lock()
+        # Path -> _PooledRepo, least recently used first.
+        self._repos = collections.OrderedDict()
+        # id(repo) -> _PooledRepo, for the repositories that are in use.
+        self._in_use = {}
+
+    def __len__(self):
+        return len(self._repos)
+
+    def _get_stamp(self, repo):
+        controldir = repo.controldir()
+        # Only notice the control directory being replaced; its mtime
+        # changes with every lock file created in it.
+        try:
+            stamp = [os.stat(controldir).st_ino]
+        except OSError:
+            stamp = [None]
+        for path in (os.path.join(controldir, 'packed-refs'),
+                     os.path.join(controldir, OBJECTDIR, 'info')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                stamp.append(None)
+            else:
+                stamp.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        return stamp
+
+    def acquire(self, path):
+        """Get the open repository at a path, opening it if necessary.
+
+        :param path: Path of the repository
+        :raise NotGitRepository: no git repository was found at path
+        :return: The repository; pass it to release once done with it
+        """
+        with self._lock:
+            entry = self._repos.get(path)
+        if entry is not None:
+            stamp = self._get_stamp(entry.repo)
+            with self._lock:
+                if entry.pooled and entry.stamp == stamp:
+                    self._repos.move_to_end(path)
+                    entry.users += 1
+                    self._in_use[id(entry.repo)] = entry
+                    return entry.repo
+        repo = self._open_repo(path)
+        if self.object_cache:
+            repo.object_store.enable_object_cache()
+        entry = _PooledRepo(path, repo, self._get_stamp(repo))
+        entry.users = 1
+        with self._lock:
+            old = self._repos.pop(path, None)
+            if old is not None:
+                self._drop(old)
+            self._repos[path] = entry
+            self._in_use[id(repo)] = entry
+            self._evict()
+        return repo
+
+    def release(self, repo):
+        """Release a repository returned by acquire.
+
+        :param repo: The repository
+        """
+        with self._lock:
+            entry = self._in_use[id(repo)]
+            entry.users -= 1
+            if entry.users == 0:
+                del self._in_use[id(repo)]
+                if not entry.pooled:
+                    entry.repo.close()
+            self._evict()
+
+    def _drop(self, entry):
+        # Called with the lock held, after removing entry from the pool.
+        entry.pooled = False
+        if entry.users == 0:
+            entry.repo.close()
+
+    def _evict(self):
+        # Called with the lock held.
+        idle = [entry for entry in self._repos.values() if not entry.users]
+        memory = sum(entry.repo.object_store.memory_size()
+                     for entry in self._repos.values())
+        for entry in idle:
+            if len(self._repos) <= self.max_repos and memory <= self.max_memory:
+                break
+            memory -= entry.repo.object_store.memory_size()
+            del self._repos[entry.path]
+            self._drop(entry)
+
+    def close(self):
+        """Close the repositories in the pool.
+
+        Repositories that are in use are closed once they are released.
+        """
+        with self._lock:
+            for entry in self._repos.values():
+                self._drop(entry)
+            self._repos.clear()
+
+
 class FileSystemBackend(Backend):
-    """Simple backend that looks up Git repositories in the local file system."""
+    """Simple backend that looks up Git repositories in the local file system.
+
+    Repositories are kept open between requests in a RepoPool.
+    """
 
-    def __init__(self):
-        self._known_repos = []
+    def __init__(self, repo_pool=None):
+        """Create a new FileSystemBackend.
+
+        :param repo_pool: Optional RepoPool to open repositories from;
+            defaults to a new RepoPool with the default limits
+        """
+        if repo_pool is None:
+            repo_pool = RepoPool()
+        self.repo_pool = repo_pool
 
     def open_repository(self, path):
         if isinstance(path, bytes):
             path = path.decode('utf-8')
         logger.debug('opening repository at %s', path)
-        repo = Repo(path)
-        self._known_repos.append(repo)
-        return repo
+        return self.repo_pool.acquire(path)
 
     def __enter__(self):
         return self
@@ -179,18 +388,455 @@ class FileSystemBackend(Backend):
     def __exit__(self, type, value, tb):
         self.close()
 
+    def release_repository(self, repo):
+        self.repo_pool.release(repo)
+
     def close(self):
-        for repo in self._known_repos:
-            repo.close()
+        self.repo_pool.close()
+
+
+# Defaults for PackCache.
+DEFAULT_PACK_CACHE_SIZE = 1024 * 1024 * 1024
+DEFAULT_PACK_CACHE_AGE = 3600
+# The same as the default of C git's uploadpack.keepAlive.
+DEFAULT_PACK_CACHE_KEEPALIVE = 5
+
+# Cached packs are sent in chunks that fill a side-band-64k packet.
+_PACK_CACHE_CHUNK_SIZE = 65515
+
+
+def _process_exists(pid):
+    """Check whether a process with the given pid is running."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class _PackInFlight(object):
+    """A pack that is being generated into a temporary file of a PackCache."""
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.size = 0
+        self.done = False
+        self.failed = False
+        self.waiters = 0
+
+
+class PackCache(object):
+    """Cache of the packs sent to clients, stored on local disk.
+
+    Packs are stored under a key for the request they were generated for,
+    and sent again as they are to clients that make the same request. The
+    oldest packs are removed when the cache grows larger than max_size
+    bytes, and packs older than max_age seconds are not used.
+
+    A pack is sent to the client it is generated for while it is written to
+    the cache. Requests for a pack that is being generated do not generate
+    it as well, but send it from the cache file as it grows, along with
+    keepalives while no new data is available. The cache can be shared by
+    threads, but processes that share a directory only share the packs that
+    were there when their PackCache was created.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_PACK_CACHE_SIZE,
+                 max_age=DEFAULT_PACK_CACHE_AGE,
+                 keepalive_interval=DEFAULT_PACK_CACHE_KEEPALIVE):
+        """Create a new PackCache.
+
+        Temporary files left behind by a PackCache that did not finish
+        generating a pack are removed. The files are named after the process
+        that generates the pack, so that files of other processes that share
+        the directory are kept while these processes run.
+
+        :param path: Directory to store the packs in; created if it does not
+            exist
+        :param max_size: Maximum size of the packs in the cache, in bytes
+        :param max_age: Maximum age of the packs in the cache, in seconds
+        :param keepalive_interval: Seconds after which requests that wait
+            for a pack being generated send a keepalive
+        """
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.keepalive_interval = keepalive_interval
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # Key -> (size, creation time), oldest first.
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._in_flight = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        existing = []
+        for name in os.listdir(path):
+            if name.endswith('.pack'):
+                st = os.stat(os.path.join(path, name))
+                existing.append((st.st_mtime, name[:-len('.pack')],
+                                 st.st_size))
+            elif name.endswith('.tmp'):
+                pid = name.split('-', 1)[0]
+                if pid.isdigit() and _process_exists(int(pid)):
+                    continue
+                try:
+                    os.remove(os.path.join(path, name))
+                except OSError:
+                    pass
+        for mtime, key, size in sorted(existing):
+            self._entries[key] = (size, mtime)
+            self._size += size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.pack')
+
+    def _remove(self, key):
+        size, created = self._entries.pop(key)
+        self._size -= size
+        try:
+            os.remove(self._filename(key))
+        except OSError:
+            pass
+
+    def _open(self, key):
+        # Called with the lock held.
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] + self.max_age < time.time():
+            self._remove(key)
+            return None
+        try:
+            return open(self._filename(key), 'rb')
+        except IOError:
+            self._remove(key)
+            return None
+
+    def _add(self, key, tmp_path, size):
+        # Called with the lock held. Readers of evicted packs keep their
+        # open files.
+        os.rename(tmp_path, self._filename(key))
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old[0]
+        self._entries[key] = (size, time.time())
+        self._size += size
+        while self._size > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def send(self, key, generate, write, keepalive=None):
+        """Send a pack, taking it from the cache if it is there.
+
+        :param key: Key of the pack, a string of hex digits
+        :param generate: Function that takes a write function and writes the
+            pack to it. Called if the pack is not in the cache; if it
+            raises an exception or writes nothing, nothing is cached.
+        :param write: Function to write the pack to
+        :param keepalive: Optional function that tells the client that the
+            request is still being handled, called while waiting for a pack
+            that is being generated for another request
+        """
+        while True:
+            with self._lock:
+                f = self._open(key)
+                if f is not None:
+                    break
+                in_flight = self._in_flight.get(key)
+                if in_flight is None:
+                    fd, tmp_path = tempfile.mkstemp(
+                      prefix='%d-' % os.getpid(), suffix='.tmp',
+                      dir=self.path)
+                    in_flight = self._in_flight[key] = _PackInFlight(tmp_path)
+                    break
+                # The file is only removed once it is no longer in flight.
+                f = open(in_flight.tmp_path, 'rb')
+                in_flight.waiters += 1
+            try:
+                if self._follow(key, in_flight, f, write, keepalive):
+                    return
+            finally:
+                f.close()
+                with self._lock:
+                    in_flight.waiters -= 1
+            # Generating the pack failed before any of it was sent; try
+            # again.
+        if f is None:
+            self._generate(key, in_flight, fd, generate, write)
+            return
+        logger.info('Sending cached pack %s', key)
+        with f:
+            data = f.read(_PACK_CACHE_CHUNK_SIZE)
+            while data:
+                write(data)
+                data = f.read(_PACK_CACHE_CHUNK_SIZE)
+
+    def _generate(self, key, in_flight, fd, generate, write):
+        """Generate a pack into the cache while sending it.
+
+        If the client goes away while other requests wait for the pack, the
+        pack is still generated for them before the error is raised.
+        """
+        client_errors = []
+
+        def write_and_store(data):
+            f.write(data)
+            f.flush()
+            with self._changed:
+                in_flight.size += len(data)
+                self._changed.notify_all()
+                waiters = in_flight.waiters
+            if client_errors:
+                return
+            try:
+                write(data)
+            except (GitProtocolError, socket.error) as e:
+                if not waiters:
+                    raise
+                client_errors.append(e)
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                generate(write_and_store)
+        except:
+            with self._changed:
+                del self._in_flight[key]
+                in_flight.failed = True
+                self._changed.notify_all()
+            os.remove(in_flight.tmp_path)
+            raise
+        with self._changed:
+            del self._in_flight[key]
+            try:
+                if in_flight.size:
+                    self._add(key, in_flight.tmp_path, in_flight.size)
+            finally:
+                in_flight.done = True
+                self._changed.notify_all()
+        if not in_flight.size:
+            os.remove(in_flight.tmp_path)
+        if client_errors:
+            raise client_errors[0]
+
+    def _follow(self, key, in_flight, f, write, keepalive):
+        """Send a pack from the file it is being generated into.
+
+        :return: Whether the pack was sent; False if generating it failed
+            before any of it was sent
+        :raise GitProtocolError: if generating the pack failed after some of
+            it was sent
+        """
+        logger.info('Sending pack %s while it is generated', key)
+        pos = 0
+        while True:
+            with self._changed:
+                if (in_flight.size == pos and not in_flight.done and
+                    not in_flight.failed):
+                    self._changed.wait(self.keepalive_interval)
+                size = in_flight.size
+                done = in_flight.done
+                failed = in_flight.failed
+            if failed:
+                if pos:
+                    raise GitProtocolError(
+                      'Generating the pack failed in another request')
+                return False
+            if size > pos:
+                data = f.read(min(size - pos, _PACK_CACHE_CHUNK_SIZE))
+                pos += len(data)
+                write(data)
+            elif done:
+                return True
+            elif keepalive is not None:
+                keepalive()
+
+
+# Default for AdmissionControl.
+DEFAULT_ADMISSION_TIMEOUT = 300
+
+
+class _AdmissionTicket(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.admitted = False
+
+
+class AdmissionControl(object):
+    """Limits on the number of requests that are handled at once.
+
+    Requests that would exceed the limit for their repository or the limit
+    for all repositories wait in a FIFO queue, for at most queue_timeout
+    seconds. Requests are admitted in the order they were queued, except
+    that a request for a repository that is at its limit does not hold up
+    requests for other repositories. The controller can be shared by
+    threads.
+
+    stats returns the queue depths and wait times.
+    """
+
+    def __init__(self, max_running=None, max_running_per_repo=None,
+                 queue_timeout=DEFAULT_ADMISSION_TIMEOUT):
+        """Create a new AdmissionControl.
+
+        :param max_running: Maximum number of requests to handle at once, or
+            None for no limit
+        :param max_running_per_repo: Maximum number of requests for one
+            repository to handle at once, or None for no limit
+        :param queue_timeout: Number of seconds requests can wait, or None to
+            let them wait indefinitely
+        """
+        self.max_running = max_running
+        self.max_running_per_repo = max_running_per_repo
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._running = collections.Counter()
+        self._num_running = 0
+        self._admitted = 0
+        self._timeouts = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def _can_run(self, key):
+        return ((self.max_running is None or
+                 self._num_running < self.max_running) and
+                (self.max_running_per_repo is None or
+                 self._running[key] < self.max_running_per_repo))
+
+    def _dispatch(self):
+        # Called with the lock held.
+        changed = False
+        for ticket in list(self._queue):
+            if self._can_run(ticket.key):
+                self._queue.remove(ticket)
+                self._running[ticket.key] += 1
+                self._num_running += 1
+                ticket.admitted = True
+                changed = True
+        if changed:
+            self._cond.notify_all()
+
+    def _wait(self, ticket, reported, deadline):
+        # Called with the lock held. Returns the position of the ticket in
+        # the queue once it differs from the reported one, or None once the
+        # ticket is admitted.
+        while not ticket.admitted:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    raise QueueTimeoutError(
+                      'timed out waiting for the server to handle the request')
+            position = self._queue.index(ticket) + 1
+            if position != reported:
+                return position
+            self._cond.wait(timeout)
+        return None
+
+    def enter(self, key, report=None):
+        """Wait until a request for a repository can be handled.
+
+        Call leave once the request has been handled.
+
+        :param key: Key of the repository, such as its path
+        :param report: Optional function that is called with the position
+            of the request in the queue, whenever it changes
+        :raise QueueTimeoutError: if the request waited for longer than
+            queue_timeout seconds
+        """
+        ticket = _AdmissionTicket(key)
+        queued = time.time()
+        deadline = None
+        if self.queue_timeout is not None:
+            deadline = queued + self.queue_timeout
+        with self._cond:
+            self._queue.append(ticket)
+            self._dispatch()
+        position = None
+        try:
+            while True:
+                with self._cond:
+                    position = self._wait(ticket, position, deadline)
+                if position is None:
+                    break
+                if report is not None:
+                    report(position)
+        except BaseException as e:
+            with self._cond:
+                if ticket.admitted:
+                    self._leave(key)
+                else:
+                    self._queue.remove(ticket)
+                    # The requests behind it moved up.
+                    self._cond.notify_all()
+                    if isinstance(e, QueueTimeoutError):
+                        self._timeouts += 1
+            raise
+        wait_time = time.time() - queued
+        with self._cond:
+            self._admitted += 1
+            self._total_wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+        if wait_time >= 1:
+            logger.info('Request for %s waited %.1f seconds to be handled',
+                        key, wait_time)
+
+    def _leave(self, key):
+        # Called with the lock held.
+        self._running[key] -= 1
+        if not self._running[key]:
+            del self._running[key]
+        self._num_running -= 1
+        self._dispatch()
+
+    def leave(self, key):
+        """Mark a request that was admitted by enter as handled.
+
+        :param key: Key of the repository
+        """
+        with self._cond:
+            self._leave(key)
+
+    def stats(self):
+        """Return statistics of the requests.
+
+        :return: Dictionary with the number of requests that are running
+            ('running') and queued ('queued'), both overall and by repository
+            key ('running_per_repo', 'queued_per_repo'), the number of
+            requests that were admitted ('admitted') and that timed out
+            ('timeouts'), and the total and maximum number of seconds that
+            admitted requests waited ('total_wait_time', 'max_wait_time').
+        """
+        with self._cond:
+            queued = collections.Counter(t.key for t in self._queue)
+            return {
+                'running': self._num_running,
+                'queued': len(self._queue),
+                'running_per_repo': dict(self._running),
+                'queued_per_repo': dict(queued),
+                'admitted': self._admitted,
+                'timeouts': self._timeouts,
+                'total_wait_time': self._total_wait_time,
+                'max_wait_time': self._max_wait_time,
+                }
 
 
 class Handler(object):
     """Smart protocol command handler base class."""
 
-    def __init__(self, backend, proto, http_req=None):
+    # Versions of the protocol the handler speaks. Clients that ask for
+    # another version get version 0.
+    protocol_versions = (0,)
+
+    def __init__(self, backend, proto, http_req=None, protocol_version=0):
         self.backend = backend
         self.proto = proto
         self.http_req = http_req
+        self.protocol_version = protocol_version
         self._client_capabilities = None
 
     def __enter__(self):
@@ -243,29 +889,45 @@ class Handler(object):
 class UploadPackHandler(Handler):
     """Protocol handler for uploading a pack to the server."""
 
+    protocol_versions = (0, 2)
+
     def __init__(self, backend, args, proto, http_req=None,
-                 advertise_refs=False):
-        Handler.__init__(self, backend, proto, http_req=http_req)
+                 advertise_refs=False, protocol_version=0):
+        Handler.__init__(self, backend, proto, http_req=http_req,
+                         protocol_version=protocol_version)
         self.repo = backend.open_repository(args[0])
+        self.repo_path = args[0]
         self._graph_walker = None
         self.advertise_refs = advertise_refs
 
     def close(self):
-        if hasattr(self.repo, 'close'):
+        release_repository = getattr(self.backend, 'release_repository', None)
+        if release_repository is not None:
+            release_repository(self.repo)
+        elif hasattr(self.repo, 'close'):
             self.repo.close()
 
     @classmethod
     def capabilities(cls):
         return (b"multi_ack_detailed", b"multi_ack", b"side-band-64k", b"thin-pack",
-                b"ofs-delta", b"no-progress", b"include-tag")
+                b"ofs-delta", b"no-progress", b"include-tag", b"shallow",
+                b"deepen-since", b"deepen-not", b"deepen-relative",
+                b"filter")
 
     @classmethod
     def required_capabilities(cls):
         return (b"side-band-64k", b"thin-pack", b"ofs-delta")
 
+    @classmethod
+    def capabilities_v2(cls):
+        """Return the capabilities advertised in protocol version 2."""
+        return (b"ls-refs", b"fetch=shallow filter")
+
     def progress(self, message):
         if self.has_capability(b"no-progress"):
             return
+        if not isinstance(message, bytes):
+            message = message.encode('ascii')
         self.proto.write_sideband(2, message)
 
     def get_tagged(self, refs=None, repo=None):
@@ -298,29 +960,421 @@ class UploadPackHandler(Handler):
         return tagged
 
     def handle(self):
-        write = lambda x: self.proto.write_sideband(1, x)
-
+        if self.protocol_version == 2:
+            self.handle_v2()
+            return
         graph_walker = ProtocolGraphWalker(self, self.repo.object_store,
             self.repo.get_peeled)
-        objects_iter = self.repo.fetch_objects(
-          graph_walker.determine_wants, graph_walker, self.progress,
-          get_tagged=self.get_tagged)
-
+        wants = graph_walker.determine_wants(self.repo.get_refs())
         # Did the process short-circuit (e.g. in a stateless RPC call)? Note
         # that the client still expects a 0-object pack in most cases.
-        if objects_iter is None:
-            return
-        objects_len = len(objects_iter)
-        if objects_len == 0:
+        if not wants:
             return
+        haves = self.repo.object_store.find_common_revisions(graph_walker)
 
         self.progress("dul-daemon says what\n")
-        self.progress("counting objects: %d, done.\n" % objects_len)
-        write_pack_objects(ProtocolFile(None, write), objects_iter)
+        if not self._send_pack(graph_walker, wants, haves, send_empty=False):
+            return
         self.progress("how was that, then?\n")
         # we are done
         self.proto.write(b"0000")
 
+    def _send_pack(self, graph_walker, wants, haves, send_empty=True):
+        """Send the pack with the objects the client is missing.
+
+        Clones are served from the clone pack of the repository where it
+        covers them; see _send_clone_pack. Otherwise, the pack is taken from
+        the pack cache of the backend if it has one and the request can be
+        cached; see _get_pack_cache_key.
+
+        If the backend has admission control, the request waits until it is
+        admitted, and the client is told its position in the queue. If it
+        times out, the client is sent an error and no pack.
+
+        :param graph_walker: ProtocolGraphWalker of the request
+        :param wants: SHAs of the objects the client wants
+        :param haves: SHAs of the commits the client and server have in
+            common
+        :param send_empty: Whether to send a pack without objects
+        :return: Whether a pack was sent
+        """
+        admission_control = getattr(self.backend, 'admission_control', None)
+        if admission_control is None:
+            return self._send_admitted_pack(graph_walker, wants, haves,
+                                            send_empty)
+        key = self.repo_path
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        try:
+            admission_control.enter(key, self._report_queue_position)
+        except QueueTimeoutError as e:
+            logger.warning('Not sending pack for %s: %s', key, e)
+            self.proto.write_sideband(3, ('%s\n' % e).encode('utf-8'))
+            return False
+        try:
+            return self._send_admitted_pack(graph_walker, wants, haves,
+                                            send_empty)
+        finally:
+            admission_control.leave(key)
+
+    def _report_queue_position(self, position):
+        self.progress("waiting for the server, position %d in queue\n"
+                      % position)
+
+    def _send_keepalive(self):
+        # An empty packet on the pack data channel, as sent by C git.
+        self.proto.write_pkt_line(b'\x01')
+
+    def _send_admitted_pack(self, graph_walker, wants, haves, send_empty):
+        # The pack data is sent in full side-band-64k packets, rather than a
+        # packet per object.
+        writer = SidebandWriter(self.proto, 1)
+        sent = self._send_buffered_pack(graph_walker, wants, haves,
+                                        send_empty, writer.write)
+        writer.flush()
+        return sent
+
+    def _send_buffered_pack(self, graph_walker, wants, haves, send_empty,
+                            write):
+
+        def generate(write):
+            store = self.repo.object_store
+            objects_iter = store.iter_shas(store.find_missing_objects(
+              haves, wants, self.progress, get_tagged=self.get_tagged,
+              shallow=graph_walker.shallow,
+              target_shallow=graph_walker.client_shallow,
+              object_filter=graph_walker.object_filter,
+              thin_pack=graph_walker.thin_pack))
+            objects_len = len(objects_iter)
+            if objects_len == 0 and not send_empty:
+                return
+            self.progress("counting objects: %d, done.\n" % objects_len)
+            write_pack_objects(ProtocolFile(None, write), objects_iter,
+                               get_delta_base=objects_iter.get_delta_base)
+
+        if self._send_clone_pack(graph_walker, wants, haves, write):
+            return True
+
+        sent = []
+        def write_sent(data):
+            sent.append(True)
+            write(data)
+
+        pack_cache = getattr(self.backend, 'pack_cache', None)
+        key = None
+        if pack_cache is not None:
+            key = self._get_pack_cache_key(graph_walker, wants, haves)
+        if key is None:
+            generate(write_sent)
+        else:
+            pack_cache.send(key, generate, write_sent, self._send_keepalive)
+        return bool(sent)
+
+    def _send_clone_pack(self, graph_walker, wants, haves, write):
+        """Send the clone pack of the repository, if it covers a request.
+
+        The clone pack covers requests that have nothing in common with the
+        server and want all of its tips, or descendants of them. Its objects
+        are copied to the client verbatim; only the objects that are
+        reachable from the wants but not from the tips are compressed and
+        sent after them.
+
+        :param graph_walker: ProtocolGraphWalker of the request
+        :param wants: SHAs of the objects the client wants
+        :param haves: SHAs of the commits the client and server have in
+            common
+        :param write: Function to write the pack data with
+        :return: Whether the clone pack was sent
+        """
+        # The clone pack may contain offset deltas.
+        if (haves or graph_walker.shallow or graph_walker.client_shallow or
+            graph_walker.object_filter is not None or
+            not self.has_capability(b'ofs-delta')):
+            return False
+        store = self.repo.object_store
+        clone_pack = store.find_clone_pack()
+        if clone_pack is None:
+            return False
+        pack, tips = clone_pack
+        if not self._covers_tips(tips, wants):
+            return False
+        missing = store.find_missing_objects(tips, wants, self.progress,
+                                             get_tagged=self.get_tagged)
+        extra = [(sha, path) for (sha, path) in missing if sha not in pack]
+        self.progress("counting objects: %d, done.\n"
+                      % (len(pack) + len(extra)))
+        records = ((o.type_num, o.sha().digest(), None, o.as_raw_string())
+                   for (o, path) in store.iter_shas(extra))
+        write_reused_pack_data(ProtocolFile(None, write), pack.data,
+                               len(extra), records)
+        return True
+
+    def _covers_tips(self, tips, wants):
+        """Check whether the objects reachable from tips are all wanted.
+
+        :param tips: SHAs of the tips of a clone pack
+        :param wants: SHAs of the objects the client wants
+        :return: True if every tip is wanted or is a commit that is an
+            ancestor of a wanted commit
+        """
+        store = self.repo.object_store
+        wants = set(Sha1Sum(sha) for sha in wants)
+        want_commits = None
+        for tip in tips:
+            if tip in wants:
+                continue
+            if want_commits is None:
+                want_commits = set()
+                for sha in wants:
+                    obj = store.peel_sha(sha)
+                    if isinstance(obj, Commit):
+                        want_commits.add(obj.id)
+            if tip not in store or not isinstance(store[tip], Commit):
+                return False
+            if not any(is_ancestor(store, tip, sha) for sha in want_commits):
+                return False
+        return True
+
+    def _get_pack_cache_key(self, graph_walker, wants, haves):
+        """Get the key of the pack for a request in the pack cache.
+
+        The key covers the repository, the wants, the haves and the
+        capabilities that change the pack. Requests that make the client
+        shallow or filter objects are not cached.
+
+        :return: The key as a string of hex digits, or None if the pack is
+            not to be cached
+        """
+        if (graph_walker.shallow or graph_walker.client_shallow or
+            graph_walker.object_filter is not None):
+            return None
+        repo_path = self.repo_path
+        if not isinstance(repo_path, bytes):
+            repo_path = repo_path.encode('utf-8')
+        key = hashlib.sha1(repo_path + b'\0')
+        for name, shas in ((b'want', wants), (b'have', haves)):
+            for sha in sorted(Sha1Sum(sha).hex_bytes for sha in shas):
+                key.update(name + b' ' + sha + b'\n')
+        for cap in (b'thin-pack', b'ofs-delta', b'include-tag'):
+            if self.has_capability(cap):
+                key.update(b'capability ' + cap + b'\n')
+        # The tags that are included depend on the refs.
+        for peeled, tag in sorted((Sha1Sum(peeled).hex_bytes,
+                                   Sha1Sum(tag).hex_bytes)
+                                  for (peeled, tag)
+                                  in self.get_tagged().items()):
+            key.update(b'tag ' + peeled + b' ' + tag + b'\n')
+        return key.hexdigest()
+
+    def handle_v2(self):
+        """Handle a session in protocol version 2.
+
+        Rather than advertising all refs up front, the server advertises its
+        capabilities and the client then sends ls-refs and fetch commands.
+        Over HTTP, every request carries a single command.
+        """
+        if self.advertise_refs or not self.http_req:
+            self.advertise_capabilities_v2()
+            if self.advertise_refs:
+                return
+        while self.handle_request_v2():
+            if self.http_req:
+                return
+
+    def advertise_capabilities_v2(self):
+        """Send the capability advertisement of protocol version 2."""
+        self.proto.write_pkt_line(b'version 2\n')
+        for cap in self.capabilities_v2():
+            self.proto.write_pkt_line(cap + b'\n')
+        self.proto.write_pkt_line(None)
+
+    def handle_request_v2(self):
+        """Read and handle a single command request of protocol version 2.
+
+        :return: False if the client ended the session, True otherwise
+        """
+        request = self._read_request_v2()
+        if request is None:
+            return False
+        command, args = request
+        if command == b'ls-refs':
+            self._handle_ls_refs(args)
+        elif command == b'fetch':
+            self._handle_fetch(args)
+        else:
+            raise GitProtocolError('Invalid command %s' %
+                                   command.decode('utf-8', 'replace'))
+        return True
+
+    def _read_request_v2(self):
+        """Read a command request of protocol version 2.
+
+        :return: Tuple with the command and the list of its arguments, or
+            None if the client ended the session
+        """
+        try:
+            pkt = self.proto.read_pkt_line()
+        except HangupException:
+            return None
+        if pkt is None:
+            return None
+        command = None
+        # The command is followed by capabilities, such as the agent, which
+        # do not change what is sent.
+        while pkt is not None and pkt is not DELIM_PKT:
+            key, _, value = pkt.rstrip(b'\n').partition(b'=')
+            if key == b'command':
+                command = value
+            pkt = self.proto.read_pkt_line()
+        if command is None:
+            raise GitProtocolError('Request without command')
+        args = []
+        if pkt is DELIM_PKT:
+            args = [arg.rstrip(b'\n') for arg in self.proto.read_pkt_seq()]
+        return command, args
+
+    def _handle_ls_refs(self, args):
+        """Handle the ls-refs command, listing refs and their values.
+
+        :param args: Arguments of the command
+        """
+        peel = False
+        symrefs = False
+        prefixes = []
+        for arg in args:
+            if arg == b'peel':
+                peel = True
+            elif arg == b'symrefs':
+                symrefs = True
+            elif arg.startswith(b'ref-prefix '):
+                prefixes.append(arg[len(b'ref-prefix '):])
+            else:
+                raise GitProtocolError('Unexpected ls-refs argument %r' % arg)
+        refs = self.repo.refs
+        for name in sorted(_find_refs_with_prefixes(refs, prefixes)):
+            try:
+                sha = refs[name]
+            except KeyError:
+                continue
+            line = sha.hex_bytes + b' ' + name
+            if symrefs:
+                target = refs.read_ref(name)
+                if isinstance(target, bytes) and target.startswith(SYMREF):
+                    line += b' symref-target:' + target[len(SYMREF):]
+            if peel:
+                peeled_sha = self.repo.get_peeled(name)
+                if peeled_sha != sha:
+                    line += b' peeled:' + peeled_sha.hex_bytes
+            self.proto.write_pkt_line(line + b'\n')
+        self.proto.write_pkt_line(None)
+
+    def _handle_fetch(self, args):
+        """Handle the fetch command of protocol version 2.
+
+        Each request carries all wants and the haves of one round of
+        negotiation. Unless the client is done or the server is ready to
+        send the pack, the response only acknowledges the haves.
+
+        :param args: Arguments of the command
+        """
+        store = self.repo.object_store
+        graph_walker = ProtocolGraphWalker(self, store, self.repo.get_peeled)
+        capabilities = []
+        wants = []
+        haves = []
+        done = False
+        depth = None
+        since = None
+        not_shas = []
+        relative = False
+        for arg in args:
+            if arg in self.innocuous_capabilities():
+                capabilities.append(arg)
+                continue
+            command, value = _split_proto_line(arg, _FETCH_COMMANDS)
+            if command == b'want':
+                # Like C git, any object the server has can be asked for.
+                if value not in store:
+                    raise GitProtocolError(
+                      'Client wants invalid object %s' % value)
+                wants.append(value)
+            elif command == b'have':
+                haves.append(value)
+            elif command == b'done':
+                done = True
+            elif command == b'shallow':
+                graph_walker.client_shallow.add(value)
+            elif command == b'deepen':
+                depth = value
+            elif command == b'deepen-since':
+                since = value
+            elif command == b'deepen-not':
+                not_shas.append(_lookup_deepen_not(self.repo.refs, value))
+            elif command == b'deepen-relative':
+                relative = True
+            else:
+                try:
+                    graph_walker.object_filter = parse_filter_spec(value)
+                except ValueError as e:
+                    raise GitProtocolError(e)
+        self._client_capabilities = set(capabilities)
+        graph_walker.set_wants(wants)
+        common = [sha for sha in haves if sha in store]
+
+        if not done:
+            self.proto.write_pkt_line(b'acknowledgments\n')
+            for sha in common:
+                graph_walker.send_ack(sha)
+            if not common:
+                graph_walker.send_nak()
+            elif graph_walker.all_wants_satisfied(common):
+                self.proto.write_pkt_line(b'ready\n')
+                done = True
+            if not done:
+                self.proto.write_pkt_line(None)
+                return
+            self.proto.write_pkt_line(DELIM_PKT)
+
+        graph_walker.shallow.update(graph_walker.client_shallow)
+        deepen = depth is not None or since is not None or not_shas
+        if deepen or graph_walker.client_shallow:
+            self.proto.write_pkt_line(b'shallow-info\n')
+            if deepen:
+                graph_walker.write_shallow_lines(graph_walker.update_shallow(
+                  wants, depth, since, not_shas, relative))
+            self.proto.write_pkt_line(DELIM_PKT)
+
+        self.proto.write_pkt_line(b'packfile\n')
+        graph_walker.thin_pack = self.has_capability(b'thin-pack')
+        self._send_pack(graph_walker, wants, common)
+        self.proto.write_pkt_line(None)
+
+
+def _find_refs_with_prefixes(refs, prefixes):
+    """Find the names of the refs that start with any of a list of prefixes.
+
+    Only the loose refs in the directories the prefixes point into are
+    listed, so that asking for refs/heads/ does not list every ref.
+
+    :param refs: A RefsContainer
+    :param prefixes: List of prefixes; all refs are found if it is empty
+    :return: Set of ref names
+    """
+    if not prefixes:
+        return refs.allkeys()
+    names = set()
+    for prefix in prefixes:
+        base, slash, _ = prefix.rpartition(b'/')
+        if slash:
+            candidates = [base + b'/' + name for name in refs.subkeys(base)]
+        elif b'refs'.startswith(prefix):
+            candidates = refs.allkeys()
+        else:
+            # Only HEAD lives outside refs/.
+            candidates = [b'HEAD']
+        names.update(name for name in candidates if name.startswith(prefix))
+    return names
+
 
 def _split_proto_line(line, allowed):
     """Split a line read from the wire.
@@ -333,6 +1387,12 @@ def _split_proto_line(line, allowed):
     :return: a tuple having one of the following forms:
         ('want', obj_id)
         ('have', obj_id)
+        ('shallow', obj_id)
+        ('deepen', depth)
+        ('deepen-since', timestamp)
+        ('deepen-not', refname)
+        ('deepen-relative', None)
+        ('filter', filter_spec)
         ('done', None)
         (None, None)  (for a flush-pkt)
 
@@ -347,16 +1407,115 @@ def _split_proto_line(line, allowed):
     if allowed is not None and command not in allowed:
         raise UnexpectedCommandError(command)
     try:
-        if len(fields) == 1 and command in (b'done', None):
+        if len(fields) == 1 and command in (b'done', b'deepen-relative', None):
             return (command, None)
-        elif len(fields) == 2 and command in (b'want', b'have'):
+        elif len(fields) == 2 and command in (b'want', b'have', b'shallow'):
             fields[1] = Sha1Sum(fields[1])
             return tuple(fields)
-    except (TypeError, AssertionError, ObjectFormatException) as e:
+        elif len(fields) == 2 and command in (b'deepen', b'deepen-since'):
+            return (command, int(fields[1]))
+        elif len(fields) == 2 and command in (b'deepen-not', b'filter'):
+            return tuple(fields)
+    except (TypeError, ValueError, AssertionError,
+            ObjectFormatException) as e:
         raise GitProtocolError(e)
     raise GitProtocolError('Received invalid line from client: %r' % line)
 
 
+def _peel_commits(store, shas):
+    """Peel tags, and leave out SHAs that do not point at commits."""
+    commits = []
+    for sha in shas:
+        obj = store.peel_sha(sha)
+        if isinstance(obj, Commit):
+            commits.append(obj.id)
+    return commits
+
+
+def _lookup_deepen_not(heads, name):
+    """Look up the ref given in a deepen-not line.
+
+    Like in C git, the name may be abbreviated.
+
+    :param heads: Dictionary mapping the advertised refs to their SHAs
+    :param name: Name of the ref
+    :return: SHA the ref points at
+    :raise GitProtocolError: if there is no such ref
+    """
+    for pattern in (b'%s', b'refs/%s', b'refs/tags/%s', b'refs/heads/%s',
+                    b'refs/remotes/%s', b'refs/remotes/%s/HEAD'):
+        ref = pattern % name
+        if ref in heads:
+            return heads[ref]
+    raise GitProtocolError('Client wants to deepen-not invalid ref %s' %
+                           name.decode('utf-8', 'replace'))
+
+
+def _find_shallow(store, heads, depth):
+    """Find the boundary of the history within a depth of a set of heads.
+
+    :param store: Object store with the commits
+    :param heads: SHAs of the commits to start from
+    :param depth: Number of commits to include along each path from a head,
+        counting the head itself
+    :return: Tuple with the set of SHAs of the commits at depth, whose parents
+        are left out, and the set of SHAs of the commits closer to the heads
+    """
+    depths = {}
+    todo = collections.deque()
+    for sha in _peel_commits(store, heads):
+        if sha not in depths:
+            depths[sha] = 1
+            todo.append(sha)
+    shallow = set()
+    not_shallow = set()
+    while todo:
+        sha = todo.popleft()
+        parents = store.get_parents(sha)
+        # Breadth-first, so this is the length of the shortest path.
+        commit_depth = depths[sha]
+        if commit_depth >= depth:
+            if parents:
+                shallow.add(sha)
+            continue
+        not_shallow.add(sha)
+        for parent in parents:
+            if parent not in depths:
+                depths[parent] = commit_depth + 1
+                todo.append(parent)
+    return shallow, not_shallow
+
+
+def _find_shallow_since(store, heads, since, not_shas):
+    """Find the boundary of the history since a time, or not in other history.
+
+    :param store: Object store with the commits
+    :param heads: SHAs of the commits to start from
+    :param since: Timestamp of the oldest commit to include, or None
+    :param not_shas: SHAs of commits whose history is left out
+    :return: Tuple with the set of SHAs of the included commits that have
+        parents which are left out, and the set of SHAs of the other included
+        commits
+    """
+    heads = _peel_commits(store, heads)
+    walker = Walker(store, heads, exclude=_peel_commits(store, not_shas),
+                    since=since)
+    commits = [entry.commit for entry in walker]
+    included = set(c.id for c in commits)
+    shallow = set()
+    not_shallow = set()
+    for commit in commits:
+        if all(p in included for p in commit.parents):
+            not_shallow.add(commit.id)
+        else:
+            shallow.add(commit.id)
+    # Heads that are left out are sent without their history.
+    for sha in heads:
+        if sha not in included and store.get_parents(sha):
+            shallow.add(sha)
+    return shallow, not_shallow
+
+
 class ProtocolGraphWalker(object):
     """A graph walker that knows the git protocol.
 
@@ -378,10 +1537,21 @@ class ProtocolGraphWalker(object):
         self.http_req = handler.http_req
         self.advertise_refs = handler.advertise_refs
         self._wants = []
+        # Commits the client reported as shallow, and those that are shallow
+        # on the client once the fetch is done.
+        self.client_shallow = set()
+        self.shallow = set()
+        self.unshallow = set()
+        # The ObjectFilter the client asked for, if any.
+        self.object_filter = None
+        # Whether the client accepts deltas against objects it has.
+        self.thin_pack = False
         self._cached = False
         self._cache = []
         self._cache_index = 0
         self._impl = None
+        # SatisfiedWants for the commits passed to add_common.
+        self._satisfied_wants = None
 
     def determine_wants(self, heads):
         """Determine the wants for a set of heads.
@@ -424,18 +1594,40 @@ class ProtocolGraphWalker(object):
         line, caps = extract_want_line_capabilities(want)
         self.handler.set_client_capabilities(caps)
         self.set_ack_type(ack_type(caps))
-        allowed = (b'want', None)
-        command, sha = _split_proto_line(line, allowed)
+        self.thin_pack = self.handler.has_capability(b'thin-pack')
+        command, value = _split_proto_line(line, (b'want', None))
 
         want_revs = []
+        depth = None
+        since = None
+        not_shas = []
+        relative = self.handler.has_capability(b'deepen-relative')
         while command != None:
-            if sha not in values:
-                raise GitProtocolError(
-                  'Client wants invalid object %s' % sha)
-            want_revs.append(sha)
-            command, sha = self.read_proto_line(allowed)
+            if command == b'want':
+                if value not in values:
+                    raise GitProtocolError(
+                      'Client wants invalid object %s' % value)
+                want_revs.append(value)
+            elif command == b'shallow':
+                self.client_shallow.add(value)
+            elif command == b'deepen':
+                depth = value
+            elif command == b'deepen-since':
+                since = value
+            elif command == b'filter':
+                try:
+                    self.object_filter = parse_filter_spec(value)
+                except ValueError as e:
+                    raise GitProtocolError(e)
+            else:
+                not_shas.append(_lookup_deepen_not(heads, value))
+            command, value = self.read_proto_line(_WANT_COMMANDS)
 
         self.set_wants(want_revs)
+        self.shallow.update(self.client_shallow)
+        if depth is not None or since is not None or not_shas:
+            self._handle_shallow_request(want_revs, depth, since, not_shas,
+                                         relative)
 
         if self.http_req and self.proto.eof():
             # The client may close the socket at this point, expecting a
@@ -445,6 +1637,74 @@ class ProtocolGraphWalker(object):
 
         return want_revs
 
+    def _handle_shallow_request(self, wants, depth, since, not_shas,
+                                relative=False):
+        """Find the new shallow boundary and send it to the client.
+
+        :param wants: SHAs of the commits the client wants
+        :param depth: Number of commits to send along each path from wants,
+            or None
+        :param since: Timestamp of the oldest commit to send, or None
+        :param not_shas: SHAs of commits whose history is not to be sent
+        :param relative: Whether depth counts from the current shallow
+            commits of the client rather than from wants
+        """
+        self.write_shallow_lines(
+          self.update_shallow(wants, depth, since, not_shas, relative))
+        self.proto.write_pkt_line(None)
+
+    def update_shallow(self, wants, depth, since, not_shas, relative=False):
+        """Find the new shallow boundary.
+
+        This updates shallow and unshallow.
+
+        :param wants: SHAs of the commits the client wants
+        :param depth: Number of commits to send along each path from wants,
+            or None
+        :param since: Timestamp of the oldest commit to send, or None
+        :param not_shas: SHAs of commits whose history is not to be sent
+        :param relative: Whether depth counts from the current shallow
+            commits of the client rather than from wants
+        :return: Set of SHAs of the commits that are newly shallow
+        :raise GitProtocolError: if the request is invalid
+        """
+        if depth is not None:
+            if since is not None or not_shas:
+                raise GitProtocolError(
+                  'deepen can not be combined with deepen-since or '
+                  'deepen-not')
+            if depth < 1:
+                raise GitProtocolError('Invalid depth %d' % depth)
+            if relative:
+                # The current shallow commits are at depth 1.
+                heads = [sha for sha in self.client_shallow
+                         if sha in self.store]
+                shallow, not_shallow = _find_shallow(self.store, heads,
+                                                     depth + 1)
+            else:
+                shallow, not_shallow = _find_shallow(self.store, wants, depth)
+        elif relative:
+            raise GitProtocolError('deepen-relative requires deepen')
+        else:
+            shallow, not_shallow = _find_shallow_since(
+              self.store, wants, since, not_shas)
+        self.unshallow = not_shallow & self.client_shallow
+        # Update self.shallow in place, as it is the set that fetch_objects
+        # stops sending history at.
+        self.shallow.difference_update(self.unshallow)
+        self.shallow.update(shallow)
+        return shallow - self.client_shallow
+
+    def write_shallow_lines(self, new_shallow):
+        """Send the changes to the shallow commits of the client.
+
+        :param new_shallow: SHAs of the commits that are newly shallow
+        """
+        for sha in sorted(new_shallow):
+            self.proto.write_pkt_line(b'shallow ' + sha.hex_bytes + b'\n')
+        for sha in sorted(self.unshallow):
+            self.proto.write_pkt_line(b'unshallow ' + sha.hex_bytes + b'\n')
+
     def ack(self, have_ref):
         return self._impl.ack(have_ref)
 
@@ -482,35 +1742,22 @@ class ProtocolGraphWalker(object):
 
     def set_wants(self, wants):
         self._wants = wants
+        self._satisfied_wants = None
 
-    def _is_satisfied(self, haves, want, earliest):
-        """Check whether a want is satisfied by a set of haves.
+    def add_common(self, have):
+        """Add a commit the client and server have in common.
 
-        A want, typically a branch tip, is "satisfied" only if there exists a
-        path back from that want to one of the haves.
+        The reachability of the wants from the common commits is kept between
+        calls, so each call only walks the history the new commit adds.
 
-        :param haves: A set of commits we know the client has.
-        :param want: The want to check satisfaction for.
-        :param earliest: A timestamp beyond which the search for haves will be
-            terminated, presumably because we're searching too far down the
-            wrong branch.
+        :param have: SHA of the commit
+        :return: Whether all the current wants are satisfied by the common
+            commits added since the wants were set
         """
-
-        o = self.store[want]
-        pending = collections.deque([o])
-        while pending:
-            commit = pending.popleft()
-            if commit.id in haves:
-                return True
-            if commit.type_name != 'commit':
-                # non-commit wants are assumed to be satisfied
-                continue
-            for parent in commit.parents:
-                parent_obj = self.store[parent]
-                # TODO: handle parents with later commit times than children
-                if parent_obj.commit_time >= earliest:
-                    pending.append(parent_obj)
-        return False
+        if self._satisfied_wants is None:
+            self._satisfied_wants = SatisfiedWants(self.store, self._wants)
+        self._satisfied_wants.add_have(have)
+        return self._satisfied_wants.all_satisfied()
 
     def all_wants_satisfied(self, haves):
         """Check whether all the current wants are satisfied by a set of haves.
@@ -519,13 +1766,10 @@ class ProtocolGraphWalker(object):
         :note: Wants are specified with set_wants rather than passed in since
             in the current interface they are determined outside this class.
         """
-        haves = set(haves)
-        earliest = min([self.store[h].commit_time for h in haves])
-
-        for want in self._wants:
-            if not self._is_satisfied(haves, want, earliest):
-                return False
-        return True
+        satisfied_wants = SatisfiedWants(self.store, self._wants)
+        for have in haves:
+            satisfied_wants.add_have(have)
+        return satisfied_wants.all_satisfied()
 
     def set_ack_type(self, ack_type):
         impl_classes = {
@@ -536,8 +1780,15 @@ class ProtocolGraphWalker(object):
         self._impl = impl_classes[ack_type](self)
 
 
+_WANT_COMMANDS = (b'want', b'shallow', b'deepen', b'deepen-since',
+                  b'deepen-not', b'filter', None)
+
 _GRAPH_WALKER_COMMANDS = (b'have', b'done', None)
 
+_FETCH_COMMANDS = (b'want', b'have', b'done', b'shallow', b'deepen',
+                   b'deepen-since', b'deepen-not', b'deepen-relative',
+                   b'filter')
+
 
 class SingleAckGraphWalkerImpl(object):
     """Graph walker implementation that speaks the single-ack protocol."""
@@ -573,7 +1824,7 @@ class MultiAckGraphWalkerImpl(object):
         self._common.append(have_ref)
         if not self._found_base:
             self.walker.send_ack(have_ref, b'continue')
-            if self.walker.all_wants_satisfied(self._common):
+            if self.walker.add_common(have_ref):
                 self._found_base = True
         # else we blind ack within next
 
@@ -612,7 +1863,7 @@ class MultiAckDetailedGraphWalkerImpl(object):
         self._common.append(have_ref)
         if not self._found_base:
             self.walker.send_ack(have_ref, b'common')
-            if self.walker.all_wants_satisfied(self._common):
+            if self.walker.add_common(have_ref):
                 self._found_base = True
                 self.walker.send_ack(have_ref, b'ready')
         # else we blind ack within next
@@ -645,13 +1896,17 @@ class ReceivePackHandler(Handler):
     """Protocol handler for downloading a pack from the client."""
 
     def __init__(self, backend, args, proto, http_req=None,
-                 advertise_refs=False):
-        Handler.__init__(self, backend, proto, http_req=http_req)
+                 advertise_refs=False, protocol_version=0):
+        Handler.__init__(self, backend, proto, http_req=http_req,
+                         protocol_version=protocol_version)
         self.repo = backend.open_repository(args[0])
         self.advertise_refs = advertise_refs
 
     def close(self):
-        if hasattr(self.repo, 'close'):
+        release_repository = getattr(self.backend, 'release_repository', None)
+        if release_repository is not None:
+            release_repository(self.repo)
+        elif hasattr(self.repo, 'close'):
             self.repo.close()
 
     @classmethod
@@ -673,6 +1928,7 @@ class ReceivePackHandler(Handler):
             # The pack may still have been moved in, but it may contain broken
             # objects. We trust a later GC to clean it up.
 
+        updated = []
         for oldsha, sha, ref in refs:
             ref_status = b'ok'
             try:
@@ -693,7 +1949,17 @@ class ReceivePackHandler(Handler):
             except KeyError as e:
                 ref_status = 'bad ref'
             status.append((ref, ref_status))
+            if ref_status == b'ok' and sha != ZERO_SHA:
+                updated.append(sha)
 
+        if updated and hasattr(self.repo, 'update_commit_graph'):
+            # The refs are already updated, so a commit graph that cannot be
+            # written, e.g. because another push holds its lock, must not
+            # fail the push. The graph is only missing the new commits.
+            try:
+                self.repo.update_commit_graph(updated)
+            except (IOError, OSError) as e:
+                logger.warning('Not updating the commit graph: %s', e)
         return status
 
     def _report_status(self, status):
@@ -773,6 +2039,22 @@ DEFAULT_HANDLERS = {
   }
 
 
+def negotiate_protocol_version(handler_cls, params):
+    """Pick the protocol version to handle a request with.
+
+    :param handler_cls: Class of the handler for the request
+    :param params: Extra parameters sent by the client; see
+        extract_protocol_version
+    :return: Keyword arguments for the handler; these set protocol_version
+        if the client asked for a version other than 0 that the handler
+        speaks
+    """
+    version = extract_protocol_version(params)
+    if version and version in getattr(handler_cls, 'protocol_versions', ()):
+        return {'protocol_version': version}
+    return {}
+
+
 class TCPGitRequestHandler(socketserver.StreamRequestHandler):
 
     def __init__(self, handlers, *args, **kwargs):
@@ -780,17 +2062,26 @@ class TCPGitRequestHandler(socketserver.StreamRequestHandler):
         socketserver.StreamRequestHandler.__init__(self, *args, **kwargs)
 
     def handle(self):
-        with ReceivableProtocol(self.connection.recv, self.wfile.write, None) as proto:
+        writev = None
+        if hasattr(self.connection, 'sendmsg'):
+            writev = lambda buffers: sendmsg_all(self.connection, buffers)
+        with ReceivableProtocol(self.connection.recv, self.wfile.write, None,
+                                writev=writev) as proto:
             command, args = proto.read_cmd()
 
             logger.info('Handling %s request, args="%s"', command.decode('utf-8'),
               ', '.join(arg.decode('utf-8') for arg in args))
 
             cls = self.handlers.get(command, None)
-            if not isinstance(cls, collections.Callable):
+            if not callable(cls):
                 raise GitProtocolError('Invalid service %s' % command.decode('utf-8'))
 
-            with cls(self.server.backend, args, proto) as h:
+            # Extra parameters follow the host after an empty argument.
+            params = []
+            if b'' in args:
+                params = args[args.index(b'') + 1:]
+            kwargs = negotiate_protocol_version(cls, params)
+            with cls(self.server.backend, args, proto, **kwargs) as h:
                 h.handle()
 
             logger.info('Finished handling request')
@@ -821,17 +2112,416 @@ class TCPGitServer(socketserver.TCPServer):
                          'from %s', client_address)
 
 
+# Defaults for the servers that handle connections concurrently.
+DEFAULT_MAX_CONNECTIONS = 32
+DEFAULT_MAX_QUEUED = 64
+DEFAULT_QUEUE_TIMEOUT = 30
+
+
+class ThreadedTCPGitServer(TCPGitServer):
+    """TCPGitServer that handles connections in a pool of threads.
+
+    At most max_connections connections are handled at once, and the others
+    wait in a FIFO queue. Connections that find max_queued connections
+    waiting, or that wait for longer than queue_timeout seconds, are sent an
+    error and closed.
+
+    The threads share the backend; the repositories of a DictBackend, with
+    their pack and object caches, are shared by all connections.
+
+    server_close waits for the connections that were accepted to be handled.
+    If serve_forever runs in another thread, call shutdown first.
+    """
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT, handlers=None,
+                 max_connections=DEFAULT_MAX_CONNECTIONS,
+                 max_queued=DEFAULT_MAX_QUEUED,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        """Create a new ThreadedTCPGitServer.
+
+        :param backend: Backend to serve repositories from
+        :param listen_addr: Address to listen on
+        :param port: Port to listen on
+        :param handlers: Optional dictionary mapping services to handler
+            classes, overriding DEFAULT_HANDLERS
+        :param max_connections: Number of connections to handle at once
+        :param max_queued: Number of connections that can wait to be handled
+        :param queue_timeout: Number of seconds connections can wait to be
+            handled, or None to let them wait indefinitely
+        """
+        self.max_connections = max_connections
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.request_queue_size = max(self.request_queue_size, max_queued)
+        self._queue = collections.deque()
+        self._queue_cond = threading.Condition()
+        self._idle = 0
+        self._closing = False
+        self._workers = []
+        TCPGitServer.__init__(self, backend, listen_addr, port, handlers)
+        self._start_workers()
+
+    def _start_workers(self):
+        for i in range(self.max_connections):
+            thread = threading.Thread(target=self._work, args=(i,),
+                                      name='dulwich-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+
+    def _work(self, index):
+        while True:
+            with self._queue_cond:
+                self._idle += 1
+                while not self._queue and not self._closing:
+                    self._queue_cond.wait()
+                self._idle -= 1
+                if not self._queue:
+                    return
+                request, client_address, queued_time = self._queue.popleft()
+            if not self._handle_queued_request(index, request, client_address):
+                return
+
+    def _handle_queued_request(self, index, request, client_address):
+        """Handle a connection taken from the queue.
+
+        :param index: Index of the worker handling the connection
+        :param request: The connected socket
+        :param client_address: Address of the client
+        :return: Whether the worker can handle more connections
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+        return True
+
+    def _reject_request(self, request, client_address, reason):
+        logger.warning('Rejecting connection from %s: %s', client_address,
+                       reason)
+        # The error is sent once the client sent its request, which may take
+        # a while, so do not hold up accepting connections.
+        thread = threading.Thread(target=self._send_error,
+                                  args=(request, reason))
+        thread.daemon = True
+        thread.start()
+
+    def _send_error(self, request, reason):
+        try:
+            # Closing the connection before the client sent its request
+            # resets it, so the client would not read the error.
+            request.settimeout(5)
+            request.recv(4096)
+            request.sendall(pkt_line(('ERR %s\n' % reason).encode('ascii')))
+        except socket.error:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        with self._queue_cond:
+            if len(self._queue) < self.max_queued + self._idle:
+                self._queue.append((request, client_address, time.time()))
+                self._queue_cond.notify()
+                return
+        self._reject_request(request, client_address, 'server is busy')
+
+    def service_actions(self):
+        TCPGitServer.service_actions(self)
+        if self.queue_timeout is None:
+            return
+        expired = []
+        queued_before = time.time() - self.queue_timeout
+        with self._queue_cond:
+            while self._queue and self._queue[0][2] < queued_before:
+                expired.append(self._queue.popleft())
+        for request, client_address, queued_time in expired:
+            self._reject_request(request, client_address,
+                                 'timed out waiting for the server')
+
+    def server_close(self):
+        TCPGitServer.server_close(self)
+        with self._queue_cond:
+            self._closing = True
+            self._queue_cond.notify_all()
+        for thread in self._workers:
+            thread.join()
+
+
+def _send_socket(sock, request, data):
+    """Pass a socket to another process over a UNIX socket.
+
+    :param data: Non-empty string to send along with the socket
+    """
+    fds = array.array('i', [request.fileno()])
+    sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+
+def _receive_socket(sock, family, type):
+    """Receive a socket sent with _send_socket.
+
+    :return: Tuple with the socket and the string sent along with it, or
+        None if the other end was closed
+    """
+    fds = array.array('i')
+    msg, ancdata, flags, addr = sock.recvmsg(
+      1024, socket.CMSG_LEN(fds.itemsize))
+    if not msg:
+        return None
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:fds.itemsize])
+    return socket.socket(family, type, fileno=fds[0]), msg
+
+
+class PreForkingTCPGitServer(ThreadedTCPGitServer):
+    """ThreadedTCPGitServer that handles connections in worker processes.
+
+    A worker process is forked for each of the max_connections connections
+    when the server is created, and handles one connection at a time. The
+    server process accepts and queues the connections, and a thread for each
+    worker passes their sockets to it. Unlike threads, the workers generate
+    packs on all CPUs at once.
+
+    Each worker has its own copy of the backend, which is closed when the
+    worker starts so that the workers do not share positions in files that
+    were already open; caches are not shared between workers. That includes
+    the pack cache of the backend: a pack generated by one worker is not
+    sent from the cache by the others, and requests for the same pack in
+    different workers each generate it. An AdmissionControl would only limit
+    the requests of the worker that has it, which handles one at a time, so
+    backends with one are rejected.
+
+    Workers that exit, for example because they were killed for running out
+    of memory, are replaced. The server process has threads and connections
+    by then, which a process forked from it would inherit, so replacements
+    are forked by a fork server: a process forked along with the first
+    workers, before any thread started.
+
+    This needs os.fork and passing file descriptors over UNIX sockets.
+    """
+
+    def __init__(self, backend, *args, **kwargs):
+        if getattr(backend, 'admission_control', None) is not None:
+            raise ValueError('worker processes can not share an '
+                             'AdmissionControl')
+        self._processes = []
+        # The pids of the processes forked by this process, rather than by
+        # the fork server.
+        self._children = []
+        self._fork_server_sock = None
+        self._fork_lock = threading.Lock()
+        ThreadedTCPGitServer.__init__(self, backend, *args, **kwargs)
+
+    def _start_workers(self):
+        for i in range(self.max_connections):
+            pid, sock = self._fork_worker()
+            self._children.append(pid)
+            self._processes.append((pid, sock))
+        server_sock, fork_server_sock = socket.socketpair()
+        pid = self._fork(self._run_fork_server, fork_server_sock,
+                         [server_sock] + [s for _, s in self._processes])
+        fork_server_sock.close()
+        self._children.append(pid)
+        self._fork_server_sock = server_sock
+        ThreadedTCPGitServer._start_workers(self)
+
+    def _fork(self, run, sock, close):
+        """Fork a process.
+
+        :param run: Function to run in the new process, with sock
+        :param sock: Socket to pass to run
+        :param close: Sockets to close in the new process
+        :return: The pid of the new process
+        """
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                for s in close:
+                    s.close()
+                # The server process shuts the other processes down.
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                self.socket.close()
+                run(sock)
+                status = 0
+            except:
+                logger.exception('Worker process failed')
+            finally:
+                os._exit(status)
+        return pid
+
+    def _fork_worker(self, close=()):
+        """Fork a worker process.
+
+        :param close: Sockets to close in the worker
+        :return: Tuple with the pid of the worker and the socket to pass
+            connections to it over
+        """
+        server_sock, worker_sock = socket.socketpair()
+        pid = self._fork(
+          self._run_worker, worker_sock,
+          [server_sock] + [s for _, s in self._processes] + list(close))
+        worker_sock.close()
+        return pid, server_sock
+
+    def _run_fork_server(self, sock):
+        """Fork workers for the server process when it asks for them.
+
+        The socket of each new worker is sent back, along with its pid. The
+        workers are waited for once the server process hangs up.
+        """
+        try:
+            while sock.recv(1):
+                pid, server_sock = self._fork_worker([sock])
+                _send_socket(sock, server_sock, str(pid).encode('ascii'))
+                server_sock.close()
+                # Reap the workers that exited since.
+                try:
+                    while os.waitpid(-1, os.WNOHANG)[0]:
+                        pass
+                except ChildProcessError:
+                    pass
+        finally:
+            try:
+                while True:
+                    os.wait()
+            except ChildProcessError:
+                pass
+
+    def _run_worker(self, sock):
+        """Handle the connections passed to a worker process."""
+        close = getattr(self.backend, 'close', None)
+        if close is not None:
+            close()
+        while True:
+            received = _receive_socket(sock, self.address_family,
+                                       self.socket_type)
+            if received is None:
+                return
+            request, address = received
+            host, port = address.decode('utf-8').rsplit(' ', 1)
+            client_address = (host, int(port))
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+            sock.sendall(b'\0')
+
+    def _replace_worker(self, index):
+        """Have the fork server fork a worker to replace the one at index.
+
+        :return: Whether the worker was replaced
+        """
+        with self._fork_lock:
+            with self._queue_cond:
+                if self._closing:
+                    return False
+            try:
+                self._fork_server_sock.sendall(b'\0')
+                received = _receive_socket(self._fork_server_sock,
+                                           socket.AF_UNIX, socket.SOCK_STREAM)
+            except socket.error:
+                received = None
+            if received is None:
+                logger.error('Fork server exited; not replacing worker')
+                return False
+            sock, pid = received
+            self._processes[index] = (int(pid), sock)
+            return True
+
+    def _handle_queued_request(self, index, request, client_address):
+        pid, sock = self._processes[index]
+        try:
+            _send_socket(sock, request,
+                         ('%s %d' % client_address[:2]).encode('utf-8'))
+            # The worker has its own copy of the socket.
+            self.close_request(request)
+            # Wait for the worker to be done with the connection.
+            if sock.recv(1):
+                return True
+        except socket.error:
+            self.close_request(request)
+        logger.error('Worker process %d exited', pid)
+        sock.close()
+        if pid in self._children:
+            os.waitpid(pid, 0)
+            self._children.remove(pid)
+        return self._replace_worker(index)
+
+    def server_close(self):
+        ThreadedTCPGitServer.server_close(self)
+        for pid, sock in self._processes:
+            sock.close()
+        if self._fork_server_sock is not None:
+            self._fork_server_sock.close()
+        # The fork server waits for the workers it forked.
+        for pid in self._children:
+            os.waitpid(pid, 0)
+
+
 def main(argv=sys.argv):
-    """Entry point for starting a TCP git server."""
-    if len(argv) > 1:
-        gitdir = argv[1]
+    """Entry point for starting a TCP git server.
+
+    Connections are handled by a pool of threads, or of processes with the
+    --processes option. With the --async option, connections are served by
+    an asyncio event loop, and requests are handled by a pool of threads.
+    The --pack-cache option takes a directory to cache the packs sent to
+    clients in. The --max-uploads option limits the number of packs that
+    are sent at once; other requests wait for them. It can not be used with
+    --processes, since the processes do not share the limit.
+    """
+    opts, args = getopt(argv[1:], "", ["threads=", "processes=",
+                                       "max-queued=", "queue-timeout=",
+                                       "async", "pack-cache=",
+                                       "max-uploads="])
+    opts = dict(opts)
+    if args:
+        gitdir = args[0]
     else:
         gitdir = '.'
 
     log_utils.default_logging_config()
     backend = DictBackend({'/': Repo(gitdir)})
-    server = TCPGitServer(backend, 'localhost')
-    server.serve_forever()
+    if '--pack-cache' in opts:
+        backend.pack_cache = PackCache(opts['--pack-cache'])
+    if '--max-uploads' in opts:
+        if '--processes' in opts:
+            sys.exit('--max-uploads can not be used with --processes')
+        backend.admission_control = AdmissionControl(
+          max_running=int(opts['--max-uploads']))
+    if '--async' in opts:
+        # The asyncio server needs a recent Python, so only import it here.
+        from dulwich.async_server import serve_async
+        serve_async(backend, 'localhost', max_workers=int(
+          opts.get('--threads', DEFAULT_MAX_CONNECTIONS)))
+        return
+    kwargs = {}
+    if '--max-queued' in opts:
+        kwargs['max_queued'] = int(opts['--max-queued'])
+    if '--queue-timeout' in opts:
+        kwargs['queue_timeout'] = float(opts['--queue-timeout'])
+    if '--processes' in opts:
+        server = PreForkingTCPGitServer(
+          backend, 'localhost', max_connections=int(opts['--processes']),
+          **kwargs)
+    else:
+        server = ThreadedTCPGitServer(
+          backend, 'localhost',
+          max_connections=int(opts.get('--threads', DEFAULT_MAX_CONNECTIONS)),
+          **kwargs)
+    # Let the connections that were accepted finish on SIGTERM.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 def serve_command(handler_cls, argv=sys.argv, backend=None, inf=sys.stdin,
@@ -862,8 +2552,10 @@ def serve_command(handler_cls, argv=sys.argv, backend=None, inf=sys.stdin,
             outf.write(data)
             outf.flush()
 
+    kwargs = negotiate_protocol_version(
+      handler_cls, os.environ.get('GIT_PROTOCOL', '').encode('ascii'))
     with Protocol(inf.read, send_fn, None) as proto:
-        with handler_cls(backend, argv[1:], proto) as handler:
+        with handler_cls(backend, argv[1:], proto, **kwargs) as handler:
             # FIXME: Catch exceptions and write a single-line summary to outf.
             handler.handle()
 
@@ -66,11 +66,14 @@ class BlackboxTestCase(TestCase):
 
 def self_test_suite():
     names = [
+        'async_server',
         'blackbox',
         'client',
+        'commit_graph',
         'diff_tree',
         'fastexport',
         'file',
+        'graph',
         'index',
         'lru_cache',
         'objects',
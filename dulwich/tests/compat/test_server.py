@@ -24,11 +24,18 @@ Warning: these tests should be fairly stable, but when writing/debugging new
     Ctrl-C'ed. On POSIX systems, you can kill the tests with Ctrl-Z, "kill %".
 """
 
+import asyncio
+import os
 import threading
 
+from dulwich.async_server import (
+    AsyncTCPGitServer,
+    )
 from dulwich.server import (
     DictBackend,
+    PreForkingTCPGitServer,
     TCPGitServer,
+    ThreadedTCPGitServer,
     )
 from dulwich.tests.compat.server_utils import (
     ServerTests,
@@ -94,3 +101,60 @@ class GitServerSideBand64kTestCase(GitServerTestCase):
         receive_pack_handler_cls = server.handlers[b'git-receive-pack']
         caps = receive_pack_handler_cls.capabilities()
         self.assertTrue(b'side-band-64k' in caps)
+
+
+class ThreadedGitServerTestCase(GitServerSideBand64kTestCase):
+    """Tests for client/server compatibility with a ThreadedTCPGitServer."""
+
+    server_class = ThreadedTCPGitServer
+
+    def _start_server(self, repo):
+        backend = DictBackend({'/': repo})
+        dul_server = self.server_class(backend, 'localhost', 0,
+                                       max_connections=2)
+        self._check_server(dul_server)
+        thread = threading.Thread(target=dul_server.serve_forever)
+        thread.start()
+
+        def stop():
+            dul_server.shutdown()
+            thread.join()
+            dul_server.server_close()
+        self.addCleanup(stop)
+        self._server = dul_server
+        _, port = self._server.socket.getsockname()
+        return port
+
+
+class PreForkingGitServerTestCase(ThreadedGitServerTestCase):
+    """Tests for client/server compatibility with a PreForkingTCPGitServer."""
+
+    server_class = PreForkingTCPGitServer
+
+    def setUp(self):
+        super(PreForkingGitServerTestCase, self).setUp()
+        if not hasattr(os, 'fork'):
+            self.skipTest('os.fork is not available')
+
+
+class AsyncGitServerTestCase(GitServerSideBand64kTestCase):
+    """Tests for client/server compatibility with an AsyncTCPGitServer."""
+
+    def _start_server(self, repo):
+        backend = DictBackend({'/': repo})
+        dul_server = AsyncTCPGitServer(backend, 'localhost', 0, max_workers=2)
+        self._check_server(dul_server)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(dul_server.start())
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+
+        def stop():
+            asyncio.run_coroutine_threadsafe(dul_server.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        self.addCleanup(stop)
+        self._server = dul_server
+        _, port = dul_server.server_address
+        return port
@@ -0,0 +1,247 @@
+# test_async_server.py -- Tests for the asyncio git server
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for the asyncio git server."""
+
+import asyncio
+import socket
+import threading
+
+from dulwich.async_server import (
+    AsyncProtocol,
+    AsyncTCPGitServer,
+    _OutputSpool,
+    )
+from dulwich.errors import (
+    GitProtocolError,
+    HangupException,
+    )
+from dulwich.protocol import (
+    DELIM_PKT,
+    Protocol,
+    pkt_line,
+    )
+from dulwich.repo import (
+    MemoryRepo,
+    )
+from dulwich.server import (
+    DictBackend,
+    )
+from dulwich.tests import TestCase
+from dulwich.tests.utils import (
+    make_commit,
+    )
+
+ONE = b'1' * 40
+
+
+class DummyWriter(object):
+
+    def __init__(self):
+        self.data = []
+        self.closed = False
+
+    def write(self, data):
+        self.data.append(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def getvalue(self):
+        return b''.join(self.data)
+
+
+class AsyncProtocolTests(TestCase):
+
+    def run_protocol(self, data, func):
+        """Call func with an AsyncProtocol reading data and return its
+        result."""
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return await func(AsyncProtocol(reader, DummyWriter()))
+        return asyncio.run(run())
+
+    def test_read_pkt_line(self):
+        self.assertEqual(b'cmd ', self.run_protocol(
+          b'0008cmd ', lambda proto: proto.read_pkt_line()))
+
+    def test_read_pkt_line_special(self):
+        self.assertEqual(None, self.run_protocol(
+          b'0000', lambda proto: proto.read_pkt_line()))
+        self.assertEqual(DELIM_PKT, self.run_protocol(
+          b'0001', lambda proto: proto.read_pkt_line()))
+
+    def test_read_pkt_line_hangup(self):
+        self.assertRaises(HangupException, self.run_protocol,
+                          b'', lambda proto: proto.read_pkt_line())
+        self.assertRaises(HangupException, self.run_protocol,
+                          b'0008cm', lambda proto: proto.read_pkt_line())
+
+    def test_read_pkt_line_invalid(self):
+        self.assertRaises(GitProtocolError, self.run_protocol,
+                          b'0003', lambda proto: proto.read_pkt_line())
+        self.assertRaises(GitProtocolError, self.run_protocol,
+                          b'zzzz', lambda proto: proto.read_pkt_line())
+
+    def test_read_pkt_seq(self):
+        self.assertEqual([b'cmd ', b'l'], self.run_protocol(
+          b'0008cmd 0005l0000', lambda proto: proto.read_pkt_seq()))
+
+    def test_read_cmd(self):
+        self.assertEqual((b'cmd', [b'/foo', b'host=bar']), self.run_protocol(
+          b'0016cmd /foo\0host=bar\0', lambda proto: proto.read_cmd()))
+
+    def test_read_cmd_invalid(self):
+        self.assertRaises(GitProtocolError, self.run_protocol,
+                          b'000ccmd /foo', lambda proto: proto.read_cmd())
+
+    def test_write(self):
+        writer = DummyWriter()
+        proto = AsyncProtocol(None, writer)
+        proto.write_pkt_line(b'bla')
+        proto.write_pkt_line(None)
+        proto.write_sideband(1, b'x' * 65520)
+        self.assertEqual(
+          [b'0007bla', b'0000', pkt_line(b'\x01' + b'x' * 65515),
+           pkt_line(b'\x01xxxxx')], writer.data)
+
+
+class OutputSpoolTests(TestCase):
+
+    def send(self, writes, max_memory):
+        async def run():
+            spool = _OutputSpool(asyncio.get_running_loop(), max_memory)
+            writer = DummyWriter()
+            thread = threading.Thread(target=writes, args=(spool,))
+            thread.start()
+            await spool.send(writer)
+            thread.join()
+            return writer.getvalue()
+        return asyncio.run(run())
+
+    def test_send(self):
+        def writes(spool):
+            for i in range(100):
+                spool.write(b'%d,' % i)
+            spool.close()
+        expected = b''.join(b'%d,' % i for i in range(100))
+        self.assertEqual(expected, self.send(writes, 1024))
+        # Most of the output goes to disk.
+        self.assertEqual(expected, self.send(writes, 4))
+
+    def test_write_after_disconnect(self):
+        class BrokenWriter(DummyWriter):
+            async def drain(self):
+                raise ConnectionResetError()
+
+        async def run():
+            spool = _OutputSpool(asyncio.get_running_loop())
+            spool.write(b'foo')
+            await spool.send(BrokenWriter())
+            return spool
+        spool = asyncio.run(run())
+        self.assertRaises(socket.error, spool.write, b'bar')
+
+
+class AsyncTCPGitServerTests(TestCase):
+    """Tests for AsyncTCPGitServer."""
+
+    def setUp(self):
+        super(AsyncTCPGitServerTests, self).setUp()
+        commit = make_commit(id=ONE, parents=[], commit_time=111)
+        self.backend = DictBackend({'/': MemoryRepo.init_bare(
+          [commit], {b'refs/heads/master': commit.id})})
+
+    def start_server(self, **kwargs):
+        loop = asyncio.new_event_loop()
+        server = AsyncTCPGitServer(self.backend, 'localhost', 0, **kwargs)
+        loop.run_until_complete(server.start())
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+
+        def stop():
+            asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        self.addCleanup(stop)
+        return server.server_address[1]
+
+    def connect(self, port, request):
+        sock = socket.create_connection(('localhost', port))
+        self.addCleanup(sock.close)
+        sock.sendall(pkt_line(request))
+        f = sock.makefile('rb')
+        self.addCleanup(f.close)
+        return Protocol(f.read, sock.sendall, None)
+
+    def test_v0(self):
+        proto = self.connect(self.start_server(),
+                             b'git-upload-pack /\0host=localhost\0')
+        line = proto.read_pkt_line()
+        self.assertEqual(ONE + b' refs/heads/master', line.split(b'\0')[0])
+
+    def test_v2(self):
+        proto = self.connect(self.start_server(),
+                             b'git-upload-pack /\0host=localhost\0\0'
+                             b'version=2\0')
+        self.assertEqual(b'version 2\n', proto.read_pkt_line())
+        self.assertEqual([b'ls-refs\n', b'fetch=shallow filter\n'],
+                         list(proto.read_pkt_seq()))
+        # The session handles commands until the client hangs up.
+        for i in range(2):
+            proto.write_pkt_line(b'command=ls-refs\n')
+            proto.write_pkt_line(DELIM_PKT)
+            proto.write_pkt_line(None)
+            self.assertEqual([ONE + b' refs/heads/master\n'],
+                             list(proto.read_pkt_seq()))
+
+    def test_max_sessions(self):
+        port = self.start_server(max_workers=2, max_sessions=1)
+        request = b'git-upload-pack /\0host=localhost\0'
+        proto1 = self.connect(port, request)
+        self.assertEqual(ONE + b' refs/heads/master',
+                         proto1.read_pkt_line().split(b'\0')[0])
+        # The first session holds a thread while it waits for the client;
+        # the second one waits without one.
+        self.connect(port, request)
+        proto3 = self.connect(port, request + b'\0version=2\0')
+        self.assertEqual(b'version 2\n', proto3.read_pkt_line())
+        list(proto3.read_pkt_seq())
+        proto3.write_pkt_line(b'command=ls-refs\n')
+        proto3.write_pkt_line(DELIM_PKT)
+        proto3.write_pkt_line(None)
+        self.assertEqual([ONE + b' refs/heads/master\n'],
+                         list(proto3.read_pkt_seq()))
+
+    def test_invalid_service(self):
+        proto = self.connect(self.start_server(),
+                             b'git-bogus-pack /\0host=localhost\0')
+        self.assertRaises(HangupException, proto.read_pkt_line)
+
+    def test_idle_timeout(self):
+        proto = self.connect(self.start_server(idle_timeout=0.1),
+                             b'git-upload-pack /\0host=localhost\0\0'
+                             b'version=2\0')
+        self.assertEqual(b'version 2\n', proto.read_pkt_line())
+        list(proto.read_pkt_seq())
+        self.assertRaises(HangupException, proto.read_pkt_line)
@@ -29,10 +29,17 @@ from dulwich.client import (
     UpdateRefsError,
     get_transport_and_path,
     )
+from dulwich.errors import (
+    GitProtocolError,
+    )
+from dulwich.objects import (
+    Sha1Sum,
+    )
 from dulwich.tests import (
     TestCase,
     )
 from dulwich.protocol import (
+    DELIM_PKT,
     TCP_GIT_PORT,
     Protocol,
     )
@@ -83,6 +90,190 @@ class GitClientTests(TestCase):
         self.client.fetch_pack('bla', lambda heads: [], None, None, None)
         self.assertEqual(self.rout.getvalue(), b'0000')
 
+    def test_fetch_pack_depth(self):
+        shallow = b'1' * 40
+        self.rin.write(
+            b'008855dcc6bf963f922e1ed5c4bbaaefcfacef57b1d7 HEAD\x00multi_ack '
+            b'thin-pack side-band side-band-64k ofs-delta shallow no-progress '
+            b'include-tag\n'
+            b'0000'
+            b'0035shallow ' + shallow + b'\n'
+            b'0000'
+            b'0008NAK\n'
+            b'0000')
+        self.rin.seek(0)
+        updates = []
+
+        class GraphWalker(object):
+            shallow = set()
+
+            def __next__(self):
+                return None
+
+            def update_shallow(self, new_shallow, new_unshallow):
+                updates.append((new_shallow, new_unshallow))
+
+        self.client.fetch_pack('bla', lambda heads: list(heads.values()),
+                               GraphWalker(), None, None, depth=1)
+        self.assertTrue(b'000ddeepen 1\n0000' in self.rout.getvalue())
+        self.assertEqual([(set([Sha1Sum(shallow)]), set())], updates)
+
+    def test_fetch_pack_depth_unsupported(self):
+        self.rin.write(
+            b'006855dcc6bf963f922e1ed5c4bbaaefcfacef57b1d7 HEAD\x00multi_ack '
+            b'thin-pack side-band side-band-64k ofs-delta\n'
+            b'0000')
+        self.rin.seek(0)
+        self.assertRaises(GitProtocolError, self.client.fetch_pack, 'bla',
+                          lambda heads: list(heads.values()), None, None,
+                          None, depth=1)
+
+    def test_fetch_pack_filter(self):
+        self.rin.write(
+            b'006f55dcc6bf963f922e1ed5c4bbaaefcfacef57b1d7 HEAD\x00multi_ack '
+            b'thin-pack side-band side-band-64k ofs-delta filter\n'
+            b'0000'
+            b'0008NAK\n'
+            b'0000')
+        self.rin.seek(0)
+
+        class GraphWalker(object):
+
+            def __next__(self):
+                return None
+
+        self.client.fetch_pack('bla', lambda heads: list(heads.values()),
+                               GraphWalker(), None, None,
+                               filter_spec=b'blob:none')
+        out = self.rout.getvalue()
+        self.assertTrue(b' filter' in out.split(b'\n')[0])
+        self.assertTrue(b'0015filter blob:none\n0000' in out)
+
+    def test_fetch_pack_filter_unsupported(self):
+        self.rin.write(
+            b'006855dcc6bf963f922e1ed5c4bbaaefcfacef57b1d7 HEAD\x00multi_ack '
+            b'thin-pack side-band side-band-64k ofs-delta\n'
+            b'0000')
+        self.rin.seek(0)
+        self.assertRaises(GitProtocolError, self.client.fetch_pack, 'bla',
+                          lambda heads: list(heads.values()), None, None,
+                          None, filter_spec=b'blob:none')
+
+    def write_pkts(self, *pkts):
+        proto = Protocol(None, self.rin.write, None)
+        for pkt in pkts:
+            proto.write_pkt_line(pkt)
+
+    def test_fetch_pack_v2(self):
+        head = b'55dcc6bf963f922e1ed5c4bbaaefcfacef57b1d7'
+        tag = b'1' * 40
+        self.write_pkts(
+            b'version 2\n', b'ls-refs\n', b'fetch=shallow filter\n', None,
+            head + b' refs/heads/master\n',
+            tag + b' refs/tags/v1 peeled:' + head + b'\n', None,
+            b'packfile\n', b'\x01PACK', b'\x02progress', None)
+        self.rin.seek(0)
+        data = []
+        progress = []
+
+        class GraphWalker(object):
+
+            def __next__(self):
+                return None
+
+        refs = self.client.fetch_pack(
+            'bla', lambda heads: [heads[b'refs/heads/master']],
+            GraphWalker(), data.append, progress.append,
+            ref_prefix=[b'refs/heads/', b'refs/tags/'])
+        self.assertEqual({b'refs/heads/master': Sha1Sum(head),
+                          b'refs/tags/v1': Sha1Sum(tag),
+                          b'refs/tags/v1^{}': Sha1Sum(head)}, refs)
+        self.assertEqual([b'PACK'], data)
+        self.assertEqual([b'progress'], progress)
+        self.assertEqual(
+            b'0014command=ls-refs\n00010009peel\n'
+            b'001bref-prefix refs/heads/\n001aref-prefix refs/tags/\n0000'
+            b'0012command=fetch\n0001000eofs-delta\n000ethin-pack\n'
+            b'0032want ' + head + b'\n0009done\n00000000',
+            self.rout.getvalue())
+
+    def test_fetch_pack_v2_negotiation(self):
+        head = Sha1Sum('5' * 40)
+        haves = [Sha1Sum('%040x' % i) for i in range(1, 61)]
+        self.write_pkts(
+            b'version 2\n', b'ls-refs\n', b'fetch\n', None,
+            head.hex_bytes + b' refs/heads/master\n', None,
+            b'acknowledgments\n', b'NAK\n', None,
+            b'acknowledgments\n', b'ACK ' + haves[17].hex_bytes + b'\n',
+            b'ready\n', DELIM_PKT,
+            b'packfile\n', b'\x01PACK', None)
+        self.rin.seek(0)
+        acked = []
+
+        class GraphWalker(object):
+
+            def __init__(self):
+                self.haves = list(haves)
+
+            def __next__(self):
+                if self.haves:
+                    return self.haves.pop(0)
+                return None
+
+            def ack(self, sha):
+                acked.append(sha)
+
+        data = []
+        self.client.fetch_pack('bla', lambda heads: [head], GraphWalker(),
+                               data.append, None)
+        self.assertEqual([haves[17]], acked)
+        self.assertEqual([b'PACK'], data)
+        requests = self.rout.getvalue().split(b'0012command=fetch\n')
+        self.assertEqual(3, len(requests))
+        # The second round has twice as many haves, and the server is ready
+        # before the client is done.
+        self.assertEqual(16, requests[1].count(b'have '))
+        self.assertEqual(32, requests[2].count(b'have '))
+        self.assertFalse(b'done' in requests[1] + requests[2])
+
+    def test_fetch_pack_v2_shallow(self):
+        head = b'55dcc6bf963f922e1ed5c4bbaaefcfacef57b1d7'
+        shallow = b'1' * 40
+        self.write_pkts(
+            b'version 2\n', b'ls-refs\n', b'fetch=shallow\n', None,
+            head + b' refs/heads/master\n', None,
+            b'shallow-info\n', b'shallow ' + shallow + b'\n', DELIM_PKT,
+            b'packfile\n', b'\x01PACK', None)
+        self.rin.seek(0)
+        updates = []
+
+        class GraphWalker(object):
+            shallow = set()
+
+            def __next__(self):
+                return None
+
+            def update_shallow(self, new_shallow, new_unshallow):
+                updates.append((new_shallow, new_unshallow))
+
+        self.client.fetch_pack('bla', lambda heads: list(heads.values()),
+                               GraphWalker(), lambda data: None, None,
+                               depth=1)
+        self.assertTrue(b'000ddeepen 1\n' in self.rout.getvalue())
+        self.assertEqual([(set([Sha1Sum(shallow)]), set())], updates)
+
+    def test_fetch_pack_ref_prefix_v0(self):
+        self.rin.write(
+            b'008855dcc6bf963f922e1ed5c4bbaaefcfacef57b1d7 HEAD\x00multi_ack '
+            b'thin-pack side-band side-band-64k ofs-delta shallow no-progress '
+            b'include-tag\n'
+            b'003f1111111111111111111111111111111111111111 refs/heads/master\n'
+            b'0000')
+        self.rin.seek(0)
+        refs = self.client.fetch_pack('bla', lambda heads: [], None, None,
+                                      None, ref_prefix=[b'refs/heads/'])
+        self.assertEqual({b'refs/heads/master': Sha1Sum('1' * 40)}, refs)
+
     def test_get_transport_and_path_tcp(self):
         client, path = get_transport_and_path('git://foo.com/bar/baz')
         self.assertTrue(isinstance(client, TCPGitClient))
@@ -0,0 +1,375 @@
+# test_commit_graph.py -- Tests for reading and writing commit-graph files.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# or (at your option) a later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for reading and writing commit-graph files."""
+
+from io import BytesIO
+import os
+import shutil
+import tempfile
+
+from dulwich.commit_graph import (
+    CommitGraph,
+    bloom_filter_contains,
+    bloom_key,
+    changed_paths,
+    commit_graph_layer_name,
+    compute_bloom_filters,
+    find_commit_graph_entries,
+    make_bloom_filter,
+    murmur3_32,
+    path_prefixes,
+    write_commit_graph,
+    )
+from dulwich.errors import (
+    ChecksumMismatch,
+    FileFormatException,
+    )
+from dulwich.object_store import (
+    MemoryObjectStore,
+    )
+from dulwich.objects import (
+    Blob,
+    Sha1Sum,
+    Tag,
+    )
+from dulwich.repo import (
+    Repo,
+    )
+from dulwich.tests import TestCase
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_object,
+    )
+
+
+class CommitGraphTests(TestCase):
+
+    def setUp(self):
+        super(CommitGraphTests, self).setUp()
+        self.store = MemoryObjectStore()
+        self.commits = build_commit_graph(
+          self.store, [[1], [2, 1], [3, 1], [4, 2, 3], [5, 4, 2, 3]],
+          attrs={5: {'commit_time': 2 ** 33 + 5}})
+
+    def make_graph(self, heads=None, graph=None):
+        if heads is None:
+            heads = [self.commits[-1].id]
+        f = BytesIO()
+        write_commit_graph(f, find_commit_graph_entries(
+          self.store, heads, graph))
+        return CommitGraph(f.getvalue())
+
+    def test_entries(self):
+        graph = self.make_graph()
+        self.assertEqual(5, len(graph))
+        self.assertEqual(sorted(c.id for c in self.commits), list(graph))
+        for c in self.commits:
+            i = graph.position(c.id)
+            self.assertEqual(c.id, graph.sha_at(i))
+            self.assertEqual(c.tree, graph.tree_at(i))
+            self.assertEqual(c.parents, graph.parents_at(i))
+            self.assertEqual(c.commit_time, graph.commit_time_at(i))
+            self.assertEqual(c.parents, graph.get_parents(c.id))
+        graph.check()
+
+    def test_generations(self):
+        graph = self.make_graph()
+        self.assertEqual([1, 2, 2, 3, 4],
+                         [graph.get_generation(c.id) for c in self.commits])
+
+    def test_missing(self):
+        graph = self.make_graph([self.commits[1].id])
+        self.assertEqual(2, len(graph))
+        self.assertFalse(self.commits[2].id in graph)
+        self.assertEqual(None, graph.position(self.commits[2].id))
+        self.assertRaises(KeyError, graph.get_parents, self.commits[2].id)
+
+    def test_incremental(self):
+        graph = self.make_graph([self.commits[1].id])
+        graph = self.make_graph([self.commits[3].id], graph)
+        self.assertEqual(4, len(graph))
+        self.assertEqual(self.commits[3].parents,
+                         graph.get_parents(self.commits[3].id))
+
+    def test_layer(self):
+        base = self.make_graph([self.commits[1].id])
+        f = BytesIO()
+        write_commit_graph(f, find_commit_graph_entries(
+          self.store, [self.commits[-1].id], base, new_only=True),
+          base=base)
+        graph = CommitGraph(f.getvalue(), base=base)
+        self.assertEqual(5, len(graph))
+        self.assertEqual(2, graph.num_base_commits)
+        self.assertEqual([base, graph], graph.layers())
+        for c in self.commits:
+            i = graph.position(c.id)
+            self.assertEqual(c.id, graph.sha_at(i))
+            self.assertEqual(c.tree, graph.tree_at(i))
+            self.assertEqual(c.parents, graph.parents_at(i))
+            self.assertEqual(c.commit_time, graph.commit_time_at(i))
+        self.assertEqual([1, 2, 2, 3, 4],
+                         [graph.get_generation(c.id) for c in self.commits])
+        graph.check()
+        # A layer can only be read on top of the base it was written on.
+        self.assertRaises(FileFormatException, CommitGraph, f.getvalue())
+        self.assertRaises(FileFormatException, CommitGraph, f.getvalue(),
+                          base=self.make_graph([self.commits[2].id]))
+
+    def test_missing_parent(self):
+        del self.store[self.commits[2].id]
+        graph = self.make_graph()
+        self.assertEqual(sorted([self.commits[0].id, self.commits[1].id]),
+                         list(graph))
+
+    def test_tag_head(self):
+        tag = make_object(Tag, name='tag', message='', tag_time=0,
+                          tag_timezone=0, tagger='Test <test@example.com>',
+                          object=(type(self.commits[1]), self.commits[1].id))
+        self.store.add_object(tag)
+        self.assertEqual(2, len(self.make_graph([tag.id])))
+
+    def test_checksum(self):
+        f = BytesIO()
+        write_commit_graph(f, find_commit_graph_entries(
+          self.store, [self.commits[-1].id]))
+        contents = f.getvalue()
+        graph = CommitGraph(contents[:-1] + b'\0')
+        self.assertRaises(ChecksumMismatch, graph.check)
+
+    def test_bad_signature(self):
+        self.assertRaises(FileFormatException, CommitGraph, b'x' * 100)
+
+
+class BloomFilterTests(TestCase):
+
+    def test_murmur3(self):
+        self.assertEqual(0, murmur3_32(b'', 0))
+        self.assertEqual(0x627b0c2c, murmur3_32(b'Hello world!', 0))
+        self.assertEqual(0x2e4ff723, murmur3_32(
+          b'The quick brown fox jumps over the lazy dog', 0))
+
+    def test_murmur3_high_bits(self):
+        data = b'\x99\xaa\xbb\xcc\xdd\xee\xff'
+        self.assertEqual(0xa183ccfd, murmur3_32(data, 0))
+        self.assertEqual(0xdd92776e, murmur3_32(data, 0, signed_chars=True))
+
+    def test_path_prefixes(self):
+        self.assertEqual([b'a'], path_prefixes(b'a'))
+        self.assertEqual([b'a/b/c', b'a/b', b'a'], path_prefixes(b'a/b/c'))
+
+    def test_contains(self):
+        data = make_bloom_filter(set([b'a', b'a/b']))
+        self.assertEqual(3, len(data))
+        self.assertTrue(bloom_filter_contains(data, bloom_key(b'a')))
+        self.assertTrue(bloom_filter_contains(data, bloom_key(b'a/b')))
+        self.assertFalse(bloom_filter_contains(data, bloom_key(b'c')))
+
+    def test_empty(self):
+        data = make_bloom_filter(set())
+        self.assertEqual(b'\0', data)
+        self.assertFalse(bloom_filter_contains(data, bloom_key(b'a')))
+        # A zero-length filter says nothing.
+        self.assertTrue(bloom_filter_contains(b'', bloom_key(b'a')))
+
+    def test_too_many_paths(self):
+        self.assertTrue(bloom_filter_contains(make_bloom_filter(None),
+                                              bloom_key(b'a')))
+
+    def test_changed_paths(self):
+        store = MemoryObjectStore()
+        blob_a = make_object(Blob, data=b'a')
+        blob_b = make_object(Blob, data=b'b')
+        c1, c2 = build_commit_graph(store, [[1], [2, 1]], trees={
+          1: [('x/a', blob_a), ('y', blob_a)],
+          2: [('x/a', blob_b), ('y', blob_a), ('z/b', blob_a)]})
+        self.assertEqual(set([b'x/a', b'x', b'y']),
+                         changed_paths(store, None, c1.tree))
+        self.assertEqual(set([b'x/a', b'x', b'z/b', b'z']),
+                         changed_paths(store, c1.tree, c2.tree))
+        self.assertEqual(None, changed_paths(store, c1.tree, c2.tree, 3))
+
+    def test_graph(self):
+        store = MemoryObjectStore()
+        blob_a = make_object(Blob, data=b'a')
+        blob_b = make_object(Blob, data=b'b')
+        c1, c2 = build_commit_graph(store, [[1], [2, 1]], trees={
+          1: [('a', blob_a)], 2: [('a', blob_a), ('b', blob_b)]})
+        entries = list(find_commit_graph_entries(store, [c2.id]))
+        f = BytesIO()
+        bloom_filters = compute_bloom_filters(store, entries)
+        write_commit_graph(f, entries, bloom_filters)
+        graph = CommitGraph(f.getvalue())
+        self.assertTrue(graph.has_bloom_filters)
+        i = graph.position(c2.id)
+        self.assertEqual(bloom_filters[c2.id], graph.bloom_filter_at(i))
+        self.assertTrue(bloom_filter_contains(graph.bloom_filter_at(i),
+                                              graph.bloom_key(b'b')))
+        # Filters of commits in an existing graph are reused.
+        del store[blob_b.id]
+        self.assertEqual(bloom_filters,
+                         compute_bloom_filters(store, entries, graph))
+
+    def test_no_filters(self):
+        store = MemoryObjectStore()
+        c1, = build_commit_graph(store, [[1]])
+        f = BytesIO()
+        write_commit_graph(f, find_commit_graph_entries(store, [c1.id]))
+        graph = CommitGraph(f.getvalue())
+        self.assertFalse(graph.has_bloom_filters)
+        self.assertEqual(None, graph.bloom_filter_at(0))
+
+
+class CommitGraphRepoTests(TestCase):
+
+    def setUp(self):
+        super(CommitGraphRepoTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.repo = Repo.init_bare(self.path)
+        self.addCleanup(self.repo.close)
+        self.commits = build_commit_graph(
+          self.repo.object_store, [[1], [2, 1], [3, 2]])
+        self.repo.refs[b'refs/heads/master'] = self.commits[1].id
+
+    def test_no_commit_graph(self):
+        self.assertEqual(None, self.repo.object_store.commit_graph)
+        self.repo.update_commit_graph([self.commits[2].id])
+        self.assertEqual(None, self.repo.object_store.commit_graph)
+
+    def test_write_commit_graph(self):
+        graph = self.repo.write_commit_graph()
+        self.assertTrue(os.path.exists(
+          os.path.join(self.path, 'objects', 'info', 'commit-graph')))
+        self.assertEqual(2, len(graph))
+        self.assertTrue(graph is self.repo.object_store.commit_graph)
+        self.assertEqual([self.commits[0].id],
+                         self.repo.get_parents(self.commits[1].id))
+
+    def test_update_commit_graph(self):
+        self.repo.write_commit_graph()
+        self.repo.update_commit_graph([self.commits[2].id])
+        graph = self.repo.object_store.commit_graph
+        self.assertEqual(3, len(graph))
+        self.assertEqual([self.commits[1].id],
+                         graph.get_parents(self.commits[2].id))
+
+    def test_update_keeps_old_graph_open(self):
+        old = self.repo.write_commit_graph()
+        self.repo.update_commit_graph([self.commits[2].id])
+        self.assertFalse(old is self.repo.object_store.commit_graph)
+        # Walks that still hold the old graph can keep using it.
+        self.assertEqual([self.commits[0].id],
+                         old.get_parents(self.commits[1].id))
+
+    def test_update_known_tag_and_blob(self):
+        self.repo.write_commit_graph()
+        tag = make_object(Tag, name='tag', message='', tag_time=0,
+                          tag_timezone=0, tagger='Test <test@example.com>',
+                          object=(type(self.commits[1]), self.commits[1].id))
+        blob = make_object(Blob, data=b'blob')
+        self.repo.object_store.add_objects([(tag, None), (blob, None)])
+        written = []
+        self.repo.object_store.extend_commit_graph = (
+          lambda *args: written.append(args))
+        self.repo.update_commit_graph([tag.id, blob.id, Sha1Sum('1' * 40)])
+        self.assertEqual([], written)
+
+    def test_update_new_tag(self):
+        self.repo.write_commit_graph()
+        tag = make_object(Tag, name='tag', message='', tag_time=0,
+                          tag_timezone=0, tagger='Test <test@example.com>',
+                          object=(type(self.commits[2]), self.commits[2].id))
+        self.repo.object_store.add_object(tag)
+        self.repo.update_commit_graph([tag.id])
+        self.assertEqual(3, len(self.repo.object_store.commit_graph))
+
+    def test_changed_paths(self):
+        graph = self.repo.write_commit_graph(changed_paths=True)
+        self.assertTrue(graph.has_bloom_filters)
+        self.repo.update_commit_graph([self.commits[2].id])
+        graph = self.repo.object_store.commit_graph
+        self.assertEqual(3, len(graph))
+        self.assertTrue(graph.has_bloom_filters)
+
+    def get_layer_names(self):
+        with open(os.path.join(self.path, 'objects', 'info', 'commit-graphs',
+                               'commit-graph-chain'), 'rb') as f:
+            return [commit_graph_layer_name(Sha1Sum(l.strip()).bytes)
+                    for l in f]
+
+    def test_update_writes_layer(self):
+        # As when a commit is pushed to a repository with a long history.
+        commits = build_commit_graph(
+          self.repo.object_store, [[1]] + [[i, i - 1] for i in range(2, 101)])
+        graph = self.repo.write_commit_graph([commits[-2].id])
+        checksum = graph.get_stored_checksum()
+        self.repo.update_commit_graph([commits[-1].id])
+        graph = self.repo.object_store.commit_graph
+        self.assertEqual(100, len(graph))
+        self.assertEqual(99, graph.num_base_commits)
+        self.assertEqual([commits[-2].id], graph.get_parents(commits[-1].id))
+        # The old graph is kept as is, as the bottom layer.
+        self.assertEqual(checksum, graph.base.get_stored_checksum())
+        self.assertFalse(os.path.exists(
+          os.path.join(self.path, 'objects', 'info', 'commit-graph')))
+        self.assertEqual([commit_graph_layer_name(c.get_stored_checksum())
+                          for c in graph.layers()], self.get_layer_names())
+        graph.check()
+
+    def test_update_merges_small_layers(self):
+        commits = build_commit_graph(
+          self.repo.object_store, [[1]] + [[i, i - 1] for i in range(2, 11)])
+        self.repo.write_commit_graph([commits[-3].id])
+        self.repo.update_commit_graph([commits[-2].id])
+        self.repo.update_commit_graph([commits[-1].id])
+        graph = self.repo.object_store.commit_graph
+        self.assertEqual([8, 2], [len(layer) - layer.num_base_commits
+                                  for layer in graph.layers()])
+        layers = os.listdir(os.path.join(
+          self.path, 'objects', 'info', 'commit-graphs'))
+        self.assertEqual(sorted(self.get_layer_names() +
+                                ['commit-graph-chain']), sorted(layers))
+
+    def test_update_changed_paths_layer(self):
+        self.repo.write_commit_graph(changed_paths=True)
+        self.repo.update_commit_graph([self.commits[2].id])
+        self.repo.object_store.close()
+        graph = self.repo.object_store.commit_graph
+        self.assertEqual(3, len(graph))
+        self.assertTrue(graph.has_bloom_filters)
+        self.assertTrue(graph.bloom_filter_at(
+          graph.position(self.commits[2].id)))
+
+    def test_write_replaces_layers(self):
+        self.repo.write_commit_graph([self.commits[0].id])
+        self.repo.update_commit_graph([self.commits[1].id])
+        graph = self.repo.write_commit_graph([self.commits[2].id])
+        self.assertEqual(None, graph.base)
+        self.assertEqual(3, len(graph))
+        self.assertEqual([], os.listdir(os.path.join(
+          self.path, 'objects', 'info', 'commit-graphs')))
+
+    def test_fetch_updates_commit_graph(self):
+        target_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_path)
+        target = Repo.init_bare(target_path)
+        self.addCleanup(target.close)
+        target.write_commit_graph()
+        self.assertEqual(0, len(target.object_store.commit_graph))
+        self.repo.fetch(target)
+        self.assertEqual(2, len(target.object_store.commit_graph))
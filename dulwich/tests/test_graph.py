@@ -0,0 +1,188 @@
+# test_graph.py -- Tests for merge bases and reachability of commits.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# or (at your option) a later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for merge bases and reachability of commits."""
+
+from io import BytesIO
+
+from dulwich.commit_graph import (
+    CommitGraph,
+    find_commit_graph_entries,
+    write_commit_graph,
+    )
+from dulwich.errors import (
+    MissingCommitError,
+    )
+from dulwich.graph import (
+    SatisfiedWants,
+    ahead_behind,
+    is_ancestor,
+    merge_base,
+    )
+from dulwich.object_store import (
+    MemoryObjectStore,
+    )
+from dulwich.tests import TestCase
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_commit,
+    )
+
+
+class GraphTests(TestCase):
+
+    def setUp(self):
+        super(GraphTests, self).setUp()
+        self.store = MemoryObjectStore()
+
+    def make_commits(self, commit_spec, **kwargs):
+        return build_commit_graph(self.store, commit_spec, **kwargs)
+
+    def test_merge_base_linear(self):
+        c1, c2, c3 = self.make_commits([[1], [2, 1], [3, 2]])
+        self.assertEqual([c2.id], merge_base(self.store, c2.id, c3.id))
+        self.assertEqual([c2.id], merge_base(self.store, c3.id, c2.id))
+        self.assertEqual([c3.id], merge_base(self.store, c3.id, c3.id))
+
+    def test_merge_base_branches(self):
+        c1, c2, x3, y4, x5 = self.make_commits(
+          [[1], [2, 1], [3, 2], [4, 2], [5, 3]])
+        self.assertEqual([c2.id], merge_base(self.store, x5.id, y4.id))
+
+    def test_merge_base_criss_cross(self):
+        c1, x2, y3, m4, m5 = self.make_commits(
+          [[1], [2, 1], [3, 1], [4, 2, 3], [5, 3, 2]])
+        self.assertEqual(set([x2.id, y3.id]),
+                         set(merge_base(self.store, m4.id, m5.id)))
+
+    def test_merge_base_skew(self):
+        # c2 has an old commit time, so it is walked after c1.
+        c1, c2, x3, y4 = self.make_commits(
+          [[1], [2, 1], [3, 2], [4, 2]],
+          attrs={1: {'commit_time': 10}, 2: {'commit_time': 5}})
+        self.assertEqual([c2.id], merge_base(self.store, x3.id, y4.id))
+
+    def test_merge_base_unrelated(self):
+        c1, c2 = self.make_commits([[1], [2]])
+        self.assertEqual([], merge_base(self.store, c1.id, c2.id))
+
+    def test_is_ancestor(self):
+        c1, c2, x3, y4 = self.make_commits([[1], [2, 1], [3, 2], [4, 2]])
+        self.assertTrue(is_ancestor(self.store, c1.id, x3.id))
+        self.assertTrue(is_ancestor(self.store, c2.id, y4.id))
+        self.assertTrue(is_ancestor(self.store, x3.id, x3.id))
+        self.assertFalse(is_ancestor(self.store, x3.id, c1.id))
+        self.assertFalse(is_ancestor(self.store, x3.id, y4.id))
+
+    def test_ahead_behind(self):
+        c1, c2, x3, y4, y5, m6 = self.make_commits(
+          [[1], [2, 1], [3, 2], [4, 2], [5, 4], [6, 3, 5]])
+        self.assertEqual([(2, 1), (1, 1), (0, 1), (3, 0), (0, 0)],
+                         ahead_behind(self.store, x3.id,
+                                      [y5.id, y4.id, c2.id, m6.id, x3.id]))
+        self.assertEqual([], ahead_behind(self.store, x3.id, []))
+
+    def test_ahead_behind_unrelated(self):
+        c1, c2, x3 = self.make_commits([[1], [2, 1], [3]])
+        self.assertEqual([(1, 2)], ahead_behind(self.store, c2.id, [x3.id]))
+
+    def test_missing(self):
+        c1, c2 = self.make_commits([[1], [2, 1]])
+        missing = make_commit(parents=[c1.id])
+        self.assertRaises(MissingCommitError, merge_base, self.store, c2.id,
+                          missing.id)
+
+    def test_satisfied_wants(self):
+        #   3---5
+        #  /
+        # 1---2---4
+        c1, c2, c3, c4, c5 = self.make_commits(
+          [[1], [2, 1], [3, 1], [4, 2], [5, 3]])
+        satisfied = SatisfiedWants(self.store, [c4.id, c5.id])
+        self.assertFalse(satisfied.all_satisfied())
+        satisfied.add_have(c2.id)
+        self.assertTrue(satisfied.is_satisfied(c4.id))
+        self.assertFalse(satisfied.is_satisfied(c5.id))
+        self.assertFalse(satisfied.all_satisfied())
+        # c1 is older than c2, so the walk goes further down.
+        satisfied.add_have(c1.id)
+        self.assertTrue(satisfied.all_satisfied())
+
+    def test_satisfied_wants_have_want(self):
+        c1, c2, c3 = self.make_commits([[1], [2, 1], [3, 1]])
+        satisfied = SatisfiedWants(self.store, [c2.id, c3.id])
+        satisfied.add_have(c3.id)
+        self.assertFalse(satisfied.is_satisfied(c2.id))
+        self.assertTrue(satisfied.is_satisfied(c3.id))
+
+    def test_satisfied_wants_earliest(self):
+        # The walk does not go past commits older than the oldest have, so
+        # the have on another branch does not find c1 until c1 is a have.
+        c1, c2, c3 = self.make_commits([[1], [2, 1], [3, 1]])
+        satisfied = SatisfiedWants(self.store, [c2.id])
+        satisfied.add_have(c3.id)
+        self.assertFalse(satisfied.all_satisfied())
+        satisfied.add_have(c1.id)
+        self.assertTrue(satisfied.all_satisfied())
+
+    def test_satisfied_wants_not_commit(self):
+        c1, = self.make_commits([[1]])
+        satisfied = SatisfiedWants(self.store, [c1.tree])
+        self.assertTrue(satisfied.all_satisfied())
+
+    def test_satisfied_wants_walks_once(self):
+        commits = self.make_commits([[1]] + [[i, i - 1] for i in range(2, 50)])
+        walked = []
+        get_parents = self.store.get_parents
+        self.store.get_parents = lambda sha: walked.append(sha) or \
+          get_parents(sha)
+        satisfied = SatisfiedWants(self.store, [commits[-1].id])
+        # Haves from newest to oldest, on a branch the want can not reach.
+        for c in self.make_commits(
+            [[i] for i in range(100, 150)],
+            attrs=dict((i, {'commit_time': 150 - i}) for i in range(100, 150))):
+            satisfied.add_have(c.id)
+        satisfied.add_have(commits[0].id)
+        self.assertTrue(satisfied.all_satisfied())
+        # The want is checked, and the commits above the have are walked
+        # once each.
+        self.assertEqual(len(commits), len(walked))
+
+
+class CommitGraphGraphTests(GraphTests):
+    """Run the graph tests with a commit graph."""
+
+    def make_commits(self, commit_spec, **kwargs):
+        commits = super(CommitGraphGraphTests, self).make_commits(
+          commit_spec, **kwargs)
+        # Leave the last commit out, to also cover commits that are not in
+        # the graph.
+        f = BytesIO()
+        write_commit_graph(f, find_commit_graph_entries(
+          self.store, [c.id for c in commits[:-1]]))
+        self.store.commit_graph = CommitGraph(f.getvalue())
+        return commits
+
+    def test_commits_not_read(self):
+        c1, c2, x3, y4, y5 = self.make_commits(
+          [[1], [2, 1], [3, 2], [4, 2], [5, 4]])
+        # Only the commit that is not in the graph needs to be read.
+        for c in (c1, c2, x3, y4):
+            del self.store[c.id]
+        self.assertEqual([c2.id], merge_base(self.store, x3.id, y5.id))
+        self.assertEqual([(2, 1)], ahead_behind(self.store, x3.id, [y5.id]))
+        self.assertFalse(is_ancestor(self.store, x3.id, y5.id))
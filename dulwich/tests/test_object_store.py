@@ -33,6 +33,7 @@ from dulwich.errors import (
 from dulwich.objects import (
     object_class,
     Blob,
+    Commit,
     Tag,
     Tree,
     TreeEntry,
@@ -41,10 +42,15 @@ from dulwich.objects import (
 from dulwich.object_store import (
     DiskObjectStore,
     MemoryObjectStore,
+    ObjectIdSet,
+    ObjectFilter,
+    ObjectNumbering,
     ObjectStoreGraphWalker,
+    parse_filter_spec,
     tree_lookup_path,
     )
 from dulwich.pack import (
+    MemoryPackIndex,
     REF_DELTA,
     write_pack_objects,
     )
@@ -53,6 +59,7 @@ from dulwich.tests import (
     )
 from dulwich.tests.utils import (
     make_object,
+    build_commit_graph,
     build_pack,
     )
 
@@ -188,6 +195,11 @@ class ObjectStoreTests(object):
         self.assertEqual((Blob.type_num, b'yummy data'),
                          self.store.get_raw(testobject.id))
 
+    def test_get_object_size(self):
+        self.store.add_object(testobject)
+        self.assertEqual(10, self.store.get_object_size(testobject.id))
+        self.assertRaises(KeyError, self.store.get_object_size, b'1' * 40)
+
 
 class MemoryObjectStoreTests(ObjectStoreTests, TestCase):
 
@@ -195,6 +207,9 @@ class MemoryObjectStoreTests(ObjectStoreTests, TestCase):
         TestCase.setUp(self)
         self.store = MemoryObjectStore()
 
+    def test_find_clone_pack(self):
+        self.assertEqual(None, self.store.find_clone_pack())
+
 
 class PackBasedObjectStoreTests(ObjectStoreTests):
 
@@ -205,6 +220,11 @@ class PackBasedObjectStoreTests(ObjectStoreTests):
     def test_empty_packs(self):
         self.assertEqual([], self.store.packs)
 
+    def test_get_packed_object_size(self):
+        self.store.add_object(testobject)
+        self.store.pack_loose_objects()
+        self.assertEqual(10, self.store.get_object_size(testobject.id))
+
     def test_pack_loose_objects(self):
         b1 = make_object(Blob, data=b"yummy data")
         self.store.add_object(b1)
@@ -260,6 +280,20 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
         write_pack_objects(f, [(b, None)])
         commit()
 
+    def test_add_pack_thin(self):
+        o = DiskObjectStore(self.store_dir)
+        base = make_object(Blob, data=b'yummy data\n' * 100)
+        o.add_object(base)
+        b = make_object(Blob, data=b'yummy data\n' * 101)
+        f, commit = o.add_pack()
+        write_pack_objects(f, [(b, None)],
+                           get_delta_base=lambda obj, path: base)
+        pack = commit()
+        # The base is added to complete the pack.
+        self.assertEqual(sorted([base.id, b.id]), sorted(pack))
+        self.assertEqual((Blob.type_num, b'yummy data\n' * 101),
+                         o.get_raw(b.id))
+
     def test_add_thin_pack(self):
         blob = make_object(Blob, data=b'yummy data')
         with DiskObjectStore(self.store_dir) as o:
@@ -280,6 +314,212 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
                     self.assertEqual((Blob.type_num, b'more yummy data'),
                                      o.get_raw(packed_blob_sha))
 
+    def test_load_packs_keeps_open_packs(self):
+        b1 = make_object(Blob, data=b'yummy data')
+        self.store.add_object(b1)
+        self.store.pack_loose_objects()
+        store = DiskObjectStore(self.store_dir)
+        self.addCleanup(store.close)
+        [pack] = store.packs
+        pack.index
+        b2 = make_object(Blob, data=b'more yummy data')
+        self.store.add_objects([(b2, None)])
+        # Make sure the pack directory looks modified.
+        store._pack_cache_time = 0
+        packs = store.packs
+        self.assertEqual(2, len(packs))
+        self.assertTrue(pack in packs)
+        self.assertTrue(any(p is pack for p in packs))
+
+    def test_memory_size(self):
+        self.assertEqual(0, self.store.memory_size())
+        self.store.add_object(testobject)
+        self.store.pack_loose_objects()
+        self.store.packs[0].index
+        size = self.store.memory_size()
+        self.assertTrue(size > 0)
+        self.store.enable_object_cache({'blob': 1024})
+        self.store[testobject.id]
+        self.assertEqual(size + testobject.raw_length(),
+                         self.store.memory_size())
+
+    def test_clone_pack(self):
+        self.assertEqual(None, self.store.find_clone_pack())
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        unreachable = make_object(Blob, data=b'unreachable')
+        self.store.add_object(unreachable)
+        pack = self.store.write_clone_pack([c1.id])
+        self.assertEqual((pack, [c1.id]), self.store.find_clone_pack())
+        self.assertEqual(
+          sorted(sha for (sha, path)
+                 in self.store.find_missing_objects([], [c1.id])),
+          sorted(pack))
+        self.assertFalse(c2.id in pack)
+        self.assertFalse(unreachable.id in pack)
+        # A new clone pack replaces the old one.
+        pack = self.store.write_clone_pack([c2.id])
+        self.assertEqual((pack, [c2.id]), self.store.find_clone_pack())
+        self.assertTrue(c2.id in pack)
+
+    def test_new_object_set(self):
+        b1 = make_object(Blob, data=b'yummy data')
+        b2 = make_object(Blob, data=b'more yummy data')
+        self.store.add_object(b1)
+        self.store.pack_loose_objects()
+        self.assertTrue(isinstance(self.store.new_object_set(), set))
+        self.store.object_id_set_min_objects = 2
+        self.assertTrue(isinstance(self.store.new_object_set(), set))
+        self.store.object_id_set_min_objects = 1
+        objects = self.store.new_object_set([b1.id])
+        self.assertTrue(isinstance(objects, ObjectIdSet))
+        self.assertTrue(b1.id in objects)
+        self.assertFalse(b2.id in objects)
+
+    def test_new_object_set_numbering(self):
+        b1 = make_object(Blob, data=b'yummy data')
+        b2 = make_object(Blob, data=b'more yummy data')
+        self.store.add_object(b1)
+        self.store.pack_loose_objects()
+        self.store.object_id_set_min_objects = 1
+        objects1 = self.store.new_object_set([b2.id])
+        objects2 = self.store.new_object_set()
+        # The packed objects are numbered once, the others for each set.
+        self.assertTrue(objects1._numbering._indexes is
+                        objects2._numbering._indexes)
+        self.assertFalse(b2.id in objects2)
+        self.assertEqual(1, len(objects2._numbering))
+        # A new pack gets a new numbering.
+        self.store.add_object(b2)
+        self.store.pack_loose_objects()
+        objects3 = self.store.new_object_set()
+        self.assertEqual(2, len(objects3._numbering))
+
+
+class ObjectNumberingTests(TestCase):
+
+    def setUp(self):
+        super(ObjectNumberingTests, self).setUp()
+        self.shas = sorted(make_object(Blob, data=data).id
+                           for data in (b'a', b'b', b'c', b'd'))
+        self.numbering = ObjectNumbering([
+          MemoryPackIndex([(self.shas[0], 0, 0), (self.shas[2], 0, 0)]),
+          MemoryPackIndex([(self.shas[1], 0, 0), (self.shas[2], 0, 0)])])
+
+    def test_packed(self):
+        self.assertEqual(4, len(self.numbering))
+        self.assertEqual(0, self.numbering.number(self.shas[0]))
+        self.assertEqual(1, self.numbering.get(self.shas[2]))
+        self.assertEqual(2, self.numbering.number(self.shas[1].hex_bytes))
+        self.assertEqual(self.shas[1], self.numbering[2])
+        self.assertEqual(self.shas[2], self.numbering[3])
+
+    def test_overflow(self):
+        self.assertEqual(None, self.numbering.get(self.shas[3]))
+        self.assertEqual(4, self.numbering.number(self.shas[3]))
+        self.assertEqual(4, self.numbering.get(self.shas[3]))
+        self.assertEqual(5, len(self.numbering))
+        self.assertEqual(self.shas[3], self.numbering[4])
+
+    def test_copy_packed(self):
+        self.numbering.number(self.shas[3])
+        numbering = self.numbering.copy_packed()
+        self.assertEqual(4, len(numbering))
+        self.assertEqual(1, numbering.get(self.shas[2]))
+        self.assertEqual(None, numbering.get(self.shas[3]))
+
+
+class ObjectIdSetTests(TestCase):
+
+    def setUp(self):
+        super(ObjectIdSetTests, self).setUp()
+        self.shas = sorted(make_object(Blob, data=data).id
+                           for data in (b'a', b'b', b'c'))
+        self.numbering = ObjectNumbering(
+          [MemoryPackIndex([(sha, 0, 0) for sha in self.shas[:2]])])
+
+    def test_add(self):
+        objects = ObjectIdSet(self.numbering, [self.shas[0]])
+        self.assertEqual(1, len(objects))
+        objects.add(self.shas[2])
+        objects.add(self.shas[2])
+        self.assertEqual(2, len(objects))
+        self.assertTrue(self.shas[0] in objects)
+        self.assertFalse(self.shas[1] in objects)
+        self.assertTrue(self.shas[2] in objects)
+        self.assertEqual([self.shas[0], self.shas[2]], list(objects))
+
+    def test_unknown_not_numbered(self):
+        objects = ObjectIdSet(self.numbering)
+        self.assertFalse(self.shas[2] in objects)
+        objects.discard(self.shas[2])
+        self.assertEqual(2, len(self.numbering))
+
+    def test_remove(self):
+        objects = ObjectIdSet(self.numbering, self.shas)
+        objects.discard(self.shas[1])
+        objects.remove(self.shas[2])
+        self.assertEqual([self.shas[0]], list(objects))
+        self.assertRaises(KeyError, objects.remove, self.shas[2])
+
+
+class ParsedObjectCacheTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+        self.store = DiskObjectStore.init(self.store_dir)
+        self.blob = make_object(Blob, data=b'blob data')
+        self.tree = Tree()
+        self.tree.add(b'a', 0o100644, self.blob.id)
+        self.store.add_object(self.blob)
+        self.store.add_object(self.tree)
+
+    def test_disabled_by_default(self):
+        self.assertEqual(None, self.store.object_cache)
+        self.assertFalse(self.store[self.tree.id] is self.store[self.tree.id])
+
+    def test_hit(self):
+        cache = self.store.enable_object_cache()
+        tree = self.store[self.tree.id]
+        self.assertTrue(tree is self.store[self.tree.id])
+        self.assertTrue(tree is self.store[self.tree.id.hex_bytes])
+        self.assertEqual((2, 1, 1), cache.stats()['tree'])
+        self.assertEqual(2.0 / 3, cache.hit_rate())
+
+    def test_blobs_not_cached_by_default(self):
+        cache = self.store.enable_object_cache()
+        blob = self.store[self.blob.id]
+        self.assertFalse(blob is self.store[self.blob.id])
+        self.assertFalse('blob' in cache.stats())
+
+    def test_per_type_budget(self):
+        cache = self.store.enable_object_cache({'blob': 1024, 'tree': 0})
+        self.assertTrue(self.store[self.blob.id] is self.store[self.blob.id])
+        self.assertFalse(self.store[self.tree.id] is self.store[self.tree.id])
+        self.assertEqual({'blob': (1, 1, 1)}, cache.stats())
+
+    def test_compact_large_trees(self):
+        self.store.enable_object_cache(compact_tree_size=1)
+        tree = self.store[self.tree.id]
+        self.assertEqual(None, tree._chunked_text)
+        self.assertEqual(self.tree.id, tree.id)
+        self.assertEqual((0o100644, self.blob.id), tree[b'a'])
+
+    def test_size(self):
+        cache = self.store.enable_object_cache()
+        self.assertEqual(0, cache.size())
+        self.store[self.tree.id]
+        self.assertEqual(self.tree.raw_length(), cache.size())
+
+    def test_disable(self):
+        self.store.enable_object_cache()
+        self.store[self.tree.id]
+        self.store.disable_object_cache()
+        self.assertEqual(None, self.store.object_cache)
+        self.assertFalse(self.store[self.tree.id] is self.store[self.tree.id])
+
+
 class TreeLookupPathTests(TestCase):
 
     def setUp(self):
@@ -321,7 +561,186 @@ class TreeLookupPathTests(TestCase):
     def test_lookup_not_tree(self):
         self.assertRaises(NotTreeError, tree_lookup_path, self.get_object, self.tree_id, 'ad/b/j')
 
-# TODO: MissingObjectFinderTests
+class MissingObjectFinderTests(TestCase):
+
+    def setUp(self):
+        super(MissingObjectFinderTests, self).setUp()
+        self.store = MemoryObjectStore()
+        self.blobs = dict((name, make_object(Blob, data=name.encode('ascii')))
+                          for name in ('a', 'b', 'c', 'd'))
+        self.c1, self.c2, self.c3 = build_commit_graph(
+          self.store, [[1], [2, 1], [3, 2]], trees={
+            1: [('x/a', self.blobs['a']), ('b', self.blobs['b'])],
+            2: [('x/a', self.blobs['a']), ('c', self.blobs['c'])],
+            3: [('x/a', self.blobs['d']), ('b', self.blobs['b']),
+                ('c', self.blobs['c'])]})
+
+    def find(self, haves, wants, get_tagged=None, **kwargs):
+        return dict(self.store.find_missing_objects(
+          haves, wants, get_tagged=get_tagged, **kwargs))
+
+    def test_all(self):
+        found = self.find([], [self.c3.id])
+        self.assertEqual(3 + 3 + 2 + 4, len(found))
+        self.assertEqual(None, found[self.c1.id])
+        self.assertEqual('', found[self.c1.tree])
+        self.assertEqual(b'b', found[self.blobs['b'].id])
+
+    def test_haves(self):
+        found = self.find([self.c2.id], [self.c3.id])
+        tree3 = self.store[self.c3.tree]
+        # Blob c is in c2. Like C git, only the trees of the haves and of the
+        # parents of missing commits are checked, so blob b is sent even
+        # though the target has it in c1.
+        self.assertEqual(
+          set([self.c3.id, tree3.id, tree3[b'x'][1], self.blobs['d'].id,
+               self.blobs['b'].id]),
+          set(found))
+        self.assertEqual(b'a', found[self.blobs['d'].id])
+
+    def test_shallow(self):
+        found = self.find([], [self.c3.id], shallow=set([self.c3.id]))
+        tree3 = self.store[self.c3.tree]
+        self.assertEqual(
+          set([self.c3.id, tree3.id, tree3[b'x'][1], self.blobs['b'].id,
+               self.blobs['c'].id, self.blobs['d'].id]),
+          set(found))
+
+    def test_target_shallow(self):
+        # The target has c2, but not its parent.
+        found = self.find([self.c2.id], [self.c3.id],
+                          shallow=set([self.c2.id]),
+                          target_shallow=set([self.c2.id]))
+        self.assertEqual(5, len(found))
+        self.assertFalse(self.c1.id in found)
+
+    def test_unshallow(self):
+        found = self.find([self.c2.id], [self.c3.id],
+                          target_shallow=set([self.c2.id]))
+        self.assertFalse(self.c2.id in found)
+        # The tree of c1 shares x with that of c2, so only its root is sent.
+        self.assertEqual(
+          set([self.c1.id, self.c1.tree]),
+          set(found) - set(self.find([self.c2.id], [self.c3.id])))
+
+    def test_filter_blob_none(self):
+        found = self.find([], [self.c3.id],
+                          object_filter=ObjectFilter(blob_limit=0))
+        self.assertEqual(3 + 3 + 2, len(found))
+        self.assertFalse(set(b.id for b in self.blobs.values()) & set(found))
+
+    def test_filter_blob_limit(self):
+        large = make_object(Blob, data=b'large')
+        c4, = build_commit_graph(self.store, [[4]], trees={
+          4: [('a', self.blobs['a']), ('large', large)]})
+        found = self.find([], [c4.id],
+                          object_filter=ObjectFilter(blob_limit=5))
+        self.assertEqual(set([c4.id, c4.tree, self.blobs['a'].id]),
+                         set(found))
+
+    def test_filter_tree_depth(self):
+        def find_depth(depth):
+            return set(self.find([self.c2.id], [self.c3.id],
+                                 object_filter=ObjectFilter(tree_depth=depth)))
+        tree3 = self.store[self.c3.tree]
+        self.assertEqual(set([self.c3.id]), find_depth(0))
+        self.assertEqual(set([self.c3.id, tree3.id]), find_depth(1))
+        self.assertEqual(set([self.c3.id, tree3.id, tree3[b'x'][1],
+                              self.blobs['b'].id]),
+                         find_depth(2))
+        self.assertEqual(set(self.find([self.c2.id], [self.c3.id])),
+                         find_depth(3))
+
+    def test_filter_tree_depth_reached_twice(self):
+        # Tree x is both at depth 1 and 2, and blob a is only in range at the
+        # former.
+        tree_x = self.store[self.store[self.c1.tree][b'x'][1]]
+        c4, c5 = build_commit_graph(self.store, [[4], [5, 4]], trees={
+          4: [('y/x/a', self.blobs['a'])], 5: [('x/a', self.blobs['a'])]})
+        found = self.find([], [c5.id],
+                          object_filter=ObjectFilter(tree_depth=3))
+        self.assertTrue(tree_x.id in found)
+        self.assertTrue(self.blobs['a'].id in found)
+
+    def test_filter_wanted_blob(self):
+        found = self.find([], [self.blobs['a'].id],
+                          object_filter=ObjectFilter(blob_limit=0))
+        self.assertEqual([self.blobs['a'].id], list(found))
+
+    def test_thin_pack(self):
+        finder = self.store.find_missing_objects(
+          [self.c2.id], [self.c3.id], thin_pack=True)
+        found = dict(finder)
+        tree2 = self.store[self.c2.tree]
+        self.assertEqual(b'a', found[self.blobs['d'].id])
+        self.assertEqual(self.blobs['a'].id, finder.get_delta_base(b'a'))
+        self.assertEqual(tree2[b'x'][1], finder.get_delta_base(b'x'))
+        self.assertEqual(tree2.id, finder.get_delta_base(''))
+        self.assertEqual(None, finder.get_delta_base(b'b'))
+
+    def test_not_thin_pack(self):
+        finder = self.store.find_missing_objects([self.c2.id], [self.c3.id])
+        list(finder)
+        self.assertEqual(None, finder.get_delta_base(b'a'))
+
+    def test_haves_not_ancestors(self):
+        found = self.find([self.c3.id], [self.c2.id])
+        self.assertEqual({}, found)
+
+    def test_unknown_haves(self):
+        unknown = make_object(Blob, data=b'unknown')
+        found = self.find([self.c2.id, unknown.id], [self.c3.id])
+        self.assertEqual(5, len(found))
+
+    def test_tagged(self):
+        tag = make_object(Tag, name='v1', message='', tag_time=0,
+                          tag_timezone=0, tagger='Test <test@example.com>',
+                          object=(Commit, self.c3.id))
+        self.store.add_object(tag)
+        calls = []
+
+        def get_tagged():
+            calls.append(None)
+            return {self.c3.id: tag.id, self.c1.id: tag.id}
+        found = self.find([self.c2.id], [self.c3.id], get_tagged)
+        self.assertEqual(6, len(found))
+        self.assertTrue(tag.id in found)
+        self.assertEqual(1, len(calls))
+
+    def test_want_tag(self):
+        tag = make_object(Tag, name='v1', message='', tag_time=0,
+                          tag_timezone=0, tagger='Test <test@example.com>',
+                          object=(Commit, self.c3.id))
+        self.store.add_object(tag)
+        found = self.find([self.c2.id], [tag.id])
+        self.assertEqual(6, len(found))
+        self.assertTrue(tag.id in found)
+        self.assertTrue(self.c3.id in found)
+
+
+class ParseFilterSpecTests(TestCase):
+
+    def test_blob_none(self):
+        self.assertEqual(ObjectFilter(blob_limit=0),
+                         parse_filter_spec(b'blob:none'))
+
+    def test_blob_limit(self):
+        self.assertEqual(ObjectFilter(blob_limit=100),
+                         parse_filter_spec(b'blob:limit=100'))
+        self.assertEqual(ObjectFilter(blob_limit=2048),
+                         parse_filter_spec(b'blob:limit=2k'))
+        self.assertEqual(ObjectFilter(blob_limit=1 << 20),
+                         parse_filter_spec(b'blob:limit=1M'))
+
+    def test_tree(self):
+        self.assertEqual(ObjectFilter(tree_depth=0),
+                         parse_filter_spec(b'tree:0'))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, parse_filter_spec, b'sparse:oid=x')
+        self.assertRaises(ValueError, parse_filter_spec, b'blob:limit=')
+        self.assertRaises(ValueError, parse_filter_spec, b'tree:-1')
+
 
 class ObjectStoreGraphWalkerTests(TestCase):
 
@@ -358,6 +777,19 @@ class ObjectStoreGraphWalkerTests(TestCase):
         gw.ack("a")
         self.assertIs(None, next(gw))
 
+    def test_shallow(self):
+        gw = ObjectStoreGraphWalker(["a"], {"a": ["b"]}.__getitem__,
+                                    shallow=set(["a"]))
+        self.assertEqual("a", next(gw))
+        self.assertIs(None, next(gw))
+
+    def test_update_shallow(self):
+        gw = ObjectStoreGraphWalker([], {}.__getitem__, shallow=set(["a"]))
+        gw.update_shallow(set(["b"]), set(["a"]))
+        self.assertEqual(set(["a"]), gw.shallow)
+        self.assertEqual(set(["b"]), gw.new_shallow)
+        self.assertEqual(set(["a"]), gw.new_unshallow)
+
     def test_only_once(self):
         # a  b
         # |  |
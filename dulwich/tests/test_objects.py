@@ -29,11 +29,13 @@ import stat
 import warnings
 import binascii
 import hashlib
+import zlib
 
 from dulwich.errors import (
     ObjectFormatException,
     )
 from itertools import permutations
+from dulwich import objects as objects_mod
 from dulwich.objects import (
     Blob,
     Tree,
@@ -46,8 +48,10 @@ from dulwich.objects import (
     check_identity,
     parse_timezone,
     TreeEntry,
+    iter_tree_entries,
     parse_tree,
     _parse_tree_py,
+    read_loose_object_size,
     sorted_tree_items,
     _sorted_tree_items_py,
     sha_to_filename,
@@ -126,6 +130,20 @@ class BlobReadTests(TestCase):
         b2 = b1.from_file(BytesIO(b_raw))
         self.assertEqual(b1, b2)
 
+    def test_read_loose_object_size(self):
+        b1 = Blob.from_string(b'foo' * 100)
+        self.assertEqual(300, read_loose_object_size(
+          BytesIO(b1.as_legacy_object())))
+        # New style objects have an uncompressed pack object header.
+        new_style = (b'\xbc\x12' + zlib.compress(b1.data))
+        self.assertEqual(300, read_loose_object_size(BytesIO(new_style)))
+
+    def test_read_loose_object_size_invalid(self):
+        self.assertRaises(ObjectFormatException, read_loose_object_size,
+                          BytesIO(b''))
+        self.assertRaises(ObjectFormatException, read_loose_object_size,
+                          BytesIO(b'\xbc\x92'))
+
     def test_chunks(self):
         string = b'test 5\n'
         b = Blob.from_string(string)
@@ -378,6 +396,40 @@ class CommitParseTests(ShaFileCheckTests):
         c = Commit.from_string(self.make_commit_text(encoding='UTF-8'))
         self.assertEqual('UTF-8', c.encoding)
 
+    def test_lazy_fields(self):
+        c = Commit.from_string(self.make_commit_text())
+        self.assertEqual(b'd80c186a03f423a81b39df39dc87fd269736ca86', c.tree)
+        self.assertEqual(2, len(c.parents))
+        self.assertEqual(1174773719, c.commit_time)
+        self.assertNotEqual(None, c._unparsed_text)
+        self.assertEqual('Merge ../b\n', c.message)
+        self.assertEqual(None, c._unparsed_text)
+
+    def test_lazy_fields_while_parsing(self):
+        c = Commit.from_string(self.make_commit_text())
+        seen = []
+        orig_parse_commit = objects_mod.parse_commit
+
+        def parse_commit(text):
+            # Another thread reads the commit while this one parses it.
+            if not seen:
+                seen.append(None)
+                seen[0] = c.author
+            return orig_parse_commit(text)
+        objects_mod.parse_commit = parse_commit
+        self.addCleanup(setattr, objects_mod, 'parse_commit',
+                        orig_parse_commit)
+        self.assertEqual('Merge ../b\n', c.message)
+        self.assertEqual(['James Westby <jw+debian@jameswestby.net>'], seen)
+
+    def test_set_parents_keeps_lazy_fields(self):
+        c = Commit.from_string(self.make_commit_text())
+        c.parents = []
+        self.assertEqual('Merge ../b\n', c.message)
+        self.assertEqual('James Westby <jw+debian@jameswestby.net>', c.author)
+        self.assertEqual(1174773719, c.commit_time)
+        self.assertFalse(b'parent ' in c.as_raw_string())
+
     def test_check(self):
         self.assertCheckSucceeds(Commit, self.make_commit_text())
         self.assertCheckSucceeds(Commit, self.make_commit_text(parents=None))
@@ -564,6 +616,135 @@ class TreeTests(ShaFileCheckTests):
         t[b"foo"] = (0o100644, a_sha)
         self.assertEqual(set([b"foo"]), set(t))
 
+    def test_iter_tree_entries(self):
+        text = b'100644 a\0' + bytes(a_sha) + b'40000 b\0' + bytes(b_sha)
+        self.assertEqual([TreeEntry(b'a', 0o100644, a_sha),
+                          TreeEntry(b'b', stat.S_IFDIR, b_sha)],
+                         list(iter_tree_entries(text)))
+        self.assertRaises(ObjectFormatException, list,
+                          iter_tree_entries(b'100644 a\0' + b'x' * 5))
+        self.assertRaises(ObjectFormatException, list,
+                          iter_tree_entries(b'10x644 a\0' + bytes(a_sha)))
+        self.assertRaises(ObjectFormatException, list,
+                          iter_tree_entries(b'100644 a'))
+
+    def test_iteritems_from_raw(self):
+        x = Tree()
+        for name, item in _TREE_ITEMS.items():
+            x[name] = item
+        t = Tree.from_string(x.as_raw_string())
+        self.assertEqual(_SORTED_TREE_ITEMS, list(t.iteritems()))
+        self.assertEqual(list(sorted_tree_items(_TREE_ITEMS, True)),
+                         list(t.iteritems(name_order=True)))
+        self.assertEqual(None, t._entries)
+
+    def test_modify_after_raw(self):
+        x = Tree()
+        x[b'a'] = (0o100644, a_sha)
+        t = Tree.from_string(x.as_raw_string())
+        t[b'b'] = (0o100644, b_sha)
+        self.assertEqual([(b'a', 0o100644, a_sha), (b'b', 0o100644, b_sha)],
+                         list(t.iteritems()))
+
+    def _compact_tree(self):
+        x = Tree()
+        x[b'a'] = (0o100644, a_sha)
+        x[b'a.c'] = (0o100644, b_sha)
+        x[b'a-b'] = (0o040000, c_sha)
+        x[b'b'] = (0o040000, b_sha)
+        x[b'b.c'] = (0o100644, a_sha)
+        t = Tree.from_string(x.as_raw_string())
+        self.assertTrue(t.compact())
+        return x, t
+
+    def test_compact(self):
+        x, t = self._compact_tree()
+        self.assertEqual(None, t._chunked_text)
+        self.assertEqual(x.items(), t.items())
+        self.assertEqual(list(x.iteritems(name_order=True)),
+                         list(t.iteritems(name_order=True)))
+        self.assertEqual(x.as_raw_string(), t.as_raw_string())
+        self.assertEqual(x.id, t.id)
+        self.assertEqual(5, len(t))
+        self.assertEqual(sorted(x), sorted(t))
+
+    def test_compact_keeps_id(self):
+        x, t = self._compact_tree()
+        expected = x.id
+        serialized = []
+        orig_serialize_tree = objects_mod.serialize_tree
+
+        def serialize_tree(items):
+            serialized.append(None)
+            return orig_serialize_tree(items)
+        objects_mod.serialize_tree = serialize_tree
+        self.addCleanup(setattr, objects_mod, 'serialize_tree',
+                        orig_serialize_tree)
+        self.assertEqual(expected, t.id)
+        self.assertEqual(expected, t.id)
+        self.assertEqual([], serialized)
+
+    def test_compact_modified(self):
+        t = Tree()
+        t[b'a'] = (0o100644, a_sha)
+        t.as_raw_string()
+        t[b'b'] = (0o100644, b_sha)
+        self.assertTrue(t.compact())
+        x = Tree()
+        x[b'a'] = (0o100644, a_sha)
+        x[b'b'] = (0o100644, b_sha)
+        self.assertEqual(x.id, t.id)
+
+    def test_compact_lookup(self):
+        x, t = self._compact_tree()
+        for name in x:
+            self.assertTrue(name in t)
+            self.assertEqual(x[name], t[name])
+        self.assertFalse(b'a/' in t)
+        self.assertFalse(b'c' in t)
+        self.assertRaises(KeyError, t.__getitem__, b'a-')
+        t.check()
+
+    def test_compact_lookup_trailing_slash(self):
+        x, t = self._compact_tree()
+        for name in (b'b/', b'a/', b'a-b/', b'b//'):
+            self.assertEqual(name in x, name in t)
+            self.assertFalse(name in t)
+            self.assertRaises(KeyError, t.__getitem__, name)
+            self.assertRaises(KeyError, t.__delitem__, name)
+        self.assertEqual(x.id, t.id)
+
+    def test_modify_after_compact(self):
+        x, t = self._compact_tree()
+        t[b'c'] = (0o100644, c_sha)
+        del t[b'a']
+        self.assertTrue(isinstance(t._entries, dict))
+        self.assertEqual(
+          [(b'a-b', 0o040000, c_sha), (b'a.c', 0o100644, b_sha),
+           (b'b.c', 0o100644, a_sha), (b'b', 0o040000, b_sha),
+           (b'c', 0o100644, c_sha)], t.items())
+        x[b'c'] = (0o100644, c_sha)
+        del x[b'a']
+        self.assertEqual(x.id, t.id)
+
+    def test_delete_missing_after_compact(self):
+        x, t = self._compact_tree()
+        self.assertRaises(KeyError, t.__delitem__, b'missing')
+        self.assertEqual(x.as_raw_string(), t.as_raw_string())
+        self.assertEqual(x.id, t.id)
+
+    def test_writable_after_compact(self):
+        x, t = self._compact_tree()
+        t._ensure_entries()
+        self.assertEqual(x.as_raw_string(), t.as_raw_string())
+        self.assertEqual(x.id, t.id)
+
+    def test_compact_unsorted(self):
+        t = Tree.from_string(b'100644 b\0' + b_sha.bytes +
+                             b'100644 a\0' + a_sha.bytes)
+        self.assertFalse(t.compact())
+        self.assertEqual(None, t._entries)
+
 
 class TagSerializeTests(TestCase):
 
@@ -799,6 +980,24 @@ class Sha1SumTests(TestCase):
 
         return (WrongShaA(), WrongShaB(), WrongShaC())
 
+    def test_from_raw(self):
+        s = Sha1Sum.from_raw(b'\x11' * 20)
+        self.assertEqual(s.bytes, b'\x11' * 20)
+        self.assertEqual(s.string, '1' * 40)
+        self.assertEqual(s.hex_bytes, b'1' * 40)
+        self.assertEqual(s, Sha1Sum('1' * 40))
+        self.assertEqual(hash(s), hash(Sha1Sum('1' * 40)))
+
+    def test_from_raw_intern_table(self):
+        table = {}
+        a = Sha1Sum.from_raw(b'\x11' * 20, table)
+        b = Sha1Sum.from_raw(b'\x11' * 20, table)
+        c = Sha1Sum.from_raw(b'\x22' * 20, table)
+        self.assertTrue(a is b)
+        self.assertFalse(a is c)
+        self.assertEqual(2, len(table))
+        self.assertFalse(a is Sha1Sum.from_raw(b'\x11' * 20))
+
     def test_invalid(self):
         wrong_a, wrong_b, wrong_c = self._make_invalid_shas()
         self.assertRaises(ObjectFormatException, Sha1Sum, 'Derp')
@@ -24,6 +24,7 @@ from io import BytesIO
 import os
 import shutil
 import tempfile
+import threading
 import zlib
 import hashlib
 
@@ -51,8 +52,10 @@ from dulwich.pack import (
     Pack,
     PackData,
     apply_delta,
+    compress_pack_records,
     create_delta,
     deltify_pack_objects,
+    deltify_thin_pack_objects,
     load_pack_index,
     UnpackedObject,
     read_zlib_chunks,
@@ -62,6 +65,8 @@ from dulwich.pack import (
     SHA1Writer,
     write_pack_object,
     write_pack,
+    write_pack_objects,
+    write_reused_pack_data,
     unpack_object,
     compute_file_sha,
     PackStreamReader,
@@ -121,6 +126,13 @@ class PackIndexTests(PackTests):
         self.assertEqual(p.object_index(tree_sha), 138)
         self.assertEqual(p.object_index(commit_sha), 12)
 
+    def test_object_position(self):
+        p = self.get_pack_index(pack1_sha)
+        self.assertEqual(None, p.object_position(pack1_sha))
+        for i, sha in enumerate(sorted([a_sha, tree_sha, commit_sha])):
+            self.assertEqual(i, p.object_position(sha))
+            self.assertEqual(sha, p.object_name(i))
+
     def test_index_len(self):
         p = self.get_pack_index(pack1_sha)
         self.assertEqual(3, len(p))
@@ -175,6 +187,28 @@ class TestPackDeltas(TestCase):
     def test_overflow(self):
         self._test_roundtrip(self.test_string_empty, self.test_string_big)
 
+    def test_large_change(self):
+        base = b''.join(b'line ' + str(i).encode('ascii') + b'\n'
+                        for i in range(10000))
+        target = base.replace(b'line 5000\n', b'new line\n')
+        self._test_roundtrip(base, target)
+        self.assertTrue(len(create_delta(base, target)) < 100)
+
+    def test_max_inserted(self):
+        base = b''.join(b'line ' + str(i).encode('ascii') + b'\n'
+                        for i in range(1000))
+        target = base.replace(b'line 500\n', b'new line\n')
+        self.assertEqual(create_delta(base, target),
+                         create_delta(base, target, max_inserted=20))
+        self.assertEqual(None, create_delta(base, target, max_inserted=5))
+        self.assertEqual(None, create_delta(base, b'x' * 1000,
+                                            max_inserted=500))
+
+    def test_long_copy(self):
+        base = bytes(bytearray(i % 251 for i in range(0x30000)))
+        self._test_roundtrip(base, b'x' + base + b'y')
+        self._test_roundtrip(base, base[0x12345:])
+
 
 class TestPackData(PackTests):
     """Tests getting the data from the packfile."""
@@ -241,6 +275,37 @@ class TestPackData(PackTests):
             idx2 = self.get_pack_index(pack1_sha)
             self.assertEqual(idx1, idx2)
 
+    def test_get_object_size(self):
+        with self.get_pack_data(pack1_sha) as p:
+            self.assertEqual(7, p.get_object_size(178))
+            self.assertEqual(len(b'100644 a\0') + 20, p.get_object_size(138))
+
+    def test_get_object_size_delta(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+          (Blob.type_num, b'blob'),
+          (OFS_DELTA, (0, b'blob1' * 100)),
+          (REF_DELTA, (0, b'blob2')),
+          ])
+        p = PackData('test.pack', file=f)
+        self.assertEqual([4, 500, 5],
+                         [p.get_object_size(e[0]) for e in entries])
+
+    def test_iter_raw_data(self):
+        path = os.path.join(self.datadir, 'pack-%s.pack' % pack1_sha)
+        with open(path, 'rb') as f:
+            contents = f.read()
+        with self.get_pack_data(pack1_sha) as p:
+            # The chunks are only valid until the next one is read.
+            self.assertEqual(contents, b''.join(
+              bytes(chunk) for chunk in p.iter_raw_data(chunk_size=100)))
+            self.assertEqual(contents[12:-20], b''.join(
+              bytes(chunk) for chunk in p.iter_raw_data(12, -20)))
+        # Without a file descriptor, the data is read.
+        p = PackData('test.pack', file=BytesIO(contents))
+        self.assertEqual(contents[12:-20],
+                         b''.join(p.iter_raw_data(12, -20, chunk_size=7)))
+
     def test_compute_file_sha(self):
         with BytesIO(b'abcd1234wxyz') as f:
             self.assertEqual(hashlib.sha1(b'abcd1234wxyz').hexdigest(),
@@ -274,6 +339,22 @@ class TestPack(PackTests):
         with self.get_pack(pack1_sha) as p:
             self.assertEqual(set([tree_sha, commit_sha, a_sha]), set(p))
 
+    def test_get_raw_threads(self):
+        with self.get_pack(pack1_sha) as p:
+            expected = dict((sha, p.get_raw(sha)) for sha in p)
+            results = []
+
+            def read():
+                for i in range(200):
+                    for sha in expected:
+                        results.append(expected[sha] == p.get_raw(sha))
+            threads = [threading.Thread(target=read) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual([True] * (4 * 200 * 3), results)
+
     def test_iterobjects(self):
         with self.get_pack(pack1_sha) as p:
             expected = set([p[s] for s in [commit_sha, tree_sha, a_sha]])
@@ -287,6 +368,11 @@ class TestPack(PackTests):
             self.assertEqual(expected, set(list(tuples)))
             self.assertEqual(3, len(tuples))
 
+    def test_get_object_size(self):
+        with self.get_pack(pack1_sha) as p:
+            self.assertEqual(7, p.get_object_size(a_sha))
+            self.assertRaises(KeyError, p.get_object_size, Sha1Sum('1' * 40))
+
     def test_get_object_at(self):
         """Tests random access for non-delta objects"""
         with self.get_pack(pack1_sha) as p:
@@ -317,6 +403,30 @@ class TestPack(PackTests):
                 new_checksum = newpack.index.get_stored_checksum()
                 self.assertTrue(wrong_version or orig_checksum == new_checksum)
 
+    def test_write_reused_pack_data(self):
+        with self.get_pack(pack1_sha) as origpack:
+            f = BytesIO()
+            self.assertEqual(origpack.get_stored_checksum(),
+                             write_reused_pack_data(f, origpack.data))
+            with open(origpack._data_path, 'rb') as orig_f:
+                self.assertEqual(orig_f.read(), f.getvalue())
+
+    def test_write_reused_pack_data_extra(self):
+        blob = make_object(Blob, data=b'extra blob')
+        records = [(blob.type_num, blob.sha().digest(), None,
+                    blob.as_raw_string())]
+        with self.get_pack(pack1_sha) as origpack:
+            f = BytesIO()
+            checksum = write_reused_pack_data(f, origpack.data, 1,
+                                              iter(records))
+            f.seek(0)
+            p = PackData('test.pack', file=f)
+            self.assertEqual(checksum, p.get_stored_checksum())
+            self.assertSucceeds(p.check)
+            self.assertEqual(
+              sorted(list(origpack) + [blob.id]),
+              sorted(Sha1Sum(entry[0]) for entry in p.iterentries()))
+
     def test_commit_obj(self):
         with self.get_pack(pack1_sha) as p:
             commit = p[commit_sha]
@@ -436,6 +546,45 @@ class WritePackTests(TestCase):
             sha_b.update(f.getvalue()[offset:])
             self.assertEqual(sha_a.digest(), sha_b.digest())
 
+    def make_records(self, count):
+        # Large enough to be compressed in several batches.
+        return [(Blob.type_num, b'%d' % i, None, os.urandom(100000))
+                for i in range(count)]
+
+    def test_compress_pack_records(self):
+        records = self.make_records(10)
+        expected = [r + (zlib.compress(r[3]),) for r in records]
+        self.assertEqual(expected,
+                         list(compress_pack_records(iter(records), 1)))
+        self.assertEqual(expected,
+                         list(compress_pack_records(iter(records), 4)))
+        self.assertEqual([], list(compress_pack_records(iter([]), 4)))
+
+    def test_compress_pack_records_error(self):
+        def records():
+            for record in self.make_records(5):
+                yield record
+            raise ValueError('bad record')
+        self.assertRaises(ValueError, list, compress_pack_records(records(),
+                                                                  4))
+
+    def test_compress_pack_records_close(self):
+        num_threads = threading.active_count()
+        records = compress_pack_records(iter(self.make_records(20)), 2)
+        next(records)
+        # The threads are stopped when not all records are consumed.
+        records.close()
+        self.assertEqual(num_threads, threading.active_count())
+
+    def test_write_pack_objects_threads(self):
+        objects = [(make_object(Blob, data=os.urandom(100000)), None)
+                   for i in range(10)]
+        f1 = BytesIO()
+        write_pack_objects(f1, objects, compression_threads=1)
+        f2 = BytesIO()
+        write_pack_objects(f2, objects, compression_threads=4)
+        self.assertEqual(f1.getvalue(), f2.getvalue())
+
 
 pack_checksum = Sha1Sum('721980e866af9a5f93ad674144e1459b8ba3e7b7')
 
@@ -474,6 +623,16 @@ class BaseTestPackIndexWriting(object):
             else:
                 self.assertTrue(actual_crc is None)
 
+    def test_object_position(self):
+        sha1 = Sha1Sum('6f670c0fb53f9463760b7295fbb814e965fb20c8')
+        sha2 = Sha1Sum('b2a2766a2879c209ab1176e7e778b81ae422eeaa')
+        idx = self.index('two.idx', [(sha1, 178, 42), (sha2, 200, 43)],
+                         pack_checksum)
+        self.assertEqual(0, idx.object_position(sha1))
+        self.assertEqual(1, idx.object_position(sha2))
+        self.assertEqual(None, idx.object_position(pack_checksum))
+        self.assertEqual(sha2, idx.object_name(1))
+
 
 class BaseTestFilePackIndexWriting(BaseTestPackIndexWriting):
 
@@ -643,6 +802,41 @@ class DeltifyTests(TestCase):
             ],
             list(deltify_pack_objects([(b1, b""), (b2, b"")])))
 
+    def test_thin(self):
+        base = Blob.from_string(b'a line of text\n' * 100)
+        b1 = Blob.from_string(b'a line of text\n' * 101)
+        b2 = Blob.from_string(b'unrelated')
+        bases = {b'b1': base, b'b2': base}
+        self.assertEqual([
+            (b1.type_num, b1.sha().digest(), base.sha().digest(),
+             create_delta(base.as_raw_string(), b1.as_raw_string())),
+            (b2.type_num, b2.sha().digest(), None, b2.as_raw_string()),
+            ],
+            list(deltify_thin_pack_objects(
+              [(b1, b'b1'), (b2, b'b2')],
+              lambda obj, path: bases.get(path))))
+
+    def test_thin_big_file(self):
+        base = Blob.from_string(b'a line of text\n' * 100)
+        b1 = Blob.from_string(b'a line of text\n' * 101)
+        self.assertEqual(
+            [(b1.type_num, b1.sha().digest(), None, b1.as_raw_string())],
+            list(deltify_thin_pack_objects(
+              [(b1, b'b1')], lambda obj, path: base,
+              big_file_threshold=1000)))
+
+    def test_write_pack_objects_thin(self):
+        base = Blob.from_string(b'a line of text\n' * 100)
+        b1 = Blob.from_string(b'a line of text\n' * 101)
+        f = BytesIO()
+        write_pack_objects(f, [(b1, b'b1')],
+                           get_delta_base=lambda obj, path: base)
+        f.seek(0)
+        data = PackData.from_file(f, len(f.getvalue()))
+        unpacked, = data.iterobjects()
+        self.assertEqual(REF_DELTA, unpacked[1])
+        self.assertEqual(base.sha().digest(), bytes(unpacked[2][0]))
+
 
 class TestPackStreamReader(TestCase):
 
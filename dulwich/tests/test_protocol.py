@@ -20,21 +20,31 @@
 
 
 from io import BytesIO
+import socket
 
 from dulwich.errors import (
+    GitProtocolError,
     HangupException,
     )
 from dulwich.protocol import (
+    DELIM_PKT,
+    RESPONSE_END_PKT,
+    PktLineBuffer,
     PktLineParser,
     Protocol,
     ReceivableProtocol,
     extract_capabilities,
     extract_want_line_capabilities,
+    extract_protocol_version,
     ack_type,
     SINGLE_ACK,
     MULTI_ACK,
     MULTI_ACK_DETAILED,
     BufferedPktLineWriter,
+    INCOMPLETE_PKT,
+    SidebandWriter,
+    pkt_line,
+    sendmsg_all,
     )
 from dulwich.tests import TestCase
 
@@ -82,6 +92,33 @@ class BaseProtocolTests(object):
         self.rin.seek(0)
         self.assertEqual(None, self.proto.read_pkt_line())
 
+    def test_read_pkt_line_special(self):
+        self.rin.write(b'000100020000')
+        self.rin.seek(0)
+        self.assertEqual(DELIM_PKT, self.proto.read_pkt_line())
+        self.assertEqual(RESPONSE_END_PKT, self.proto.read_pkt_line())
+        self.assertEqual(None, self.proto.read_pkt_line())
+
+    def test_read_pkt_line_invalid_length(self):
+        self.rin.write(b'0003')
+        self.rin.seek(0)
+        self.assertRaises(GitProtocolError, self.proto.read_pkt_line)
+
+    def test_read_pkt_line_invalid_prefix(self):
+        self.rin.write(b'zzzz')
+        self.rin.seek(0)
+        self.assertRaises(GitProtocolError, self.proto.read_pkt_line)
+
+    def test_read_pkt_line_truncated(self):
+        self.rin.allow_read_past_eof = True
+        self.rin.write(b'0008cm')
+        self.rin.seek(0)
+        self.assertRaises(HangupException, self.proto.read_pkt_line)
+
+    def test_write_pkt_line_delim(self):
+        self.proto.write_pkt_line(DELIM_PKT)
+        self.assertEqual(self.rout.getvalue(), b'0001')
+
     def test_write_sideband(self):
         self.proto.write_sideband(3, b'bloe')
         self.assertEqual(self.rout.getvalue(), b'0009\x03bloe')
@@ -115,6 +152,22 @@ class ProtocolTests(BaseProtocolTests, TestCase):
         self.proto = Protocol(self.rin.read, self.rout.write, _closeit)
         self.addCleanup(self.proto.close)
 
+class PartialBytesIO(BytesIO):
+    """BytesIO whose reads return at most a few bytes, like pipes."""
+
+    def read(self, size=-1):
+        return BytesIO.read(self, min(size, 3))
+
+
+class PartialReadProtocolTests(BaseProtocolTests, TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.rout = BytesIO()
+        self.rin = PartialBytesIO()
+        self.proto = Protocol(self.rin.read, self.rout.write, None)
+
+
 class ReceivableBytesIO(BytesIO):
     """BytesIO with socket-like recv semantics for testing."""
 
@@ -185,6 +238,38 @@ class ReceivableProtocolTests(BaseProtocolTests, TestCase):
         self.assertEqual(b'defg', self.proto.read(4))
         self.assertRaises(AssertionError, self.proto.recv, 10)
 
+    def test_read_pkt_lines_per_recv(self):
+        calls = []
+
+        def recv(size):
+            calls.append(size)
+            return self.rin.recv(size)
+        self.proto._recv = recv
+        self.proto._rbufsize = 64
+        self.rin.write(b'0008cmd 0005l0006ab0000' + b'PACK')
+        self.rin.seek(0)
+        self.assertEqual([b'cmd ', b'l', b'ab'],
+                         list(self.proto.read_pkt_seq()))
+        self.assertEqual([64], calls)
+        # The data after the pkt-lines was read ahead.
+        self.assertTrue(self.proto.has_buffered_data())
+        self.assertEqual(b'PACK', self.proto.recv(10))
+
+    def test_unread_pkt_line_buffered(self):
+        self.proto._rbufsize = 64
+        self.rin.write(b'0008cmd 0005l0000')
+        self.rin.seek(0)
+        self.assertEqual(b'cmd ', self.proto.read_pkt_line())
+        self.proto.unread_pkt_line(b'foo')
+        self.assertEqual([b'foo', b'l'], list(self.proto.read_pkt_seq()))
+
+    def test_read_all(self):
+        self.rin.allow_read_past_eof = True
+        self.rin.write(b'0008cmd ' + b'x' * 20)
+        self.rin.seek(0)
+        self.assertEqual(b'cmd ', self.proto.read_pkt_line())
+        self.assertEqual(b'x' * 20, self.proto.read())
+
     def test_mixed(self):
         # arbitrary non-repeating string
         all_data = ','.join(str(i) for i in range(100)).encode('utf-8')
@@ -228,6 +313,13 @@ class CapabilitiesTestCase(TestCase):
         self.assertEqual((b'want bla', [b'la']), extract_want_line_capabilities(b'want bla la\n'))
         self.assertEqual((b'want bla', [b'la', b'la']), extract_want_line_capabilities(b'want bla la la'))
 
+    def test_protocol_version(self):
+        self.assertEqual(0, extract_protocol_version(b''))
+        self.assertEqual(2, extract_protocol_version(b'version=2'))
+        self.assertEqual(2, extract_protocol_version(b'foo:version=1:version=2'))
+        self.assertEqual(2, extract_protocol_version([b'version=2', b'x=y']))
+        self.assertEqual(0, extract_protocol_version([b'version=two']))
+
     def test_ack_type(self):
         self.assertEqual(SINGLE_ACK, ack_type([b'foo', b'bar']))
         self.assertEqual(MULTI_ACK, ack_type([b'foo', b'bar', b'multi_ack']))
@@ -293,6 +385,111 @@ class BufferedPktLineWriterTests(TestCase):
         self._writer.flush()
         self.assertOutputEquals(b'0005z')
 
+    def test_write_after_flush(self):
+        self._writer.write(b'foo')
+        self._writer.flush()
+        self._truncate()
+        self._writer.write(b'foo')
+        self._writer.write(b'bar')
+        self.assertOutputEquals(b'')
+        self._writer.flush()
+        self.assertOutputEquals(b'0007foo0007bar')
+
+
+class SidebandWriterTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self._output = []
+        self._proto = Protocol(None, self._output.append, None)
+        self._writer = SidebandWriter(self._proto, 1, bufsize=4)
+
+    def test_write(self):
+        self._writer.write(b'foo')
+        self.assertEqual([], self._output)
+        self._writer.write(b'bar')
+        self.assertEqual([b'0009\x01foob'], self._output)
+        self._writer.flush()
+        self.assertEqual([b'0009\x01foob', b'0007\x01ar'], self._output)
+        self.assertEqual(6, self._writer.tell())
+
+    def test_flush_empty(self):
+        self._writer.flush()
+        self.assertEqual([], self._output)
+
+    def test_write_large(self):
+        self._writer.write(b'f')
+        self._writer.write(b'0123456789')
+        self._writer.write(b'abc')
+        self._writer.close()
+        self.assertEqual(
+          [pkt_line(b'\x01f012'), pkt_line(b'\x013456'),
+           pkt_line(b'\x01789a'), pkt_line(b'\x01bc')], self._output)
+
+    def test_write_data_reused(self):
+        data = bytearray(b'0123456789')
+        self._writer.write(data)
+        data[:] = b'abcdefghij'
+        self._writer.flush()
+        self.assertEqual(b''.join([pkt_line(b'\x010123'),
+                                   pkt_line(b'\x014567'),
+                                   pkt_line(b'\x0189')]),
+                         b''.join(self._output))
+
+    def test_writev(self):
+        calls = []
+        self._proto.writev = lambda buffers: calls.append(
+          b''.join(buffers))
+        self._writer.write(b'0123456789')
+        self.assertEqual([], self._output)
+        self.assertEqual([pkt_line(b'\x010123') + pkt_line(b'\x014567')],
+                         calls)
+        self._writer.flush()
+        self.assertEqual([pkt_line(b'\x0189')], self._output)
+
+    def test_report_activity(self):
+        activity = []
+        self._proto.report_activity = lambda size, kind: activity.append(
+          (size, kind))
+        self._writer.write(b'012345')
+        self._writer.flush()
+        self.assertEqual([(9, 'write'), (7, 'write')], activity)
+
+    def test_socket_error(self):
+        def write(data):
+            raise socket.error()
+        self._proto.write = write
+        self._writer.write(b'foo')
+        self.assertRaises(GitProtocolError, self._writer.flush)
+
+
+class SendmsgAllTests(TestCase):
+
+    class PartialSocket(object):
+
+        def __init__(self, max_size):
+            self.max_size = max_size
+            self.data = []
+            self.calls = 0
+
+        def sendmsg(self, buffers):
+            self.calls += 1
+            data = b''.join(bytes(b) for b in buffers)[:self.max_size]
+            self.data.append(data)
+            return len(data)
+
+    def test_sendmsg_all(self):
+        sock = self.PartialSocket(1024)
+        sendmsg_all(sock, [b'foo', b'bar', b'baz'])
+        self.assertEqual(b'foobarbaz', b''.join(sock.data))
+        self.assertEqual(1, sock.calls)
+
+    def test_partial(self):
+        sock = self.PartialSocket(4)
+        sendmsg_all(sock, [b'foo', b'', b'barbaz', b'q', b''])
+        self.assertEqual(b'foobarbazq', b''.join(sock.data))
+        self.assertEqual(3, sock.calls)
+
 
 class PktLineParserTests(TestCase):
 
@@ -318,3 +515,49 @@ class PktLineParserTests(TestCase):
         parser.parse(b"0005z0006aba")
         self.assertEqual(pktlines, [b"z", b"ab"])
         self.assertEqual(b"a", parser.get_tail())
+
+    def test_special(self):
+        pktlines = []
+        parser = PktLineParser(pktlines.append)
+        parser.parse(b"00010005z0002")
+        self.assertEqual(pktlines, [DELIM_PKT, b"z", RESPONSE_END_PKT])
+        self.assertRaises(GitProtocolError, parser.parse, b"0003")
+
+
+class PktLineBufferTests(TestCase):
+
+    def test_read_pkt(self):
+        rbuf = PktLineBuffer()
+        self.assertEqual((INCOMPLETE_PKT, 4), rbuf.read_pkt())
+        rbuf.feed(b'00')
+        self.assertEqual((INCOMPLETE_PKT, 2), rbuf.read_pkt())
+        rbuf.feed(b'08cm')
+        self.assertEqual((INCOMPLETE_PKT, 2), rbuf.read_pkt())
+        rbuf.feed(b'd 0000')
+        self.assertEqual((b'cmd ', 8), rbuf.read_pkt())
+        self.assertEqual((None, 4), rbuf.read_pkt())
+        self.assertEqual(0, len(rbuf))
+
+    def test_take(self):
+        rbuf = PktLineBuffer()
+        rbuf.feed(b'0005z')
+        rbuf.feed(b'abc')
+        self.assertEqual((b'z', 5), rbuf.read_pkt())
+        self.assertEqual(b'abc', rbuf.getvalue())
+        self.assertEqual(b'ab', rbuf.take(2))
+        self.assertEqual(b'c', rbuf.take(10))
+        self.assertEqual(b'', rbuf.getvalue())
+
+    def test_unread(self):
+        rbuf = PktLineBuffer()
+        rbuf.feed(b'0005z0005y')
+        self.assertEqual((b'z', 5), rbuf.read_pkt())
+        rbuf.unread(b'0005x')
+        self.assertEqual((b'x', 5), rbuf.read_pkt())
+        rbuf.unread(b'0006ww')
+        self.assertEqual(b'0006ww0005y', rbuf.getvalue())
+
+    def test_invalid(self):
+        rbuf = PktLineBuffer()
+        rbuf.feed(b'zzzz')
+        self.assertRaises(GitProtocolError, rbuf.read_pkt)
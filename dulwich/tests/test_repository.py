@@ -264,6 +264,18 @@ class RepositoryTests(TestCase):
             [e.commit.id for e in r.get_walker([Sha1Sum('2a72d929692c41d8554c07f6301757ba18a65d91')])],
             [Sha1Sum('2a72d929692c41d8554c07f6301757ba18a65d91')])
 
+    def test_shallow(self):
+        r = self._repo = open_repo('a.git')
+        parent = Sha1Sum('2a72d929692c41d8554c07f6301757ba18a65d91')
+        self.assertEqual(set(), r.get_shallow())
+        r.update_shallow([r.head()], None)
+        self.assertEqual(set([r.head()]), r.get_shallow())
+        gw = r.get_graph_walker()
+        self.assertEqual(r.head(), next(gw))
+        self.assertEqual(None, next(gw))
+        r.update_shallow([parent], [r.head()])
+        self.assertEqual(set([parent]), r.get_shallow())
+
     def test_linear_history(self):
         r = self._repo = open_repo('a.git')
         warnings.simplefilter("ignore", DeprecationWarning)
@@ -19,26 +19,58 @@
 """Tests for the smart protocol server."""
 
 from io import BytesIO
+import errno
 import os
+import shutil
+import signal
+import socket
+import struct
 import tempfile
+import threading
+import time
 
 from dulwich.errors import (
     GitProtocolError,
+    HangupException,
     NotGitRepository,
+    QueueTimeoutError,
     UnexpectedCommandError,
     )
+from dulwich.object_store import (
+    MemoryObjectStore,
+    ObjectFilter,
+    )
+from dulwich.pack import (
+    Pack,
+    PackData,
+    write_pack,
+    )
+from dulwich.protocol import (
+    DELIM_PKT,
+    ZERO_SHA,
+    Protocol,
+    ReceivableProtocol,
+    pkt_line,
+    )
 from dulwich.repo import (
+    DictRefsContainer,
     MemoryRepo,
     Repo,
     )
 from dulwich.server import (
+    AdmissionControl,
     Backend,
     DictBackend,
     FileSystemBackend,
     Handler,
     MultiAckGraphWalkerImpl,
     MultiAckDetailedGraphWalkerImpl,
+    PackCache,
+    PreForkingTCPGitServer,
+    RepoPool,
+    ThreadedTCPGitServer,
     _split_proto_line,
+    negotiate_protocol_version,
     serve_command,
     ProtocolGraphWalker,
     ReceivePackHandler,
@@ -47,6 +79,7 @@ from dulwich.server import (
     )
 from dulwich.tests import TestCase
 from dulwich.tests.utils import (
+    build_commit_graph,
     make_commit,
     )
 from dulwich.objects import (
@@ -163,6 +196,16 @@ class UploadPackHandlerTestCase(TestCase):
                          self._handler.proto.get_received_line(2))
         self.assertRaises(IndexError, self._handler.proto.get_received_line, 2)
 
+    def test_progress_str(self):
+        caps = self._handler.required_capabilities()
+        self._handler.set_client_capabilities(caps)
+        self._handler.progress('counting objects: 1\r')
+        self._handler.progress('counting objects: 1, done.\n')
+        self.assertEqual(b'counting objects: 1\r',
+                         self._handler.proto.get_received_line(2))
+        self.assertEqual(b'counting objects: 1, done.\n',
+                         self._handler.proto.get_received_line(2))
+
     def test_no_progress(self):
         caps = list(self._handler.required_capabilities()) + [b'no-progress']
         self._handler.set_client_capabilities(caps)
@@ -196,6 +239,545 @@ class UploadPackHandlerTestCase(TestCase):
         self.assertEqual({}, self._handler.get_tagged(refs, repo=self._repo))
 
 
+class UploadPackHandlerV2TestCase(TestCase):
+
+    def setUp(self):
+        super(UploadPackHandlerV2TestCase, self).setUp()
+        self._repo = MemoryRepo.init_bare([], {})
+        self._commits = build_commit_graph(self._repo.object_store,
+                                           [[1], [2, 1], [3, 2]])
+        self._repo.refs[b'refs/heads/master'] = self._commits[2].id
+        self._repo.refs[b'refs/heads/old'] = self._commits[0].id
+        self._repo.refs.set_symbolic_ref(b'HEAD', b'refs/heads/master')
+        self._backend = DictBackend({'/': self._repo})
+
+    def handle(self, *pkts):
+        inf = BytesIO()
+        outf = BytesIO()
+        in_proto = Protocol(None, inf.write, None)
+        for pkt in pkts:
+            in_proto.write_pkt_line(pkt)
+        inf.seek(0)
+        proto = Protocol(inf.read, outf.write, None)
+        UploadPackHandler(self._backend, ['/'], proto,
+                          protocol_version=2).handle()
+        outf.seek(0)
+        out_proto = Protocol(outf.read, None, None)
+        received = []
+        while not out_proto.eof():
+            received.append(out_proto.read_pkt_line())
+        return received
+
+    def handle_command(self, command, *args):
+        received = self.handle(b'command=' + command + b'\n', DELIM_PKT,
+                               *(args + (None,)))
+        self.assertEqual(b'version 2\n', received[0])
+        return received[received.index(None) + 1:]
+
+    def test_advertisement(self):
+        self.assertEqual(
+          [b'version 2\n', b'ls-refs\n', b'fetch=shallow filter\n', None],
+          self.handle())
+
+    def test_ls_refs(self):
+        master = self._commits[2].id.hex_bytes
+        received = self.handle_command(b'ls-refs', b'symrefs\n')
+        self.assertEqual(None, received[-1])
+        self.assertEqual(
+          [master + b' HEAD symref-target:refs/heads/master\n',
+           master + b' refs/heads/master\n',
+           self._commits[0].id.hex_bytes + b' refs/heads/old\n'],
+          sorted(received[:-1], key=lambda pkt: pkt[41:]))
+
+    def test_ls_refs_prefix(self):
+        self.assertEqual(
+          [self._commits[2].id.hex_bytes + b' refs/heads/master\n', None],
+          self.handle_command(b'ls-refs', b'ref-prefix refs/heads/ma\n'))
+        self.assertEqual([None], self.handle_command(
+          b'ls-refs', b'ref-prefix refs/tags/\n'))
+
+    def get_pack_count(self, pkts):
+        self.assertEqual(b'packfile\n', pkts[0])
+        data = b''.join(pkt[1:] for pkt in pkts[1:-1] if pkt[0] == 1)
+        self.assertEqual(b'PACK', data[:4])
+        return struct.unpack('>L', data[8:12])[0]
+
+    def test_fetch(self):
+        received = self.handle_command(
+          b'fetch', b'want ' + self._commits[2].id.hex_bytes + b'\n',
+          b'no-progress\n', b'done\n')
+        # Three commits, which share an empty tree
+        self.assertEqual(4, self.get_pack_count(received))
+        self.assertEqual(None, received[-1])
+        # The small pack fits in a single side-band packet.
+        self.assertEqual(3, len(received))
+
+    def test_fetch_acknowledgments(self):
+        received = self.handle_command(
+          b'fetch', b'want ' + self._commits[2].id.hex_bytes + b'\n',
+          b'have ' + self._commits[1].id.hex_bytes + b'\n',
+          b'have ' + FOUR.hex_bytes + b'\n', b'no-progress\n')
+        self.assertEqual(
+          [b'acknowledgments\n',
+           b'ACK ' + self._commits[1].id.hex_bytes + b'\n', b'ready\n',
+           DELIM_PKT], received[:4])
+        self.assertEqual(1, self.get_pack_count(received[4:]))
+
+    def test_fetch_not_ready(self):
+        received = self.handle_command(
+          b'fetch', b'want ' + self._commits[2].id.hex_bytes + b'\n',
+          b'have ' + FOUR.hex_bytes + b'\n', b'no-progress\n')
+        self.assertEqual([b'acknowledgments\n', b'NAK\n', None], received)
+
+    def test_fetch_deepen(self):
+        received = self.handle_command(
+          b'fetch', b'want ' + self._commits[2].id.hex_bytes + b'\n',
+          b'deepen 2\n', b'no-progress\n', b'done\n')
+        self.assertEqual(
+          [b'shallow-info\n',
+           b'shallow ' + self._commits[1].id.hex_bytes + b'\n', DELIM_PKT],
+          received[:3])
+        self.assertEqual(3, self.get_pack_count(received[3:]))
+
+    def test_fetch_deepen_relative(self):
+        received = self.handle_command(
+          b'fetch', b'want ' + self._commits[2].id.hex_bytes + b'\n',
+          b'have ' + self._commits[2].id.hex_bytes + b'\n',
+          b'shallow ' + self._commits[2].id.hex_bytes + b'\n',
+          b'deepen 1\n', b'deepen-relative\n', b'no-progress\n', b'done\n')
+        self.assertEqual(
+          [b'shallow-info\n',
+           b'shallow ' + self._commits[1].id.hex_bytes + b'\n',
+           b'unshallow ' + self._commits[2].id.hex_bytes + b'\n', DELIM_PKT],
+          received[:4])
+
+    def test_fetch_missing_want(self):
+        self.assertRaises(GitProtocolError, self.handle_command, b'fetch',
+                          b'want ' + FOUR.hex_bytes + b'\n', b'done\n')
+
+    def test_fetch_pack_cache(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self._backend.pack_cache = PackCache(path)
+        args = (b'fetch', b'want ' + self._commits[2].id.hex_bytes + b'\n',
+                b'no-progress\n', b'done\n')
+        received = self.handle_command(*args)
+        self.assertEqual(1, len(self._backend.pack_cache))
+
+        def find_missing_objects(*args, **kwargs):
+            raise AssertionError('pack generated again')
+        self._repo.object_store.find_missing_objects = find_missing_objects
+        cached = self.handle_command(*args)
+        self.assertEqual(4, self.get_pack_count(cached))
+        self.assertEqual(b''.join(pkt[1:] for pkt in received[1:-1]),
+                         b''.join(pkt[1:] for pkt in cached[1:-1]))
+
+    def test_fetch_pack_cache_deepen(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self._backend.pack_cache = PackCache(path)
+        self.handle_command(
+          b'fetch', b'want ' + self._commits[2].id.hex_bytes + b'\n',
+          b'deepen 2\n', b'no-progress\n', b'done\n')
+        self.assertEqual(0, len(self._backend.pack_cache))
+
+    def set_clone_pack(self, tip):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        store = self._repo.object_store
+        write_pack(os.path.join(path, 'pack'), store.iter_shas(
+          store.find_missing_objects([], [tip])))
+        pack = Pack(os.path.join(path, 'pack'))
+        self.addCleanup(pack.close)
+        store.find_clone_pack = lambda: (pack, [tip])
+        return pack
+
+    def get_pack_data(self, pkts):
+        self.assertEqual(b'packfile\n', pkts[0])
+        return b''.join(pkt[1:] for pkt in pkts[1:-1] if pkt[0] == 1)
+
+    def test_fetch_clone_pack(self):
+        pack = self.set_clone_pack(self._commits[1].id)
+        received = self.handle_command(
+          b'fetch', b'want ' + self._commits[2].id.hex_bytes + b'\n',
+          b'ofs-delta\n', b'no-progress\n', b'done\n')
+        data = self.get_pack_data(received)
+        # The objects of the clone pack are copied, followed by the third
+        # commit.
+        with open(pack._data_path, 'rb') as f:
+            contents = f.read()
+        self.assertEqual(contents[12:-20], data[12:len(contents) - 20])
+        pack_data = PackData('test.pack', file=BytesIO(data))
+        pack_data.check()
+        self.assertEqual(
+          sorted(list(pack) + [self._commits[2].id]),
+          sorted(Sha1Sum(entry[0]) for entry in pack_data.iterentries()))
+
+    def test_fetch_clone_pack_not_covered(self):
+        self.set_clone_pack(self._commits[2].id)
+        received = self.handle_command(
+          b'fetch', b'want ' + self._commits[1].id.hex_bytes + b'\n',
+          b'ofs-delta\n', b'no-progress\n', b'done\n')
+        self.assertEqual(3, self.get_pack_count(received))
+
+    def test_fetch_clone_pack_haves(self):
+        self.set_clone_pack(self._commits[1].id)
+        received = self.handle_command(
+          b'fetch', b'want ' + self._commits[2].id.hex_bytes + b'\n',
+          b'have ' + self._commits[0].id.hex_bytes + b'\n',
+          b'ofs-delta\n', b'no-progress\n', b'done\n')
+        self.assertEqual(2, self.get_pack_count(received))
+
+    def test_fetch_admission_control(self):
+        admission_control = AdmissionControl(max_running_per_repo=1)
+        self._backend.admission_control = admission_control
+        received = self.handle_command(
+          b'fetch', b'want ' + self._commits[2].id.hex_bytes + b'\n',
+          b'no-progress\n', b'done\n')
+        self.assertEqual(4, self.get_pack_count(received))
+        self.assertEqual(0, admission_control.stats()['running'])
+        self.assertEqual(1, admission_control.stats()['admitted'])
+
+    def test_fetch_admission_timeout(self):
+        admission_control = AdmissionControl(max_running_per_repo=1,
+                                             queue_timeout=0.01)
+        self._backend.admission_control = admission_control
+        admission_control.enter('/')
+        received = self.handle_command(
+          b'fetch', b'want ' + self._commits[2].id.hex_bytes + b'\n',
+          b'done\n')
+        self.assertEqual(
+          [b'packfile\n',
+           b'\x02waiting for the server, position 1 in queue\n',
+           b'\x03timed out waiting for the server to handle the request\n',
+           None], received)
+        self.assertEqual(1, admission_control.stats()['timeouts'])
+
+    def test_unknown_command(self):
+        self.assertRaises(GitProtocolError, self.handle_command, b'foo')
+
+    def test_negotiate_protocol_version(self):
+        self.assertEqual({'protocol_version': 2}, negotiate_protocol_version(
+          UploadPackHandler, [b'version=2']))
+        self.assertEqual({}, negotiate_protocol_version(
+          UploadPackHandler, [b'version=1']))
+        self.assertEqual({}, negotiate_protocol_version(
+          ReceivePackHandler, b'version=2'))
+
+
+class FailingRefsContainer(DictRefsContainer):
+    """DictRefsContainer that fails to write one ref."""
+
+    def __init__(self, refs, failing):
+        DictRefsContainer.__init__(self, refs)
+        self._failing = failing
+
+    def set_if_equals(self, name, old_ref, new_ref):
+        if name == self._failing:
+            raise OSError('cannot write %r' % name)
+        return DictRefsContainer.set_if_equals(self, name, old_ref, new_ref)
+
+
+class ReceivePackHandlerTestCase(TestCase):
+
+    def setUp(self):
+        super(ReceivePackHandlerTestCase, self).setUp()
+        self._commits = build_commit_graph(
+          MemoryObjectStore(), [[1], [2, 1], [3, 1]])
+        self._repo = MemoryRepo.init_bare(self._commits, {})
+        self._repo.refs = FailingRefsContainer({}, b'refs/heads/bad')
+        self._repo.object_store.add_thin_pack = lambda read, recv: None
+        self._updated = []
+        self._repo.update_commit_graph = self._updated.extend
+        backend = DictBackend({'/': self._repo})
+        self._handler = ReceivePackHandler(
+          backend, ['/'], ReceivableProtocol(BytesIO().read, None, None))
+
+    def test_apply_pack_updates_commit_graph(self):
+        status = self._handler._apply_pack([
+          (ZERO_SHA, self._commits[1].id, b'refs/heads/good'),
+          (ZERO_SHA, self._commits[2].id, b'refs/heads/bad'),
+          (self._commits[0].id, ZERO_SHA, b'refs/heads/gone')])
+        self.assertEqual((b'refs/heads/good', b'ok'), status[1])
+        self.assertEqual((b'refs/heads/bad', 'failed to write'), status[2])
+        self.assertEqual([self._commits[1].id], self._updated)
+
+    def test_apply_pack_commit_graph_locked(self):
+        def update_commit_graph(heads):
+            raise OSError(errno.EEXIST, 'commit-graph.lock exists')
+        self._repo.update_commit_graph = update_commit_graph
+        status = self._handler._apply_pack([
+          (ZERO_SHA, self._commits[1].id, b'refs/heads/good')])
+        self.assertEqual([(b'unpack', b'ok'), (b'refs/heads/good', b'ok')],
+                         status)
+        self.assertEqual(self._commits[1].id,
+                         self._repo.refs[b'refs/heads/good'])
+
+
+class AdmissionControlTests(TestCase):
+
+    def setUp(self):
+        super(AdmissionControlTests, self).setUp()
+        self.admission_control = AdmissionControl(max_running=2,
+                                                  max_running_per_repo=1)
+        self.reports = []
+        self.admitted = []
+
+    def enter_in_thread(self, key):
+        def enter():
+            self.admission_control.enter(
+              key, lambda position: self.reports.append((key, position)))
+            self.admitted.append(key)
+        thread = threading.Thread(target=enter)
+        thread.start()
+        self.addCleanup(thread.join)
+        return thread
+
+    def wait_reported(self, num):
+        while len(self.reports) < num:
+            time.sleep(0.001)
+
+    def test_enter(self):
+        self.admission_control.enter('/a')
+        self.admission_control.enter('/b')
+        stats = self.admission_control.stats()
+        self.assertEqual(2, stats['running'])
+        self.assertEqual({'/a': 1, '/b': 1}, stats['running_per_repo'])
+        self.admission_control.leave('/a')
+        self.admission_control.leave('/b')
+        stats = self.admission_control.stats()
+        self.assertEqual(0, stats['running'])
+        self.assertEqual(2, stats['admitted'])
+
+    def test_queue_per_repo(self):
+        self.admission_control.enter('/a')
+        thread = self.enter_in_thread('/a')
+        self.wait_reported(1)
+        self.assertEqual({'/a': 1},
+                         self.admission_control.stats()['queued_per_repo'])
+        # Other repositories are not held up.
+        self.admission_control.enter('/b')
+        self.admission_control.leave('/b')
+        self.assertEqual([], self.admitted)
+        self.admission_control.leave('/a')
+        thread.join()
+        self.assertEqual(['/a'], self.admitted)
+        self.assertEqual([('/a', 1)], self.reports)
+        self.assertTrue(self.admission_control.stats()['max_wait_time'] > 0)
+
+    def test_queue_fifo(self):
+        self.admission_control.enter('/a')
+        self.admission_control.enter('/b')
+        threads = []
+        for key in ['/c', '/d']:
+            threads.append(self.enter_in_thread(key))
+            self.wait_reported(len(threads))
+        self.admission_control.leave('/a')
+        threads[0].join()
+        self.assertEqual(['/c'], self.admitted)
+        # The second request moves up when the first is admitted.
+        self.wait_reported(3)
+        self.assertEqual([('/c', 1), ('/d', 2), ('/d', 1)], self.reports)
+        self.admission_control.leave('/b')
+        threads[1].join()
+        self.assertEqual(['/c', '/d'], self.admitted)
+
+    def test_timeout(self):
+        self.admission_control.queue_timeout = 0.01
+        self.admission_control.enter('/a')
+        self.assertRaises(QueueTimeoutError, self.admission_control.enter,
+                          '/a')
+        stats = self.admission_control.stats()
+        self.assertEqual(0, stats['queued'])
+        self.assertEqual(1, stats['timeouts'])
+
+    def test_report_error(self):
+        self.admission_control.enter('/a')
+        def report(position):
+            raise HangupException()
+        self.assertRaises(HangupException, self.admission_control.enter,
+                          '/a', report)
+        self.assertEqual(0, self.admission_control.stats()['queued'])
+
+
+class PackCacheTests(TestCase):
+
+    def setUp(self):
+        super(PackCacheTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.generated = []
+
+    def send(self, cache, key, data):
+        def generate(write):
+            self.generated.append(key)
+            for chunk in data:
+                write(chunk)
+        out = []
+        cache.send(key, generate, out.append)
+        return b''.join(out)
+
+    def test_send(self):
+        cache = PackCache(self.path)
+        self.assertEqual(b'foobar', self.send(cache, 'a', [b'foo', b'bar']))
+        self.assertEqual(b'foobar', self.send(cache, 'a', [b'baz']))
+        self.assertEqual(['a'], self.generated)
+        self.assertEqual(b'baz', self.send(cache, 'b', [b'baz']))
+        self.assertEqual(['a', 'b'], self.generated)
+
+    def test_existing(self):
+        self.send(PackCache(self.path), 'a', [b'foo'])
+        self.assertEqual(b'foo', self.send(PackCache(self.path), 'a',
+                                           [b'bar']))
+        self.assertEqual(['a'], self.generated)
+
+    def test_not_cached(self):
+        cache = PackCache(self.path)
+        self.send(cache, 'a', [])
+
+        def generate(write):
+            write(b'foo')
+            raise GitProtocolError('client went away')
+        self.assertRaises(GitProtocolError, cache.send, 'b', generate,
+                          lambda data: None)
+        self.assertEqual(0, len(cache))
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_removes_orphaned_tmp_files(self):
+        if not hasattr(os, 'fork'):
+            self.skipTest('os.fork is not available')
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        for name in ('%d-a.tmp' % os.getpid(), '%d-b.tmp' % pid, 'c.tmp'):
+            with open(os.path.join(self.path, name), 'wb') as f:
+                f.write(b'foo')
+        PackCache(self.path)
+        # The files of running processes may be packs that are being
+        # generated.
+        self.assertEqual(['%d-a.tmp' % os.getpid()], os.listdir(self.path))
+
+    def test_max_size(self):
+        cache = PackCache(self.path, max_size=5)
+        self.send(cache, 'a', [b'foo'])
+        self.send(cache, 'b', [b'bar'])
+        self.assertEqual(['b.pack'], os.listdir(self.path))
+        self.send(cache, 'a', [b'foo'])
+        self.assertEqual(['a', 'b', 'a'], self.generated)
+
+    def test_max_age(self):
+        cache = PackCache(self.path, max_age=-1)
+        self.send(cache, 'a', [b'foo'])
+        self.assertEqual(b'bar', self.send(cache, 'a', [b'bar']))
+        self.assertEqual(['a', 'a'], self.generated)
+
+    def test_in_flight(self):
+        cache = PackCache(self.path)
+        started = threading.Event()
+        finish = threading.Event()
+
+        def generate(write):
+            self.generated.append('a')
+            write(b'foo')
+            started.set()
+            finish.wait()
+            write(b'bar')
+        out1 = []
+        thread = threading.Thread(target=cache.send,
+                                  args=('a', generate, out1.append))
+        thread.start()
+        started.wait()
+        threading.Timer(0.1, finish.set).start()
+        # Waits for the pack that is being generated.
+        self.assertEqual(b'foobar', self.send(cache, 'a', [b'baz']))
+        thread.join()
+        self.assertEqual(b'foobar', b''.join(out1))
+        self.assertEqual(['a'], self.generated)
+
+    def start_in_flight(self, cache, generate, write):
+        """Start generating a pack in a thread, once it has written foo."""
+        started = threading.Event()
+        self.errors = []
+
+        def generate_and_signal(write):
+            write(b'foo')
+            started.set()
+            generate(write)
+
+        def send():
+            try:
+                cache.send('a', generate_and_signal, write)
+            except GitProtocolError as e:
+                self.errors.append(e)
+        thread = threading.Thread(target=send)
+        thread.start()
+        started.wait()
+        return thread
+
+    def test_in_flight_keepalive(self):
+        cache = PackCache(self.path, keepalive_interval=0.01)
+        finish = threading.Event()
+        out1 = []
+        thread = self.start_in_flight(
+          cache, lambda write: (finish.wait(), write(b'bar')), out1.append)
+        self.addCleanup(finish.set)
+        out2 = []
+        keepalives = []
+
+        def keepalive():
+            # Gets the data that is there while waiting for the rest.
+            self.assertEqual([b'foo'], out2)
+            keepalives.append(None)
+            finish.set()
+        cache.send('a', None, out2.append, keepalive)
+        thread.join()
+        self.assertEqual(b'foobar', b''.join(out1))
+        self.assertEqual(b'foobar', b''.join(out2))
+        self.assertEqual([None], keepalives)
+
+    def test_in_flight_first_client_gone(self):
+        cache = PackCache(self.path, keepalive_interval=0.01)
+        finish = threading.Event()
+
+        def write(data):
+            if data == b'bar':
+                raise GitProtocolError('client went away')
+
+        def generate(write):
+            finish.wait()
+            write(b'bar')
+            write(b'baz')
+        thread = self.start_in_flight(cache, generate, write)
+        # The pack is still generated for the waiting request and cached.
+        out = []
+        cache.send('a', None, out.append, finish.set)
+        thread.join()
+        self.assertEqual(b'foobarbaz', b''.join(out))
+        self.assertEqual(1, len(self.errors))
+        self.assertEqual(b'foobarbaz', self.send(cache, 'a', [b'qux']))
+
+    def test_in_flight_failed(self):
+        cache = PackCache(self.path, keepalive_interval=0.01)
+        finish = threading.Event()
+
+        def generate(write):
+            finish.wait()
+            raise GitProtocolError('client went away')
+        thread = self.start_in_flight(cache, generate, lambda data: None)
+        self.assertRaises(GitProtocolError, cache.send, 'a', None,
+                          lambda data: None, finish.set)
+        thread.join()
+        self.assertEqual(1, len(self.errors))
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_removes_temporary_files(self):
+        with open(os.path.join(self.path, 'tmpabc.tmp'), 'wb') as f:
+            f.write(b'foo')
+        self.send(PackCache(self.path), 'a', [b'foo'])
+        self.assertEqual(['a.pack'], os.listdir(self.path))
+
+
 class TestUploadPackHandler(UploadPackHandler):
     @classmethod
     def required_capabilities(self):
@@ -223,20 +805,20 @@ class ProtocolGraphWalkerTestCase(TestCase):
             TestUploadPackHandler(backend, ['/', 'host=lolcats'], TestProto()),
             self._repo.object_store, self._repo.get_peeled)
 
-    def test_is_satisfied_no_haves(self):
-        self.assertFalse(self._walker._is_satisfied([], ONE, 0))
-        self.assertFalse(self._walker._is_satisfied([], TWO, 0))
-        self.assertFalse(self._walker._is_satisfied([], THREE, 0))
+    def test_all_wants_satisfied_no_haves(self):
+        self._walker.set_wants([ONE, TWO, THREE])
+        self.assertFalse(self._walker.all_wants_satisfied([]))
 
-    def test_is_satisfied_have_root(self):
-        self.assertTrue(self._walker._is_satisfied([ONE], ONE, 0))
-        self.assertTrue(self._walker._is_satisfied([ONE], TWO, 0))
-        self.assertTrue(self._walker._is_satisfied([ONE], THREE, 0))
+    def test_all_wants_satisfied_have_root(self):
+        self._walker.set_wants([ONE, TWO, THREE])
+        self.assertTrue(self._walker.all_wants_satisfied([ONE]))
 
-    def test_is_satisfied_have_branch(self):
-        self.assertTrue(self._walker._is_satisfied([TWO], TWO, 0))
+    def test_all_wants_satisfied_have_branch(self):
+        self._walker.set_wants([TWO])
+        self.assertTrue(self._walker.all_wants_satisfied([TWO]))
         # wrong branch
-        self.assertFalse(self._walker._is_satisfied([TWO], THREE, 0))
+        self._walker.set_wants([THREE])
+        self.assertFalse(self._walker.all_wants_satisfied([TWO]))
 
     def test_all_wants_satisfied(self):
         self._walker.set_wants([FOUR, FIVE])
@@ -248,6 +830,16 @@ class ProtocolGraphWalkerTestCase(TestCase):
         self.assertFalse(self._walker.all_wants_satisfied([THREE]))
         self.assertTrue(self._walker.all_wants_satisfied([TWO, THREE]))
 
+    def test_add_common(self):
+        self._walker.set_wants([FOUR, FIVE])
+        self.assertFalse(self._walker.add_common(FOUR))
+        self.assertFalse(self._walker.add_common(TWO))
+        self.assertTrue(self._walker.add_common(ONE))
+        # New wants start over.
+        self._walker.set_wants([FIVE])
+        self.assertFalse(self._walker.add_common(TWO))
+        self.assertTrue(self._walker.add_common(THREE))
+
     def test_split_proto_line(self):
         allowed = (b'want', b'done', None)
         self.assertEqual((b'want', ONE),
@@ -292,6 +884,113 @@ class ProtocolGraphWalkerTestCase(TestCase):
         self._walker.proto.set_output([b'want ' + FOUR.hex_bytes + b' multi_ack'])
         self.assertRaises(GitProtocolError, self._walker.determine_wants, heads)
 
+    def test_split_proto_line_shallow(self):
+        allowed = (b'shallow', b'deepen', b'deepen-since', b'deepen-not')
+        self.assertEqual((b'shallow', ONE), _split_proto_line(
+          b'shallow ' + ONE.hex_bytes + b'\n', allowed))
+        self.assertEqual((b'deepen', 2),
+                         _split_proto_line(b'deepen 2\n', allowed))
+        self.assertEqual((b'deepen-since', 333),
+                         _split_proto_line(b'deepen-since 333\n', allowed))
+        self.assertEqual((b'deepen-not', b'refs/heads/ref4'),
+                         _split_proto_line(b'deepen-not refs/heads/ref4\n',
+                                           allowed))
+        self.assertRaises(GitProtocolError, _split_proto_line,
+                          b'deepen x\n', allowed)
+
+    def _deepen(self, *lines):
+        heads = {
+          b'refs/heads/ref4': FOUR,
+          b'refs/heads/ref5': FIVE,
+          }
+        self._repo.refs._update(heads)
+        self._walker.proto.set_output([
+          b'want ' + FOUR.hex_bytes + b' multi_ack shallow',
+          b'want ' + FIVE.hex_bytes] + list(lines))
+        self.assertEqual([FOUR, FIVE], self._walker.determine_wants(heads))
+        # Skip the advertisement.
+        while self._walker.proto.get_received_line() is not None:
+            pass
+        received = []
+        while True:
+            line = self._walker.proto.get_received_line()
+            if line is None:
+                return received
+            received.append(line.rstrip())
+
+    def test_deepen(self):
+        self.assertEqual(
+          [b'shallow ' + TWO.hex_bytes, b'shallow ' + THREE.hex_bytes],
+          self._deepen(b'deepen 2'))
+        self.assertEqual(set([TWO, THREE]), self._walker.shallow)
+        self.assertEqual(set(), self._walker.unshallow)
+
+    def test_deepen_unshallow(self):
+        self.assertEqual(
+          [b'shallow ' + TWO.hex_bytes, b'unshallow ' + FOUR.hex_bytes],
+          self._deepen(b'shallow ' + FOUR.hex_bytes,
+                       b'shallow ' + THREE.hex_bytes, b'deepen 2'))
+        self.assertEqual(set([TWO, THREE]), self._walker.shallow)
+        self.assertEqual(set([FOUR]), self._walker.unshallow)
+        self.assertEqual(set([THREE, FOUR]), self._walker.client_shallow)
+
+    def test_deepen_since(self):
+        self.assertEqual(
+          [b'shallow ' + TWO.hex_bytes, b'shallow ' + THREE.hex_bytes],
+          self._deepen(b'deepen-since 200'))
+
+    def test_deepen_not(self):
+        # FOUR is wanted but excluded itself, so it is sent without history.
+        self.assertEqual(
+          [b'shallow ' + THREE.hex_bytes, b'shallow ' + FOUR.hex_bytes],
+          self._deepen(b'deepen-not refs/heads/ref4'))
+        self.assertEqual(set([THREE, FOUR]), self._walker.shallow)
+
+    def test_deepen_invalid(self):
+        self.assertRaises(GitProtocolError, self._deepen,
+                          b'deepen-not refs/heads/unknown')
+        self.assertRaises(GitProtocolError, self._deepen, b'deepen 0')
+        self.assertRaises(GitProtocolError, self._deepen, b'deepen 1',
+                          b'deepen-since 200')
+
+    def test_split_proto_line_filter(self):
+        self.assertEqual((b'filter', b'blob:limit=1k'),
+                         _split_proto_line(b'filter blob:limit=1k\n',
+                                           (b'filter',)))
+
+    def test_filter(self):
+        heads = {b'refs/heads/ref4': FOUR}
+        self._repo.refs._update(heads)
+        self._walker.proto.set_output([
+          b'want ' + FOUR.hex_bytes + b' multi_ack filter',
+          b'filter tree:1'])
+        self.assertEqual([FOUR], self._walker.determine_wants(heads))
+        self.assertEqual(ObjectFilter(tree_depth=1),
+                         self._walker.object_filter)
+
+    def test_filter_invalid(self):
+        heads = {b'refs/heads/ref4': FOUR}
+        self._repo.refs._update(heads)
+        self._walker.proto.set_output([
+          b'want ' + FOUR.hex_bytes + b' multi_ack filter',
+          b'filter sparse:oid=1234'])
+        self.assertRaises(GitProtocolError, self._walker.determine_wants,
+                          heads)
+
+    def test_shallow_without_deepen(self):
+        heads = {b'refs/heads/ref4': FOUR}
+        self._repo.refs._update(heads)
+        self._walker.proto.set_output([
+          b'want ' + FOUR.hex_bytes + b' multi_ack shallow',
+          b'shallow ' + TWO.hex_bytes])
+        self.assertEqual([FOUR], self._walker.determine_wants(heads))
+        # Only the advertisement is sent.
+        self.assertEqual(
+          [FOUR.hex_bytes + b' refs/heads/ref4', None],
+          [l and l.split(b'\x00')[0] for l in self._walker.proto._received[0]])
+        self.assertEqual(set([TWO]), self._walker.shallow)
+        self.assertEqual(set([TWO]), self._walker.client_shallow)
+
     def test_determine_wants_advertisement(self):
         self._walker.proto.set_output([])
         # advertise branch tips plus tag
@@ -353,6 +1052,9 @@ class TestProtocolGraphWalker(object):
     def all_wants_satisfied(self, haves):
         return self.done
 
+    def add_common(self, have):
+        return self.done
+
     def pop_ack(self):
         if not self.acks:
             return None
@@ -667,6 +1369,245 @@ class FileSystemBackendTests(TestCase):
         self.assertRaises(NotGitRepository,
             self.backend.open_repository, os.path.join(self.path, "foo"))
 
+    def test_release_repository(self):
+        repo = self.backend.open_repository(self.path)
+        repo.object_store.packs
+        self.backend.release_repository(repo)
+        # The repository is kept open for the next request.
+        self.assertNotEqual(None, repo.object_store._pack_cache)
+        self.assertTrue(repo is self.backend.open_repository(self.path))
+        self.backend.release_repository(repo)
+        self.backend.close()
+        self.assertEqual(None, repo.object_store._pack_cache)
+
+    def test_release_repository_unpooled(self):
+        backend = FileSystemBackend(RepoPool(max_repos=0))
+        repo = backend.open_repository(self.path)
+        repo.object_store.packs
+        backend.release_repository(repo)
+        self.assertEqual(None, repo.object_store._pack_cache)
+        self.assertEqual(0, len(backend.repo_pool))
+
+
+class RepoPoolTests(TestCase):
+
+    def setUp(self):
+        super(RepoPoolTests, self).setUp()
+        self.paths = []
+        for i in range(3):
+            path = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, path)
+            Repo.init_bare(path).close()
+            self.paths.append(path)
+        self.pool = RepoPool()
+        self.addCleanup(self.pool.close)
+
+    def use(self, path):
+        repo = self.pool.acquire(path)
+        repo.object_store.packs
+        self.pool.release(repo)
+        return repo
+
+    def assertClosed(self, repo):
+        self.assertEqual(None, repo.object_store._pack_cache)
+
+    def assertOpen(self, repo):
+        self.assertNotEqual(None, repo.object_store._pack_cache)
+
+    def test_reuse(self):
+        repo = self.use(self.paths[0])
+        self.assertTrue(repo is self.use(self.paths[0]))
+        self.assertOpen(repo)
+        self.assertNotEqual(None, repo.object_store.object_cache)
+        self.assertEqual(1, len(self.pool))
+
+    def test_object_cache_disabled(self):
+        pool = RepoPool(object_cache=False)
+        repo = pool.acquire(self.paths[0])
+        self.assertEqual(None, repo.object_store.object_cache)
+        pool.release(repo)
+        pool.close()
+
+    def test_nonexistant(self):
+        self.assertRaises(NotGitRepository, self.pool.acquire,
+                          os.path.join(self.paths[0], 'foo'))
+        self.assertEqual(0, len(self.pool))
+
+    def test_packed_refs_changed(self):
+        repo = self.use(self.paths[0])
+        with open(os.path.join(self.paths[0], 'packed-refs'), 'wb') as f:
+            f.write(b'# pack-refs with: peeled\n')
+        new_repo = self.use(self.paths[0])
+        self.assertFalse(repo is new_repo)
+        self.assertClosed(repo)
+        self.assertOpen(new_repo)
+
+    def test_changed_in_use(self):
+        repo = self.pool.acquire(self.paths[0])
+        repo.object_store.packs
+        os.mkdir(os.path.join(self.paths[0], 'objects', 'info', 'foo'))
+        new_repo = self.use(self.paths[0])
+        self.assertFalse(repo is new_repo)
+        # The old repository is closed once it is released.
+        self.assertOpen(repo)
+        self.pool.release(repo)
+        self.assertClosed(repo)
+        self.assertOpen(new_repo)
+
+    def test_max_repos(self):
+        self.pool.max_repos = 2
+        repos = [self.use(path) for path in self.paths]
+        self.assertEqual(2, len(self.pool))
+        self.assertClosed(repos[0])
+        self.assertOpen(repos[1])
+        self.assertOpen(repos[2])
+
+    def test_max_repos_in_use(self):
+        self.pool.max_repos = 1
+        repo = self.pool.acquire(self.paths[0])
+        repo.object_store.packs
+        other = self.use(self.paths[1])
+        # Repositories that are in use are not closed.
+        self.assertOpen(repo)
+        self.assertClosed(other)
+        self.pool.release(repo)
+        self.assertOpen(repo)
+
+    def test_max_memory(self):
+        self.pool.max_memory = 100
+        repo = self.pool.acquire(self.paths[0])
+        repo.object_store.packs
+        repo.object_store.add_object(make_commit())
+        repo.object_store.pack_loose_objects()
+        for sha in repo.object_store:
+            repo.object_store[sha]
+        self.assertTrue(repo.object_store.memory_size() > 100)
+        self.pool.release(repo)
+        self.assertClosed(repo)
+        self.assertEqual(0, len(self.pool))
+
+    def test_close(self):
+        repo = self.use(self.paths[0])
+        self.pool.close()
+        self.assertClosed(repo)
+        self.assertEqual(0, len(self.pool))
+
+
+class DictBackendTests(TestCase):
+    """Tests for DictBackend."""
+
+    def test_release_repository(self):
+        repo = Repo.init(tempfile.mkdtemp())
+        backend = DictBackend({'/': repo})
+        repo.object_store.packs
+        backend.release_repository(backend.open_repository('/'))
+        # The repository may still be in use by another request.
+        self.assertNotEqual(None, repo.object_store._pack_cache)
+        backend.close()
+        self.assertEqual(None, repo.object_store._pack_cache)
+
+
+class ThreadedTCPGitServerTests(TestCase):
+    """Tests for ThreadedTCPGitServer."""
+
+    server_class = ThreadedTCPGitServer
+
+    def setUp(self):
+        super(ThreadedTCPGitServerTests, self).setUp()
+        commit = make_commit(id=ONE, parents=[], commit_time=111)
+        self.backend = DictBackend({'/': MemoryRepo.init_bare(
+          [commit], {b'refs/heads/master': commit.id})})
+
+    def start_server(self, **kwargs):
+        server = self.server_class(self.backend, 'localhost', 0, **kwargs)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.addCleanup(stop)
+        return server.socket.getsockname()[1]
+
+    def connect(self, port):
+        """Request upload-pack and read the first line of the response."""
+        sock = socket.create_connection(('localhost', port))
+        self.addCleanup(sock.close)
+        sock.sendall(pkt_line(b'git-upload-pack /\0host=localhost\0'))
+        f = sock.makefile('rb')
+        self.addCleanup(f.close)
+        proto = Protocol(f.read, sock.sendall, None)
+        return proto, proto.read_pkt_line()
+
+    def assertAdvertisement(self, line):
+        self.assertEqual(ONE.hex_bytes + b' refs/heads/master',
+                         line.split(b'\0')[0])
+
+    def test_concurrent(self):
+        port = self.start_server(max_connections=2)
+        proto1, line1 = self.connect(port)
+        proto2, line2 = self.connect(port)
+        self.assertAdvertisement(line1)
+        self.assertAdvertisement(line2)
+
+    def test_busy(self):
+        port = self.start_server(max_connections=1, max_queued=0)
+        proto1, line1 = self.connect(port)
+        self.assertAdvertisement(line1)
+        proto2, line2 = self.connect(port)
+        self.assertEqual(b'ERR server is busy\n', line2)
+
+    def test_queued(self):
+        port = self.start_server(max_connections=1, max_queued=1)
+        proto1, line1 = self.connect(port)
+        self.assertAdvertisement(line1)
+        # Reading the second response waits for the first one to finish.
+        threading.Timer(0.1, proto1.write_pkt_line, (None,)).start()
+        proto2, line2 = self.connect(port)
+        self.assertAdvertisement(line2)
+
+    def test_queue_timeout(self):
+        port = self.start_server(max_connections=1, max_queued=1,
+                                 queue_timeout=0.1)
+        proto1, line1 = self.connect(port)
+        proto2, line2 = self.connect(port)
+        self.assertEqual(b'ERR timed out waiting for the server\n', line2)
+
+
+class PreForkingTCPGitServerTests(ThreadedTCPGitServerTests):
+    """Tests for PreForkingTCPGitServer."""
+
+    server_class = PreForkingTCPGitServer
+
+    def setUp(self):
+        super(PreForkingTCPGitServerTests, self).setUp()
+        if not hasattr(os, 'fork'):
+            self.skipTest('os.fork is not available')
+
+    def test_worker_replaced(self):
+        servers = []
+        server_class = self.server_class
+        self.server_class = lambda *args, **kwargs: (
+          servers.append(server_class(*args, **kwargs)) or servers[-1])
+        port = self.start_server(max_connections=1)
+        pid = servers[0]._processes[0][0]
+        os.kill(pid, signal.SIGKILL)
+        # The connection passed to the dead worker is lost, but the next
+        # one is handled by a new worker.
+        self.assertRaises(GitProtocolError, self.connect, port)
+        # The new worker does not keep this connection open once the client
+        # closes it, which would keep the server from shutting down.
+        proto, line = self.connect(port)
+        self.assertAdvertisement(line)
+        self.assertNotEqual(pid, servers[0]._processes[0][0])
+
+    def test_admission_control(self):
+        self.backend.admission_control = AdmissionControl()
+        self.assertRaises(ValueError, self.server_class, self.backend,
+                          'localhost', 0)
+
 
 class ServeCommandTests(TestCase):
     """Tests for serve_command."""
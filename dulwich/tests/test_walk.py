@@ -18,7 +18,14 @@
 
 """Tests for commit walking functionality."""
 
+from io import BytesIO
 from itertools import permutations
+from dulwich.commit_graph import (
+    CommitGraph,
+    compute_bloom_filters,
+    find_commit_graph_entries,
+    write_commit_graph,
+    )
 from dulwich.diff_tree import (
     CHANGE_ADD,
     CHANGE_MODIFY,
@@ -41,11 +48,13 @@ from dulwich.walk import (
     ORDER_TOPO,
     WalkEntry,
     Walker,
+    _TopoQueue,
     _topo_reorder
     )
 from dulwich.tests import TestCase
 from .utils import (
     F,
+    make_commit,
     make_object,
     build_commit_graph,
     )
@@ -389,6 +398,10 @@ class WalkerTest(TestCase):
         self.assertTopoOrderEqual([c2, c3, c1], [c2, c1, c3])
         self.assertTopoOrderEqual([c2, c3, c1], [c1, c2, c3])
 
+    def test_exclude_descendant(self):
+        c1, c2 = self.make_linear_commits(2)
+        self.assertWalkYields([], [c1.id], exclude=[c2.id])
+
     def test_out_of_order_children(self):
         c1, c2, c3, c4, c5 = self.make_commits(
           [[1], [2, 1], [3, 2], [4, 1], [5, 3, 4]],
@@ -409,3 +422,60 @@ class WalkerTest(TestCase):
         # Ensure that c1..y4 get excluded even though they're popped from the
         # priority queue long before y5.
         self.assertWalkYields([m6, x2], [m6.id], exclude=[y5.id])
+
+
+class CommitGraphWalkerTest(WalkerTest):
+    """Run the walker tests with a commit graph with Bloom filters."""
+
+    def make_commits(self, commit_spec, **kwargs):
+        commits = super(CommitGraphWalkerTest, self).make_commits(
+          commit_spec, **kwargs)
+        graph = self.store.commit_graph
+        entries = list(find_commit_graph_entries(
+          self.store, [c.id for c in commits], graph))
+        f = BytesIO()
+        write_commit_graph(f, entries,
+                           compute_bloom_filters(self.store, entries, graph))
+        self.store.commit_graph = CommitGraph(f.getvalue())
+        return commits
+
+    def test_paths_bloom_filter(self):
+        blob_a1 = make_object(Blob, data=b'a1')
+        blob_a2 = make_object(Blob, data=b'a2')
+        blob_b = make_object(Blob, data=b'b')
+        c1, c2, c3 = self.make_linear_commits(
+          3, trees={1: [('x/a', blob_a1)],
+                    2: [('x/a', blob_a1), ('y/b', blob_b)],
+                    3: [('x/a', blob_a2), ('y/b', blob_b)]})
+        walker = Walker(self.store, [c3.id], paths=[b'x/a'])
+        self.assertTrue(walker._maybe_changes_paths(c3))
+        self.assertFalse(walker._maybe_changes_paths(c2))
+        self.assertTrue(walker._maybe_changes_paths(c1))
+        self.assertEqual([c3, c1], [e.commit for e in walker])
+        # Filters are only used without rename detection.
+        walker = Walker(self.store, [c3.id], paths=[b'x/a'], follow=True)
+        self.assertEqual(None, walker._bloom_graph)
+
+    def test_topo_streams(self):
+        c1, c2, c3, c4, c5 = self.make_linear_commits(5)
+        walker = Walker(self.store, [c5.id], order=ORDER_TOPO, max_entries=2)
+        self.assertTrue(isinstance(walker._queue, _TopoQueue))
+        # Commits that are not returned are only looked up in the graph.
+        del self.store[c1.id]
+        del self.store[c2.id]
+        self.assertEqual([c5, c4], [e.commit for e in walker])
+
+    def test_topo_exclude(self):
+        c1, x2, y3, y4, m5 = self.make_commits(
+          [[1], [2, 1], [3, 1], [4, 3], [5, 2, 4]], times=[1, 4, 2, 3, 5])
+        self.assertWalkYields([m5, x2], [m5.id], exclude=[y4.id],
+                              order=ORDER_TOPO)
+        self.assertWalkYields([m5, y4, y3], [m5.id], exclude=[x2.id],
+                              order=ORDER_TOPO)
+
+    def test_topo_not_in_graph(self):
+        c1, c2, c3 = self.make_commits([[1], [2, 1], [3, 1]], times=[1, 2, 3])
+        c4 = make_commit(parents=[c2.id, c3.id], tree=c1.tree, commit_time=4)
+        self.store.add_object(c4)
+        self.assertFalse(c4.id in self.store.commit_graph)
+        self.assertWalkYields([c4, c3, c2, c1], [c4.id], order=ORDER_TOPO)
@@ -20,18 +20,30 @@
 
 from io import BytesIO
 import re
+import shutil
+import tempfile
+import threading
+from wsgiref.simple_server import (
+    WSGIServer,
+    make_server,
+    )
 
+from dulwich.client import (
+    HttpGitClient,
+    )
 from dulwich.object_store import (
     MemoryObjectStore,
     )
 from dulwich.objects import (
     Blob,
     Tag,
+    Tree,
     Sha1Sum,
     )
 from dulwich.repo import (
     BaseRepo,
     MemoryRepo,
+    Repo,
     )
 from dulwich.server import (
     DictBackend,
@@ -55,9 +67,11 @@ from dulwich.web import (
     _LengthLimitedFile,
     HTTPGitRequest,
     HTTPGitApplication,
+    HTTPGitRequestHandler,
     )
 
 from dulwich.tests.utils import (
+    make_commit,
     make_object,
     )
 
@@ -452,3 +466,38 @@ class HTTPGitApplicationTestCase(TestCase):
           'REQUEST_METHOD': 'GET',
           }
         self.assertEqual(b'output', self._app(environ, None))
+
+
+class HTTPGitApplicationFetchTestCase(TestCase):
+    """Fetches from an HTTPGitApplication with HttpGitClient."""
+
+    def setUp(self):
+        super(HTTPGitApplicationFetchTestCase, self).setUp()
+        tree = Tree()
+        self.parent = make_commit(tree=tree.id, parents=[], commit_time=111)
+        self.head = make_commit(tree=tree.id, parents=[self.parent.id],
+                                commit_time=222)
+        backend = DictBackend({'/': MemoryRepo.init_bare(
+          [tree, self.parent, self.head],
+          {b'refs/heads/master': self.head.id})})
+        server = make_server('localhost', 0, HTTPGitApplication(backend),
+                             server_class=WSGIServer,
+                             handler_class=HTTPGitRequestHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.addCleanup(stop)
+        self.url = 'http://localhost:%d/' % server.server_address[1]
+
+    def test_fetch_depth(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        target = Repo.init_bare(path)
+        HttpGitClient(self.url).fetch('/', target, depth=1)
+        self.assertEqual(set([self.head.id]), target.get_shallow())
+        self.assertTrue(self.head.id in target.object_store)
+        self.assertFalse(self.parent.id in target.object_store)
@@ -25,6 +25,10 @@ import collections
 import heapq
 import itertools
 
+from dulwich.commit_graph import (
+    bloom_filter_contains,
+    path_prefixes,
+    )
 from dulwich.diff_tree import (
     RENAME_CHANGE_TYPES,
     tree_changes,
@@ -85,19 +89,31 @@ class WalkEntry(object):
           self.commit.id, self.changes())
 
 
+def _new_object_set(store, iterable=()):
+    new_object_set = getattr(store, 'new_object_set', None)
+    if new_object_set is None:
+        return set(iterable)
+    return new_object_set(iterable)
+
+
 class _CommitTimeQueue(object):
-    """Priority queue of WalkEntry objects by commit time."""
+    """Priority queue of WalkEntry objects by commit time.
+
+    If the store has a commit graph, commit times and parents are read from
+    it, and only commits that are returned are read from the store.
+    """
 
     def __init__(self, walker):
         self._walker = walker
         self._store = walker.store
+        self._graph = getattr(walker.store, 'commit_graph', None)
         self._excluded = walker.excluded
         self._pq = []
         self._pq_set = set()
-        self._seen = set()
-        self._done = set()
+        self._seen = _new_object_set(self._store)
+        self._done = _new_object_set(self._store)
         self._min_time = walker.since
-        self._last = None
+        self._last_time = None
         self._extra_commits_left = _MAX_EXTRA_COMMITS
         self._is_finished = False
 
@@ -105,52 +121,67 @@ class _CommitTimeQueue(object):
             self._push(commit_id)
 
     def _push(self, commit_id):
-        try:
-            commit = self._store[commit_id]
-        except KeyError:
-            raise MissingCommitError(commit_id)
+        i = None
+        if self._graph is not None:
+            i = self._graph.position(commit_id)
+        if i is not None:
+            # The commit is only read if it is returned.
+            commit = None
+            commit_time = self._graph.commit_time_at(i)
+        else:
+            try:
+                commit = self._store[commit_id]
+            except KeyError:
+                raise MissingCommitError(commit_id)
+            commit_time = commit.commit_time
         if commit_id not in self._pq_set and commit_id not in self._done:
-            heapq.heappush(self._pq, (-commit.commit_time, commit))
+            heapq.heappush(self._pq, (-commit_time, commit_id, commit))
             self._pq_set.add(commit_id)
             self._seen.add(commit_id)
 
-    def _exclude_parents(self, commit):
+    def _get_parents(self, commit_id, commit=None):
+        if commit is None:
+            if self._graph is not None:
+                return self._store.get_parents(commit_id)
+            commit = self._store[commit_id]
+        return commit.parents
+
+    def _exclude_parents(self, commit_id, commit=None):
         excluded = self._excluded
         seen = self._seen
-        todo = [commit]
+        todo = [(commit_id, commit)]
         while todo:
-            commit = todo.pop()
-            for parent in commit.parents:
+            commit_id, commit = todo.pop()
+            for parent in self._get_parents(commit_id, commit):
                 if parent not in excluded and parent in seen:
-                    # TODO: This is inefficient unless the object store does
-                    # some caching (which DiskObjectStore currently does not).
-                    # We could either add caching in this class or pass around
-                    # parsed queue entry objects instead of commits.
-                    todo.append(self._store[parent])
+                    # This rereads commits that were already seen, which is
+                    # only cheap if the store has a commit graph or its object
+                    # cache is enabled (see BaseObjectStore.enable_object_cache).
+                    todo.append((parent, None))
                 excluded.add(parent)
 
     def __next__(self):
         if self._is_finished:
             return None
         while self._pq:
-            _, commit = heapq.heappop(self._pq)
-            sha = commit.id
+            neg_time, sha, commit = heapq.heappop(self._pq)
+            commit_time = -neg_time
             self._pq_set.remove(sha)
             if sha in self._done:
                 continue
-            self._done.add(commit.id)
+            self._done.add(sha)
 
-            for parent_id in commit.parents:
+            for parent_id in self._get_parents(sha, commit):
                 self._push(parent_id)
 
             reset_extra_commits = True
             is_excluded = sha in self._excluded
             if is_excluded:
-                self._exclude_parents(commit)
-                if self._pq and all(c.id in self._excluded
-                                    for _, c in self._pq):
-                    _, n = self._pq[0]
-                    if n.commit_time >= self._last.commit_time:
+                self._exclude_parents(sha, commit)
+                if self._pq and all(c in self._excluded
+                                    for _, c, _ in self._pq):
+                    if (self._last_time is not None and
+                        -self._pq[0][0] >= self._last_time):
                         # If the next commit is newer than the last one, we need
                         # to keep walking in case its parents (which we may not
                         # have seen yet) are excluded. This gives the excluded
@@ -161,7 +192,7 @@ class _CommitTimeQueue(object):
                         reset_extra_commits = False
 
             if (self._min_time is not None and
-                commit.commit_time < self._min_time):
+                commit_time < self._min_time):
                 # We want to stop walking at min_time, but commits at the
                 # boundary may be out of order with respect to their parents. So
                 # we walk _MAX_EXTRA_COMMITS more commits once we hit this
@@ -177,12 +208,162 @@ class _CommitTimeQueue(object):
                     break
 
             if not is_excluded:
-                self._last = commit
+                if commit is None:
+                    try:
+                        commit = self._store[sha]
+                    except KeyError:
+                        raise MissingCommitError(sha)
+                self._last_time = commit_time
                 return WalkEntry(self._walker, commit)
         self._is_finished = True
         return None
 
 
+class _TopoQueue(object):
+    """Queue of WalkEntry objects in topological order.
+
+    This uses generation numbers: the children of a commit all have a higher
+    generation than the commit itself. Children are counted by walking the
+    history in order of decreasing generation, only as deep as needed for
+    the commits that are about to be returned, so results are streamed
+    instead of being buffered. Commits whose children have all been returned
+    are returned newest first.
+
+    Generation numbers are read from the commit graph of the store, and
+    computed for commits that are not in it.
+    """
+
+    def __init__(self, walker):
+        self._walker = walker
+        self._store = walker.store
+        self._graph = walker.store.commit_graph
+        self._excluded = walker.excluded
+        self._positions = {}
+        self._generations = {}
+        self._indegrees = {}
+        self._indegree_queue = []
+        self._exclude_queue = []
+        self._ready = []
+
+        for commit_id in self._excluded:
+            heapq.heappush(self._exclude_queue,
+                           (-self._generation(commit_id), commit_id))
+        include = []
+        for commit_id in walker.include:
+            if commit_id not in self._indegrees:
+                self._indegrees[commit_id] = 1
+                heapq.heappush(self._indegree_queue,
+                               (-self._generation(commit_id), commit_id))
+                include.append(commit_id)
+        if include:
+            min_generation = min(self._generation(c) for c in include)
+            self._walk_to_generation(min_generation)
+        for commit_id in include:
+            if (self._indegrees[commit_id] == 1 and
+                commit_id not in self._excluded):
+                self._push_ready(commit_id)
+
+    def _lookup(self, commit_id):
+        """Return the graph position of a commit, or its parsed commit."""
+        if self._graph is not None:
+            try:
+                i = self._positions[commit_id]
+            except KeyError:
+                i = self._positions[commit_id] = self._graph.position(commit_id)
+            if i is not None:
+                return i, None
+        try:
+            return None, self._store[commit_id]
+        except KeyError:
+            raise MissingCommitError(commit_id)
+
+    def _parents(self, commit_id):
+        i, commit = self._lookup(commit_id)
+        if commit is None:
+            return self._graph.parents_at(i)
+        return commit.parents
+
+    def _generation(self, commit_id):
+        generation = self._generations.get(commit_id)
+        if generation is not None:
+            return generation
+        # Commits that are not in the commit graph get their generation
+        # computed from those of their parents.
+        todo = [commit_id]
+        while todo:
+            sha = todo[-1]
+            if sha in self._generations:
+                todo.pop()
+                continue
+            i, commit = self._lookup(sha)
+            if commit is None:
+                self._generations[sha] = self._graph.generation_at(i)
+                todo.pop()
+                continue
+            pending = [p for p in commit.parents if p not in self._generations]
+            if pending:
+                todo.extend(pending)
+                continue
+            todo.pop()
+            self._generations[sha] = 1 + max(
+              [self._generations[p] for p in commit.parents] or [0])
+        return self._generations[commit_id]
+
+    def _walk_to_generation(self, generation):
+        """Walk all commits that may be children of commits of a generation.
+
+        This counts the children of the commits they reach, and marks excluded
+        commits, so both are final for commits of that generation.
+        """
+        excluded = self._excluded
+        queue = self._exclude_queue
+        while queue and -queue[0][0] >= generation:
+            _, commit_id = heapq.heappop(queue)
+            for parent in self._parents(commit_id):
+                if parent not in excluded:
+                    excluded.add(parent)
+                    heapq.heappush(queue, (-self._generation(parent), parent))
+
+        indegrees = self._indegrees
+        queue = self._indegree_queue
+        while queue and -queue[0][0] >= generation:
+            _, commit_id = heapq.heappop(queue)
+            if commit_id in excluded:
+                continue
+            for parent in self._parents(commit_id):
+                if parent in indegrees:
+                    indegrees[parent] += 1
+                else:
+                    indegrees[parent] = 2
+                    heapq.heappush(queue, (-self._generation(parent), parent))
+
+    def _push_ready(self, commit_id):
+        i, commit = self._lookup(commit_id)
+        if commit is None:
+            commit_time = self._graph.commit_time_at(i)
+        else:
+            commit_time = commit.commit_time
+        heapq.heappush(self._ready, (-commit_time, commit_id, commit))
+
+    def __next__(self):
+        if not self._ready:
+            return None
+        _, commit_id, commit = heapq.heappop(self._ready)
+        for parent in self._parents(commit_id):
+            self._walk_to_generation(self._generation(parent))
+            if parent in self._excluded:
+                continue
+            self._indegrees[parent] -= 1
+            if self._indegrees[parent] == 1:
+                self._push_ready(parent)
+        if commit is None:
+            try:
+                commit = self._store[commit_id]
+            except KeyError:
+                raise MissingCommitError(commit_id)
+        return WalkEntry(self._walker, commit)
+
+
 class Walker(object):
     """Object for performing a walk of commits in a store.
 
@@ -202,7 +383,9 @@ class Walker(object):
         :param exclude: Iterable of SHAs of commits to exclude along with their
             ancestors, overriding includes.
         :param order: ORDER_* constant specifying the order of results. Anything
-            other than ORDER_DATE may result in O(n) memory usage.
+            other than ORDER_DATE may result in O(n) memory usage, unless the
+            store has a commit graph and since is not given; ORDER_TOPO then
+            streams results.
         :param reverse: If True, reverse the order of output, requiring O(n)
             memory.
         :param max_entries: The maximum number of entries to yield, or None for
@@ -224,7 +407,7 @@ class Walker(object):
             raise ValueError('Unknown walk order %s' % order)
         self.store = store
         self.include = include
-        self.excluded = set(exclude or [])
+        self.excluded = _new_object_set(store, exclude or [])
         self.order = order
         self.reverse = reverse
         self.max_entries = max_entries
@@ -236,6 +419,20 @@ class Walker(object):
         self.since = since
         self.until = until
 
+        # Changed-path Bloom filters only record the paths changed relative
+        # to the first parent, without rename detection.
+        self._bloom_graph = None
+        graph = getattr(store, 'commit_graph', None)
+        if (self.paths is not None and rename_detector is None and
+            graph is not None and graph.has_bloom_filters):
+            self._bloom_graph = graph
+            self._bloom_keys = [[graph.bloom_key(p) for p in path_prefixes(path)]
+                                for path in self.paths]
+
+        if (order == ORDER_TOPO and queue_cls is _CommitTimeQueue and
+            since is None and getattr(store, 'commit_graph', None) is not None):
+            queue_cls = _TopoQueue
+
         self._num_entries = 0
         self._queue = queue_cls(self)
         self._out_queue = collections.deque()
@@ -263,6 +460,22 @@ class Walker(object):
             return True
         return False
 
+    def _maybe_changes_paths(self, commit):
+        """Check the Bloom filters of the commit graph for a commit.
+
+        :return: False if the commit certainly does not change any of the
+            paths, True otherwise.
+        """
+        graph = self._bloom_graph
+        i = graph.position(commit.id)
+        if i is None:
+            return True
+        data = graph.bloom_filter_at(i)
+        for keys in self._bloom_keys:
+            if all(bloom_filter_contains(data, key) for key in keys):
+                return True
+        return False
+
     def _should_return(self, entry):
         """Determine if a walk entry should be returned..
 
@@ -281,6 +494,10 @@ class Walker(object):
         if self.paths is None:
             return True
 
+        if (self._bloom_graph is not None and
+            not self._maybe_changes_paths(commit)):
+            return None
+
         if len(commit.parents) > 1:
             for path_changes in entry.changes():
                 # For merge commits, only include changes with conflicts for
@@ -297,11 +514,17 @@ class Walker(object):
 
     def _next(self):
         max_entries = self.max_entries
+        # Excluded commits are known exactly in topological order, so there is
+        # no need to look ahead.
+        if isinstance(self._queue, _TopoQueue):
+            max_extra_commits = 0
+        else:
+            max_extra_commits = _MAX_EXTRA_COMMITS
         while max_entries is None or self._num_entries < max_entries:
             entry = next(self._queue)
             if entry is not None:
                 self._out_queue.append(entry)
-            if entry is None or len(self._out_queue) > _MAX_EXTRA_COMMITS:
+            if entry is None or len(self._out_queue) > max_extra_commits:
                 if not self._out_queue:
                     return None
                 entry = self._out_queue.popleft()
@@ -318,7 +541,7 @@ class Walker(object):
         :return: An iterator or list of WalkEntry objects, in the order required
             by the Walker.
         """
-        if self.order == ORDER_TOPO:
+        if self.order == ORDER_TOPO and not isinstance(self._queue, _TopoQueue):
             results = _topo_reorder(results)
         if self.reverse:
             results = reversed(list(results))
@@ -35,6 +35,7 @@ from dulwich.repo import (
 from dulwich.server import (
     DictBackend,
     DEFAULT_HANDLERS,
+    negotiate_protocol_version,
     )
 from dulwich.objects import (
     Sha1Sum
@@ -171,10 +172,16 @@ def get_info_refs(req, backend, mat):
         req.nocache()
         write = req.respond(HTTP_OK, 'application/x-%s-advertisement' % service)
         req2 = BytesIO()
+        kwargs = negotiate_protocol_version(
+          handler_cls, req.environ.get('HTTP_GIT_PROTOCOL', '').encode('ascii'))
         with ReceivableProtocol(req2.read, write, req2.close) as proto:
-            with handler_cls(backend, [url_prefix(mat)], proto, http_req=req, advertise_refs=True) as handler:
-                handler.proto.write_pkt_line(('# service=%s\n' % service).encode('utf-8'))
-                handler.proto.write_pkt_line(None)
+            with handler_cls(backend, [url_prefix(mat)], proto, http_req=req,
+                             advertise_refs=True, **kwargs) as handler:
+                # Like C git, only announce the service in protocol version
+                # 0; version 2 starts with the capabilities.
+                if not kwargs:
+                    handler.proto.write_pkt_line(('# service=%s\n' % service).encode('utf-8'))
+                    handler.proto.write_pkt_line(None)
                 handler.handle()
     else:
         # non-smart fallback
@@ -253,8 +260,11 @@ def handle_service_request(req, backend, mat):
     content_length = req.environ.get('CONTENT_LENGTH', '')
     if content_length:
         input = _LengthLimitedFile(input, int(content_length))
+    kwargs = negotiate_protocol_version(
+      handler_cls, req.environ.get('HTTP_GIT_PROTOCOL', '').encode('ascii'))
     with ReceivableProtocol(input.read, write, None) as proto:
-        with handler_cls(backend, [url_prefix(mat)], proto, http_req=req) as handler:
+        with handler_cls(backend, [url_prefix(mat)], proto, http_req=req,
+                         **kwargs) as handler:
             handler.handle()
 
 